@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+"""
+This script decides when the non-linear rounds of the atlas construction (nl_1 ... nl_4) stop improving the average, so the later rounds can be shortened or skipped.
+
+After round k is averaged, check compares the new average with the previous one (the lsq12 average for round 1) and every resampled specimen with the new
+average, within the atlas mask, by the cross-correlation of minccmp. The change of the average is 1 - xcorr(NL_k average, NL_k-1 average); the gain of the
+specimens is the increase of their mean cross-correlation with the average since the previous round. Once at least --min-rounds rounds are done and both fall
+below --threshold, the atlas has converged: the state written for round k says so, and every later round carries the transformations, resampled specimens,
+and average of round k over instead of registering again (see the skip commands of the nl rounds in Atlas_Pipeline.py). Below --shorten, the next round runs with a fraction of its
+minctracc iterations. The state (a JSON file in the Quality directory) keeps the metrics of every specimen.
+
+python3 Atlas_Convergence.py check --round <k> --average <NL_k average> --previous <NL_k-1 average> --mask <mask> --specimens <NL_k files> --state <state>
+                                   [--previous-state <state of round k-1>] [--threshold 0.002] [--shorten 0.006] [--min-rounds 2]
+python3 Atlas_Convergence.py converged <state>          (exit code 0 if the atlas converged at or before that round)
+python3 Atlas_Convergence.py iterations <state> <count> (the minctracc iterations of the next round)
+
+Dependencies required: minccmp of the MINC Toolkit (https://bic-mni.github.io/) on the PATH.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# Fraction of the minctracc iterations of a round that follows a round whose change fell below the shorten threshold.
+SHORTEN_FACTOR = 0.5
+
+
+def xcorr(mask, first, second):
+    # Cross-correlation of two volumes of the same grid within a mask.
+    output = subprocess.check_output(["minccmp", "-quiet", "-mask", mask, "-xcorr", first, second], universal_newlines=True)
+    return float(output.split()[0])
+
+
+def read_state(path):
+    if not path or not os.path.isfile(path):
+        return None
+    with open(path) as handle:
+        return json.load(handle, object_pairs_hook=OrderedDict)
+
+
+def workers():
+    # The CPUs SLURM gave the job, or every CPU outside of SLURM; minccmp is single-threaded and mostly reads.
+    return int(os.environ.get("SLURM_CPUS_ON_NODE", 0)) or os.cpu_count() or 1
+
+
+def check(round_, average, previous, mask, specimens, state_path, previous_state_path=None, threshold=0.002, shorten=0.006, min_rounds=2):
+    """
+    Measure round round_ and write its state. A previous state that already converged is copied forward (with this round's metrics for the record), so the
+    rounds after convergence stay carried over.
+    """
+    previous_state = read_state(previous_state_path)
+    with ThreadPoolExecutor(workers()) as pool:
+        change = pool.submit(lambda: 1.0 - xcorr(mask, average, previous))
+        scores = list(pool.map(lambda path: xcorr(mask, path, average), specimens))
+        change = change.result()
+    names = [os.path.basename(path)[:-len(".mnc")] for path in specimens]
+    mean = sum(scores) / len(scores)
+    gain = mean - previous_state["specimen_xcorr"] if previous_state else None
+    already = bool(previous_state and previous_state["converged"])
+    converged = already or (round_ >= min_rounds and change < threshold and (gain is None or gain < threshold))
+    factor = 1.0 if converged or change >= shorten else SHORTEN_FACTOR
+    state = OrderedDict([("round", round_), ("converged", converged), ("converged_round", previous_state["converged_round"] if already else
+                                                                      (round_ if converged else None)),
+                         ("average_change", round(change, 6)), ("specimen_xcorr", round(mean, 6)), ("specimen_gain", None if gain is None else round(gain, 6)),
+                         ("threshold", threshold), ("shorten", shorten), ("iterations_factor", factor),
+                         ("specimens", OrderedDict((name, round(score, 6)) for name, score in zip(names, scores)))])
+    with open(state_path, 'w') as handle:
+        json.dump(state, handle, indent=1)
+    print("Round " + str(round_) + ": average change " + "%.5f" % change + ", mean specimen xcorr " + "%.5f" % mean +
+          ("" if gain is None else " (" + "%+.5f" % gain + ")") + (", converged; later rounds are carried over." if converged else
+                                                                 (", shortening the next round." if factor < 1.0 else ".")))
+    return state
+
+
+def converged(state_path):
+    state = read_state(state_path)
+    return bool(state and state["converged"])
+
+
+def iterations(state_path, count):
+    # The iterations of the round after the state: count, or a fraction of it after a round that barely changed the average (never fewer than one).
+    state = read_state(state_path)
+    factor = state["iterations_factor"] if state else 1.0
+    return max(1, int(round(count * factor)))
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) == 3 and sys.argv[1] == "converged":
+        sys.exit(0 if converged(sys.argv[2]) else 1)
+    if len(sys.argv) == 4 and sys.argv[1] == "iterations":
+        print(iterations(sys.argv[2], int(sys.argv[3])))
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser(description="Measure the convergence of a non-linear atlas round.")
+    parser.add_argument('action', choices=['check'])
+    parser.add_argument('--round', type=int, required=True, help='Non-linear round (1 to 4)')
+    parser.add_argument('--average', required=True, help='Average of this round')
+    parser.add_argument('--previous', required=True, help='Average of the previous round (the lsq12 average for round 1)')
+    parser.add_argument('--mask', required=True, help='Mask on the grid of the averages')
+    parser.add_argument('--specimens', nargs='+', required=True, help='Resampled specimens of this round')
+    parser.add_argument('--state', required=True, help='State of this round (JSON)')
+    parser.add_argument('--previous-state', default=None, help='State of the previous round')
+    parser.add_argument('--threshold', type=float, default=0.002, help='Change of the average (1 - xcorr) and gain of the specimens below which the atlas converged')
+    parser.add_argument('--shorten', type=float, default=0.006, help='Change of the average below which the next round runs with fewer iterations')
+    parser.add_argument('--min-rounds', type=int, default=2, help='Rounds that always run')
+    args = parser.parse_args()
+
+    check(args.round, args.average, args.previous, args.mask, args.specimens, args.state, args.previous_state, args.threshold, args.shorten, args.min_rounds)
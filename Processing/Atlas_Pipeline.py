@@ -0,0 +1,618 @@
+#!/usr/bin/env python3
+
+"""
+This module describes the unbiased atlas construction (lsq6 -> lsq12 -> nl_1 ... nl_4) as a DAG of tasks (see Pipeline_DAG.py). It is shared by LoRes_Atlas.py and HiRes_Atlas.py, which only differ in their blurring kernels, registration strings, and cluster resources.
+
+The task names match the Bash (.sh) scripts the atlas generators have always written (lsq6_First.sh, lsq6_Second_1.sh, ..., nl_Ninth.sh). Per-specimen (and per-pair) stages are added as arrays, so they can also be written as SLURM job arrays (lsq6_Second_Array.sh, ...).
+"""
+
+import csv
+import json
+import os
+import random
+import re
+from collections import OrderedDict
+from types import SimpleNamespace
+
+from Intermediate_Lifecycle import plan as lifecycle_plan
+from Pipeline_DAG import Pipeline, Task
+from Resource_Model import estimated, read_history, size_pipeline, task_cost, task_size, volume_sizes, parse_mem
+
+# Script names of the non-linear rounds: (per-specimen registration stage, average stage).
+NL_STAGES = [("nl_Second", "nl_Third"), ("nl_Fourth", "nl_Fifth"), ("nl_Sixth", "nl_Seventh"), ("nl_Eighth", "nl_Ninth")]
+
+# Voxel size (um) of the images LoRes_Atlas.py was tuned for, and its kernels and registration parameters, which scaled_levels scales to other voxel sizes.
+# lsq6 and lsq12 levels are (fwhm, step, simplex), in mm; nl levels are (fwhm, step, simplex, iterations, lattice diameter).
+REFERENCE_RESOLUTION = 35.0
+REFERENCE_LSQ6 = [("0.352", "0.352", "0.78"), ("0.176", "0.176", "0.54"), ("0.078", "0.078", "0.32")]
+REFERENCE_LSQ12 = [("0.098", "0.098", "0.980"), ("0.064", "0.064", "0.490"), ("0.050", "0.050", "0.333")]
+REFERENCE_NL = [("1.4", "1.4", "3.5", "40", "4.2"), ("1.0", "1.0", "3.5", "20", "3.0"), ("0.7", "0.7", "3.5", "15", "2.1"), ("0.4", "0.4", "3.5", "15", "1.2")]
+
+
+def blur_tag(fwhm):
+    # Blurred files are named after the kernel size in microns (e.g., 0.352 -> 352, 0.078 -> 078, 1.4 -> 1400).
+    return "%03d" % round(float(fwhm) * 1000)
+
+
+def scale(value, factor):
+    # A length (mm) of the reference parameters at another voxel size, written with up to four decimals (e.g., 0.352 x 2 -> 0.704).
+    if factor == 1:
+        return value
+    return ("%.4f" % (float(value) * factor)).rstrip("0").rstrip(".")
+
+
+def streaming(S):
+    return getattr(S, "Average_Engine", "mincaverage") == "Streaming_Average"
+
+
+def kept(P, Gate, files):
+    # The files of a command line, less those of the specimens quarantined by the quality gate state Gate, which the job filters when it runs (see Quality_Gate.py).
+    return "$(" + P.python + " Quality_Gate.py keep " + Gate + " " + " ".join(files) + ")" if Gate else " ".join(files)
+
+
+def gated(task, Gate):
+    # Put a task downstream of the quality gate state Gate: its job leaves out the files of the quarantined specimens, and drops a task left without outputs.
+    if Gate:
+        task.gate = Gate
+        task.inputs.append(Gate)
+    return task
+
+
+def gate_stage(P, stage, Gate):
+    # Put every task of an array stage, and the template of its array, downstream of the quality gate state Gate.
+    for task in [P.tasks[name] for name in P.arrays[stage].names] + [P.arrays[stage].template]:
+        gated(task, Gate)
+
+
+def quality_gate(S, P, stage, target, mask, volume, Specimen_IDs, Previous, mem, time):
+    """
+    With Gate_Threshold, add the quality gate of a per-specimen stage (e.g., Gate_lsq6): the resampled specimens (volume, with {SpecID} for the ID) that were
+    not quarantined by the Previous gate are measured against the target of the stage within the mask, and the outliers are quarantined (see Quality_Gate.py).
+    Returns the state of the gate, which the later tasks read, or Previous without Gate_Threshold.
+    """
+    Threshold = getattr(S, "Gate_Threshold", None)
+    if not Threshold:
+        return Previous
+    State = S.Quality_path + S.PROJECT_NAME + "_" + stage + "_Gate.json"
+    Report = S.Quality_path + S.PROJECT_NAME + "_" + stage + "_Gate.csv"
+    Min_Xcorr = getattr(S, "Gate_Min_Xcorr", None)
+    P.add(gated(Task("Gate_" + stage, [P.python + " Quality_Gate.py check --stage " + stage + " --target " + target + " --mask " + mask + " --volume " + volume +
+                                       " --specimens " + " ".join(Specimen_IDs) + " --state " + State + " --report " + Report +
+                                       (" --previous-state " + Previous if Previous else "") + " --threshold " + str(Threshold) +
+                                       (" --min-xcorr " + str(Min_Xcorr) if Min_Xcorr is not None else "") + " --downsample " + str(getattr(S, "Gate_Downsample", 2))],
+                     [volume.replace("{SpecID}", SpecID) for SpecID in Specimen_IDs] + [target, mask], [State, Report], mem, time,
+                     message="The " + stage + " specimens are being checked against " + target + "."), Previous))
+    return State
+
+
+def stream_volume(S, P, task, volume, average, average_task, stage, Gate=None):
+    # With Average_Engine = "Streaming_Average", a per-specimen task folds its resampled volume into the running average of its stage as soon as it is written
+    # (see Streaming_Average.py); the task that completes the stage (less the specimens quarantined by the gate state Gate) writes the average.
+    if streaming(S):
+        task.commands.append(P.python + " Streaming_Average.py add " + average + " " + volume + (" --variance" if getattr(S, "Stream_Variance", False) else "") +
+                             " --graph " + getattr(S, "Graph_path", "Atlas_Graph.json") + " --task " + average_task + " --stage " + stage +
+                             (" --gate " + Gate if Gate else ""))
+
+
+def average_task(S, P, name, stage, files, average, mem, time, message=None, Gate=None):
+    """
+    Average the resampled volumes of a stage: one mincaverage call, the check of the running average of Streaming_Average.py (Average_Engine =
+    "Streaming_Average"), which reads the volumes from the graph instead of the command line, or a reduction tree (Average_Engine = "Tree"). The tree adds
+    jobs of partial sums of at most Tree_Fan_In volumes (or partial sums) to P (e.g., lsq6_Third_Sum0_1, ...), and the returned task, the root, combines
+    the last level. With Stream_Variance, the streaming and tree averages also write a variance map (<average>_variance.mnc). With the state of a quality
+    gate (Gate), the volumes of the quarantined specimens are left out.
+    """
+    Engine = getattr(S, "Average_Engine", "mincaverage")
+    Variance = getattr(S, "Stream_Variance", False) and Engine != "mincaverage"
+    Outputs = [average] + ([average[:-len(".mnc")] + "_variance.mnc"] if Variance else [])
+    if Engine == "Streaming_Average":
+        return gated(Task(name, [P.python + " Streaming_Average.py finalize " + average + " --graph " + getattr(S, "Graph_path", "Atlas_Graph.json") + " --task " + name +
+                                 " --stage " + stage + (" --variance" if Variance else "") + (" --gate " + Gate if Gate else "")], files, Outputs, mem, time,
+                          message=message), Gate)
+    if Engine != "Tree":
+        return gated(Task(name, [S.MNC_Avg + kept(P, Gate, files) + " " + average], files, [average], mem, time, message=message), Gate)
+    # Every level splits its items into consecutive, even groups; the partial sums live in <average>_tree/, and a partial sum is complete with its meta.json.
+    Fan_In = getattr(S, "Tree_Fan_In", 32)
+    Level, Depth = list(files), 0
+    while Depth == 0 or len(Level) > Fan_In:
+        Count = -(-len(Level) // Fan_In)
+        Size, Extra = divmod(len(Level), Count)
+        Next, Start = [], 0
+        for Index in range(Count):
+            Group, Start = Level[Start:Start + Size + (Index < Extra)], Start + Size + (Index < Extra)
+            Partial = average[:-len(".mnc")] + "_tree/" + str(Depth) + "_" + str(Index + 1) + "/"
+            Command = ("partial " + Partial + " " + kept(P, Gate, Group) + (" --variance" if Variance else "") if Depth == 0 else
+                       "combine " + Partial + " " + " ".join(Group))
+            P.add(gated(Task(name + "_Sum" + str(Depth) + "_" + str(Index + 1), [P.python + " Streaming_Average.py " + Command],
+                             Group if Depth == 0 else [Child + "meta.json" for Child in Group], [Partial + "meta.json"], mem, time, name + "_Sum" + str(Depth)),
+                        Gate if Depth == 0 else None))
+            Next.append(Partial)
+        Level, Depth = Next, Depth + 1
+    return gated(Task(name, [P.python + " Streaming_Average.py combine " + average + " " + " ".join(Level)], [Partial + "meta.json" for Partial in Level], Outputs, mem,
+                      time, message=message), Gate)
+
+
+def lsq_register(kind, step, simplex):
+    # minctracc string of a linear (-lsq6 or -lsq12) registration level.
+    return ("minctracc -clobber -xcorr -" + kind + " -w_translations 0.4 0.4 0.4 -w_rotations 0.0174533 0.0174533 0.0174533 -w_scales 0.02 0.02 0.02 "
+            "-w_shear 0.02 0.02 0.02 -step " + " ".join([step] * 3) + " -simplex " + simplex + " -use_simplex -tol 0.0001 ")
+
+
+def nl_register(step, simplex, iterations, lattice, first):
+    # Beginning and end of the minctracc string of a non-linear level; the first level starts from the identity, the others from the previous transformation.
+    begin = ("minctracc -clobber -xcorr -w_translations 0.4 0.4 0.4 -w_rotations 0.0174533 0.0174533 0.0174533 -w_scales 0.02 0.02 0.02 -w_shear 0.02 0.02 0.02 "
+             "-step " + " ".join([step] * 3) + " -simplex " + simplex + " -use_simplex -tol 0.0001 ")
+    end = ("-iterations " + iterations + " -similarity 0.8 -weight 0.8 -stiffness 0.98 -nonlinear corrcoeff -sub_lattice 6 -lattice_diameter " +
+           " ".join([lattice] * 3) + " -max_def_magnitude 1 -debug -xcorr " + ("-identity " if first else "-transform "))
+    return begin, end
+
+
+def scaled_levels(resolution):
+    """
+    The lsq6_Levels, lsq12_Levels, and nl_Levels of an atlas at a voxel size of resolution um: every blurring kernel, step, simplex size, and lattice diameter of
+    the reference (LoRes_Atlas.py at 35 um) times resolution / 35. The weights, tolerances, and iteration counts do not depend on the voxel size.
+    """
+    factor = float(resolution) / REFERENCE_RESOLUTION
+    lsq6_Levels = [(scale(fwhm, factor), lsq_register("lsq6", scale(step, factor), scale(simplex, factor))) for fwhm, step, simplex in REFERENCE_LSQ6]
+    lsq12_Levels = [(scale(fwhm, factor), lsq_register("lsq12", scale(step, factor), scale(simplex, factor))) for fwhm, step, simplex in REFERENCE_LSQ12]
+    nl_Levels = [(scale(fwhm, factor),) + nl_register(scale(step, factor), scale(simplex, factor), iterations, scale(lattice, factor), Round == 0)
+                 for Round, (fwhm, step, simplex, iterations, lattice) in enumerate(REFERENCE_NL)]
+    return lsq6_Levels, lsq12_Levels, nl_Levels
+
+
+def mincblur(MNC_Blur, fwhm, source, base, gradient=True):
+    # mincblur appends "_blur.mnc" (and "_dxyz.mnc" when -gradient is given) to the output base name. Without gradient, -gradient is dropped from MNC_Blur.
+    if not gradient:
+        MNC_Blur = " ".join(option for option in MNC_Blur.split(" ") if option != "-gradient")
+    outputs = [base + "_blur.mnc"]
+    if "-gradient" in MNC_Blur.split():
+        outputs.append(base + "_dxyz.mnc")
+    return MNC_Blur + fwhm + " " + source + " " + base, outputs
+
+
+def multi_blur(P, source, levels, gradients):
+    # Blur a source at all of its (fwhm, output base) levels after reading it once (see Multi_Blur.py); only the bases in gradients get a "_dxyz.mnc" volume.
+    command = P.python + " Multi_Blur.py " + source
+    outputs = []
+    for fwhm, base in levels:
+        command += (" --gradient " if base in gradients else " --level ") + fwhm + " " + base
+        outputs += [base + "_blur.mnc"] + ([base + "_dxyz.mnc"] if base in gradients else [])
+    return command, outputs
+
+
+def blur_task(S, P, name, stage, mem, time, jobs, message=None, gradients=()):
+    # Blur a list of (source, output base, fwhm) jobs within a single task. Only the output bases in gradients get a gradient volume, which only ANTS reads.
+    # With Blur_Engine = "Multi_Blur", every source is read once for all of its kernels; otherwise every job is its own mincblur call.
+    commands, inputs, outputs = [], [], []
+    Sources = OrderedDict()
+    for source, base, fwhm in jobs:
+        Sources.setdefault(source, []).append((fwhm, base))
+    for source, levels in Sources.items():
+        inputs.append(source)
+        if getattr(S, "Blur_Engine", "mincblur") == "Multi_Blur":
+            command, blurred = multi_blur(P, source, levels, gradients)
+            commands.append(command)
+            outputs += blurred
+            continue
+        for fwhm, base in levels:
+            command, blurred = mincblur(S.MNC_Blur, fwhm, source, base, base in gradients)
+            commands.append(command)
+            outputs += blurred
+    return Task(name, commands, inputs, outputs, mem, time, stage, message)
+
+
+def xfm_concat(S, P, sources, output, inverse=None):
+    # Concatenate transformations (applied in order) into output, and optionally invert the result into inverse. With XFM_Engine = "XFM_Algebra", the linear
+    # parts are composed exactly and the displacement grids are referenced instead of copied (see XFM_Algebra.py); otherwise xfmconcat (and xfminvert) copy every grid.
+    if getattr(S, "XFM_Engine", "xfmconcat") == "XFM_Algebra":
+        return P.python + " XFM_Algebra.py concat " + " ".join(sources) + " " + output + (" --inverse " + inverse if inverse else "")
+    return "xfmconcat -clobber " + " ".join(sources) + " " + output + (" && xfminvert -clobber " + output + " " + inverse if inverse else "")
+
+
+def xfm_invert(S, P, source, output):
+    if getattr(S, "XFM_Engine", "xfmconcat") == "XFM_Algebra":
+        return P.python + " XFM_Algebra.py invert " + source + " " + output
+    return "xfminvert -clobber " + source + " " + output
+
+
+def read_strata(Metadata_CSV, Columns, ID_Column="Biosample"):
+    # Map every specimen of the metadata table to its stratum, i.e., the tuple of its values in Columns (e.g., Experimental_Group and Genotype).
+    with open(Metadata_CSV, newline='', encoding='utf-8-sig') as Metadata:
+        return {row[ID_Column]: tuple(row[Column] for Column in Columns) for row in csv.DictReader(Metadata)}
+
+
+def lsq12_partners(Specimen_IDs, k=None, mode="random", strata=None, seed=1):
+    """
+    Choose the registration targets of every specimen in the pairwise lsq12 stage. Without k (or with k >= N - 1), every specimen is registered to every specimen (N x N).
+    "random" registers each specimen to its k successors in a shuffled order, so every specimen is also the target of exactly k others. "stratified" allocates the
+    k partners to the strata in proportion to their size (largest remainder) and samples within each stratum, so every average reflects the composition of the cohort.
+    """
+    if not k or k >= len(Specimen_IDs) - 1:
+        return OrderedDict((SpecID, list(Specimen_IDs)) for SpecID in Specimen_IDs)
+    rng = random.Random(seed)
+    if mode == "random":
+        Order = list(Specimen_IDs)
+        rng.shuffle(Order)
+        Position = {SpecID: Index for Index, SpecID in enumerate(Order)}
+        return OrderedDict((SpecID, [Order[(Position[SpecID] + Step) % len(Order)] for Step in range(1, k + 1)]) for SpecID in Specimen_IDs)
+    if mode == "stratified":
+        # Specimens missing from the metadata table form their own stratum.
+        Groups = OrderedDict()
+        for SpecID in Specimen_IDs:
+            Groups.setdefault(strata.get(SpecID, ("NA",)), []).append(SpecID)
+        Partners = OrderedDict()
+        for SpecID in Specimen_IDs:
+            Pools = [[SpecID2 for SpecID2 in Members if SpecID2 != SpecID] for Members in Groups.values()]
+            Total = sum(len(Pool) for Pool in Pools)
+            Quotas = [k * len(Pool) / Total for Pool in Pools]
+            Counts = [int(Quota) for Quota in Quotas]
+            # Ties between equal remainders (e.g., many strata of one specimen) are broken at random rather than by the order of the strata.
+            for Index in sorted(range(len(Pools)), key=lambda Index: (Quotas[Index] - Counts[Index], rng.random()), reverse=True)[:k - sum(Counts)]:
+                Counts[Index] += 1
+            Partners[SpecID] = [SpecID2 for Pool, Count in zip(Pools, Counts) for SpecID2 in rng.sample(Pool, Count)]
+        return Partners
+    raise ValueError("Unknown lsq12 partner mode: " + str(mode))
+
+
+def previous_design(Graph_path):
+    """
+    The specimens (in the order of lsq6_Second) and the lsq12 pairs (in the order of lsq12_Third) of a previous build, read from the arrays of its graph, so a
+    grown atlas keeps the task names, and with them the stamps, of the previous build.
+    """
+    Arrays = None
+    if Graph_path and os.path.isfile(Graph_path):
+        with open(Graph_path) as Graph:
+            Arrays = json.load(Graph).get("arrays")
+    if not Arrays or "lsq6_Second" not in Arrays or "lsq12_Third" not in Arrays:
+        raise ValueError("Grow_Atlas needs the graph of the previous build with its arrays (" + str(Graph_path) + "); generate the previous build again first.")
+    return [Item[0] for Item in Arrays["lsq6_Second"]["items"]], [tuple(Item) for Item in Arrays["lsq12_Third"]["items"]]
+
+
+def build_atlas_pipeline(Settings):
+    """
+    Build the atlas DAG. Settings is a dictionary with the generator's paths, specimen IDs, blurring kernels, registration strings, and cluster resources:
+    lsq6_Levels and lsq12_Levels are lists of (fwhm, minctracc string); nl_Levels is a list of (fwhm, minctracc string beginning, minctracc string end).
+    Blur_Engine selects mincblur or Multi_Blur.py for the blurs; no stage of the atlas reads gradient volumes, so none are written. The optional lsq12_Partners, lsq12_Partner_Mode, Metadata_CSV, Strata_Columns, lsq12_Seed, and lsq12_Drift_Subset select a sparse pairwise lsq12 design (see lsq12_partners);
+    lsq12_Symmetric registers one direction of every pair and inverts it for the other. With lsq12_Pack_Budget (seconds), the pairs are packed into jobs of that
+    much estimated work. With Preview_Factor (2 or 4), the specimens and the average of Preview_Source_path (voxels of Resolution um) are first downsampled
+    into Source_MNC_path, and the levels should be scaled to the downsampled voxels (see scaled_levels). With Auto_Resources, the Mem and Time of every stage become ceilings, and every job is sized (with Resource_Margin) from the headers
+    of the volumes in Local_MNC_path, or from Volume_Voxels, and from the usage recorded in Stamps and Graph_path by previous runs (see Resource_Model.py).
+    Average_Engine = "Streaming_Average" folds every resampled specimen into the running average of its stage as soon as it is written, and "Tree" reduces
+    partial sums of Tree_Fan_In specimens across jobs (see average_task and Streaming_Average.py), with a variance map when Stream_Variance is set; otherwise
+    every average is one mincaverage call. lsq12_Average_Engine = "XFM_Average" averages the pairwise lsq12 transformations of all specimens in one task instead of one xfmavg call per specimen. XFM_Engine = "XFM_Algebra" concatenates and inverts the transformations with XFM_Algebra.py instead of xfmconcat and xfminvert. With nl_Convergence_Threshold, every non-linear average is measured against the previous one (see Atlas_Convergence.py): the rounds after nl_Min_Rounds
+    carry the previous round over once the average stops changing, and run with fewer iterations below nl_Shorten_Threshold. With Gate_Threshold, a quality
+    gate follows the lsq6, lsq12, and every non-linear stage (see quality_gate): the specimens whose cross-correlation with the target of the stage falls
+    Gate_Threshold robust z-scores below the others (or below Gate_Min_Xcorr) are quarantined, and left out of the later stages and averages. With Grow_Atlas,
+    the specimens and lsq12 pairs of the previous build (see previous_design) keep their task names and come first, so their stamps hold and only the pairs of
+    the new specimens are registered before everything is averaged again; with Previous_Atlas, the first non-linear round registers to the previous atlas.
+    With Lifecycle_Mode ("delete" or "archive" into Archive_path), every .mnc and .xfm output outside of Lifecycle_Keep is released once the last task that
+    reads it succeeded (see Intermediate_Lifecycle.py).
+    """
+    S = SimpleNamespace(**Settings)
+    P = Pipeline(S.PROJECT_NAME + "_Atlas", S.Scripts_path, S.Module, S.n_nodes)
+    P.array_jobs = getattr(S, "Array_Jobs", False)
+    P.array_concurrency = getattr(S, "Array_Concurrency", None)
+    P.telemetry_path = getattr(S, "Telemetry_path", None)
+    Specimen_IDs = S.Specimen_IDs
+    # Growing a previous build: its specimens keep their positions (and task names), and the new specimens of the list follow them.
+    Grow = getattr(S, "Grow_Atlas", False)
+    if Grow:
+        Previous_IDs, Previous_Pairs = previous_design(getattr(S, "Graph_path", "Atlas_Graph.json"))
+        Missing = [SpecID for SpecID in Previous_IDs if SpecID not in Specimen_IDs]
+        if Missing:
+            raise ValueError("Grow_Atlas only adds specimens, but the list lacks " + ", ".join(Missing) + " of the previous build; rebuild the atlas instead.")
+        Specimen_IDs = Previous_IDs + [SpecID for SpecID in Specimen_IDs if SpecID not in Previous_IDs]
+    lsq6_Tags = [blur_tag(fwhm) for fwhm, _ in S.lsq6_Levels]
+    lsq12_Tags = [blur_tag(fwhm) for fwhm, _ in S.lsq12_Levels]
+    nl_Tags = [blur_tag(level[0]) for level in S.nl_Levels]
+    k = getattr(S, "lsq12_Partners", None)
+    Mode = getattr(S, "lsq12_Partner_Mode", "random")
+    Seed = getattr(S, "lsq12_Seed", 1)
+    Strata = read_strata(S.Metadata_CSV, S.Strata_Columns) if k and Mode == "stratified" else None
+    Partners = lsq12_partners(Specimen_IDs, k, Mode, Strata, Seed)
+    Symmetric = getattr(S, "lsq12_Symmetric", False)
+    Sparse = any(Targets != Specimen_IDs for Targets in Partners.values())
+    if Grow and Sparse:
+        raise ValueError("Grow_Atlas needs the full pairwise lsq12 design (lsq12_Partners = None); the partners of a sparse design are drawn from the whole cohort.")
+    # With a sparse design, the full N x N average is also computed for a subset of specimens to report the drift of the k-partner averages.
+    Drift_IDs = random.Random(Seed).sample(Specimen_IDs, min(getattr(S, "lsq12_Drift_Subset", 0), len(Specimen_IDs))) if Sparse else []
+    Drift_IDs = sorted(Drift_IDs, key=Specimen_IDs.index)
+
+    #---------------------------------------------------------------------------------------------------------------
+    # Preview: downsample the source volumes of the full-resolution project into this one.
+    #---------------------------------------------------------------------------------------------------------------
+    if getattr(S, "Preview_Factor", None):
+        Step = scale(str(S.Resolution / 1000.0), S.Preview_Factor)
+        def Downsample(Source, Output, Temp):
+            # Blur with a kernel of the new voxel size to avoid aliasing, then resample to isotropic voxels of that size over the same extent (autocrop -isostep).
+            return ["mincblur -clobber -no_apodize -fwhm " + Step + " " + Source + " " + Temp, "autocrop -clobber -isostep " + Step + " " + Temp + "_blur.mnc " + Output,
+                    "rm -f " + Temp + "_blur.mnc"]
+        Full_Avg, Full_Mask = S.Preview_Source_path + "LM_average.mnc", S.Preview_Source_path + "LM_average_mask.mnc"
+        P.add(Task("Preview_First", Downsample(Full_Avg, S.LM_Avg, S.Source_MNC_path + "LM_average_full") +
+                   ["mincresample -clobber -nearest_neighbour -like " + S.LM_Avg + " " + Full_Mask + " " + S.LM_Avg_Mask],
+                   [Full_Avg, Full_Mask], [S.LM_Avg, S.LM_Avg_Mask], S.lsq6_Mem, S.lsq6_Time,
+                   message="The average and mask are being downsampled " + str(S.Preview_Factor) + " times for the preview atlas."))
+        P.add_array("Preview_Second", lambda Name, SpecID: Task(
+            Name, Downsample(S.Preview_Source_path + SpecID + ".mnc", S.Source_MNC_path + SpecID + ".mnc", S.Source_MNC_path + SpecID + "_full"),
+            [S.Preview_Source_path + SpecID + ".mnc"], [S.Source_MNC_path + SpecID + ".mnc"], S.lsq6_Mem, S.lsq6_Time, "Preview_Second",
+            "Downsampling " + SpecID + " for the preview atlas."), Specimen_IDs, start=1)
+
+    #---------------------------------------------------------------------------------------------------------------
+    # 6-parameter (translation (z,y,x), rotation (z,y,x)) optimized rigid body registration.
+    #---------------------------------------------------------------------------------------------------------------
+    # Blur the intended target (i.e., the landmark initialized average) as well as a mask of equivalent resolution to constrain our computation.
+    P.add(blur_task(S, P, "lsq6_First", "lsq6_First", S.lsq6_Mem, S.lsq6_Time,
+                    [(S.LM_Avg, S.Source_MNC_path + "LM_average_" + tag, fwhm) for (fwhm, _), tag in zip(S.lsq6_Levels, lsq6_Tags)] +
+                    [(S.LM_Avg_Mask, S.Source_MNC_path + "LM_average_mask_" + tag, fwhm) for (fwhm, _), tag in zip(S.lsq6_Levels, lsq6_Tags)]))
+
+    # Blur every landmark initialized source file, register it hierarchically to LM_average, and resample it into the translation and rotation invariant space.
+    def lsq6_Second(Name, SpecID):
+        Task_lsq6 = blur_task(S, P, Name, "lsq6_Second", S.lsq6_Mem, S.lsq6_Time,
+                              [(S.Source_MNC_path + SpecID + ".mnc", S.lsq6_Blurred_path + SpecID + "_" + tag, fwhm) for (fwhm, _), tag in zip(S.lsq6_Levels, lsq6_Tags)],
+                              "Begin the optimized 6-parameter registration for " + SpecID + ".")
+        Previous = None
+        for Level, ((fwhm, Register), tag) in enumerate(zip(S.lsq6_Levels, lsq6_Tags)):
+            Blurred = S.lsq6_Blurred_path + SpecID + "_" + tag + "_blur.mnc"
+            Target = S.Source_MNC_path + "LM_average_" + tag + "_blur.mnc"
+            Mask = S.Source_MNC_path + "LM_average_mask_" + tag + "_blur.mnc"
+            XFM = S.lsq6_XFM_path + SpecID + "_lsq6_" + str(Level) + ".xfm"
+            Init = " -identity" if Previous is None else " -transformation " + Previous
+            Task_lsq6.commands.append(Register + Blurred + " " + Target + " " + XFM + " -model_mask " + Mask + Init)
+            Task_lsq6.inputs += [Target, Mask]
+            Task_lsq6.outputs.append(XFM)
+            Previous = XFM
+        # Resample the original image into the rotation and translation invariant space.
+        Task_lsq6.commands.append("mincresample -like " + S.LM_Avg + " -clobber -transformation " + Previous + " " + S.Source_MNC_path + SpecID + ".mnc " + S.lsq6_MNC_path + SpecID + "_lsq6.mnc")
+        Task_lsq6.inputs.append(S.LM_Avg)
+        Task_lsq6.outputs.append(S.lsq6_MNC_path + SpecID + "_lsq6.mnc")
+        stream_volume(S, P, Task_lsq6, S.lsq6_MNC_path + SpecID + "_lsq6.mnc", S.lsq6_Avg, "lsq6_Third", "lsq6_Second")
+        return Task_lsq6
+    P.add_array("lsq6_Second", lsq6_Second, Specimen_IDs, start=1)
+
+    # With Gate_Threshold, quarantine the specimens that failed the stage; the gate of every stage carries the quarantine of the earlier ones, and the later
+    # tasks leave the quarantined specimens out (see quality_gate).
+    lsq6_Gate = Gate = quality_gate(S, P, "lsq6", S.LM_Avg, S.LM_Avg_Mask, S.lsq6_MNC_path + "{SpecID}_lsq6.mnc", Specimen_IDs, None, S.lsq6_Mem, S.lsq6_Time)
+
+    # Average all lsq6 files.
+    lsq6_Files = [S.lsq6_MNC_path + SpecID + "_lsq6.mnc" for SpecID in Specimen_IDs]
+    P.add(average_task(S, P, "lsq6_Third", "lsq6_Second", lsq6_Files, S.lsq6_Avg, S.lsq6_Mem, S.lsq6_Time, "All lsq6 files are being averaged.", Gate))
+
+    #---------------------------------------------------------------------------------------------------------------
+    # 12-parameter (translation (z,y,x), rotation (z,y,x), scale (z,y,x), shear (z,y,x)) optimized affine registration.
+    #---------------------------------------------------------------------------------------------------------------
+    # Blur the like file (LM_average) and the mask to constrain our computation.
+    P.add(blur_task(S, P, "lsq12_First", "lsq12_First", S.lsq12_Mem, S.lsq12_Time,
+                    [(S.LM_Avg, S.Source_MNC_path + "LM_average_" + tag, fwhm) for (fwhm, _), tag in zip(S.lsq12_Levels, lsq12_Tags)] +
+                    [(S.LM_Avg_Mask, S.Source_MNC_path + "LM_average_mask_" + tag, fwhm) for (fwhm, _), tag in zip(S.lsq12_Levels, lsq12_Tags)],
+                    "We are blurring LM_average and LM_average_mask."))
+
+    # Blur every lsq6 image in a descending fashion for the hierarchical registration. Registering a specimen to itself gives the identity, so the self-pair
+    # transformation averaged in lsq12_Fourth is written directly by param2xfm instead of being registered.
+    def lsq12_Second(Name, SpecID):
+        Task_Blur = blur_task(S, P, Name, "lsq12_Second", S.lsq12_Mem, S.lsq12_Time,
+                              [(S.lsq6_MNC_path + SpecID + "_lsq6.mnc", S.lsq12_Blurred_path + SpecID + "_" + tag, fwhm) for (fwhm, _), tag in zip(S.lsq12_Levels, lsq12_Tags)],
+                              "We are blurring " + SpecID + ".")
+        Task_Blur.commands.append("param2xfm -clobber " + S.lsq12_XFM_path + SpecID + "_to_" + SpecID + "_lsq12_2.xfm")
+        Task_Blur.outputs.append(S.lsq12_XFM_path + SpecID + "_to_" + SpecID + "_lsq12_2.xfm")
+        return Task_Blur
+    P.add_array("lsq12_Second", lsq12_Second, Specimen_IDs, start=1)
+    gate_stage(P, "lsq12_Second", Gate)
+
+    # Register every specimen to each of its partners (every other specimen, unless the design is sparse); each pair is its own task. With lsq12_Symmetric,
+    # only one direction of every pair is registered, and the other direction is the inverse of its 12-parameter transformation.
+    def lsq12_Third(Name, SpecID, SpecID2):
+        Task_Pair = Task(Name, [], [], [], S.lsq12_Mem, S.lsq12_Time, "lsq12_Third")
+        Previous = None
+        for Level, ((fwhm, Register), tag) in enumerate(zip(S.lsq12_Levels, lsq12_Tags)):
+            Source = S.lsq12_Blurred_path + SpecID + "_" + tag + "_blur.mnc"
+            Target = S.lsq12_Blurred_path + SpecID2 + "_" + tag + "_blur.mnc"
+            Mask = S.Source_MNC_path + "LM_average_mask_" + tag + "_blur.mnc"
+            XFM = S.lsq12_XFM_path + SpecID + "_to_" + SpecID2 + "_lsq12_" + str(Level) + ".xfm"
+            Init = " -identity" if Previous is None else " -transform " + Previous
+            Task_Pair.commands.append(Register + Source + " " + Target + " " + XFM + " -model_mask " + Mask + Init)
+            Task_Pair.inputs += [Source, Target, Mask]
+            Task_Pair.outputs.append(XFM)
+            Previous = XFM
+        if Symmetric:
+            Task_Pair.commands.append(xfm_invert(S, P, Previous, S.lsq12_XFM_path + SpecID2 + "_to_" + SpecID + "_lsq12_2.xfm"))
+            Task_Pair.outputs.append(S.lsq12_XFM_path + SpecID2 + "_to_" + SpecID + "_lsq12_2.xfm")
+        return Task_Pair
+    Pairs = [(SpecID, SpecID2) for SpecID in Specimen_IDs for SpecID2 in Partners[SpecID] if SpecID2 != SpecID]
+    Pairs += [(SpecID, SpecID2) for SpecID in Drift_IDs for SpecID2 in Specimen_IDs if SpecID2 not in Partners[SpecID] and SpecID2 != SpecID]
+    if Symmetric:
+        Order = {SpecID: Index for Index, SpecID in enumerate(Specimen_IDs)}
+        Pairs = list(OrderedDict.fromkeys((SpecID, SpecID2) if Order[SpecID] < Order[SpecID2] else (SpecID2, SpecID) for SpecID, SpecID2 in Pairs))
+    if Grow:
+        # The pairs of the previous build come first, in their previous order, so only the new rows and columns of the pair matrix are registered.
+        Known = set(Pairs)
+        Changed = [Pair for Pair in Previous_Pairs if Pair not in Known]
+        if Changed:
+            raise ValueError("Grow_Atlas keeps the lsq12 pairs of the previous build, but " + str(len(Changed)) + " of them (e.g., " + " to ".join(Changed[0]) +
+                             ") are not part of this design (see lsq12_Symmetric).")
+        Previous_Set = set(Previous_Pairs)
+        Pairs = Previous_Pairs + [Pair for Pair in Pairs if Pair not in Previous_Set]
+    P.add_array("lsq12_Third", lsq12_Third, Pairs, ("SpecID", "SpecID2"), start=0)
+    gate_stage(P, "lsq12_Third", Gate)
+
+    # Average the pairwise transformations of every specimen, concatenate the average with the lsq6 transformation, and resample the specimen into the 12-parameter space.
+    # With a sparse design, the partners differ between specimens, so the list of transformations to average is a variable of the job array.
+    def Pair_XFMs(SpecID, Targets):
+        return " ".join(S.lsq12_XFM_path + SpecID + "_to_" + SpecID2 + "_lsq12_2.xfm" for SpecID2 in Targets)
+
+    def lsq12_Average(Name, SpecID, XFMs, Suffix, Stage):
+        # Without XFMs, the average transformation was written by lsq12_XFM_Average.
+        Avg_XFM = S.lsq12_XFM_path + SpecID + "_lsq12_AVG" + Suffix + ".xfm"
+        Orig_XFM = S.lsq12_XFM_path + SpecID + "_origtolsq12" + Suffix + ".xfm"
+        lsq12_File = S.lsq12_MNC_path + SpecID + "_lsq12" + Suffix + ".mnc"
+        Task_Average = Task(Name,
+                            ([] if XFMs is None else ["xfmavg -verbose -clobber " + kept(P, lsq6_Gate, [XFMs]) + " " + Avg_XFM]) +
+                            [xfm_concat(S, P, [S.lsq6_XFM_path + SpecID + "_lsq6_2.xfm", Avg_XFM], Orig_XFM),
+                             "mincresample -like " + S.LM_Avg + " -clobber -transformation " + Orig_XFM + " " + S.Source_MNC_path + SpecID + ".mnc " + lsq12_File],
+                            ([Avg_XFM] if XFMs is None else XFMs.split(" ")) + [S.lsq6_XFM_path + SpecID + "_lsq6_2.xfm", S.LM_Avg, S.Source_MNC_path + SpecID + ".mnc"],
+                            ([] if XFMs is None else [Avg_XFM]) + [Orig_XFM, lsq12_File], S.lsq12_Mem, S.lsq12_Time, Stage)
+        if Stage == "lsq12_Fourth":
+            stream_volume(S, P, Task_Average, lsq12_File, S.lsq12_Avg, "lsq12_Fifth", Stage, lsq6_Gate)
+        return Task_Average
+
+    if getattr(S, "lsq12_Average_Engine", "xfmavg") == "XFM_Average":
+        # One task reads every pairwise transformation and writes the log-Euclidean mean of every specimen (see XFM_Average.py), which reads its
+        # transformations from the graph instead of the command line.
+        P.add(gated(Task("lsq12_XFM_Average", [P.python + " XFM_Average.py lsq12 --graph " + getattr(S, "Graph_path", "Atlas_Graph.json") + " --task lsq12_XFM_Average" +
+                                               (" --gate " + Gate if Gate else "")],
+                         [S.lsq12_XFM_path + SpecID + "_to_" + SpecID2 + "_lsq12_2.xfm" for SpecID in Specimen_IDs for SpecID2 in Partners[SpecID]],
+                         [S.lsq12_XFM_path + SpecID + "_lsq12_AVG.xfm" for SpecID in Specimen_IDs], S.lsq12_Mem, S.lsq12_Time,
+                         message="All pairwise lsq12 transformations are being averaged."), Gate))
+        P.add_array("lsq12_Fourth", lambda Name, SpecID: lsq12_Average(Name, SpecID, None, "", "lsq12_Fourth"), Specimen_IDs, start=0)
+    elif Sparse:
+        P.add_array("lsq12_Fourth", lambda Name, SpecID, XFMs: lsq12_Average(Name, SpecID, XFMs, "", "lsq12_Fourth"),
+                    [(SpecID, Pair_XFMs(SpecID, Partners[SpecID])) for SpecID in Specimen_IDs], ("SpecID", "XFMs"), start=0)
+    else:
+        P.add_array("lsq12_Fourth", lambda Name, SpecID: lsq12_Average(Name, SpecID, Pair_XFMs(SpecID, Specimen_IDs), "", "lsq12_Fourth"), Specimen_IDs, start=0)
+
+    gate_stage(P, "lsq12_Fourth", Gate)
+    # The lsq12 specimens are checked against the lsq6 average, the consensus the pairwise registrations converge to.
+    Gate = quality_gate(S, P, "lsq12", S.lsq6_Avg, S.LM_Avg_Mask, S.lsq12_MNC_path + "{SpecID}_lsq12.mnc", Specimen_IDs, Gate, S.lsq12_Mem, S.lsq12_Time)
+
+    # Average the lsq12 files to create a target for the non-linear deformations.
+    lsq12_Files = [S.lsq12_MNC_path + SpecID + "_lsq12.mnc" for SpecID in Specimen_IDs]
+    P.add(average_task(S, P, "lsq12_Fifth", "lsq12_Fourth", lsq12_Files, S.lsq12_Avg, S.lsq12_Mem, S.lsq12_Time, "All lsq12 files are being averaged.", Gate))
+
+    # Drift report of a sparse design: average the transformations to all N specimens for the subset, and compare the resulting lsq12 files and their averages
+    # with the k-partner results (minccmp cross-correlation and root mean square error).
+    if Drift_IDs:
+        P.add_array("lsq12_Drift", lambda Name, SpecID: lsq12_Average(Name, SpecID, Pair_XFMs(SpecID, Specimen_IDs), "_full", "lsq12_Drift"), Drift_IDs, start=0)
+        gate_stage(P, "lsq12_Drift", lsq6_Gate)
+        Drift_Files = [S.lsq12_MNC_path + SpecID + "_lsq12.mnc" for SpecID in Drift_IDs]
+        Full_Files = [S.lsq12_MNC_path + SpecID + "_lsq12_full.mnc" for SpecID in Drift_IDs]
+        Drift_Avg = S.lsq12_MNC_path + S.PROJECT_NAME + "_lsq12_subset_average.mnc"
+        Full_Avg = S.lsq12_MNC_path + S.PROJECT_NAME + "_lsq12_subset_full_average.mnc"
+        Report = S.Quality_path + S.PROJECT_NAME + "_lsq12_Drift.txt"
+
+        def Compare(Label, Sparse_File, Full_File):
+            return "echo \"" + Label + " $(minccmp -quiet -mask " + S.LM_Avg_Mask + " -xcorr -rmse " + Full_File + " " + Sparse_File + " | tr '\\n' ' ')\" >> " + Report
+        P.add(gated(Task("lsq12_Drift_Report",
+                   [S.MNC_Avg + kept(P, Gate, Drift_Files) + " " + Drift_Avg, S.MNC_Avg + kept(P, Gate, Full_Files) + " " + Full_Avg,
+                    "echo \"SpecID xcorr rmse (" + str(k) + " " + Mode + " partners vs. all " + str(len(Specimen_IDs)) + " specimens)\" > " + Report] +
+                   [Compare(SpecID, Sparse_File, Full_File) for SpecID, Sparse_File, Full_File in zip(Drift_IDs, Drift_Files, Full_Files)] +
+                   [Compare("average", Drift_Avg, Full_Avg)],
+                   Drift_Files + Full_Files + [S.LM_Avg_Mask], [Drift_Avg, Full_Avg, Report], S.lsq12_Mem, S.lsq12_Time,
+                   message="The k-partner lsq12 files are being compared with the full pairwise results."), Gate))
+
+    #---------------------------------------------------------------------------------------------------------------
+    # NON-LINEAR STAGES
+    #---------------------------------------------------------------------------------------------------------------
+    # Blur the 12-parameter average and mask with the largest non-linear kernel. With Previous_Atlas (e.g., the final average of the build a grown atlas started
+    # from), the first round is warm-started: it registers to the previous atlas, which is much closer to the new one than the 12-parameter average.
+    Previous_Atlas = getattr(S, "Previous_Atlas", None)
+    if Previous_Atlas in S.nl_Avgs:
+        raise ValueError("Previous_Atlas is overwritten by this build; copy " + Previous_Atlas + " out of the non-linear directory first.")
+    Start_Avg = Previous_Atlas or S.lsq12_Avg
+    Start_Base = S.nl_Init_path + S.PROJECT_NAME + ("_previous_atlas_" if Previous_Atlas else "_lsq12_average_") + nl_Tags[0]
+    P.add(blur_task(S, P, "nl_First", "nl_First", S.nl_Mem, S.nl_Time,
+                    [(Start_Avg, Start_Base, S.nl_Levels[0][0]), (S.LM_Avg_Mask, S.nl_Init_path + "LM_average_mask_" + nl_Tags[0], S.nl_Levels[0][0])]))
+
+    # Each round registers every lsq12 specimen to the blurred average of the previous round, then averages the resampled specimens.
+    # With a convergence threshold, every average (but the last) also writes the state of its round into the Quality directory, which the later rounds read.
+    Threshold = getattr(S, "nl_Convergence_Threshold", None)
+    States = [S.Quality_path + S.PROJECT_NAME + "_nl_" + str(Round) + "_Convergence.json" for Round in range(1, len(S.nl_Levels))]
+    Convergence = P.python + " Atlas_Convergence.py "
+
+    def carry(Round, Pairs):
+        # Skip command of a task of a later round: once the state of the previous round says the atlas converged, its (previous, current) files are copied over.
+        # Non-linear transformations are copied with xfm_concat, so their displacement grids are copied by xfmconcat or referenced by XFM_Algebra.py.
+        return " && ".join([Convergence + "converged " + States[Round - 2]] +
+                           [xfm_concat(S, P, [Previous], Current) if Previous.endswith(".xfm") else "cp " + Previous + " " + Current for Previous, Current in Pairs])
+
+    Target = Start_Base + "_blur.mnc"
+    for Round, ((fwhm, Register_Begin, Register_End), tag, (Register_Stage, Average_Stage)) in enumerate(zip(S.nl_Levels, nl_Tags, NL_STAGES), start=1):
+        Mask = S.nl_Init_path + "LM_average_mask_" + tag + "_blur.mnc"
+        def nl_Register(Name, SpecID):
+            Base = S.nl_Blurred_path + SpecID + "_" + tag
+            XFM = S.nl_XFM_path + SpecID + "_nl_" + str(Round) + ".xfm"
+            Orig_XFM = S.nl_XFM_path + SpecID + "_origtonl_" + str(Round) + ".xfm"
+            Task_nl = blur_task(S, P, Name, Register_Stage, S.nl_Mem, S.nl_Time, [(S.lsq12_MNC_path + SpecID + "_lsq12.mnc", Base, fwhm)])
+            # The first round starts from the identity; later rounds start from the previous round's transformation.
+            Init = "" if Round == 1 else S.nl_XFM_path + SpecID + "_nl_" + str(Round - 1) + ".xfm"
+            Task_nl.commands += [Register_Begin + Base + "_blur.mnc " + Target + " " + XFM + " -model_mask " + Mask + " " + Register_End + Init,
+                                 xfm_concat(S, P, [S.lsq6_XFM_path + SpecID + "_lsq6_2.xfm", S.lsq12_XFM_path + SpecID + "_lsq12_AVG.xfm", XFM], Orig_XFM),
+                                 "mincresample -like " + S.LM_Avg + " -clobber -transformation " + Orig_XFM + " " + S.Source_MNC_path + SpecID + ".mnc " + S.nl_MNC_path + SpecID + "_nl_" + str(Round) + ".mnc"]
+            Task_nl.inputs += [Target, Mask, S.lsq6_XFM_path + SpecID + "_lsq6_2.xfm", S.lsq12_XFM_path + SpecID + "_lsq12_AVG.xfm", S.LM_Avg, S.Source_MNC_path + SpecID + ".mnc"] + ([Init] if Init else [])
+            Task_nl.outputs += [XFM, Orig_XFM, S.nl_MNC_path + SpecID + "_nl_" + str(Round) + ".mnc"]
+            if Threshold and Round > 1:
+                # The number of iterations is read from the state of the previous round when the job runs. The blurred specimen is only read by this task, so it
+                # is not declared, and a carried-over round does not have to blur it.
+                Task_nl.commands[-3] = re.sub(r"-iterations (\d+)", lambda Match: "-iterations $(" + Convergence + "iterations " + States[Round - 2] + " " + Match.group(1) + ")",
+                                              Task_nl.commands[-3])
+                Previous = [Init, S.nl_XFM_path + SpecID + "_origtonl_" + str(Round - 1) + ".xfm", S.nl_MNC_path + SpecID + "_nl_" + str(Round - 1) + ".mnc"]
+                Task_nl.inputs += [States[Round - 2]] + Previous[1:]
+                Task_nl.outputs = [Output for Output in Task_nl.outputs if not Output.startswith(Base)]
+                Task_nl.skip = carry(Round, zip(Previous, Task_nl.outputs))
+            stream_volume(S, P, Task_nl, S.nl_MNC_path + SpecID + "_nl_" + str(Round) + ".mnc", S.nl_Avgs[Round - 1], Average_Stage, Register_Stage, Gate)
+            return Task_nl
+        P.add_array(Register_Stage, nl_Register, Specimen_IDs, start=0)
+        gate_stage(P, Register_Stage, Gate)
+        # The specimens of a round are checked against the average they were registered to.
+        Gate = quality_gate(S, P, "nl_" + str(Round), S.nl_Avgs[Round - 2] if Round > 1 else Start_Avg, S.LM_Avg_Mask,
+                            S.nl_MNC_path + "{SpecID}_nl_" + str(Round) + ".mnc", Specimen_IDs, Gate, S.nl_Mem, S.nl_Time)
+
+        # Average the resampled specimens of this round; unless this is the last round, blur the average and mask as the next target.
+        nl_Files = [S.nl_MNC_path + SpecID + "_nl_" + str(Round) + ".mnc" for SpecID in Specimen_IDs]
+        Average = S.nl_Avgs[Round - 1]
+        Task_Avg = average_task(S, P, Average_Stage, Register_Stage, nl_Files, Average, S.nl_Mem, S.nl_Time,
+                                "All of the non-linearly deformed files of round " + str(Round) + " are being averaged.", Gate)
+        if Round < len(S.nl_Levels):
+            Next_fwhm, Next_tag = S.nl_Levels[Round][0], nl_Tags[Round]
+            Blurs = blur_task(S, P, Average_Stage, Average_Stage, S.nl_Mem, S.nl_Time,
+                              [(Average, S.nl_Init_path + "NL_" + str(Round) + "_average_" + Next_tag, Next_fwhm),
+                               (S.LM_Avg_Mask, S.nl_Init_path + "LM_average_mask_" + Next_tag, Next_fwhm)])
+            Task_Avg.commands += Blurs.commands
+            Task_Avg.inputs.append(S.LM_Avg_Mask)
+            Task_Avg.outputs += Blurs.outputs
+            Target = S.nl_Init_path + "NL_" + str(Round) + "_average_" + Next_tag + "_blur.mnc"
+        if Threshold:
+            Previous_Avg = S.nl_Avgs[Round - 2] if Round > 1 else Start_Avg
+            Previous_State = States[Round - 2] if Round > 1 else None
+            Carried = [(Previous_Avg, Average)] + ([(Previous_State, States[Round - 1])] if Previous_State and Round < len(S.nl_Levels) else [])
+            if getattr(S, "Average_Engine", "mincaverage") != "mincaverage" and getattr(S, "Stream_Variance", False):
+                Carried.append((Previous_Avg[:-len(".mnc")] + "_variance.mnc", Average[:-len(".mnc")] + "_variance.mnc"))
+            if Round > 1:
+                # A carried-over average is still blurred as the next target, which the carried-over registrations of the next round declare as an input.
+                Task_Avg.skip = " && ".join([carry(Round, Carried)] + Task_Avg.commands[1:])
+                Task_Avg.inputs += [Previous_Avg, Previous_State]
+            if Round < len(S.nl_Levels):
+                Task_Avg.commands.append(Convergence + "check --round " + str(Round) + " --average " + Average + " --previous " + Previous_Avg + " --mask " + S.LM_Avg_Mask +
+                                         " --specimens " + kept(P, Gate, nl_Files) + " --state " + States[Round - 1] +
+                                         (" --previous-state " + Previous_State if Previous_State else "") + " --threshold " + str(Threshold) +
+                                         " --shorten " + str(getattr(S, "nl_Shorten_Threshold", None) or 3 * Threshold) + " --min-rounds " + str(getattr(S, "nl_Min_Rounds", 2)))
+                Task_Avg.inputs += [Input for Input in (S.LM_Avg_Mask, Previous_Avg) if Input not in Task_Avg.inputs]
+                Task_Avg.outputs.append(States[Round - 1])
+        P.add(Task_Avg)
+
+    #---------------------------------------------------------------------------------------------------------------
+    # Job resources.
+    #---------------------------------------------------------------------------------------------------------------
+    # Size the header of every job from the headers of its input volumes and the usage recorded by previous runs (see Resource_Model.py).
+    History = read_history(graph_path=getattr(S, "Graph_path", None))
+    Sizes = volume_sizes(getattr(S, "Preview_Source_path", None) or S.Source_MNC_path, getattr(S, "Local_MNC_path", None), S.LM_Avg, getattr(S, "Volume_Voxels", None),
+                         getattr(S, "Preview_Factor", None) or 1)
+    Margin = getattr(S, "Resource_Margin", 1.5)
+    if getattr(S, "Auto_Resources", False):
+        size_pipeline(P, History, Sizes, Margin)
+    # A pair only takes minutes, so the pairs are packed into jobs of about lsq12_Pack_Budget seconds of estimated work, with the memory of the largest pair.
+    # Without the sizes of their volumes or recorded runtimes, the cost of a pair is only a guess (DEFAULT_SECONDS), so every pair keeps its own job.
+    Pair_Tasks = [P.tasks[Name] for Name in P.arrays["lsq12_Third"].names]
+    if getattr(S, "lsq12_Pack_Budget", None) and all(estimated(Task_Pair, History, Task_Pair.size or task_size(Task_Pair, Sizes)) for Task_Pair in Pair_Tasks):
+        # The pairs of a previous build are up to date, so a grown atlas packs them apart from the new pairs, whose jobs are then the only ones submitted.
+        Previous_Names = set(P.arrays["lsq12_Third"].names[:len(Previous_Pairs)]) if Grow else set()
+        P.pack("lsq12_Third", lambda Task_Pair: task_cost(Task_Pair, History, Task_Pair.size or task_size(Task_Pair, Sizes)), S.lsq12_Pack_Budget, Margin,
+               max((Task_Pair.mem for Task_Pair in Pair_Tasks), key=parse_mem), (lambda Task_Pair: Task_Pair.name in Previous_Names) if Grow else None)
+
+    #---------------------------------------------------------------------------------------------------------------
+    # Intermediate files.
+    #---------------------------------------------------------------------------------------------------------------
+    # The plan of the intermediates every job releases once it is their last consumer, with the projected disk use of the stages (see Intermediate_Lifecycle.py).
+    if getattr(S, "Lifecycle_Mode", None):
+        P.lifecycle_path = "Lifecycle.json"
+        P.lifecycle = lifecycle_plan(P, S.Lifecycle_Mode, getattr(S, "Lifecycle_Keep", ()), getattr(S, "Archive_path", None), Sizes)
+
+    return P
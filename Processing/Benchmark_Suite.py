@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+
+"""
+This script benchmarks the pipelines without micro-CT data. It builds deterministic, skull-like phantoms with known warps, runs every stage of the atlas,
+pairwise, and label propagation pipelines on them with Local_Executor.py, and writes a machine-readable baseline (JSON) to compare later runs against.
+
+The phantoms are an ellipsoidal bone shell with a sagittal crest and two orbits around a soft-tissue interior, sampled at 35 um or 70 um (or any other
+voxel size) over a cubic field of view; the atlas is built by Scaled_Atlas.py at the voxel size of the phantoms. Every specimen is the template deformed by
+a known warp: a smooth displacement (a sum of Gaussian bumps) followed by an affine transformation (scales, rotations, and a translation), drawn from a
+seeded random generator, so the same arguments always give the same volumes. The ground truth is kept in <project>/Truth: the affine transformation of
+every specimen (<specimen>.xfm), its landmarks (<specimen>_Landmarks.tag), and every parameter (Phantoms.json).
+
+python3 Benchmark_Suite.py phantoms <directory> [--resolution 70] [--fov 4] [--specimens 10]    (only build a phantom project)
+python3 Benchmark_Suite.py stages <directory> [--resolutions 35 70] [--fovs 3 6] [--specimens 5 10] [--cores N]
+python3 Benchmark_Suite.py generation <directory> [--specimens 10 100 1000]
+
+stages runs every stage and reports its throughput (specimens per hour), peak memory, and generated files, from the telemetry of the commands (see
+Telemetry.py); generation times the generators themselves for growing specimen lists. Both add their results to <directory>/Benchmark_Baseline.json
+(or --output). Stages need the MINC Toolkit and ANTS on the PATH, and the phantoms need numpy and pyminc (pip install numpy pyminc); stages whose tools
+are missing are reported as skipped.
+"""
+
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import time
+from collections import OrderedDict
+
+import numpy as np
+try:
+    from pyminc.volumes.factory import volumeFromDescription
+except ImportError:
+    volumeFromDescription = None
+
+from Pipeline_DAG import Pipeline
+from Telemetry import command_name, latest_runs, read_records
+
+PROCESSING_PATH = os.path.dirname(os.path.abspath(__file__))
+# Voxel sizes (in um) of the phantoms. Scaled_Atlas.py builds the atlas at any of them; LoRes_Pairwise.py and Label_Propagation.py serve all of them.
+RESOLUTIONS = [35, 70]
+# Directory structure of a project, as printed by the generators.
+PROJECT_DIRS = ["Scripts", "Quality", "Truth", "Source/Blurred", "Source/MNC", "Source/Orig", "Source/Resample", "Source/Tag", "Source/XFM",
+                "lsq6/Blurred", "lsq6/MNC", "lsq6/XFM", "lsq12/Blurred", "lsq12/MNC", "lsq12/XFM",
+                "nl/Ana_Test", "nl/Blurred", "nl/INIT", "nl/MNC", "nl/XFM"]
+# Landmarks of the template, as fractions of the radii (x: left-right, y: posterior-anterior, z: inferior-superior) of the skull.
+LANDMARKS = OrderedDict([("Anterior", (0.0, 1.0, 0.0)), ("Posterior", (0.0, -1.0, 0.0)), ("Left", (-1.0, 0.0, 0.0)), ("Right", (1.0, 0.0, 0.0)),
+                         ("Vertex", (0.0, 0.0, 1.15)), ("Left_Orbit", (-0.45, 0.75, 0.25)), ("Right_Orbit", (0.45, 0.75, 0.25))])
+# Intensities (as stored, unsigned short) of bone and soft tissue, and the standard deviation of the noise.
+BONE, TISSUE, NOISE = 3000.0, 900.0, 40.0
+
+
+#-------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
+# Phantoms.
+#-------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
+def skull_radii(fov):
+    # Radii (x, y, z) of the skull ellipsoid in mm, leaving room for the warps in the field of view.
+    return np.array([0.30, 0.38, 0.24]) * fov
+
+
+def warp_parameters(fov, index, seed=1):
+    # The known warp of a specimen (index >= 1): Gaussian bumps of displacement in template space, then scales, rotations (degrees), and a translation (mm).
+    rng = random.Random(seed * 1000003 + index)
+    radii = skull_radii(fov)
+    bumps = [{"center": [rng.uniform(-r, r) for r in radii], "displacement": [rng.uniform(-0.03, 0.03) * fov for _ in range(3)], "width": 0.25 * fov}
+             for _ in range(3)]
+    return OrderedDict([("scales", [rng.uniform(0.93, 1.07) for _ in range(3)]), ("rotations", [rng.uniform(-4.0, 4.0) for _ in range(3)]),
+                        ("translation", [rng.uniform(-0.03, 0.03) * fov for _ in range(3)]), ("bumps", bumps)])
+
+
+def affine(parameters):
+    # The 4 x 4 world (mm) matrix of rotations about x, y, and z applied after the scales, followed by the translation.
+    ax, ay, az = [math.radians(angle) for angle in parameters["rotations"]]
+    rx = np.array([[1, 0, 0], [0, math.cos(ax), -math.sin(ax)], [0, math.sin(ax), math.cos(ax)]])
+    ry = np.array([[math.cos(ay), 0, math.sin(ay)], [0, 1, 0], [-math.sin(ay), 0, math.cos(ay)]])
+    rz = np.array([[math.cos(az), -math.sin(az), 0], [math.sin(az), math.cos(az), 0], [0, 0, 1]])
+    matrix = np.eye(4)
+    matrix[:3, :3] = rz.dot(ry).dot(rx).dot(np.diag(parameters["scales"]))
+    matrix[:3, 3] = parameters["translation"]
+    return matrix
+
+
+def displacement(points, parameters):
+    # Displacement (mm) of template points (n x 3) by the Gaussian bumps.
+    moved = np.zeros_like(points)
+    for bump in parameters["bumps"]:
+        weight = np.exp(-np.sum((points - bump["center"]) ** 2, axis=1) / (2.0 * bump["width"] ** 2))
+        moved += weight[:, None] * np.array(bump["displacement"])
+    return moved
+
+
+def warp(points, parameters):
+    # Template points (n x 3) to specimen points: W(p) = A (p + d(p)).
+    matrix = affine(parameters)
+    return (points + displacement(points, parameters)).dot(matrix[:3, :3].T) + matrix[:3, 3]
+
+
+def unwarp(points, parameters, iterations=6):
+    # Specimen points to template points, the inverse of warp: p = A^-1 x - d(p), solved by fixed-point iteration (the bumps are smooth and small).
+    matrix = np.linalg.inv(affine(parameters))
+    target = points.dot(matrix[:3, :3].T) + matrix[:3, 3]
+    template = target.copy()
+    for _ in range(iterations):
+        template = target - displacement(template, parameters)
+    return template
+
+
+def sigmoid(values):
+    return 1.0 / (1.0 + np.exp(-np.clip(values, -50.0, 50.0)))
+
+
+def template_tissues(points, fov, resolution):
+    # (bone, soft tissue) fractions of template points: an ellipsoidal shell with a sagittal crest, cut by two orbits, around a soft-tissue interior.
+    # Edges are smoothed over about a voxel, like the partial volumes of a scan, and the shell is at least four voxels thick.
+    radii = skull_radii(fov)
+    edge = resolution / 1000.0
+    rho = np.sqrt(np.sum((points / radii) ** 2, axis=1)) * radii.min()
+    thickness = max(0.08 * radii.min(), 4.0 * edge)
+    shell = sigmoid((radii.min() - rho) / edge) * sigmoid((rho - radii.min() + thickness) / edge)
+    crest = np.sqrt(np.sum(((points - [0.0, 0.0, radii[2]]) / (radii * [0.05, 0.7, 0.18])) ** 2, axis=1))
+    bone = np.maximum(shell, sigmoid((1.0 - crest) * radii[0] * 0.05 / edge))
+    for side in (-1.0, 1.0):
+        orbit = np.sqrt(np.sum((points - radii * [0.45 * side, 0.75, 0.25]) ** 2, axis=1))
+        bone *= sigmoid((orbit - 0.15 * radii.min()) / edge)
+    tissue = sigmoid((radii.min() - thickness - rho) / edge) * (1.0 - bone)
+    return bone, tissue
+
+
+def grid(fov, resolution):
+    # Voxels per dimension, and the world start of a field of view centred on the origin.
+    size = int(round(fov * 1000.0 / resolution))
+    step = resolution / 1000.0
+    return size, -(size - 1) / 2.0 * step, step
+
+
+def write_minc(path, fov, resolution, sample, volume_type="ushort", slab=16):
+    # Write a cubic volume (zspace, yspace, xspace) whose voxel values are sample(points), the points being (x, y, z) world coordinates, a few slices at a time.
+    if volumeFromDescription is None:
+        raise ImportError("Failed to import pyminc. Try 'pip install pyminc'")
+    size, start, step = grid(fov, resolution)
+    volume = volumeFromDescription(path, ("zspace", "yspace", "xspace"), (size, size, size), (start, start, start), (step, step, step),
+                                   volumeType=volume_type, dtype="float")
+    axis = start + step * np.arange(size)
+    y, x = np.meshgrid(axis, axis, indexing="ij")
+    for first in range(0, size, slab):
+        slices = range(first, min(first + slab, size))
+        points = np.concatenate([np.stack([x.ravel(), y.ravel(), np.full(x.size, axis[z])], axis=1) for z in slices])
+        volume.data[first:first + len(slices)] = sample(points).reshape(len(slices), size, size)
+    volume.writeFile()
+    volume.closeVolume()
+
+
+def write_tags(path, points, labels):
+    # An MNI tag file with one point (x, y, z in mm) per label.
+    with open(path, 'w') as tags:
+        tags.write("MNI Tag Point File\nVolumes = 1;\n\nPoints =\n")
+        tags.write("\n".join(" %.6f %.6f %.6f \"%s\"" % (point[0], point[1], point[2], label) for point, label in zip(points, labels)) + ";\n")
+
+
+def write_xfm(path, matrix):
+    # A linear MINC transformation file.
+    with open(path, 'w') as xfm:
+        xfm.write("MNI Transform File\n\nTransform_Type = Linear;\nLinear_Transform =\n")
+        xfm.write("\n".join(" " + " ".join("%.10f" % value for value in row) for row in matrix[:3]) + ";\n")
+
+
+def build_phantoms(project_path, resolution, fov, specimens, seed=1):
+    """
+    Write a phantom project: the directory structure of the generators, the specimens (Phantom_001.mnc, ...), the landmark initialized average and its mask
+    (LM_average.mnc and LM_average_mask.mnc, for the atlas), the atlas with its mask, segmentations, and landmarks (Phantom_Atlas*.mnc and .tag, for the
+    pairwise registrations and the label propagation), spec_list.txt, and the ground truth in Truth. Returns the specimen IDs.
+    """
+    for directory in PROJECT_DIRS:
+        os.makedirs(os.path.join(project_path, directory), exist_ok=True)
+    source = os.path.join(project_path, "Source", "MNC")
+    truth = os.path.join(project_path, "Truth")
+    noise = np.random.RandomState(seed)
+
+    def intensity(points):
+        bone, tissue = template_tissues(points, fov, resolution)
+        return np.clip(BONE * bone + TISSUE * tissue + noise.normal(0.0, NOISE, len(points)), 0.0, None)
+
+    def mask(points):
+        return (np.sqrt(np.sum((points / (skull_radii(fov) * 1.1)) ** 2, axis=1)) <= 1.0).astype(float)
+
+    def labels(points):
+        bone, _ = template_tissues(points, fov, resolution)
+        crest = points[:, 2] > skull_radii(fov)[2]
+        return np.where(bone > 0.5, np.where(crest, 2.0, 1.0), 0.0)
+
+    for name in ("LM_average.mnc", "Phantom_Atlas.mnc"):
+        write_minc(os.path.join(source, name), fov, resolution, intensity)
+    for name in ("LM_average_mask.mnc", "Phantom_Atlas_Mask.mnc"):
+        write_minc(os.path.join(source, name), fov, resolution, mask, "ubyte")
+    write_minc(os.path.join(source, "Phantom_Atlas_Segs.mnc"), fov, resolution, labels, "ubyte")
+    template_landmarks = np.array(list(LANDMARKS.values())) * skull_radii(fov)
+    write_tags(os.path.join(source, "Phantom_Atlas_Landmarks.tag"), template_landmarks, list(LANDMARKS))
+    Specimen_IDs, parameters = [], OrderedDict()
+    for index in range(1, specimens + 1):
+        SpecID = "Phantom_%03d" % index
+        parameters[SpecID] = warp_parameters(fov, index, seed)
+        write_minc(os.path.join(source, SpecID + ".mnc"), fov, resolution, lambda points: intensity(unwarp(points, parameters[SpecID])))
+        write_xfm(os.path.join(truth, SpecID + ".xfm"), affine(parameters[SpecID]))
+        write_tags(os.path.join(truth, SpecID + "_Landmarks.tag"), warp(template_landmarks, parameters[SpecID]), list(LANDMARKS))
+        Specimen_IDs.append(SpecID)
+    with open(os.path.join(project_path, "spec_list.txt"), 'w') as spec_list:
+        spec_list.write("\n".join(Specimen_IDs) + "\n")
+    with open(os.path.join(truth, "Phantoms.json"), 'w') as description:
+        json.dump(OrderedDict([("resolution_um", resolution), ("fov_mm", fov), ("voxels", grid(fov, resolution)[0] ** 3), ("seed", seed),
+                               ("landmarks", OrderedDict(zip(LANDMARKS, template_landmarks.tolist()))), ("specimens", parameters)]), description, indent=1)
+    return Specimen_IDs
+
+
+#-------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
+# Benchmarks.
+#-------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
+def run_generator(generator, answers, cwd):
+    # Run a generator with its prompts answered on stdin. Returns (seconds, peak resident memory in MB, exit code) of the generator process.
+    start = time.time()
+    process = subprocess.Popen([sys.executable, os.path.join(PROCESSING_PATH, generator + ".py")], cwd=cwd, stdin=subprocess.PIPE,
+                               stdout=subprocess.DEVNULL, universal_newlines=True)
+    process.stdin.write("\n".join(answers) + "\n")
+    process.stdin.close()
+    # os.wait4 gives the resource usage of this process alone.
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    return time.time() - start, usage.ru_maxrss / 1024.0, process.returncode
+
+
+def missing_tools(pipeline):
+    # Programs of the pipeline's commands that are not on the PATH (the Python scripts are installed next to the graph).
+    programs = set(command_name(command).split()[0] for task in pipeline.tasks.values() for command in task.commands)
+    return sorted(program for program in programs if program and not program.startswith("python") and program != "echo" and shutil.which(program) is None)
+
+
+def stage_results(project_path, graph_path, specimens, cores):
+    # Run a pipeline graph with Local_Executor.py, then summarize its telemetry by stage: tasks, wall span, specimens per hour, CPU, peak memory, and files.
+    # The generators record no telemetry by default, so it is turned on in the graph the executor runs.
+    with open(graph_path) as handle:
+        graph = json.load(handle, object_pairs_hook=OrderedDict)
+    graph["telemetry_path"] = os.path.join(project_path, "Telemetry") + os.sep
+    with open(graph_path, 'w') as handle:
+        json.dump(graph, handle, indent=1)
+    pipeline = Pipeline.load(graph_path)
+    missing = missing_tools(pipeline)
+    if missing:
+        return [OrderedDict([("stage", stage), ("skipped", "missing " + " ".join(missing))]) for stage in pipeline.stages()]
+    start = time.time()
+    subprocess.call([sys.executable, os.path.join(PROCESSING_PATH, "Local_Executor.py"), "graph", graph_path, "--cores", str(cores)], stdout=subprocess.DEVNULL)
+    records = [record for record in latest_runs(read_records(os.path.join(project_path, "Telemetry"))) if record["start"] >= start]
+    with open(os.path.join(os.path.dirname(graph_path), "Logs", "Local_Executor.json")) as summary:
+        statuses = json.load(summary)
+    results = []
+    for stage, tasks in pipeline.stages().items():
+        stage_records = [record for record in records if record["stage"] == stage]
+        outputs = [output for task in tasks for output in task.outputs]
+        result = OrderedDict([("stage", stage), ("tasks", len(tasks)),
+                              ("failed", sum(1 for task in tasks if statuses.get(task.name, {}).get("status") != "done"))])
+        if stage_records:
+            span = max(record["start"] + record["wall"] for record in stage_records) - min(record["start"] for record in stage_records)
+            result["seconds"] = round(span, 2)
+            result["specimens_per_hour"] = round(specimens * 3600.0 / span, 1) if span else None
+            result["cpu_seconds"] = round(sum(record["cpu"] for record in stage_records), 2)
+            result["peak_rss_mb"] = max(record["peak_rss_mb"] for record in stage_records)
+        result["files"] = sum(1 for output in outputs if os.path.exists(output))
+        results.append(result)
+    return results
+
+
+def benchmark_stages(directory, resolutions, fovs, counts, cores, seed=1):
+    """
+    For every resolution, field of view, and specimen count: build a phantom project and run the atlas pipeline, then the pairwise registrations and the label
+    propagation against the phantom atlas. Returns one result per stage.
+    """
+    results = []
+    for resolution in resolutions:
+        for fov in fovs:
+            for specimens in counts:
+                name = "Phantom_%dum_%smm_N%d" % (resolution, ("%g" % fov).replace(".", "p"), specimens)
+                setting = OrderedDict([("resolution_um", resolution), ("fov_mm", fov), ("voxels", grid(fov, resolution)[0] ** 3), ("specimens", specimens)])
+                runs = [("Scaled_Atlas", name + "_Atlas", "Atlas_Graph.json", []),
+                        ("LoRes_Pairwise", name + "_Pairwise", "Pairwise_Graph.json", ["Phantom_Atlas.mnc", "Phantom_Atlas_Mask.mnc"]),
+                        ("Label_Propagation", name + "_Pairwise", "Labels_Graph.json", ["Phantom_Atlas.mnc", "Phantom_Atlas_Mask.mnc", "Phantom_Atlas_Segs.mnc"])]
+                for generator, project, graph, answers in runs:
+                    project_path = os.path.join(directory, project)
+                    scripts_path = os.path.join(project_path, "Scripts")
+                    if not os.path.isfile(os.path.join(project_path, "spec_list.txt")):
+                        build_phantoms(project_path, resolution, fov, specimens, seed)
+                    if generator == "Label_Propagation":
+                        answers = answers + [os.path.join(project_path, "Source", "MNC", "Phantom_Atlas_Landmarks.tag"), "Phantom"]
+                    # Scaled_Atlas.py asks for the voxel size and the preview factor (none) before the local scripts directory.
+                    prompts = [project, directory + os.sep] + ([str(resolution), ""] if generator == "Scaled_Atlas" else [])
+                    seconds, _, code = run_generator(generator, prompts + [scripts_path, os.path.join(project_path, "spec_list.txt")] + answers, scripts_path)
+                    if code != 0:
+                        results.append(OrderedDict(setting, generator=generator, skipped="generator failed with exit code " + str(code)))
+                        continue
+                    for result in stage_results(project_path, os.path.join(scripts_path, graph), specimens, cores):
+                        results.append(OrderedDict(list(setting.items()) + [("generator", generator), ("generation_seconds", round(seconds, 2))] +
+                                                   list(result.items())))
+    return results
+
+
+def benchmark_generation(directory, counts, generators=("LoRes_Atlas", "HiRes_Atlas", "Scaled_Atlas", "LoRes_Pairwise", "HiRes_Pairwise", "Label_Propagation")):
+    # Time every generator on specimen lists of every count (no volumes are read): seconds, peak memory, and the number of files it writes.
+    results = []
+    for specimens in counts:
+        spec_list = os.path.join(directory, "spec_list_%d.txt" % specimens)
+        with open(spec_list, 'w') as handle:
+            handle.write("".join("Phantom_%03d\n" % index for index in range(1, specimens + 1)))
+        for generator in generators:
+            scripts_path = os.path.join(directory, "Generation_%s_N%d" % (generator, specimens))
+            if os.path.isdir(scripts_path):
+                shutil.rmtree(scripts_path)
+            os.makedirs(scripts_path)
+            answers = ["Phantom", directory + os.sep] + (["35", ""] if generator == "Scaled_Atlas" else []) + [scripts_path, spec_list]
+            if "Pairwise" in generator:
+                answers += ["Phantom_Atlas.mnc", "Phantom_Atlas_Mask.mnc"]
+            elif generator == "Label_Propagation":
+                answers += ["Phantom_Atlas.mnc", "Phantom_Atlas_Mask.mnc", "", "Phantom_Atlas_Landmarks.tag", "Phantom"]
+            seconds, rss, code = run_generator(generator, answers, scripts_path)
+            results.append(OrderedDict([("generator", generator), ("specimens", specimens), ("seconds", round(seconds, 3)), ("peak_rss_mb", round(rss, 1)),
+                                        ("exit_code", code), ("files", len(os.listdir(scripts_path)))]))
+            print(generator + " with " + str(specimens) + " specimens: " + "%.2f" % seconds + " s, " + "%.0f" % rss + " MB, " +
+                  str(results[-1]["files"]) + " files")
+    return results
+
+
+def save_baseline(path, key, results):
+    # Add (or replace) one section of the baseline, with the machine it was measured on.
+    baseline = OrderedDict()
+    if os.path.isfile(path):
+        with open(path) as handle:
+            baseline = json.load(handle, object_pairs_hook=OrderedDict)
+    baseline["machine"] = OrderedDict([("host", platform.node()), ("cpus", os.cpu_count()), ("python", platform.python_version()),
+                                       ("date", time.strftime("%Y-%m-%dT%H:%M:%S"))])
+    baseline[key] = results
+    with open(path, 'w') as handle:
+        json.dump(baseline, handle, indent=1)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark the pipelines on synthetic phantoms.")
+    parser.add_argument('action', choices=['phantoms', 'stages', 'generation'])
+    parser.add_argument('directory', help='Working directory of the phantom projects')
+    parser.add_argument('--resolution', type=int, default=70, help='phantoms: voxel size in um')
+    parser.add_argument('--fov', type=float, default=4.0, help='phantoms: edge of the cubic field of view in mm')
+    parser.add_argument('--resolutions', type=int, nargs='+', default=RESOLUTIONS, help='stages: voxel sizes in um')
+    parser.add_argument('--fovs', type=float, nargs='+', default=[3.0, 6.0], help='stages: fields of view in mm')
+    parser.add_argument('--specimens', type=int, nargs='+', default=None, help='Specimen counts (default: 10 for phantoms, 5 10 for stages, 10 100 1000 for generation)')
+    parser.add_argument('--cores', type=int, default=os.cpu_count(), help='stages: cores of the local executor')
+    parser.add_argument('--seed', type=int, default=1, help='Seed of the warps and the noise')
+    parser.add_argument('--output', default=None, help='Baseline file (default: <directory>/Benchmark_Baseline.json)')
+    args = parser.parse_args()
+
+    directory = os.path.abspath(args.directory)
+    os.makedirs(directory, exist_ok=True)
+    output = args.output or os.path.join(directory, "Benchmark_Baseline.json")
+    if args.action == 'phantoms':
+        project_path = os.path.join(directory, "Phantom_%dum" % args.resolution)
+        Specimen_IDs = build_phantoms(project_path, args.resolution, args.fov, (args.specimens or [10])[0], args.seed)
+        print(str(len(Specimen_IDs)) + " phantoms written to " + project_path)
+    elif args.action == 'stages':
+        save_baseline(output, "stages", benchmark_stages(directory, args.resolutions, args.fovs, args.specimens or [5, 10], args.cores, args.seed))
+        print("Baseline written to " + output)
+    else:
+        save_baseline(output, "generation", benchmark_generation(directory, args.specimens or [10, 100, 1000]))
+        print("Baseline written to " + output)
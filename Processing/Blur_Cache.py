@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+"""
+This module keeps a shared, content-addressed cache of blurred volumes, i.e., the blur pyramid of an atlas and its mask. Projects registered against the same atlas link the cached files instead of running mincblur again, so the serial Atlas_Blur job at the head of every pairwise run disappears once the cache holds the atlas.
+
+Every entry is keyed by the SHA-256 of the source volume and by the mincblur command (options and kernel) that produced it:
+
+<cache>/<source SHA-256>/<fwhm tag>_<command hash>/volume_blur.mnc (and volume_dxyz.mnc with -gradient)
+
+Entries are written into a temporary directory and renamed, so concurrent projects never see a partial entry, and the cached files are read-only, so no -clobber can write through the links. The pairwise generators call this module from the Scripts directory when Blur_Cache_path is set:
+
+python3 Blur_Cache.py blur --cache <dir> --command "<mincblur options> -fwhm " <fwhm> <source> <output base>    (link the entry, blurring into the cache first if it is missing)
+python3 Blur_Cache.py link --cache <dir> --command "<mincblur options> -fwhm " <fwhm> <source> <output base>    (link the entry, fail if it is missing; run on the login node by the submission script)
+
+To pre-populate the cache once per atlas (e.g., in an interactive job):
+
+python3 Blur_Cache.py populate --cache <dir> --command "mincblur -clobber -no_apodize -gradient -fwhm " <source> <fwhm> [<fwhm> ...]
+"""
+
+import argparse
+import hashlib
+import os
+import shlex
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+
+from Pipeline_DAG import STAMP_DIR, file_digest
+
+
+def suffixes(command):
+    # mincblur appends "_blur.mnc" (and "_dxyz.mnc" when -gradient is given) to the output base name.
+    return ["_blur.mnc"] + (["_dxyz.mnc"] if "-gradient" in command.split() else [])
+
+
+def entry(cache, command, fwhm, source, stamp_dir=STAMP_DIR):
+    # The cache directory of a blurred volume. The digest of the source is cached by Pipeline_DAG, so a large atlas is only hashed once.
+    digest = file_digest(source, stamp_dir)
+    if digest is None:
+        raise SystemExit(source + " does not exist.")
+    key = hashlib.sha256((" ".join(command.split()) + " " + fwhm).encode()).hexdigest()[:16]
+    return os.path.join(cache, digest, "%03d" % round(float(fwhm) * 1000) + "_" + key)
+
+
+def cached(directory, command):
+    return all(os.path.isfile(os.path.join(directory, "volume" + suffix)) for suffix in suffixes(command))
+
+
+def fill(directory, command, fwhm, source):
+    # Blur the source into a temporary directory next to the entry, then rename it into place; if another project filled the entry first, keep theirs.
+    if cached(directory, command):
+        return
+    parent = os.path.dirname(directory)
+    os.makedirs(parent, exist_ok=True)
+    temp = tempfile.mkdtemp(prefix=".tmp_", dir=parent)
+    try:
+        subprocess.check_call(shlex.split(command) + [fwhm, source, os.path.join(temp, "volume")])
+        with open(os.path.join(temp, "source.txt"), 'w') as note:
+            note.write(os.path.abspath(source) + "\n" + " ".join(command.split()) + " " + fwhm + "\n")
+        for suffix in suffixes(command):
+            os.chmod(os.path.join(temp, "volume" + suffix), stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+        try:
+            os.rename(temp, directory)
+        except OSError:
+            if not cached(directory, command):
+                raise
+    finally:
+        if os.path.isdir(temp):
+            shutil.rmtree(temp)
+
+
+def link(directory, command, base):
+    # Point the outputs of mincblur (base + suffix) at the cached files. Returns False, without touching the outputs, if the entry is missing.
+    if not cached(directory, command):
+        return False
+    for suffix in suffixes(command):
+        temp = base + suffix + ".link"
+        if os.path.lexists(temp):
+            os.remove(temp)
+        os.symlink(os.path.abspath(os.path.join(directory, "volume" + suffix)), temp)
+        os.replace(temp, base + suffix)
+    return True
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Shared, content-addressed cache of blurred volumes.")
+    parser.add_argument('action', choices=['blur', 'link', 'populate'])
+    parser.add_argument('--cache', required=True, help='Cache directory')
+    parser.add_argument('--command', required=True, help='mincblur command up to the kernel (e.g., "mincblur -clobber -no_apodize -gradient -fwhm ")')
+    parser.add_argument('--stamps', default=STAMP_DIR, help='Stamp directory holding the cached file digests')
+    parser.add_argument('arguments', nargs='+', help='blur/link: <fwhm> <source> <output base>; populate: <source> <fwhm> [<fwhm> ...]')
+    args = parser.parse_args()
+
+    if args.action == 'populate':
+        source, kernels = args.arguments[0], args.arguments[1:]
+        for fwhm in kernels:
+            directory = entry(args.cache, args.command, fwhm, source, args.stamps)
+            fill(directory, args.command, fwhm, source)
+            print(source + " at " + fwhm + ": " + directory)
+        sys.exit(0)
+    if len(args.arguments) != 3:
+        parser.error(args.action + " takes <fwhm> <source> <output base>")
+    fwhm, source, base = args.arguments
+    directory = entry(args.cache, args.command, fwhm, source, args.stamps)
+    if args.action == 'blur':
+        fill(directory, args.command, fwhm, source)
+    sys.exit(0 if link(directory, args.command, base) else 1)
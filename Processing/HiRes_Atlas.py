@@ -1,11 +1,15 @@
 # This is a Python script designed to generate an unbiased popoulation average. The script generates a series of bash (.sh) files that should be executed in parallel on a compute cluster. Any compute cluster can be used. To run these scripts, you must install the MINC Toolkit module onto the cluster beforehand, unless one already exists. You will notice here, for example, that we use a module called "minc/1.9.15", which is defined in the Bash header of every script via "module load minc/1.9.15". SLURM identifies the software on the cluster using this line. Other parameters you can play around with are time and memory. 
 
-# The resulting Bash scripts non-linearly register high-resolution mouse images (12 um) together. Other resolutions can be used to create an atlas, but the blurring and registratation step values need to be scaled accordingly. For instance, if you have 36 um image files, you would just scale the blurring values and the registration step values by a factor of 3. To execute these scripts, upload them to your remote /path/to/<PROJECT>/Scripts directory, and run "sbatch Job_Submission_First.sh". 
+# The resulting Bash scripts non-linearly register high-resolution mouse images (12 um) together. Other resolutions can be used to create an atlas, but the blurring and registratation step values need to be scaled accordingly. For instance, if you have 36 um image files, you would just scale the blurring values and the registration step values by a factor of 3. To execute these scripts, upload them to your remote /path/to/<PROJECT>/Scripts directory, and run "bash <PROJECT>_Atlas_Submission.sh" on the login node. 
 
 # To use OS dependent functionality.
 import os
 # To read and write data in the .csv format.
 import csv
+# To describe the atlas construction as a DAG of tasks and write one .sh script per task.
+from Pipeline_DAG import install
+from Intermediate_Lifecycle import report as lifecycle_report
+from Atlas_Pipeline import build_atlas_pipeline
 
 #-------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
 # PLEASE READ! THE ONLY VARIABLES THAT NEED TO BE EDITED WITHIN THIS SCRIPT ARE BETWEEN THESE DASHED LINES.
@@ -46,8 +50,13 @@ lsq12_Time = "07:00:00"
 lsq12_Mem = "30000M"
 nl_Time = "11:00:00"
 nl_Mem = "30000M"
-Job_Submission_Time = "05-00:00:00"
-Job_Submission_Mem = "2000M"
+# Submit every per-specimen (and per-pair) stage as a single SLURM job array instead of one sbatch per script. At most Array_Concurrency elements of an array run at the same time (--array=1-N%K).
+Array_Jobs = True
+Array_Concurrency = "50"
+# Size the --mem and --time of every job from the headers of the volumes it reads (mincinfo dimensions and data type) and from the usage recorded by previous runs (the Stamps directory of the cluster, copied next to these scripts before regenerating them), times Resource_Margin; the Mem and Time above become ceilings. Local_MNC_path is a directory holding the specimens and the landmark initialized average (LM_average.mnc) (set it to Source_MNC_path when generating the scripts on the cluster); without it, the jobs are sized from Volume_Voxels (below) or from the recorded usage. Set Auto_Resources = False to use the Mem and Time above for every job.
+Auto_Resources = True
+Local_MNC_path = None
+Resource_Margin = 1.5
 
 # Echo default parameters.
 print("\nThese are the default compute cluster parameters:")
@@ -59,8 +68,8 @@ print(f"lsq12 Time: {lsq12_Time}")
 print(f"lsq12 Memory: {lsq12_Mem}")
 print(f"nl Time: {nl_Time}")
 print(f"nl Memory: {nl_Mem}")
-print(f"Job Submission Time: {Job_Submission_Time}")
-print(f"Job Submission Memory: {Job_Submission_Mem}\n")
+print(f"Job arrays: {Array_Jobs}")
+print(f"Job array concurrency: {Array_Concurrency}\n")
 
 # Reminder to change parameters if needed.
 print(f"They need to be changed manually if you encounter any errors. Please put these scripts into the {PROJECT_PATH}Scripts directory and all of your image data into the {PROJECT_PATH}Source/MNC/ directory. \n")
@@ -82,6 +91,9 @@ nl_Init_path = PROJECT_PATH + "nl/INIT/"
 nl_Blurred_path = PROJECT_PATH + "nl/Blurred/"
 nl_XFM_path = PROJECT_PATH + "nl/XFM/"
 nl_MNC_path = PROJECT_PATH + "nl/MNC/"
+Quality_path = PROJECT_PATH + "Quality/"
+# With Telemetry_path, every command of the scripts appends its runtime, CPU time, peak memory, exit code, and disk I/O to Telemetry_path/<task>.jsonl; copy the directory back and run "python3 Telemetry.py report <Telemetry directory> --graph Atlas_Graph.json" for the hot spots of every stage and the critical path. Recording is opt-in: set Telemetry_path (e.g., PROJECT_PATH + "Telemetry/") to record; the default None runs the commands as they are.
+Telemetry_path = None
 
 # Define average files.
 LM_Avg = Source_MNC_path + "LM_average.mnc"
@@ -93,50 +105,6 @@ nl_2_Avg = nl_MNC_path + "NL_2_average.mnc"
 nl_3_Avg = nl_MNC_path + "NL_3_average.mnc"
 nl_4_Avg = nl_MNC_path + PROJECT_NAME + "_Atlas.mnc"
 
-# Define blur files without "_blur" suffix.
-LM_Avg_167 = Source_MNC_path + "LM_average_167"
-LM_Avg_088 = Source_MNC_path + "LM_average_088"
-LM_Avg_049 = Source_MNC_path + "LM_average_049"
-LM_Avg_039 = Source_MNC_path + "LM_average_039"
-LM_Avg_032 = Source_MNC_path + "LM_average_032"
-LM_Avg_025 = Source_MNC_path + "LM_average_025"
-LM_Avg_Mask_400 = nl_Init_path + "LM_average_mask_400"
-LM_Avg_Mask_300 = nl_Init_path + "LM_average_mask_300"
-LM_Avg_Mask_200 = nl_Init_path + "LM_average_mask_200"
-LM_Avg_Mask_100 = nl_Init_path + "LM_average_mask_100"
-LM_Avg_Mask_167 = Source_MNC_path + "LM_average_mask_167"
-LM_Avg_Mask_088 = Source_MNC_path + "LM_average_mask_088"
-LM_Avg_Mask_049 = Source_MNC_path + "LM_average_mask_049"
-LM_Avg_Mask_039 = Source_MNC_path + "LM_average_mask_039"
-LM_Avg_Mask_032 = Source_MNC_path + "LM_average_mask_032"
-LM_Avg_Mask_025 = Source_MNC_path + "LM_average_mask_025"
-lsq12_Avg_400 = nl_Init_path + PROJECT_NAME + "_lsq12_average_400"
-nl_1_Avg_300 = nl_Init_path + "NL_1_average_300"
-nl_2_Avg_200 = nl_Init_path + "NL_2_average_200"
-nl_3_Avg_100 = nl_Init_path + "NL_3_average_100"
-
-# Define blur files with "_blur" suffix.
-LM_Avg_167_Blur = Source_MNC_path + "LM_average_167_blur.mnc"
-LM_Avg_088_Blur = Source_MNC_path + "LM_average_088_blur.mnc"
-LM_Avg_049_Blur = Source_MNC_path + "LM_average_049_blur.mnc"
-LM_Avg_039_Blur = Source_MNC_path + "LM_average_039_blur.mnc"
-LM_Avg_032_Blur = Source_MNC_path + "LM_average_032_blur.mnc"
-LM_Avg_025_Blur = Source_MNC_path + "LM_average_025_blur.mnc"
-LM_Avg_Mask_400_Blur = nl_Init_path + "LM_average_mask_400_blur.mnc"
-LM_Avg_Mask_300_Blur = nl_Init_path + "LM_average_mask_300_blur.mnc"
-LM_Avg_Mask_200_Blur = nl_Init_path + "LM_average_mask_200_blur.mnc"
-LM_Avg_Mask_100_Blur = nl_Init_path + "LM_average_mask_100_blur.mnc"
-LM_Avg_Mask_167_Blur = Source_MNC_path + "LM_average_mask_167_blur.mnc"
-LM_Avg_Mask_088_Blur = Source_MNC_path + "LM_average_mask_088_blur.mnc"
-LM_Avg_Mask_049_Blur = Source_MNC_path + "LM_average_mask_049_blur.mnc"
-LM_Avg_Mask_039_Blur = Source_MNC_path + "LM_average_mask_039_blur.mnc"
-LM_Avg_Mask_032_Blur = Source_MNC_path + "LM_average_mask_032_blur.mnc"
-LM_Avg_Mask_025_Blur = Source_MNC_path + "LM_average_mask_025_blur.mnc"
-lsq12_Avg_400_Blur = nl_Init_path + PROJECT_NAME + "_lsq12_average_400_blur.mnc"
-nl_1_Avg_300_Blur = nl_Init_path + "NL_1_average_300_blur.mnc"
-nl_2_Avg_200_Blur = nl_Init_path + "NL_2_average_200_blur.mnc"
-nl_3_Avg_100_Blur = nl_Init_path + "NL_3_average_100_blur.mnc"
-
 # Open and read ('r') the specimen list.
 Specimen_List=open(All_Specimens,'r')
 # Read specimen list as a single string.
@@ -145,17 +113,22 @@ Specimens=Specimen_List.read()
 Specimen_IDs=Specimens.split('\n')
 # Remove the last blank entry caused by the final \n.
 del Specimen_IDs[-1]
-# Define the length of the specimen list.
-Specimen_List_Length=len(Specimen_IDs)
-# Divide the length of the list by the same number.
-Specimen_Group=int(Specimen_List_Length/Specimen_List_Length)
-# Calculate upper limit of specimen list to use in for loop sequences.
-Specimen_Upper=(Specimen_List_Length*Specimen_List_Length)-1
 # Close the specimen list.
 Specimen_List.close()
 
 # Code the strings for iterative blurring via mincblur. -clobber overwrites existing files; -no apodize turns off apodization, which is designed to reduce diffraction edge effects (e.g., detector noise); -gradient calculates the change in intensity of a single pixel in the source image to the target image; -fwhm stands for full-width at half-maximum. In other words, what we want to do is convolve a "smoothing kernel", or Gaussian function, over an input volume in order to average neighboring points. The full-width at half-maximum describes the width of the Gaussian function at half of its peak to the left and right;
 MNC_Blur = "mincblur -clobber -no_apodize -gradient -fwhm "
+# Blur_Engine = "Multi_Blur" replaces the chained mincblur calls with Multi_Blur.py, which reads every volume once and writes all of its blurring kernels (separable Gaussian filtering), and only writes gradient volumes (_dxyz.mnc) where ANTS reads them. It needs numpy, scipy, and pyminc on the cluster (pip install numpy scipy pyminc), so it is opt-in; the default Blur_Engine = "mincblur" uses MNC_Blur with the MINC Toolkit alone.
+Blur_Engine = "mincblur"
+# Average_Engine = "Streaming_Average" replaces the mincaverage call at the end of every stage with Streaming_Average.py: every per-specimen job folds its resampled file into a running sum (memory-mapped, in <average>.stream next to the average) as soon as it is written, the job of the last specimen writes the average (as floats), and the average job only checks it against its inputs. The files are read from Atlas_Graph.json instead of one command line, which overflows for large cohorts. It needs numpy and pyminc on the cluster, so it is opt-in; the default Average_Engine = "mincaverage" uses MNC_Avg. With Stream_Variance = True, a variance map (<average>_variance.mnc) is written next to every average.
+# For very large cohorts (e.g., over 1,000 specimens), Average_Engine = "Tree" spreads every average over jobs instead: partial sums of Tree_Fan_In files each (<average>_tree/), combined Tree_Fan_In at a time until one job divides the total, so no job reads more than Tree_Fan_In volumes. The partial sums are compensated, so the average does not depend on Tree_Fan_In (python3 Streaming_Average.py selftest checks this).
+Average_Engine = "mincaverage"
+Stream_Variance = False
+Tree_Fan_In = 32
+# XFM_Engine = "XFM_Algebra" concatenates and inverts the transformation files with XFM_Algebra.py instead of xfmconcat and xfminvert: the linear parts are composed exactly, and the concatenated files (e.g., _origtonl_1.xfm) reference the displacement grids of the non-linear registrations instead of copying them, which saves one grid volume per specimen and transformation. The referenced grids must then stay next to their registration files. It needs numpy on the cluster and changes the format of the concatenated files, so it is opt-in; the default XFM_Engine = "xfmconcat" uses the MINC tools.
+XFM_Engine = "xfmconcat"
+# lsq12_Average_Engine = "XFM_Average" replaces the xfmavg call of every lsq12_Fourth job with one job (lsq12_XFM_Average) that reads all pairwise lsq12 transformations into one array and writes the log-Euclidean mean (the mean of the matrix logarithms, as xfmavg takes it) of every specimen with XFM_Average.py, in seconds. It needs numpy on the cluster, so it is opt-in; the default lsq12_Average_Engine = "xfmavg" uses xfmavg.
+lsq12_Average_Engine = "xfmavg"
 
 # Code the hierarchical registration strings which call upon the minctracc command. -clobber overwrites existing files; -xcorr stands for cross-correlation, which is the similarity metric to be optimized (maximized); -lsq6 indicates that we want perform a rigid body transformation with six degrees of freedom (translation (z,y,x) and rotation (z,y,x)); -lsq12 indicates that we want to perform a 12-parameter affine transformation with twelve degrees of freedom (translation (z,y,x), rotation (z,y,x), scale (z,y,x), and shear (z,y,x)); -w_translations/rotations/scales/shear optimization weights along z,y,x; -step is the z,y,x resolution; -simplex is the optimizer; -tol is the value at which the optimization stops.
 lsq6_Register_167_Blur = "minctracc -clobber -xcorr -lsq6 -w_translations 0.4 0.4 0.4 -w_rotations 0.0174533 0.0174533 0.0174533 -w_scales 0.02 0.02 0.02 -w_shear 0.02 0.02 0.02 -step 0.167 0.167 0.167 -simplex 0.39 -use_simplex -tol 0.0001 "
@@ -173,462 +146,74 @@ nl_3_Register_200_Blur_End = "-iterations 15 -similarity 0.8 -weight 0.8 -stiffn
 nl_4_Register_100_Blur_Begin = "minctracc -clobber -xcorr -w_translations 0.4 0.4 0.4 -w_rotations 0.0174533 0.0174533 0.0174533 -w_scales 0.02 0.02 0.02 -w_shear 0.02 0.02 0.02 -step 0.1 0.1 0.1 -simplex 0.6 -use_simplex -tol 0.0001 "
 nl_4_Register_100_Blur_End = "-iterations 15 -similarity 0.8 -weight 0.8 -stiffness 0.98 -nonlinear corrcoeff -sub_lattice 6 -lattice_diameter 0.3 0.3 0.3 -max_def_magnitude 1 -debug -xcorr -transform "
 
-# Beginning of mincbigaverage command to which .mnc files will be added.
-lsq6_MNC_Avg = "mincaverage -clobber -2 -filetype -nonormalize "
-lsq12_MNC_Avg = "mincaverage -clobber -2 -filetype -nonormalize "
-nl_1_MNC_Avg = "mincaverage -clobber -2 -filetype -nonormalize "
-nl_2_MNC_Avg = "mincaverage -clobber -2 -filetype -nonormalize "
-nl_3_MNC_Avg = "mincaverage -clobber -2 -filetype -nonormalize "
-nl_4_MNC_Avg = "mincaverage -clobber -2 -filetype -nonormalize "
+# Beginning of mincaverage command to which .mnc files will be added.
+MNC_Avg = "mincaverage -clobber -2 -filetype -nonormalize "
+
+# Blurring kernels (full-width at half-maximum, in mm) and their registration strings, from the most to the least blurred image. Blurred files are named after the kernel size in microns (e.g., LM_average_167_blur.mnc). These blur values should be decided upon with respect to the original resolution of the image.
+lsq6_Levels = [("0.167", lsq6_Register_167_Blur), ("0.088", lsq6_Register_088_Blur), ("0.039", lsq6_Register_039_Blur)]
+lsq12_Levels = [("0.049", lsq12_Register_049_Blur), ("0.032", lsq12_Register_032_Blur), ("0.025", lsq12_Register_025_Blur)]
+nl_Levels = [("0.4", nl_1_Register_400_Blur_Begin, nl_1_Register_400_Blur_End), ("0.3", nl_2_Register_300_Blur_Begin, nl_2_Register_300_Blur_End), ("0.2", nl_3_Register_200_Blur_Begin, nl_3_Register_200_Blur_End), ("0.1", nl_4_Register_100_Blur_Begin, nl_4_Register_100_Blur_End)]
+
+# Pairwise lsq12 design. With lsq12_Partners = None, every specimen is registered to every specimen (N x N registrations). For large cohorts, set lsq12_Partners to k to register each specimen to only k partners and average over those, either "random" partners or "stratified" partners, which are drawn in proportion to the strata (Strata_Columns) of the metadata table (matched on its Biosample column).
+lsq12_Partners = None
+lsq12_Partner_Mode = "random"
+Metadata_CSV = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Postprocessing", "Data", "Metadata", "MusMorph_Metadata_Mar2024.csv")
+Strata_Columns = ["Experimental_Group", "Genotype"]
+# With lsq12_Symmetric = True, only one direction of every pair (A to B) is registered, and B to A is the inverse (xfminvert) of the 12-parameter transformation, which halves the pairwise registrations.
+lsq12_Symmetric = False
+# Pack the pairwise lsq12 registrations into jobs of about lsq12_Pack_Budget seconds of estimated work, instead of one job (or array element) per pair; the headers of these jobs are sized to the packed work. A pair is estimated like every job (see Auto_Resources above): from its runtime in a previous run, or from the size of its volumes. Volume_Voxels, the number of voxels of the average (the product of mincinfo -dimlength xspace, yspace, and zspace), stands in for the volume headers when Local_MNC_path is not set. Without the sizes or the runtimes of a previous run, the cost of a pair is unknown, and every pair keeps its own job. Set lsq12_Pack_Budget = None for one job per pair.
+lsq12_Pack_Budget = 4 * 3600
+Volume_Voxels = None
+# Seed of the random partner choices, so regenerating the scripts gives the same design.
+lsq12_Seed = 1
+# With k partners, the full N x N lsq12 average is also computed for lsq12_Drift_Subset random specimens, and Quality/<PROJECT>_lsq12_Drift.txt reports how far the k-partner results drift from it.
+lsq12_Drift_Subset = 10
+
+# Non-linear convergence. With nl_Convergence_Threshold (e.g., 0.002), every non-linear average is compared with the previous one and every resampled specimen with the new average, within the mask (minccmp cross-correlation), and Quality/<PROJECT>_nl_<round>_Convergence.json keeps the result. Once nl_Min_Rounds rounds are done and the average changes by less than the threshold (1 - cross-correlation), and the specimens gain less than the threshold in cross-correlation, the later rounds carry the last transformations, specimens, and average over instead of registering again. Below nl_Shorten_Threshold (3 x the threshold when None), the next round runs with half of its minctracc iterations. Set nl_Convergence_Threshold = None to always run every round in full.
+nl_Convergence_Threshold = None
+nl_Shorten_Threshold = None
+nl_Min_Rounds = 2
+# Quality gates. With Gate_Threshold (e.g., 3.5), a gate job follows the lsq6 and lsq12 stages and every non-linear round (Gate_lsq6, Gate_lsq12, Gate_nl_1, ...): every resampled specimen is compared with the target of the stage within the mask (cross-correlation of volumes downsampled Gate_Downsample times; see Quality_Gate.py), and the specimens more than Gate_Threshold robust z-scores below the others, or below Gate_Min_Xcorr, are quarantined. The later jobs of a quarantined specimen end without running, it is left out of every later average, and Quality/<PROJECT>_<stage>_Gate.csv reports the measures and the status of every specimen. Once the source of a quarantined specimen is fixed (e.g., its landmarks), rerunning the jobs measures it again. Gate_Threshold = None (the default) keeps every specimen.
+Gate_Threshold = None
+Gate_Min_Xcorr = None
+Gate_Downsample = 2
+# Incremental growth. When new specimens arrive (e.g., a new litter), add them to the specimen list and set Grow_Atlas = True: the specimens and lsq12 pairs of the previous build, read from the Atlas_Graph.json it left in this directory, keep their task names, so their stamps still hold and only the new rows and columns of the pairwise lsq12 matrix are registered (about 2 x N x m pairs for m new specimens instead of (N + m)^2) before the averages are recomputed. Keep LM_average.mnc and the files of the previous build, and use the full pairwise design (lsq12_Partners = None). With Previous_Atlas (e.g., CLUSTER_PATH + PROJECT_NAME + "/Previous_atlas.mnc", a copy of the final non-linear average of the previous build), the first non-linear round registers to the previous atlas instead of the lsq12 average, and with nl_Convergence_Threshold the later rounds are carried over once the average stops changing.
+Grow_Atlas = False
+Previous_Atlas = None
+# Intermediate files. With Lifecycle_Mode = "delete", every .mnc and .xfm file a job writes (the blurs and gradients, the lsq12 pairs, the resampled volumes of every round, ...) is deleted once the last job that reads it has succeeded (see Intermediate_Lifecycle.py), so a HiRes run fits the scratch quota; "archive" compresses it into Archive_path first. The files matching Lifecycle_Keep (fnmatch patterns on the paths or file names) are kept, and the non-linear transformations are always kept with their grids. The stamps keep the checksums of the released files, so the jobs around them stay up to date; a job that runs again restores its archived inputs, and <PROJECT>_Atlas_Submission.sh runs the jobs of deleted inputs again (with Grow_Atlas, use "archive", or the lsq12 pairs of the previous build run again). <PROJECT>_Atlas_Submission.sh prints the projected peak disk use with and without the releases before submitting. Set Lifecycle_Mode = None to keep every file.
+Lifecycle_Mode = None
+Lifecycle_Keep = ["*_average.mnc", "*_Atlas.mnc", "*_lsq6_2.xfm", "*_lsq12_AVG.xfm", "*_origtolsq12.xfm", "*_nl_4.mnc", "*_origtonl_4.xfm"]
+Archive_path = PROJECT_PATH + "Archive/"
 
 #-------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
 # Begin writing .sh scripts that will be submitted to the cluster.
 #-------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
-
-#-------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
-# 6-parameter (translation (z,y,x), rotation (z,y,x)) optimized rigid body registration.
-#-------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
-# Open a file to write to; 'a' for append; lsq6_First is the first 6-parameter .sh script to submit, because it blurs the intended target (i.e., the landmark initialized average) as well as a mask of equivalent resolution to constrain our computation.
-lsq6_First = open("lsq6_First.sh",'a')
-# Write standard .sh header. This header is needed for SLURM job submission.
-lsq6_First.write("#!/bin/bash\n#SBATCH --nodes=" + n_nodes + "\n#SBATCH --mem=" + lsq6_Mem + "\n#SBATCH --time=" + lsq6_Time + "\n\nmodule load " + Module + "\n\ncd " + Scripts_path + "\n\necho \"The job started at $(date).\"\n\n")
-# Write commands to blur LM_average and LM_average_mask with isotropic blurring kernels of 167 microns, 88 microns, and 78 microns. These blur values should be decided upon with respect to the original resolution of the image. Here, we're assuming 35 micron resolution.
-lsq6_First.write(MNC_Blur + "0.167 " + LM_Avg + " " + LM_Avg_167 + "\n")
-lsq6_First.write(MNC_Blur + "0.088 " + LM_Avg + " " + LM_Avg_088 + "\n")
-lsq6_First.write(MNC_Blur + "0.039 " + LM_Avg + " " + LM_Avg_039 + "\n")
-lsq6_First.write(MNC_Blur + "0.167 " + LM_Avg_Mask + " " + LM_Avg_Mask_167 + "\n")
-lsq6_First.write(MNC_Blur + "0.088 " + LM_Avg_Mask + " " + LM_Avg_Mask_088 + "\n")
-lsq6_First.write(MNC_Blur + "0.039 " + LM_Avg_Mask + " " + LM_Avg_Mask_039 + "\n\n")
-lsq6_First.write("echo \"The job ended at $(date).\"")
-# Close the file.
-lsq6_First.close()
-
-# Begin a for loop to blur all landmark initialized source files, register them to LM_Average, and resample each image into the new translation and rotation invariant space.
-# Note that we ideally want to resample the LM initialized images (e.g., SpecID_to_Target.mnc), rather than the original .mnc images. Hence, the LM .xfm is not included in the concatenation.
-# Begin a counter.
-i=0
-for SpecID in Specimen_IDs:
-	# Add 1 to the counter for every new file in the loop.
-	i += 1
-	# Open a file to write to; 'a' for append; lsq6_Second is the second stage of .sh scripts to submit.
-	lsq6_Second = open("lsq6_Second_" + str(i) + ".sh",'a')
-	# Add header.
-	lsq6_Second.write("#!/bin/bash\n#SBATCH --nodes=" + n_nodes + "\n#SBATCH --mem=" + lsq6_Mem + "\n#SBATCH --time=" + lsq6_Time + "\n\nmodule load " + Module + "\n\ncd " + Scripts_path + "\n\necho \"The job started at $(date).\"\n\n")
-	lsq6_Second.write("echo \"Begin the optimized 6-parameter registration for " + SpecID + ".\"\n\n")
-	# Blur each image, as done with the average and average mask, with a 0.167, 0.088, and 0.039 isotropic Gaussian blurring kernel. These blur values should be decided upon with respect to the original resolution of the image.
-	lsq6_Second.write(MNC_Blur + "0.167 " + Source_MNC_path + SpecID + ".mnc " + lsq6_Blurred_path + SpecID + "_167\n")
-	lsq6_Second.write(MNC_Blur + "0.088 " + Source_MNC_path + SpecID + ".mnc " + lsq6_Blurred_path + SpecID + "_088\n")
-	lsq6_Second.write(MNC_Blur + "0.039 " + Source_MNC_path + SpecID + ".mnc " + lsq6_Blurred_path + SpecID + "_039\n")
-	# Call registration strings. We begin with the most blurred (e.g., 0.167) image. -model_mask specifies the mask we wish to use. Note that we use a mask with the same amount of blurring; -identity specifies an identity matrix that initializes the transformation matrix. Upon specifying a transformation matrix, we extract the relevant transformation parameters (here, rotation and translation) and optimize them to find the best transformation; -transformation specifies a file giving a previous source to target mapping, which is used as the new coordinate starting point for the optimization.
-	lsq6_Second.write(lsq6_Register_167_Blur + lsq6_Blurred_path + SpecID + "_167_blur.mnc " + LM_Avg_167_Blur + " " + lsq6_XFM_path + SpecID + "_lsq6_0.xfm -model_mask " + LM_Avg_Mask_167_Blur + " -identity\n")
-	lsq6_Second.write(lsq6_Register_088_Blur + lsq6_Blurred_path + SpecID + "_088_blur.mnc " + LM_Avg_088_Blur + " " + lsq6_XFM_path + SpecID + "_lsq6_1.xfm -model_mask " + LM_Avg_Mask_088_Blur + " -transformation " + lsq6_XFM_path + SpecID + "_lsq6_0.xfm\n")
-	lsq6_Second.write(lsq6_Register_039_Blur + lsq6_Blurred_path + SpecID + "_039_blur.mnc " + LM_Avg_039_Blur + " " + lsq6_XFM_path + SpecID + "_lsq6_2.xfm -model_mask " + LM_Avg_Mask_039_Blur + " -transformation " + lsq6_XFM_path + SpecID + "_lsq6_1.xfm\n")
-	# Resample the original image into the rotation and translation invariant space using the concatenated transformation. Be mindful of your "original" images and their naming convention.
-	lsq6_Second.write("mincresample -like " + LM_Avg + " -clobber -transformation " + lsq6_XFM_path + SpecID + "_lsq6_2.xfm " + Source_MNC_path + SpecID + ".mnc " + lsq6_MNC_path + SpecID + "_lsq6.mnc\n\n")
-	lsq6_Second.write("echo \"The job ended at $(date).\"")
-	# Close the 6-parameter blur/register file.
-	lsq6_Second.close()
-
-# Open a file to write to; 'a' for append; lsq6_Third is the third and final stage of 6-parameter .sh scripts to submit.
-lsq6_Third = open("lsq6_Third.sh",'a')
-# Add header.
-lsq6_Third.write("#!/bin/bash\n#SBATCH --nodes=" + n_nodes + "\n#SBATCH --mem=" + lsq6_Mem + "\n#SBATCH --time=" + lsq6_Time + "\n\nmodule load " + Module + "\n\ncd " + Scripts_path + "\n\necho \"The job started at $(date).\"\n\n")
-lsq6_Third.write("echo \"All lsq6 files are being averaged.\"\n")
-# Add _lsq6.mnc files to MNC_Avg string.
-for SpecID in Specimen_IDs:
-	lsq6_MNC_Avg += lsq6_MNC_path + SpecID + "_lsq6.mnc "
-lsq6_Third.write(lsq6_MNC_Avg + lsq6_Avg + "\n\n")
-lsq6_Third.write("echo \"The job ended at $(date).\"")
-# Close the 6-parameter average file.
-lsq6_Third.close()
-
-#-------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
-# 12-parameter (translation (z,y,x), rotation (z,y,x), scale (z,y,x), shear (z,y,x)) optimized affine registration.
-#-------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
-# Open file to write to; 'a' for append; lsq12_First is the first 12-parameter .sh script to submit, because it blurs the like file (LM_average) and the mask to constrain our computation.
-lsq12_First = open("lsq12_First.sh",'a')
-# Add header.
-lsq12_First.write("#!/bin/bash\n#SBATCH --nodes=" + n_nodes + "\n#SBATCH --mem=" + lsq12_Mem + "\n#SBATCH --time=" + lsq12_Time + "\n\nmodule load " + Module + "\n\ncd " + Scripts_path + "\n\necho \"The job started at $(date).\"\n\n")
-lsq12_First.write("echo \"We are blurring LM_average and LM_average_mask.\"\n")
-lsq12_First.write(MNC_Blur + "0.049 " + LM_Avg + " " + LM_Avg_049 + "\n")
-lsq12_First.write(MNC_Blur + "0.032 " + LM_Avg + " " + LM_Avg_032 + "\n")
-lsq12_First.write(MNC_Blur + "0.025 " + LM_Avg + " " + LM_Avg_025 + "\n")
-lsq12_First.write(MNC_Blur + "0.049 " + LM_Avg_Mask + " " + LM_Avg_Mask_049 + "\n")
-lsq12_First.write(MNC_Blur + "0.032 " + LM_Avg_Mask + " " + LM_Avg_Mask_032 + "\n")
-lsq12_First.write(MNC_Blur + "0.025 " + LM_Avg_Mask + " " + LM_Avg_Mask_025 + "\n\n")
-lsq12_First.write("echo \"The job ended at $(date).\"")
-# Close the average blur file.
-lsq12_First.close()
-
-# Write commands to blur each specimen with isotropic blurring kernels equal in size to those used in lsq12_First.
-# Begin a counter.
-i=0
-for SpecID in Specimen_IDs:
-	# Add 1 to the counter for every new file in the loop.
-	i += 1
-	# Open a file to write to; 'a' for append; lsq12_Second is the second 12-parameter stage designed to blur every specimen in a descending fashion for the hierarchical registration.
-	lsq12_Second = open("lsq12_Second_" + str(i) + ".sh",'a')
-	# Add header.
-	lsq12_Second.write("#!/bin/bash\n#SBATCH --nodes=" + n_nodes + "\n#SBATCH --mem=" + lsq12_Mem + "\n#SBATCH --time=" + lsq12_Time + "\n\nmodule load " + Module + "\n\ncd " + Scripts_path + "\n\necho \"The job started at $(date).\"\n\n")
-	lsq12_Second.write("echo \"We are blurring " + SpecID + ".\"\n")
-	# Blur the previously created lsq6 images, as done with the average and average mask, with a 0.049, 0.032, and 0.025 isotropic Gaussian blurring kernel. These blur values should be decided upon with respect to the original resolution of the image.
-	lsq12_Second.write(MNC_Blur + "0.049 " + lsq6_MNC_path + SpecID + "_lsq6.mnc " + lsq12_Blurred_path + SpecID + "_049\n")
-	lsq12_Second.write(MNC_Blur + "0.032 " + lsq6_MNC_path + SpecID + "_lsq6.mnc " + lsq12_Blurred_path + SpecID + "_032\n")
-	lsq12_Second.write(MNC_Blur + "0.025 " + lsq6_MNC_path + SpecID + "_lsq6.mnc " + lsq12_Blurred_path + SpecID + "_025\n\n")
-	lsq12_Second.write("echo \"The job ended at $(date).\"")
-	# Close the 12-parameter blur file.
-	lsq12_Second.close()
-
-# Create a single big .sh file containing all of the 12-parameter pairwise registration commands.
-# Open a file to write to; 'a' for append; lsq12_Third is the third stage of the 12-parameter stage, where the images are registered to one another. A big script is initially created, then divided specimen by specimen so as to generate many smaller scripts that may be submitted en masse and in parallel on a cluster.
-lsq12_Third = open("lsq12_Temp_Big.sh",'a')
-for SpecID in Specimen_IDs:
-	for SpecID2 in Specimen_IDs:
-		# Add header.
-		lsq12_Third.write("#!/bin/bash\n#SBATCH --nodes=" + n_nodes + "\n#SBATCH --mem=" + lsq12_Mem + "\n#SBATCH --time=" + lsq12_Time + "\n\nmodule load " + Module + "\n\ncd " + Scripts_path + "\n\necho \"The job started at $(date).\"\n\n")
-		# Call the registration strings. We begin with the most blurred (e.g., 0.049 microns) image. -model_mask specifies the mask we wish to use. Note that we use a -model_mask with the same amount of blurring to constrain our computation. -identity specifies an identity matrix that initializes the transformation matrix. Upon specifying a transformation matrix, we extract the relevant transformation parameters (here, rotation and translation) and optimize them to find the best transformation; -transform specifies a file giving a previous source to target mapping, which is used as the new coordinate starting point for the optimization.
-		lsq12_Third.write(lsq12_Register_049_Blur + lsq12_Blurred_path + SpecID + "_049_blur.mnc " + lsq12_Blurred_path + SpecID2 + "_049_blur.mnc " + lsq12_XFM_path + SpecID + "_to_" + SpecID2 + "_lsq12_0.xfm -model_mask " + LM_Avg_Mask_049_Blur + " -identity\n")
-		lsq12_Third.write(lsq12_Register_032_Blur + lsq12_Blurred_path + SpecID + "_032_blur.mnc " + lsq12_Blurred_path + SpecID2 + "_032_blur.mnc " + lsq12_XFM_path + SpecID + "_to_" + SpecID2 + "_lsq12_1.xfm -model_mask " + LM_Avg_Mask_032_Blur + " -transform " + lsq12_XFM_path + SpecID + "_to_" + SpecID2 + "_lsq12_0.xfm\n")
-		lsq12_Third.write(lsq12_Register_025_Blur + lsq12_Blurred_path + SpecID + "_025_blur.mnc " + lsq12_Blurred_path + SpecID2 + "_025_blur.mnc " + lsq12_XFM_path + SpecID + "_to_" + SpecID2 + "_lsq12_2.xfm -model_mask " + LM_Avg_Mask_025_Blur + " -transform " + lsq12_XFM_path + SpecID + "_to_" + SpecID2 + "_lsq12_1.xfm\n")
-		lsq12_Third.write("echo \"The job ended at $(date).\"\n")
-# Close the 12-parameter registration file.
-lsq12_Third.close()
-
-# Divide the lsq12_Temp_Big.sh file into a series of small lsq12_Third_*.sh files.
-# lines_per_file is equal to the number of lines to divide each script into. Note that this MAY vary depending on the cluster and job requirements you're using!
-lines_per_file = 15
-# Give the smallfile variable null behavior.
-smallfile = None
-# Open the previously created lsq12_Temp_Big.sh file, refer to it as the bigfile object, and split it into 18 line chunks.
-with open("lsq12_Temp_Big.sh") as bigfile:
-	for lineno, line in enumerate(bigfile):
-		if lineno % lines_per_file == 0:
-			if smallfile:
-				smallfile.close()
-			small_filename = "lsq12_Third_" + str(int(lineno/15)) + ".sh"
-			smallfile = open(small_filename, "w")
-		smallfile.write(line)
-	if smallfile:
-			smallfile.close()
-
-# Range should be equal to the number of specimens, because we want a single file for each specimen.
-for Element in list(range(Specimen_List_Length)):
-	# Open a file to write to; 'a' for append; lsq12_Fourth is the fourth stage of the registration. Upon generating transformation (.xfm) outputs for every specimen, we want to average them, concate the average .xfm with previous .xfm files, and use that total concatenated transformation to resample the original specimen into the 12-parameter space.
-	lsq12_Fourth = open("lsq12_Fourth_" + str(Element) + ".sh",'a')
-	# Add header.
-	lsq12_Fourth.write("#!/bin/bash\n#SBATCH --nodes=" + n_nodes + "\n#SBATCH --mem=" + lsq12_Mem + "\n#SBATCH --time=" + lsq12_Time + "\n\nmodule load " + Module + "\n\ncd " + Scripts_path + "\n\necho \"The job started at $(date).\"\n\n")
-	# Start XFM_Avg string for each specimen.
-	XFM_Avg ="xfmavg -verbose -clobber "
-	for SpecID in Specimen_IDs[(Specimen_Group*Element):(Specimen_Group*(Element+1))]:
-		for SpecID2 in Specimen_IDs:
-			XFM_Avg += lsq12_XFM_path + SpecID + "_to_" + SpecID2 + "_lsq12_2.xfm "
-		# Average the added $spec_to_$spec2_lsq12_2.xfm files in the form of $spec_lsq12_AVG.xfm.
-		lsq12_Fourth.write(XFM_Avg + lsq12_XFM_path + SpecID + "_lsq12_AVG.xfm\n")
-		# Concatenate .xfm files.
-		lsq12_Fourth.write("xfmconcat -clobber " + lsq6_XFM_path + SpecID + "_lsq6_2.xfm " + lsq12_XFM_path + SpecID + "_lsq12_AVG.xfm " + lsq12_XFM_path + SpecID + "_origtolsq12.xfm\n")
-		# Resample source image into 12-parameter space with concatenated .xfm.
-		lsq12_Fourth.write("mincresample -like " + LM_Avg + " -clobber -transformation " + lsq12_XFM_path + SpecID + "_origtolsq12.xfm " + Source_MNC_path + SpecID + ".mnc " + lsq12_MNC_path + SpecID + "_lsq12.mnc\n\n")
-	lsq12_Fourth.write("echo \"The job ended at $(date).\"")
-	# Close the xfmconcat and resample file.
-	lsq12_Fourth.close()
-
-# Create .mnc average script for specimens.
-# Open a file to write to; 'a' for append; lsq12_Fifth is the fifth and final stage of the 12-parameter affine registration. After creating the lsq12 resampled .mnc images, we average these to create a target for non-linear deformations.
-lsq12_Fifth = open("lsq12_Fifth.sh",'a')
-# Add header.
-lsq12_Fifth.write("#!/bin/bash\n#SBATCH --nodes=" + n_nodes + "\n#SBATCH --mem=" + lsq12_Mem + "\n#SBATCH --time=" + lsq12_Time + "\n\nmodule load " + Module + "\n\ncd " + Scripts_path + "\n\necho \"The job started at $(date).\"\n\n")
-lsq12_Fifth.write("echo \"All lsq12 files are being averaged.\"\n")
-for SpecID in Specimen_IDs:
-	# Add the new $spec_lsq12.mnc files to the Avg_String variable.
-	lsq12_MNC_Avg += lsq12_MNC_path + SpecID + "_lsq12.mnc "
-lsq12_Fifth.write(lsq12_MNC_Avg + lsq12_Avg + "\n\n")
-lsq12_Fifth.write("echo \"The job ended at $(date).\"")
-# Close the average file.
-lsq12_Fifth.close()
-
-#-------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
-# FIRST NON-LINEAR STAGE (includes nl_First.sh, nl_Second_*.sh, and nl_Third.sh)
-#-------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
-# Open a file to write to; 'a' for append; nl_First is the first non-linear deformation script, where we blur the 12-parameter average and mask with the largest blurring kernels.
-nl_First = open("nl_First.sh",'a')
-# Add header.
-nl_First.write("#!/bin/bash\n#SBATCH --nodes=" + n_nodes + "\n#SBATCH --mem=" + nl_Mem + "\n#SBATCH --time=" + nl_Time + "\n\nmodule load " + Module + "\n\ncd " + Scripts_path + "\n\necho \"The job started at $(date).\"\n\n")
-# Blur the average and average mask with different kernels. Observe that these blurs (1.4mm), relative to those at the 12-parameter stage, are much larger.
-nl_First.write(MNC_Blur + "0.4 " + lsq12_Avg + " " + lsq12_Avg_400 + "\n")
-nl_First.write(MNC_Blur + "0.4 " + LM_Avg_Mask + " " + LM_Avg_Mask_400 + "\n\n")
-nl_First.write("echo \"The job ended at $(date).\"")
-nl_First.close()
-
-# Create .sh files for the first round of non-linear commands (nl_1).
-for Element in list(range(Specimen_List_Length)):
-	# Open a file to write to; 'a' for append; nl_Second includes the non-linear registrations of the most blurred images.
-	nl_Second = open("nl_Second_" + str(Element) + ".sh",'a')
-	# Add header.
-	nl_Second.write("#!/bin/bash\n#SBATCH --nodes=" + n_nodes + "\n#SBATCH --mem=" + nl_Mem + "\n#SBATCH --time=" + nl_Time + "\n\nmodule load " + Module + "\n\ncd " + Scripts_path + "\n\necho \"The job started at $(date).\"\n\n")
-	for SpecID in Specimen_IDs[(Specimen_Group*Element):(Specimen_Group*(Element+1))]:
-		# Blur string.
-		nl_Second.write(MNC_Blur + "0.4 " + lsq12_MNC_path + SpecID + "_lsq12.mnc " + nl_Blurred_path + SpecID + "_400\n")
-		# Registration string.
-		nl_Second.write(nl_1_Register_400_Blur_Begin + nl_Blurred_path + SpecID + "_400_blur.mnc " + lsq12_Avg_400_Blur + " " + nl_XFM_path + SpecID + "_nl_1.xfm -model_mask " + LM_Avg_Mask_400_Blur + " " + nl_1_Register_400_Blur_End + "\n")
-		# Concatenate .xfm files.
-		nl_Second.write("xfmconcat -clobber " + lsq6_XFM_path + SpecID + "_lsq6_2.xfm " + lsq12_XFM_path + SpecID + "_lsq12_AVG.xfm " + nl_XFM_path + SpecID + "_nl_1.xfm " + nl_XFM_path + SpecID + "_origtonl_1.xfm\n")
-		# Resample source image into the first on-linear space with concatenated .xfm.
-		nl_Second.write("mincresample -like " + LM_Avg + " -clobber -transformation " + nl_XFM_path + SpecID + "_origtonl_1.xfm " + Source_MNC_path + SpecID + ".mnc "+ nl_MNC_path + SpecID + "_nl_1.mnc\n\n")
-	nl_Second.write("echo \"The job ended at $(date).\"")
-	# Close the file.
-	nl_Second.close()
-
-# Average the non-linear files from the first set of deformations.
-for SpecID in Specimen_IDs:
-	nl_1_MNC_Avg += nl_MNC_path + SpecID + "_nl_1.mnc "
-# Open a file to write to; 'a' for append; nl_Third is the averaging of all nl_Second images to create a target for the next set of non-linear deformations.
-nl_Third = open("nl_Third.sh",'a')
-# Add header.
-nl_Third.write("#!/bin/bash\n#SBATCH --nodes=" + n_nodes + "\n#SBATCH --mem=" + nl_Mem + "\n#SBATCH --time=" + nl_Time + "\n\nmodule load " + Module + "\n\ncd " + Scripts_path + "\n\necho \"The job started at $(date).\"\n\n")
-nl_Third.write("echo \"All of the first non-linearly deformed files are being averaged.\"\n")
-nl_Third.write(nl_1_MNC_Avg + nl_1_Avg + "\n\n")
-# Blur string for the average and average mask.
-nl_Third.write("echo \"Blur this first non-linear average, as it will become the target in the next set of the hierarchical non-linear deformations.\"\n")
-nl_Third.write(MNC_Blur + "0.3 " + nl_1_Avg + " " + nl_1_Avg_300 + "\n")
-nl_Third.write(MNC_Blur + "0.3 " + LM_Avg_Mask + " " + LM_Avg_Mask_300 + "\n\n")
-nl_Third.write("echo \"The job ended at $(date).\"")
-# Close the script.
-nl_Third.close()
-
-#-------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
-# SECOND NON-LINEAR STAGE (includes nl_Fourth_*.sh and nl_Fifth.sh)
-#-------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
-# Create .sh files for the second round of non-linear commands (nl_2).
-for Element in list(range(Specimen_List_Length)):
-	# Open a file to write to; 'a' for append; nl_Fourth includes the non-linear registrations of the second most blurred images.
-	nl_Fourth = open("nl_Fourth_" + str(Element) + ".sh",'a')
-	# Add header.
-	nl_Fourth.write("#!/bin/bash\n#SBATCH --nodes=" + n_nodes + "\n#SBATCH --mem=" + nl_Mem + "\n#SBATCH --time=" + nl_Time + "\n\nmodule load " + Module + "\n\ncd " + Scripts_path + "\n\necho \"The job started at $(date).\"\n\n")
-	for SpecID in Specimen_IDs[(Specimen_Group*Element):(Specimen_Group*(Element+1))]:
-		# Blur string.
-		nl_Fourth.write(MNC_Blur + "0.3 " + lsq12_MNC_path + SpecID + "_lsq12.mnc " + nl_Blurred_path + SpecID + "_300\n")
-		# Registration string.
-		nl_Fourth.write(nl_2_Register_300_Blur_Begin + nl_Blurred_path + SpecID + "_300_blur.mnc " + nl_1_Avg_300_Blur + " " + nl_XFM_path + SpecID + "_nl_2.xfm -model_mask " + LM_Avg_Mask_300_Blur + " " + nl_2_Register_300_Blur_End + nl_XFM_path + SpecID + "_nl_1.xfm\n")
-		# Concatenate .xfm files.
-		nl_Fourth.write("xfmconcat -clobber " + lsq6_XFM_path + SpecID + "_lsq6_2.xfm " + lsq12_XFM_path + SpecID + "_lsq12_AVG.xfm " + nl_XFM_path + SpecID + "_nl_2.xfm " + nl_XFM_path + SpecID + "_origtonl_2.xfm\n")
-		# Resample source image into the second non-linear space with concatenated .xfm.
-		nl_Fourth.write("mincresample -like " + LM_Avg + " -clobber -transformation " + nl_XFM_path + SpecID + "_origtonl_2.xfm " + Source_MNC_path + SpecID + ".mnc "+ nl_MNC_path + SpecID + "_nl_2.mnc\n\n")
-	nl_Fourth.write("echo \"The job ended at $(date).\"")
-	# Close the file.
-	nl_Fourth.close()
-
-# Average the non-linear files from the first set of deformations.
-for SpecID in Specimen_IDs:
-	nl_2_MNC_Avg += nl_MNC_path + SpecID + "_nl_2.mnc "
-# Open a file to write to; 'a' for append; nl_Fifth is the averaging of all nl_Fourth images to create a target for the next set of non-linear deformations.
-nl_Fifth = open("nl_Fifth.sh",'a')
-# Add header.
-nl_Fifth.write("#!/bin/bash\n#SBATCH --nodes=" + n_nodes + "\n#SBATCH --mem=" + nl_Mem + "\n#SBATCH --time=" + nl_Time + "\n\nmodule load " + Module + "\n\ncd " + Scripts_path + "\n\necho \"The job started at $(date).\"\n\n")
-nl_Fifth.write("echo \"All of the second non-linearly deformed files are being averaged.\"\n")
-nl_Fifth.write(nl_2_MNC_Avg + nl_2_Avg + "\n\n")
-# Blur string for the average and average mask.
-nl_Fifth.write("echo \"Blur this second non-linear average, as it will become the target in the next set of the hierarchical non-linear deformations.\"\n")
-nl_Fifth.write(MNC_Blur + "0.2 " + nl_2_Avg + " " + nl_2_Avg_200 + "\n")
-nl_Fifth.write(MNC_Blur + "0.2 " + LM_Avg_Mask + " " + LM_Avg_Mask_200 + "\n\n")
-nl_Fifth.write("echo \"The job ended at $(date).\"")
-# Close the NL_4 end script.
-nl_Fifth.close()
-
-#-------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
-# THIRD NON-LINEAR STAGE (includes nl_Sixth_*.sh and nl_Seventh.sh)
-#-------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
-# Create .sh files for the third round of non-linear commands (nl_3).
-for Element in list(range(Specimen_List_Length)):
-	# Open a file to write to; 'a' for append; nl_Sixth includes the non-linear registrations of the third most blurred images.
-	nl_Sixth = open("nl_Sixth_" + str(Element) + ".sh",'a')
-	# Add header.
-	nl_Sixth.write("#!/bin/bash\n#SBATCH --nodes=" + n_nodes + "\n#SBATCH --mem=" + nl_Mem + "\n#SBATCH --time=" + nl_Time + "\n\nmodule load " + Module + "\n\ncd " + Scripts_path + "\n\necho \"The job started at $(date).\"\n\n")
-	for SpecID in Specimen_IDs[(Specimen_Group*Element):(Specimen_Group*(Element+1))]:
-		# Blur string.
-		nl_Sixth.write(MNC_Blur + "0.2 " + lsq12_MNC_path + SpecID + "_lsq12.mnc " + nl_Blurred_path + SpecID + "_200\n")
-		# Registration string.
-		nl_Sixth.write(nl_3_Register_200_Blur_Begin + nl_Blurred_path + SpecID + "_200_blur.mnc " + nl_2_Avg_200_Blur + " " + nl_XFM_path + SpecID + "_nl_3.xfm -model_mask " + LM_Avg_Mask_200_Blur + " " + nl_3_Register_200_Blur_End + nl_XFM_path + SpecID + "_nl_2.xfm\n")
-		# Concatenate .xfm files.
-		nl_Sixth.write("xfmconcat -clobber " + lsq6_XFM_path + SpecID + "_lsq6_2.xfm " + lsq12_XFM_path + SpecID + "_lsq12_AVG.xfm " + nl_XFM_path + SpecID + "_nl_3.xfm " + nl_XFM_path + SpecID + "_origtonl_3.xfm\n")
-		# Resample source image into third non-linear space with concatenated .xfm.
-		nl_Sixth.write("mincresample -like " + LM_Avg + " -clobber -transformation " + nl_XFM_path + SpecID + "_origtonl_3.xfm " + Source_MNC_path + SpecID + ".mnc "+ nl_MNC_path + SpecID + "_nl_3.mnc\n\n")
-	nl_Sixth.write("echo \"The job ended at $(date).\"")
-	# Close the script.
-	nl_Sixth.close()
-
-# Average the non-linear files from the third set of deformations.
-for SpecID in Specimen_IDs:
-	nl_3_MNC_Avg += nl_MNC_path + SpecID + "_nl_3.mnc "
-# Open a file to write to; 'a' for append; nl_Seventh is the averaging of all nl_Sixth images to create a target for the final non-linear deformation.
-nl_Seventh = open("nl_Seventh.sh",'a')
-# Add header.
-nl_Seventh.write("#!/bin/bash\n#SBATCH --nodes=" + n_nodes + "\n#SBATCH --mem=" + nl_Mem + "\n#SBATCH --time=" + nl_Time + "\n\nmodule load " + Module + "\n\ncd " + Scripts_path + "\n\necho \"The job started at $(date).\"\n\n")
-nl_Seventh.write("echo \"All of the third non-linearly deformed files are being averaged.\"\n")
-nl_Seventh.write(nl_3_MNC_Avg + nl_3_Avg + "\n\n")
-# Blur string for the average and average mask.
-nl_Seventh.write("echo \"Blur this third non-linear average, as it will become the target in the next set of the hierarchical non-linear deformations.\"\n")
-nl_Seventh.write(MNC_Blur + "0.1 " + nl_3_Avg + " " + nl_3_Avg_100 + "\n")
-nl_Seventh.write(MNC_Blur + "0.1 " + LM_Avg_Mask + " " + LM_Avg_Mask_100 + "\n\n")
-nl_Seventh.write("echo \"The job ended at $(date).\"")
-# Close the script.
-nl_Seventh.close()
-
-#-------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
-# FOURTH NON-LINEAR STAGE (includes nl_Sixth_*.sh and nl_Seventh.sh)
-#-------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
-# Create .sh files for the third round of non-linear commands (nl_3).
-for Element in list(range(Specimen_List_Length)):
-	# Open a file to write to; 'a' for append; nl_Eighth includes the non-linear registrations of the fourth most (least) blurred images.
-	nl_Eighth = open("nl_Eighth_" + str(Element) + ".sh",'a')
-	# Add header.
-	nl_Eighth.write("#!/bin/bash\n#SBATCH --nodes=" + n_nodes + "\n#SBATCH --mem=" + nl_Mem + "\n#SBATCH --time=" + nl_Time + "\n\nmodule load " + Module + "\n\ncd " + Scripts_path + "\n\necho \"The job started at $(date).\"\n\n")
-	for SpecID in Specimen_IDs[(Specimen_Group*Element):(Specimen_Group*(Element+1))]:
-		# Blur string.
-		nl_Eighth.write(MNC_Blur + "0.1 " + lsq12_MNC_path + SpecID + "_lsq12.mnc " + nl_Blurred_path + SpecID + "_100\n")
-		# Registration string.
-		nl_Eighth.write(nl_4_Register_100_Blur_Begin + nl_Blurred_path + SpecID + "_100_blur.mnc " + nl_3_Avg_100_Blur + " " + nl_XFM_path + SpecID + "_nl_4.xfm -model_mask " + LM_Avg_Mask_100_Blur + " " + nl_4_Register_100_Blur_End + nl_XFM_path + SpecID + "_nl_3.xfm\n")
-		# Concatenate .xfm files.
-		nl_Eighth.write("xfmconcat -clobber " + lsq6_XFM_path + SpecID + "_lsq6_2.xfm " + lsq12_XFM_path + SpecID + "_lsq12_AVG.xfm " + nl_XFM_path + SpecID + "_nl_4.xfm " + nl_XFM_path + SpecID + "_origtonl_4.xfm\n")
-		# Resample source image into third non-linear space with concatenated .xfm.
-		nl_Eighth.write("mincresample -like " + LM_Avg + " -clobber -transformation " + nl_XFM_path + SpecID + "_origtonl_4.xfm " + Source_MNC_path + SpecID + ".mnc "+ nl_MNC_path + SpecID + "_nl_4.mnc\n\n")
-	nl_Eighth.write("echo \"The job ended at $(date).\"")
-	# Close the script.
-	nl_Eighth.close()
-
-# Average the non-linear files from the third set of deformations.
-for SpecID in Specimen_IDs:
-	nl_4_MNC_Avg += nl_MNC_path + SpecID + "_nl_4.mnc "
-# Open a file to write to; 'a' for append; nl_Ninth is the averaging of all nl_Eighth images to create a final average atlas to be labelled.
-nl_Ninth = open("nl_Ninth.sh",'a')
-# Add header.
-nl_Ninth.write("#!/bin/bash\n#SBATCH --nodes=" + n_nodes + "\n#SBATCH --mem=" + nl_Mem + "\n#SBATCH --time=" + nl_Time + "\n\nmodule load " + Module + "\n\ncd " + Scripts_path + "\n\necho \"The job started at $(date).\"\n\n")
-nl_Ninth.write("echo \"All of the fourth non-linearly deformed files are being averaged.\"\n")
-nl_Ninth.write(nl_4_MNC_Avg + nl_4_Avg + "\n\n")
-nl_Ninth.write("echo \"The job ended at $(date).\"")
-# Close the script.
-nl_Ninth.close()
-
-#-------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
-# Create master job submission scripts for all stages. These scripts will automatically submit all .sh scripts to the queue and will be chained together. In other words, only the first script, Job_Submission_First.sh, needs to be submitted.
-#-------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
-# Job_Submission_First (i.e., 6-parameter blurs, registrations, concatenations, resamplings, and the average).
-Job_Submission_First = open("Job_Submission_First.sh",'a')
-Job_Submission_First.write("#!/bin/bash\n#SBATCH --nodes=" + n_nodes + "\n#SBATCH --mem=" + Job_Submission_Mem + "\n#SBATCH --time=" + Job_Submission_Time + "\n#SBATCH --job-name=Job_Submission_First.sh\n\necho \"The job started at $(date).\"\n\n")
-Job_Submission_First.write("cd " + Scripts_path + "\n\n")
-Job_Submission_First.write("sleep 10\n\n")
-Job_Submission_First.write("lsq6_First=$(sbatch -W lsq6_First.sh | awk '{print $4}')\n\n")
-Job_Submission_First.write("until [[ $(squeue -t CD -u $USER --noheader -j ${lsq6_First##* } | wc -l) -eq 1 ]]; do\nsleep 5\ndone\n\n")
-Job_Submission_First.write("# Generate a sequence of numbers.\nNUMBERS=$(seq 1 " + str(Specimen_List_Length) + ")\n\n")
-Job_Submission_First.write("# For loop to automatically submit your jobs.\nfor NUM in $NUMBERS; do\nNAME=\"lsq6_Second_$NUM.sh\"\nLSQ6=\"sbatch $NAME\"\n$LSQ6\necho $LSQ6\n# Sleep script in 3 second intervals.\nsleep 3\ndone\n\n")
-Job_Submission_First.write("# Sleep script for 5 seconds before while loop.\nsleep 5\n\n")
-Job_Submission_First.write("# Create while loop for PD jobs to idle submission script.\nwhile [[ $(squeue -t PD -u $USER --noheader | wc -l) -gt 0 ]]; do\nsleep 5\ndone\n\n")
-Job_Submission_First.write("# Create while loop for R jobs to idle submission script.\nwhile [[ $(squeue -t R -u $USER --noheader | wc -l) -gt 1 ]]; do\nsleep 5\ndone\n\n")
-Job_Submission_First.write("# Submit 6-parameter average script.\nlsq6_Third=$(sbatch -W lsq6_Third.sh | awk '{print $4}')\n\n")
-Job_Submission_First.write("#----------------------------------------------------- Submit next job submission script after average finishes and remove current submission script from the queue.\n\n")
-Job_Submission_First.write("sbatch --dependency=afterok:${lsq6_Third##* } Job_Submission_Second.sh\n\n")
-Job_Submission_First.write("echo \"The job ended at $(date).\"\n")
-Job_Submission_First.write("scancel -u $USER --jobname=Job_Submission_First.sh")
-# Job_Submission_Second (i.e., 12-parameter blurs).
-Job_Submission_Second = open("Job_Submission_Second.sh",'a')
-Job_Submission_Second.write("#!/bin/bash\n#SBATCH --nodes=" + n_nodes + "\n#SBATCH --mem=" + Job_Submission_Mem + "\n#SBATCH --time=" + Job_Submission_Time + "\n#SBATCH --job-name=Job_Submission_Second.sh\n\necho \"The job started at $(date).\"\n\n")
-Job_Submission_Second.write("cd " + Scripts_path + "\n\n")
-Job_Submission_Second.write("sleep 10\n\n")
-Job_Submission_Second.write("lsq12_First=$(sbatch -W lsq12_First.sh | awk '{print $4}')\n\n")
-Job_Submission_Second.write("# Generate a sequence of numbers.\nNUMBERS=$(seq 1 " + str(Specimen_List_Length) + ")\n\n")
-Job_Submission_Second.write("# For loop to automatically submit your jobs.\nfor NUM in $NUMBERS; do\nNAME=\"lsq12_Second_$NUM.sh\"\nLSQ12=\"sbatch $NAME\"\n$LSQ12\necho $LSQ12\n# Sleep script in 3 second intervals.\nsleep 3\ndone\n\n")
-Job_Submission_Second.write("# Sleep script for 5 seconds before while loop.\nsleep 5\n\n")
-Job_Submission_Second.write("# Create while loop for PD jobs to idle submission script.\nwhile [[ $(squeue -t PD -u $USER --noheader | wc -l) -gt 0 ]]; do\nsleep 5\ndone\n\n")
-Job_Submission_Second.write("# Create while loop for R jobs to idle submission script.\nwhile [[ $(squeue -t R -u $USER --noheader | wc -l) -gt 1 ]]; do\nsleep 5\ndone\n\n")
-Job_Submission_Second.write("#----------------------------------------------------- Submit 12-parameter registration job submission script and remove current submission script from the queue.\n\n")
-Job_Submission_Second.write("Job_Submission_Third=$(sbatch Job_Submission_Third.sh)\n\n")
-Job_Submission_Second.write("echo \"The job ended at $(date).\"\n")
-Job_Submission_Second.write("scancel -u $USER --jobname=Job_Submission_Second.sh")
-# Job_Submission_Third (i.e., 12-parameter pairwise registrations).
-Job_Submission_Third = open("Job_Submission_Third.sh",'a')
-Job_Submission_Third.write("#!/bin/bash\n#SBATCH --nodes=" + n_nodes + "\n#SBATCH --mem=" + Job_Submission_Mem + "\n#SBATCH --time=" + Job_Submission_Time + "\n#SBATCH --job-name=Job_Submission_Third.sh\n\necho \"The job started at $(date).\"\n\n")
-Job_Submission_Third.write("cd " + Scripts_path + "\n\n")
-Job_Submission_Third.write("sleep 10\n\n")
-Job_Submission_Third.write("# Generate a sequence of numbers.\nNUMBERS=$(seq 0 " + str(Specimen_Upper) + ")\n\n")
-Job_Submission_Third.write("# For loop to automatically submit your jobs.\nfor NUM in $NUMBERS; do\nNAME=\"lsq12_Third_$NUM.sh\"\nLSQ12=\"sbatch $NAME\"\n$LSQ12\necho $LSQ12\n# Sleep script in 3 second intervals.\nsleep 3\ndone\n\n")
-Job_Submission_Third.write("# Sleep script for 5 seconds before while loop.\nsleep 5\n\n")
-Job_Submission_Third.write("# Create while loop for PD jobs to idle submission script.\nwhile [[ $(squeue -t PD -u $USER --noheader | wc -l) -gt 0 ]]; do\nsleep 5\ndone\n\n")
-Job_Submission_Third.write("# Create while loop for R jobs to idle submission script.\nwhile [[ $(squeue -t R -u $USER --noheader | wc -l) -gt 1 ]]; do\nsleep 5\ndone\n\n")
-Job_Submission_Third.write("#----------------------------------------------------- Submit xfm average, concatenating, and resampling job submission script and remove current submission script from the queue.\n\n")
-Job_Submission_Third.write("Job_Submission_Fourth=$(sbatch Job_Submission_Fourth.sh)\n\n")
-Job_Submission_Third.write("echo \"The job ended at $(date).\"\n")
-Job_Submission_Third.write("scancel -u $USER --jobname=Job_Submission_Third.sh")
-# Job_Submission_Fourth (i.e., 12-parameter concatenations, resamplings, and the average).
-Job_Submission_Fourth = open("Job_Submission_Fourth.sh",'a')
-Job_Submission_Fourth.write("#!/bin/bash\n#SBATCH --nodes=" + n_nodes + "\n#SBATCH --mem=" + Job_Submission_Mem + "\n#SBATCH --time=" + Job_Submission_Time + "\n#SBATCH --job-name=Job_Submission_Fourth.sh\n\necho \"The job started at $(date).\"\n\n")
-Job_Submission_Fourth.write("cd " + Scripts_path + "\n\n")
-Job_Submission_Fourth.write("sleep 10\n\n")
-Job_Submission_Fourth.write("# Generate a sequence of numbers.\nNUMBERS=$(seq 0 " + str(Specimen_List_Length-1) + ")\n\n")
-Job_Submission_Fourth.write("# For loop to automatically submit your jobs.\nfor NUM in $NUMBERS; do\nNAME=\"lsq12_Fourth_$NUM.sh\"\nLSQ12=\"sbatch $NAME\"\n$LSQ12\necho $LSQ12\n# Sleep script in 3 second intervals.\nsleep 3\ndone\n\n")
-Job_Submission_Fourth.write("# Sleep script for 5 seconds before while loop.\nsleep 5\n\n")
-Job_Submission_Fourth.write("# Create while loop for PD jobs to idle submission script.\nwhile [[ $(squeue -t PD -u $USER --noheader | wc -l) -gt 0 ]]; do\nsleep 5\ndone\n\n")
-Job_Submission_Fourth.write("# Create while loop for R jobs to idle submission script.\nwhile [[ $(squeue -t R -u $USER --noheader | wc -l) -gt 1 ]]; do\nsleep 5\ndone\n\n")
-Job_Submission_Fourth.write("#----------------------------------------------------- Submit lsq12 average job submission script and the first non-linear (NL_1) dependency, then remove current submission script from the queue.\n\n")
-Job_Submission_Fourth.write("lsq12_Fifth=$(sbatch -W lsq12_Fifth.sh  | awk '{print $4}')\n\n")
-Job_Submission_Fourth.write("sbatch --dependency=afterok:${lsq12_Fifth##* } Job_Submission_Fifth.sh\n\n")
-Job_Submission_Fourth.write("echo \"The job ended at $(date).\"\n")
-Job_Submission_Fourth.write("scancel -u $USER --jobname=Job_Submission_Fourth.sh")
-# Job_Submission_Fifth (i.e., NL_1 and the first hierarchical non-linear registration).
-Job_Submission_Fifth = open("Job_Submission_Fifth.sh",'a')
-Job_Submission_Fifth.write("#!/bin/bash\n#SBATCH --nodes=" + n_nodes + "\n#SBATCH --mem=" + Job_Submission_Mem + "\n#SBATCH --time=" + Job_Submission_Time + "\n#SBATCH --job-name=Job_Submission_Fifth.sh\n\necho \"The job started at $(date).\"\n\n")
-Job_Submission_Fifth.write("cd " + Scripts_path + "\n\n")
-Job_Submission_Fifth.write("sleep 10\n\n")
-Job_Submission_Fifth.write("nl_First=$(sbatch -W nl_First.sh | awk '{print $4}')\n\n")
-Job_Submission_Fifth.write("until [[ $(squeue -t CD -u $USER --noheader -j ${nl_First##* } | wc -l) -eq 1 ]]; do\nsleep 5\ndone\n\n")
-Job_Submission_Fifth.write("# Generate a sequence of numbers.\nNUMBERS=$(seq 0 " + str(Specimen_List_Length-1) + ")\n\n")
-Job_Submission_Fifth.write("# For loop to automatically submit your jobs.\nfor NUM in $NUMBERS; do\nNAME=\"nl_Second_$NUM.sh\"\nNL1=\"sbatch $NAME\"\n$NL1\necho $NL1\n# Sleep script in 3 second intervals.\nsleep 3\ndone\n\n")
-Job_Submission_Fifth.write("# Sleep script for 5 seconds before while loop.\nsleep 5\n\n")
-Job_Submission_Fifth.write("# Create while loop for PD jobs to idle submission script.\nwhile [[ $(squeue -t PD -u $USER --noheader | wc -l) -gt 0 ]]; do\nsleep 5\ndone\n\n")
-Job_Submission_Fifth.write("# Create while loop for R jobs to idle submission script.\nwhile [[ $(squeue -t R -u $USER --noheader | wc -l) -gt 1 ]]; do\nsleep 5\ndone\n\n")
-Job_Submission_Fifth.write("#----------------------------------------------------- Submit NL_1 average job submission script and the second non-linear (NL_2) dependency, then remove current submission script from the queue.\n\n")
-Job_Submission_Fifth.write("nl_Third=$(sbatch -W nl_Third.sh | awk '{print $4}')\n\n")
-Job_Submission_Fifth.write("sbatch --dependency=afterok:${nl_Third##* } Job_Submission_Sixth.sh\n\n")
-Job_Submission_Fifth.write("echo \"The job ended at $(date).\"\n")
-Job_Submission_Fifth.write("scancel -u $USER --jobname=Job_Submission_Fifth.sh")
-# Job_Submission_Sixth (i.e., NL_2 and the second hierarchical non-linear registration).
-Job_Submission_Sixth = open("Job_Submission_Sixth.sh",'a')
-Job_Submission_Sixth.write("#!/bin/bash\n#SBATCH --nodes=" + n_nodes + "\n#SBATCH --mem=" + Job_Submission_Mem + "\n#SBATCH --time=" + Job_Submission_Time + "\n#SBATCH --job-name=Job_Submission_Sixth.sh\n\necho \"The job started at $(date).\"\n\n")
-Job_Submission_Sixth.write("cd " + Scripts_path + "\n\n")
-Job_Submission_Sixth.write("sleep 10\n\n")
-Job_Submission_Sixth.write("# Generate a sequence of numbers.\nNUMBERS=$(seq 0 " + str(Specimen_List_Length-1) + ")\n\n")
-Job_Submission_Sixth.write("# For loop to automatically submit your jobs.\nfor NUM in $NUMBERS; do\nNAME=\"nl_Fourth_$NUM.sh\"\nNL2=\"sbatch $NAME\"\n$NL2\necho $NL2\n# Sleep script in 3 second intervals.\nsleep 3\ndone\n\n")
-Job_Submission_Sixth.write("# Sleep script for 5 seconds before while loop.\nsleep 5\n\n")
-Job_Submission_Sixth.write("# Create while loop for PD jobs to idle submission script.\nwhile [[ $(squeue -t PD -u $USER --noheader | wc -l) -gt 0 ]]; do\nsleep 5\ndone\n\n")
-Job_Submission_Sixth.write("# Create while loop for R jobs to idle submission script.\nwhile [[ $(squeue -t R -u $USER --noheader | wc -l) -gt 1 ]]; do\nsleep 5\ndone\n\n")
-Job_Submission_Sixth.write("#----------------------------------------------------- Submit NL_2 average job submission script and the third non-linear (NL_3) dependency, then remove current submission script from the queue.\n\n")
-Job_Submission_Sixth.write("nl_Fifth=$(sbatch -W nl_Fifth.sh | awk '{print $4}')\n\n")
-Job_Submission_Sixth.write("sbatch --dependency=afterok:${nl_Fifth##* } Job_Submission_Seventh.sh\n\n")
-Job_Submission_Sixth.write("echo \"The job ended at $(date).\"\n")
-Job_Submission_Sixth.write("scancel -u $USER --jobname=Job_Submission_Sixth.sh")
-# Job_Submission_Seventh (i.e., NL_3 and the third hierarchical non-linear registration).
-Job_Submission_Seventh = open("Job_Submission_Seventh.sh",'a')
-Job_Submission_Seventh.write("#!/bin/bash\n#SBATCH --nodes=" + n_nodes + "\n#SBATCH --mem=" + Job_Submission_Mem + "\n#SBATCH --time=" + Job_Submission_Time + "\n#SBATCH --job-name=Job_Submission_Seventh.sh\n\necho \"The job started at $(date).\"\n\n")
-Job_Submission_Seventh.write("cd " + Scripts_path + "\n\n")
-Job_Submission_Seventh.write("sleep 10\n\n")
-Job_Submission_Seventh.write("# Generate a sequence of numbers.\nNUMBERS=$(seq 0 " + str(Specimen_List_Length-1) + ")\n\n")
-Job_Submission_Seventh.write("# For loop to automatically submit your jobs.\nfor NUM in $NUMBERS; do\nNAME=\"nl_Sixth_$NUM.sh\"\nNL3=\"sbatch $NAME\"\n$NL3\necho $NL3\n# Sleep script in 3 second intervals.\nsleep 3\ndone\n\n")
-Job_Submission_Seventh.write("# Sleep script for 5 seconds before while loop.\nsleep 5\n\n")
-Job_Submission_Seventh.write("# Create while loop for PD jobs to idle submission script.\nwhile [[ $(squeue -t PD -u $USER --noheader | wc -l) -gt 0 ]]; do\nsleep 5\ndone\n\n")
-Job_Submission_Seventh.write("# Create while loop for R jobs to idle submission script.\nwhile [[ $(squeue -t R -u $USER --noheader | wc -l) -gt 1 ]]; do\nsleep 5\ndone\n\n")
-Job_Submission_Seventh.write("#----------------------------------------------------- Submit NL_3 average job submission script and the fourth non-linear (NL_4) dependency, then remove current submission script from the queue.\n\n")
-Job_Submission_Seventh.write("nl_Seventh=$(sbatch -W nl_Seventh.sh  | awk '{print $4}')\n\n")
-Job_Submission_Seventh.write("sbatch --dependency=afterok:${nl_Seventh##* } Job_Submission_Eighth.sh\n\n")
-Job_Submission_Seventh.write("echo \"The job ended at $(date).\"\n")
-Job_Submission_Seventh.write("scancel -u $USER --jobname=Job_Submission_Seventh.sh")
-# Job_Submission_Eighth (i.e., NL_4 and the third hierarchical non-linear registration).
-Job_Submission_Eighth = open("Job_Submission_Eighth.sh",'a')
-Job_Submission_Eighth.write("#!/bin/bash\n#SBATCH --nodes=" + n_nodes + "\n#SBATCH --mem=" + Job_Submission_Mem + "\n#SBATCH --time=" + Job_Submission_Time + "\n#SBATCH --job-name=Job_Submission_Eighth.sh\n\necho \"The job started at $(date).\"\n\n")
-Job_Submission_Eighth.write("cd " + Scripts_path + "\n\n")
-Job_Submission_Eighth.write("sleep 10\n\n")
-Job_Submission_Eighth.write("# Generate a sequence of numbers.\nNUMBERS=$(seq 0 " + str(Specimen_List_Length-1) + ")\n\n")
-Job_Submission_Eighth.write("# For loop to automatically submit your jobs.\nfor NUM in $NUMBERS; do\nNAME=\"nl_Eighth_$NUM.sh\"\nNL4=\"sbatch $NAME\"\n$NL4\necho $NL4\n# Sleep script in 3 second intervals.\nsleep 3\ndone\n\n")
-Job_Submission_Eighth.write("# Sleep script for 5 seconds before while loop.\nsleep 5\n\n")
-Job_Submission_Eighth.write("# Create while loop for PD jobs to idle submission script.\nwhile [[ $(squeue -t PD -u $USER --noheader | wc -l) -gt 0 ]]; do\nsleep 5\ndone\n\n")
-Job_Submission_Eighth.write("# Create while loop for R jobs to idle submission script.\nwhile [[ $(squeue -t R -u $USER --noheader | wc -l) -gt 1 ]]; do\nsleep 5\ndone\n\n")
-Job_Submission_Eighth.write("#----------------------------------------------------- Submit final NL_4 average script.\n\n")
-Job_Submission_Eighth.write("nl_Ninth=$(sbatch -W nl_Ninth.sh | awk '{print $4}')\n\n")
-Job_Submission_Eighth.write("echo \"The job ended at $(date).\"\n")
+# Describe the lsq6, lsq12, and four non-linear stages as a DAG of tasks. Every task declares its inputs and outputs, and its script skips the work when the outputs are up to date with the task's commands and inputs (see Pipeline_DAG.py).
+Atlas = build_atlas_pipeline(dict(
+	PROJECT_NAME=PROJECT_NAME, Specimen_IDs=Specimen_IDs, Module=Module, n_nodes=n_nodes,
+	Scripts_path=Scripts_path, Source_MNC_path=Source_MNC_path, lsq6_Blurred_path=lsq6_Blurred_path, lsq6_XFM_path=lsq6_XFM_path, lsq6_MNC_path=lsq6_MNC_path,
+	lsq12_Blurred_path=lsq12_Blurred_path, lsq12_XFM_path=lsq12_XFM_path, lsq12_MNC_path=lsq12_MNC_path, nl_Init_path=nl_Init_path, nl_Blurred_path=nl_Blurred_path, nl_XFM_path=nl_XFM_path, nl_MNC_path=nl_MNC_path,
+	LM_Avg=LM_Avg, LM_Avg_Mask=LM_Avg_Mask, lsq6_Avg=lsq6_Avg, lsq12_Avg=lsq12_Avg, nl_Avgs=[nl_1_Avg, nl_2_Avg, nl_3_Avg, nl_4_Avg],
+	MNC_Blur=MNC_Blur, Blur_Engine=Blur_Engine, XFM_Engine=XFM_Engine, lsq12_Average_Engine=lsq12_Average_Engine, MNC_Avg=MNC_Avg, Average_Engine=Average_Engine, Stream_Variance=Stream_Variance, Tree_Fan_In=Tree_Fan_In, lsq6_Levels=lsq6_Levels, lsq12_Levels=lsq12_Levels, nl_Levels=nl_Levels,
+	lsq6_Mem=lsq6_Mem, lsq6_Time=lsq6_Time, lsq12_Mem=lsq12_Mem, lsq12_Time=lsq12_Time, nl_Mem=nl_Mem, nl_Time=nl_Time, Array_Jobs=Array_Jobs, Array_Concurrency=Array_Concurrency,
+	Quality_path=Quality_path, lsq12_Partners=lsq12_Partners, lsq12_Partner_Mode=lsq12_Partner_Mode, Metadata_CSV=Metadata_CSV, Strata_Columns=Strata_Columns, lsq12_Seed=lsq12_Seed, lsq12_Drift_Subset=lsq12_Drift_Subset, lsq12_Symmetric=lsq12_Symmetric,
+	nl_Convergence_Threshold=nl_Convergence_Threshold, nl_Shorten_Threshold=nl_Shorten_Threshold, nl_Min_Rounds=nl_Min_Rounds, Gate_Threshold=Gate_Threshold, Gate_Min_Xcorr=Gate_Min_Xcorr, Gate_Downsample=Gate_Downsample, Grow_Atlas=Grow_Atlas, Previous_Atlas=Previous_Atlas,
+	lsq12_Pack_Budget=lsq12_Pack_Budget, Volume_Voxels=Volume_Voxels, Auto_Resources=Auto_Resources, Local_MNC_path=Local_MNC_path, Resource_Margin=Resource_Margin, Graph_path="Atlas_Graph.json", Telemetry_path=Telemetry_path,
+	Lifecycle_Mode=Lifecycle_Mode, Lifecycle_Keep=Lifecycle_Keep, Archive_path=Archive_path))
+# Write one .sh script per task (or per job array), a description of the DAG (Atlas_Graph.json), and copies of Pipeline_DAG.py, Multi_Blur.py, Streaming_Average.py, Telemetry.py, Atlas_Convergence.py, XFM_Algebra.py, XFM_Average.py, Registration_QC.py, Quality_Gate.py, and Intermediate_Lifecycle.py, which the scripts call to check and stamp their tasks, to blur and average the volumes, to record their commands, to measure the convergence of the non-linear rounds, to concatenate and average the transformations, to quarantine the specimens that fail a stage, and to release the intermediate files, and the Lists directory of the tasks with more than LIST_LIMIT files (see Pipeline_DAG.py). Upload all of them to the Scripts directory.
+Atlas.write_scripts()
+Atlas.write_graph("Atlas_Graph.json")
+install(".", ("Pipeline_DAG.py", "Multi_Blur.py", "Streaming_Average.py", "Telemetry.py", "Atlas_Convergence.py", "XFM_Algebra.py", "XFM_Average.py", "Registration_QC.py", "Quality_Gate.py", "Intermediate_Lifecycle.py"))
+
+#-------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
+# Create the master job submission script. It submits every .sh script once, and SLURM starts each job as soon as the jobs that produce its inputs have finished (--dependency=afterok, or aftercorr between the elements of two job arrays).
+# In other words, only <PROJECT>_Atlas_Submission.sh needs to be run, on the login node (bash <PROJECT>_Atlas_Submission.sh); there are no submission jobs polling the queue.
+# It also writes <PROJECT>_Atlas_Manifest.json (upload it with the scripts), the expected outputs of every task: rerunning <PROJECT>_Atlas_Submission.sh after a crash or a node failure (once the jobs left in the queue are cancelled) only submits the jobs, and the job array elements, whose tasks are missing or stale, and generating the scripts again in the same directory removes the scripts that are no longer part of the pipeline (the scripts of the other pipelines in the directory, which have their own submission scripts and manifests, are kept).
+#-------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
+Atlas.write_submission()
+# With Lifecycle_Mode, it also writes Lifecycle.json (upload it with the scripts), the intermediates every job releases; the projected peak disk use of the run:
+if Atlas.lifecycle:
+    print(lifecycle_report(Atlas.lifecycle))
+
+# Without a cluster (e.g., a pilot on a workstation), set the project paths above to local paths and run the same jobs with a local pool of processes, bounded by the cores and the declared memory:
+# python3 Local_Executor.py graph Atlas_Graph.json --cores 64    (or: python3 Local_Executor.py slurm <PROJECT>_Atlas_Submission.sh, which runs <PROJECT>_Atlas_Submission.sh with stand-ins for sbatch and squeue)
@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+
+"""
+This script releases the intermediate files of a pipeline (e.g., the _352_blur.mnc and _dxyz.mnc volumes, the pairwise lsq12 transformations, and the _nl_k.mnc
+volumes of the atlas rounds) once the last task that reads them has succeeded, so a run does not keep every intermediate on the scratch space until it ends.
+
+The generators build a plan (Lifecycle.json, see plan) from the task graph of Pipeline_DAG.py: every .mnc and .xfm output of a task that does not match the
+keep-list (fnmatch patterns, e.g., the averages and the final transformations) is managed, with the tasks that read it (its consumers). After its stamp, every
+job calls release, which marks the managed inputs of its task as consumed (Stamps/Consumers/, by the digest of the file, so a file that is written again has
+to be consumed again) and releases the files whose consumers have all succeeded, as well as the managed outputs no task reads. A released file is deleted
+(mode delete) or compressed into the archive directory first (mode archive), and its record (Stamps/Released/) keeps its digest, so the stamps of its producer
+and consumers still hold. Transformations with displacement grids are never released, as the grids are not listed as outputs.
+
+A task that runs again (e.g., with a new parameter) calls restore before its commands, which decompresses its archived inputs. A deleted input cannot be
+restored: the pending check of the submission script (see Pipeline_DAG.py) then drops its record, so its producer runs again, and the tasks downstream of the
+producer with it; in mode delete, a change late in the pipeline can thus recompute the stages before it.
+
+The plan also holds a projection of the disk use of the declared outputs, stage by stage, with and without the releases (in bytes when the voxels of the
+volumes are known, see Resource_Model.py, and in volumes otherwise), which report prints before the jobs are submitted.
+
+python3 Intermediate_Lifecycle.py release <Lifecycle.json> <task> --inputs <files> --outputs <files>
+python3 Intermediate_Lifecycle.py restore <Lifecycle.json> --inputs <files>
+python3 Intermediate_Lifecycle.py report <Lifecycle.json>
+
+Dependencies required: Python only.
+"""
+
+import argparse
+import fnmatch
+import gzip
+import hashlib
+import os
+import shutil
+from collections import OrderedDict
+
+from Pipeline_DAG import STAMP_DIR, _read_json, _write_json, file_digest, release_record
+
+MODES = ("delete", "archive")
+# Only volumes and transformations are released; the tables, states, and tag files are small.
+MANAGED = (".mnc", ".xfm")
+# Bytes assumed for a transformation without its grid, and per voxel of a volume when its voxels are known but not its type.
+XFM_BYTES = 1024
+VOXEL_BYTES = 4
+# Compression level of the archives: the volumes compress well at the lowest levels, and the higher levels cost the jobs minutes.
+COMPRESSLEVEL = 1
+
+
+def managed(path, keep):
+    return path.endswith(MANAGED) and not any(fnmatch.fnmatch(path, pattern) or fnmatch.fnmatch(os.path.basename(path), pattern) for pattern in keep)
+
+
+def volume_weight(path, volume_size=None):
+    """
+    The projected size of an output: its bytes from volume_size (path -> (voxels, bytes), see Resource_Model.volume_sizes) when the voxels of the volume are
+    known (VOXEL_BYTES per voxel), and None otherwise. Gradient volumes (_dxyz) hold three components.
+    """
+    if path.endswith(".xfm"):
+        return XFM_BYTES
+    size = volume_size(path) if volume_size else None
+    if not size:
+        return None
+    voxels = size[0]
+    return voxels * VOXEL_BYTES * (3 if path.endswith("_dxyz.mnc") else 1)
+
+
+def projection(P, consumers, volume_size=None):
+    """
+    The disk use of the declared outputs of P at the end of every stage (in the order of P.stages(), as if the stages ran one after the other), before the
+    releases of the stage, and without any release. Returns (unit, rows of [stage, written, with releases, without releases]).
+    """
+    outputs = OrderedDict.fromkeys(path for task in P.tasks.values() for path in task.outputs if path.endswith(MANAGED))
+    weights = OrderedDict((path, volume_weight(path, volume_size)) for path in outputs)
+    unit = "bytes"
+    if any(weight is None for weight in weights.values()):
+        # Without the voxels, every volume counts as one (a gradient volume as three) and the transformations as none.
+        unit = "volumes"
+        weights = OrderedDict((path, 0 if path.endswith(".xfm") else 3 if path.endswith("_dxyz.mnc") else 1) for path in outputs)
+    left = OrderedDict((path, set(names)) for path, names in consumers.items())
+    with_releases, without_releases, rows = 0, 0, []
+    for stage, tasks in P.stages().items():
+        written = sum(weights[path] for task in tasks for path in task.outputs if path in weights)
+        with_releases += written
+        without_releases += written
+        rows.append([stage, written, with_releases, without_releases])
+        released = [path for task in tasks for path in task.outputs if path in left and not left[path]]
+        for task in tasks:
+            for path in task.inputs:
+                if path in left and task.name in left[path]:
+                    left[path].discard(task.name)
+                    if not left[path]:
+                        released.append(path)
+        with_releases -= sum(weights[path] for path in set(released))
+    return unit, rows
+
+
+def plan(P, mode, keep=(), archive_path=None, volume_size=None):
+    """
+    The lifecycle plan of the pipeline P (see Pipeline_DAG.py): the mode, the archive directory, the keep-list, every managed output with the names of the tasks
+    that read it (other than the task that writes it), and the projection of the disk use.
+    """
+    if mode not in MODES:
+        raise ValueError("Lifecycle_Mode has to be one of " + ", ".join(MODES) + " (or None to keep every file), not " + str(mode) + ".")
+    if mode == "archive" and not archive_path:
+        raise ValueError("Lifecycle_Mode archive needs Archive_path.")
+    producers = P.producers()
+    consumers = OrderedDict((path, []) for path in producers if managed(path, keep))
+    for task in P.tasks.values():
+        for path in OrderedDict.fromkeys(task.inputs):
+            if path in consumers and producers[path] != task.name:
+                consumers[path].append(task.name)
+    unit, rows = projection(P, consumers, volume_size)
+    return OrderedDict([("mode", mode), ("archive", archive_path), ("keep", list(keep)), ("files", consumers),
+                        ("projection", OrderedDict([("unit", unit), ("stages", rows)]))])
+
+
+def amount(value, unit):
+    return "%.2f GB" % (value / 1e9) if unit == "bytes" else str(value) + " volumes"
+
+
+def report(lifecycle):
+    # The projected disk use after every stage, and its peak, with and without the releases.
+    unit, rows = lifecycle["projection"]["unit"], lifecycle["projection"]["stages"]
+    width = max([len(row[0]) for row in rows] + [5])
+    lines = ["Projected disk use of the declared outputs (" + lifecycle["mode"] + " mode; the stages are assumed to run one after the other):",
+             "%-*s %14s %18s %18s" % (width, "Stage", "Written", "With releases", "Without releases")]
+    lines += ["%-*s %14s %18s %18s" % (width, row[0], amount(row[1], unit), amount(row[2], unit), amount(row[3], unit)) for row in rows]
+    peak_with, peak_without = max([row[2] for row in rows] + [0]), max([row[3] for row in rows] + [0])
+    lines.append("Peak: " + amount(peak_with, unit) + " with releases, " + amount(peak_without, unit) + " without; " + str(len(lifecycle["files"])) +
+                 " intermediates are released once their last consumer succeeds (transformations with displacement grids are kept).")
+    return "\n".join(lines)
+
+
+def displacement(path):
+    # Whether a transformation refers to a displacement grid, which is not an output of its task and is never released.
+    with open(path, errors='replace') as handle:
+        return "Displacement_Volume" in handle.read()
+
+
+def release_file(path, lifecycle, stamp_dir=STAMP_DIR):
+    """Delete (or archive, then delete) a consumed intermediate, and record its digest. Returns the bytes freed."""
+    if not os.path.lexists(path) or (path.endswith(".xfm") and os.path.exists(path) and displacement(path)):
+        return 0
+    digest = file_digest(path, stamp_dir)
+    size = os.lstat(path).st_size
+    archive = None
+    # A cached volume linked into place (e.g., a blur of Blur_Cache) is only unlinked; the cache keeps it.
+    if lifecycle["mode"] == "archive" and not os.path.islink(path):
+        archive = os.path.join(lifecycle["archive"], os.path.abspath(path).lstrip("/") + ".gz")
+        os.makedirs(os.path.dirname(archive), exist_ok=True)
+        temporary = archive + "." + str(os.getpid()) + ".tmp"
+        with open(path, 'rb') as source, gzip.open(temporary, 'wb', compresslevel=COMPRESSLEVEL) as target:
+            shutil.copyfileobj(source, target, 1 << 23)
+        os.replace(temporary, archive)
+    _write_json(release_record(path, stamp_dir), OrderedDict([("path", os.path.abspath(path)), ("sha256", digest), ("archive", archive), ("bytes", size)]))
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        # Another consumer released it at the same time.
+        return 0
+    return size
+
+
+def consumed(path, stamp_dir=STAMP_DIR):
+    # Directory of the markers of the tasks that consumed path, by the digest of its content.
+    return os.path.join(stamp_dir, "Consumers", hashlib.sha1(os.path.abspath(path).encode()).hexdigest())
+
+
+def release(lifecycle_path, task, inputs, outputs, stamp_dir=STAMP_DIR):
+    """Mark the managed inputs of a succeeded task as consumed, and release the ones all of whose consumers succeeded, and the outputs no task reads."""
+    lifecycle = _read_json(lifecycle_path)
+    files = lifecycle["files"]
+    # The outputs were just written (again), so their earlier consumers have to consume them again.
+    for path in OrderedDict.fromkeys(outputs):
+        if path in files:
+            shutil.rmtree(consumed(path, stamp_dir), ignore_errors=True)
+    done = []
+    for path in OrderedDict.fromkeys(inputs):
+        if path not in files or not os.path.lexists(path):
+            continue
+        digest = file_digest(path, stamp_dir)
+        if digest is None:
+            continue
+        markers = os.path.join(consumed(path, stamp_dir), digest[:16])
+        os.makedirs(markers, exist_ok=True)
+        open(os.path.join(markers, task), 'w').close()
+        if set(files[path]) <= set(os.listdir(markers)):
+            done.append(path)
+    done += [path for path in OrderedDict.fromkeys(outputs) if path in files and not files[path]]
+    freed = sum(release_file(path, lifecycle, stamp_dir) for path in done)
+    if done:
+        print(task + " released " + str(len(done)) + " intermediates (" + "%.2f GB" % (freed / 1e9) + (", archived" if lifecycle["mode"] == "archive" else "") + ").")
+
+
+def restore(lifecycle_path, inputs, stamp_dir=STAMP_DIR):
+    """Decompress the archived inputs of a task that runs again. A deleted input stops the task."""
+    deleted = []
+    for path in OrderedDict.fromkeys(inputs):
+        if os.path.lexists(path):
+            continue
+        record = _read_json(release_record(path, stamp_dir))
+        if record is None:
+            continue
+        if not record["archive"] or not os.path.isfile(record["archive"]):
+            deleted.append(path)
+            continue
+        temporary = path + "." + str(os.getpid()) + ".tmp"
+        with gzip.open(record["archive"], 'rb') as source, open(temporary, 'wb') as target:
+            shutil.copyfileobj(source, target, 1 << 23)
+        os.replace(temporary, path)
+        os.remove(release_record(path, stamp_dir))
+        os.remove(record["archive"])
+        print("Restored " + path + " from " + record["archive"] + ".")
+    if deleted:
+        raise SystemExit("Deleted intermediates are needed again: " + " ".join(deleted) + ". Run the submission script again, which writes them again.")
+
+
+if __name__ == "__main__":
+
+    # @<list file> stands for the files of a list (see Pipeline_DAG.list_file).
+    parser = argparse.ArgumentParser(description="Release the intermediate files of a pipeline once their last consumer succeeded.", fromfile_prefix_chars='@')
+    parser.add_argument('action', choices=['release', 'restore', 'report'])
+    parser.add_argument('lifecycle', help='Lifecycle plan (Lifecycle.json)')
+    parser.add_argument('task', nargs='?', default=None, help='release: the task that succeeded')
+    parser.add_argument('--inputs', nargs='*', default=[])
+    parser.add_argument('--outputs', nargs='*', default=[])
+    args = parser.parse_args()
+
+    if args.action == 'release':
+        if args.task is None:
+            parser.error("release needs the task")
+        release(args.lifecycle, args.task, args.inputs, args.outputs)
+    elif args.action == 'restore':
+        restore(args.lifecycle, args.inputs)
+    else:
+        lifecycle = _read_json(args.lifecycle)
+        if lifecycle is None:
+            raise SystemExit("Cannot read " + args.lifecycle + "; generate the scripts again.")
+        print(report(lifecycle))
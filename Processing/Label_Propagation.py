@@ -1,11 +1,17 @@
 # This is a Python script for validating and labelling initialized images after non-linearly registering them to an atlas. It will generate a series of Bash scripts that will resample the initialized image into the non-linear atlas space, compare the similarity of the two images, concatenate the registration transformation files, invert them, and propagate the labels to the initialized space using this concatenated transformation. 
 
-# Any compute cluster can be used. To run these scripts, you must install the MINC Toolkit module onto the cluster beforehand, unless one already exists. You will notice here, for example, that we use a module called "minc/1.9.15", which is defined in the Bash header of every script via "module load minc/1.9.15". SLURM identifies the software on the cluster using this line. Other parameters you can play around with are time and memory. To execute these scripts, upload them to your remote /path/to/<PROJECT>/Scripts directory, and run "sbatch Job_Submission_First.sh". The landmark files will end up in /path/to/<PROJECT>/Source/Tag and the segmentations will end up in /path/to/<PROJECT>/Source/Resample. 
+# Any compute cluster can be used. To run these scripts, you must install the MINC Toolkit module onto the cluster beforehand, unless one already exists. You will notice here, for example, that we use a module called "minc/1.9.15", which is defined in the Bash header of every script via "module load minc/1.9.15". SLURM identifies the software on the cluster using this line. Other parameters you can play around with are time and memory. To execute these scripts, upload them to your remote /path/to/<PROJECT>/Scripts directory, and run "bash <PROJECT>_Labels_Submission.sh" on the login node. The landmark files will end up in /path/to/<PROJECT>/Source/Tag and the segmentations will end up in /path/to/<PROJECT>/Source/Resample. 
 
 # To use OS dependent functionality
 import os 
 # To read and write data in the .csv format.      
 import csv
+# To quote the anatomy terms on the command lines.
+import shlex
+# To describe the label propagation as a DAG of tasks and write the .sh scripts.
+from Pipeline_DAG import Pipeline, Task, install
+# To size the --mem and --time of every job from the volume headers and the recorded usage.
+from Resource_Model import read_history, size_pipeline, volume_sizes
 
 #-------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
 # PLEASE READ! THE ONLY VARIABLES THAT NEED TO BE EDITED WITHIN THIS SCRIPT ARE BETWEEN THESE DASHED LINES.
@@ -66,8 +72,25 @@ Module = "minc/1.9.15"
 n_nodes = "1"
 Label_Time = "10:00:00"
 Label_Mem = "40000M"
-Job_Submission_Time = "05-00:00:00"
-Job_Submission_Mem = "2000M"
+# Submit the label propagation as a single SLURM job array instead of one sbatch per script. At most Array_Concurrency elements of the array run at the same time (--array=1-N%K).
+Array_Jobs = True
+Array_Concurrency = "50"
+# Size the --mem and --time of every job from the headers of the volumes it reads (mincinfo dimensions and data type) and from the usage recorded by previous runs (the Stamps directory of the cluster, copied next to these scripts before regenerating them), times Resource_Margin; the Mem and Time above become ceilings. Local_MNC_path is a directory holding the specimens and the atlas (set it to Source_MNC_path when generating the scripts on the cluster); without it, the jobs are sized from the recorded usage. Set Auto_Resources = False to use the Mem and Time above for every job.
+Auto_Resources = True
+Local_MNC_path = None
+Resource_Margin = 1.5
+# XFM_Engine = "XFM_Algebra" concatenates the lsq6, lsq12, and ANTS transformations and inverts the result in one call of XFM_Algebra.py instead of xfmconcat and xfminvert; the concatenated and inverted files reference the displacement grid of the ANTS registration instead of copying it twice. It needs numpy on the cluster and changes the format of the concatenated files, so it is opt-in; the default XFM_Engine = "xfmconcat" uses the MINC tools.
+XFM_Engine = "xfmconcat"
+# With ANTS_Inverse = True, the inverted transformation (_origtoANTS_nl_inverted.xfm), which brings the landmarks and segmentations of the atlas to every specimen, is built from the inverse warp ANTS writes next to its forward warp (_ANTS_nl_inverse.xfm) and the inverses of the lsq12 and lsq6 matrices, instead of inverting the concatenated grid. transformtags and mincresample then apply a forward grid instead of inverting the deformation field point by point, which is most of the memory and time of every Label_Query job. Set ANTS_Inverse = False for registrations whose inverse warps are missing.
+ANTS_Inverse = True
+# Landmark_Engine = "Landmark_Propagation" propagates the landmarks of all tag files with one call of Landmark_Propagation.py per specimen instead of one transformtags call per tag file: the transformation is read once, and only the part of the displacement grid around the landmarks. It needs numpy and pyminc on the cluster (pip install numpy pyminc), so it is opt-in; the default Landmark_Engine = "transformtags" uses transformtags. Landmark_Propagation.py can also propagate new tag files to every specimen of a finished project at once (e.g., "python3 Landmark_Propagation.py --tags New.tag --anatomy Palate --xfm <PROJECT>/nl/XFM/{SpecID}_origtoANTS_nl_inverted.xfm --output <PROJECT>/Source/Tag/{SpecID}_{anatomy}_Landmarks.tag --specimens $(cat spec_list.txt)"), with one process per CPU.
+Landmark_Engine = "transformtags"
+# QC_Engine = "Registration_QC" replaces the minccmp call of every Label_Query job (appended to Quality/<SpecID>_Quality.txt) with one Registration_QC job after all of them: Registration_QC.py streams every resampled specimen against the atlas within the mask, slab by slab, and writes the cross-correlation, root mean square error, and mutual information of all specimens into Quality/<PROJECT>_Registration_QC.csv, with robust z-scores and the outliers flagged, joined to Metadata_CSV (a table on the cluster with the specimen IDs in the Biosample column) when it is set. With QC_Downsample = 2 (or 4), blocks of 2 x 2 x 2 voxels are averaged first, which is eight times faster. It needs numpy and pyminc on the cluster, so it is opt-in; the default QC_Engine = "minccmp" uses minccmp.
+QC_Engine = "minccmp"
+QC_Downsample = 1
+QC_Time = "02:00:00"
+QC_Mem = "8000M"
+Metadata_CSV = None
 
 # Echo default parameters.
 print("\nThese are the default compute cluster parameters:")
@@ -75,8 +98,10 @@ print(f"Module: {Module}")
 print(f"Number of nodes: {n_nodes}")
 print(f"Label Time: {Label_Time}")
 print(f"Label Memory: {Label_Mem}")
-print(f"Job Submission Time: {Job_Submission_Time}")
-print(f"Job Submission Memory: {Job_Submission_Mem}\n")
+print(f"QC Time: {QC_Time}")
+print(f"QC Memory: {QC_Mem}")
+print(f"Job arrays: {Array_Jobs}")
+print(f"Job array concurrency: {Array_Concurrency}\n")
 
 # Reminder to change parameters if needed.
 print(f"They need to be changed manually if you encounter any errors. Please put these scripts into the {PROJECT_PATH}Scripts directory and all of your image data, including segmentation and landmark files, into the {PROJECT_PATH}Source/MNC/ directory. \n")
@@ -99,6 +124,8 @@ nl_Init_path = PROJECT_PATH + "nl/INIT/"
 nl_Blurred_path = PROJECT_PATH + "nl/Blurred/"
 nl_XFM_path = PROJECT_PATH + "nl/XFM/"
 nl_MNC_path = PROJECT_PATH + "nl/MNC/"
+# With Telemetry_path, every command of the scripts appends its runtime, CPU time, peak memory, exit code, and disk I/O to Telemetry_path/<task>.jsonl; copy the directory back and run "python3 Telemetry.py report <Telemetry directory> --graph Labels_Graph.json" for the hot spots of every stage and the critical path. Recording is opt-in: set Telemetry_path (e.g., PROJECT_PATH + "Telemetry/") to record; the default None runs the commands as they are.
+Telemetry_path = None
 
 # Define full paths to atlas files.
 Atlas_Avg = Source_MNC_path + Atlas
@@ -114,59 +141,84 @@ Specimens=Specimen_List.read()
 Specimen_IDs=Specimens.split('\n')
 # Remove the last blank entry caused by the final \n.
 del Specimen_IDs[-1]
-# Define the length of the specimen list.
-Specimen_List_Length=len(Specimen_IDs)
-# Divide the length of the list by the same number.
-Specimen_Group=int(Specimen_List_Length/Specimen_List_Length)
-# Calculate upper limit of specimen list to use in for loop sequences.
-Specimen_Upper=(Specimen_List_Length)-1
 # Close the specimen list.
 Specimen_List.close()
 
-# Create .sh files for landmarks and segmentations.
-# Begin a counter.
-Label_Counter = 0
-for SpecID in Specimen_IDs:
-    # Add 1 to the counter for every new file in the loop.
-    Label_Counter += 1
-    # Open a file to write to; 'a' for append; lsq6_Second is the second stage of .sh scripts to submit.
-    Label_Query = open("Label_Query_" + str(Label_Counter) + ".sh", 'a')
-    # Add header.
-    Label_Query.write("#!/bin/bash\n#SBATCH --nodes=" + n_nodes + "\n#SBATCH --mem=" + Label_Mem + "\n#SBATCH --time=" + Label_Time + "\n\nmodule load " + Module + "\n\ncd " + Scripts_path + "\n\necho \"The job started at $(date).\"\n\n")
-    Label_Query.write("echo \"Begin the label propagation for " + SpecID + ".\"\n\n")
-    # Concatenate the transformation files.
-    Label_Query.write("xfmconcat -clobber " + lsq6_XFM_path + SpecID + "_lsq6_2.xfm " + lsq12_XFM_path + SpecID + "_lsq12_2.xfm " + nl_XFM_path + SpecID + "_ANTS_nl.xfm " + nl_XFM_path + SpecID + "_origtoANTS_nl.xfm\n")
+# Create .sh files for landmarks and segmentations. Every task declares its inputs and outputs, and its script skips the work when the outputs are up to date with the task's commands and inputs (see Pipeline_DAG.py).
+Labels = Pipeline(PROJECT_NAME + "_Labels", Scripts_path, Module, n_nodes)
+Labels.array_jobs = Array_Jobs
+Labels.array_concurrency = Array_Concurrency
+Labels.telemetry_path = Telemetry_path
+
+def Label_Query(Name, SpecID):
+    Orig_XFM = nl_XFM_path + SpecID + "_origtoANTS_nl.xfm"
+    Inverted_XFM = nl_XFM_path + SpecID + "_origtoANTS_nl_inverted.xfm"
+    nl_File = nl_MNC_path + SpecID + "_ANTS_nl.mnc"
+    Task_Label = Task(Name, [], [], [], Label_Mem, Label_Time, "Label_Query", "Begin the label propagation for " + SpecID + ".")
+    lsq6_XFM = lsq6_XFM_path + SpecID + "_lsq6_2.xfm"
+    lsq12_XFM = lsq12_XFM_path + SpecID + "_lsq12_2.xfm"
+    nl_XFM = nl_XFM_path + SpecID + "_ANTS_nl.xfm"
+    nl_Inverse_XFM = nl_XFM_path + SpecID + "_ANTS_nl_inverse.xfm"
+    XFMs = lsq6_XFM + " " + lsq12_XFM + " " + nl_XFM + " "
+    # Concatenate the transformation files (and, with XFM_Algebra.py, invert the concatenation in the same call).
+    if XFM_Engine == "XFM_Algebra":
+        Task_Label.commands.append(Labels.python + " XFM_Algebra.py concat " + XFMs + Orig_XFM + " --inverse " + Inverted_XFM + (" --known-inverse " + nl_XFM + " " + nl_Inverse_XFM if ANTS_Inverse else ""))
+    else:
+        Task_Label.commands.append("xfmconcat -clobber " + XFMs + Orig_XFM)
     # Resample the initialized images into the non-linear atlas space.
-    Label_Query.write("mincresample -like " + Atlas_Avg + " -clobber -transformation " + nl_XFM_path + SpecID + "_origtoANTS_nl.xfm " + Source_MNC_path + SpecID + ".mnc " + nl_MNC_path + SpecID + "_ANTS_nl.mnc\n")
-    # Compare the similarity of the resampled image and the atlas.
-    Label_Query.write("echo -e \"" + SpecID + "\n$(minccmp -quiet -mask " + Atlas_Avg_Mask + " -xcorr -rmse " + Atlas_Avg + " " + nl_MNC_path + SpecID + "_ANTS_nl.mnc)\"" + " >> " + Quality_path + SpecID + "_Quality.txt\n")
-    # Invert the concatenated transformation file.
-    Label_Query.write("xfminvert -clobber " + nl_XFM_path + SpecID + "_origtoANTS_nl.xfm " + nl_XFM_path + SpecID + "_origtoANTS_nl_inverted.xfm\n")
+    Task_Label.commands.append("mincresample -like " + Atlas_Avg + " -clobber -transformation " + Orig_XFM + " " + Source_MNC_path + SpecID + ".mnc " + nl_File)
+    # Compare the similarity of the resampled image and the atlas (or, with Registration_QC.py, in one job for all specimens after the label propagation).
+    if QC_Engine != "Registration_QC":
+        Task_Label.commands.append("echo -e \"" + SpecID + "\n$(minccmp -quiet -mask " + Atlas_Avg_Mask + " -xcorr -rmse " + Atlas_Avg + " " + nl_File + ")\"" + " >> " + Quality_path + SpecID + "_Quality.txt")
+    # Invert the concatenated transformation file: the inverse warp of ANTS followed by the inverted lsq12 and lsq6 matrices, or the inverted concatenation.
+    if XFM_Engine != "XFM_Algebra" and ANTS_Inverse:
+        Task_Label.commands += ["xfminvert -clobber " + lsq12_XFM + " " + nl_XFM_path + SpecID + "_lsq12_2_inverted.xfm",
+                                "xfminvert -clobber " + lsq6_XFM + " " + nl_XFM_path + SpecID + "_lsq6_2_inverted.xfm",
+                                "xfmconcat -clobber " + nl_Inverse_XFM + " " + nl_XFM_path + SpecID + "_lsq12_2_inverted.xfm " + nl_XFM_path + SpecID + "_lsq6_2_inverted.xfm " + Inverted_XFM]
+        Task_Label.outputs += [nl_XFM_path + SpecID + "_lsq12_2_inverted.xfm", nl_XFM_path + SpecID + "_lsq6_2_inverted.xfm"]
+    elif XFM_Engine != "XFM_Algebra":
+        Task_Label.commands.append("xfminvert -clobber " + Orig_XFM + " " + Inverted_XFM)
+    if ANTS_Inverse:
+        Task_Label.inputs.append(nl_Inverse_XFM)
+    Task_Label.inputs += [lsq6_XFM, lsq12_XFM, nl_XFM, Atlas_Avg, Atlas_Avg_Mask, Source_MNC_path + SpecID + ".mnc"]
+    Task_Label.outputs += [Orig_XFM, nl_File, Inverted_XFM]
     # Propagate the atlas landmarks to the initialized space of each image using the inverted transformation file.
-    for key, (tag_file, anatomy_term) in tag_files.items():
-        Label_Query.write("transformtags -vol1 -transformation " + nl_XFM_path + SpecID + "_origtoANTS_nl_inverted.xfm " + tag_file + " " + Source_Tag_path + SpecID + "_" + anatomy_term + "_Landmarks.tag\n")
+    Tags = [(tag_file, anatomy_term) for tag_file, anatomy_term in tag_files.values() if tag_file]
+    if Tags and Landmark_Engine == "Landmark_Propagation":
+        # All tag files in one pass, reading the transformation once.
+        Task_Label.commands.append(Labels.python + " Landmark_Propagation.py --tags " + " ".join(tag_file for tag_file, _ in Tags) + " --anatomy " + " ".join(shlex.quote(anatomy_term) for _, anatomy_term in Tags) +
+                                   " --xfm " + nl_XFM_path + "{SpecID}_origtoANTS_nl_inverted.xfm --output " + Source_Tag_path + "{SpecID}_{anatomy}_Landmarks.tag --specimens " + SpecID + " --workers 1")
+    for tag_file, anatomy_term in Tags:
+        if Landmark_Engine != "Landmark_Propagation":
+            Task_Label.commands.append("transformtags -vol1 -transformation " + Inverted_XFM + " " + tag_file + " " + Source_Tag_path + SpecID + "_" + anatomy_term + "_Landmarks.tag")
+        Task_Label.inputs.append(tag_file)
+        Task_Label.outputs.append(Source_Tag_path + SpecID + "_" + anatomy_term + "_Landmarks.tag")
     # Propagate the atlas segmentations to the initialized space of each image using the inverted transformation file.
-    try:
-        if Atlas_Avg_Segs:
-            Label_Query.write("mincresample -like " + Atlas_Avg + " -clobber -transform " + nl_XFM_path + SpecID + "_origtoANTS_nl_inverted.xfm " + Atlas_Avg_Segs + " " + Source_Resample_path + SpecID + "_Segs.mnc\n")
-    except NameError:
-        pass
-    Label_Query.write("echo \"The job ended at $(date).\"")
-    # Close the file.
-    Label_Query.close()
+    if Atlas_Segs:
+        Task_Label.commands.append("mincresample -like " + Atlas_Avg + " -clobber -transform " + Inverted_XFM + " " + Atlas_Avg_Segs + " " + Source_Resample_path + SpecID + "_Segs.mnc")
+        Task_Label.inputs.append(Atlas_Avg_Segs)
+        Task_Label.outputs.append(Source_Resample_path + SpecID + "_Segs.mnc")
+    return Task_Label
+
+Labels.add_array("Label_Query", Label_Query, Specimen_IDs, start=1)
+if QC_Engine == "Registration_QC":
+    QC_Table = Quality_path + PROJECT_NAME + "_Registration_QC.csv"
+    Labels.add(Task("Registration_QC", [Labels.python + " Registration_QC.py --atlas " + Atlas_Avg + " --mask " + Atlas_Avg_Mask + " --volume " + nl_MNC_path + "{SpecID}_ANTS_nl.mnc --specimens " +
+                                        " ".join(Specimen_IDs) + " --output " + QC_Table + (" --metadata " + Metadata_CSV if Metadata_CSV else "") + " --downsample " + str(QC_Downsample)],
+                    [nl_MNC_path + SpecID + "_ANTS_nl.mnc" for SpecID in Specimen_IDs] + [Atlas_Avg, Atlas_Avg_Mask] + ([Metadata_CSV] if Metadata_CSV else []), [QC_Table],
+                    QC_Mem, QC_Time, "Registration_QC", "The registration of every specimen to the atlas is being measured."))
+# Size the header of every job from the headers of its input volumes and the usage recorded by previous runs (see Resource_Model.py).
+if Auto_Resources:
+    size_pipeline(Labels, read_history(graph_path="Labels_Graph.json"), volume_sizes(Source_MNC_path, Local_MNC_path, Atlas_Avg), Resource_Margin)
+# Write one .sh script per specimen (or a single job array), a description of the DAG (Labels_Graph.json), and copies of Pipeline_DAG.py, Telemetry.py, XFM_Algebra.py, Landmark_Propagation.py, and Registration_QC.py, which the scripts call to check and stamp their tasks, to record their commands, to concatenate the transformations, to propagate the landmarks, and to measure the registrations.
+Labels.write_scripts()
+Labels.write_graph("Labels_Graph.json")
+install(".", ("Pipeline_DAG.py", "Telemetry.py", "XFM_Algebra.py", "Landmark_Propagation.py", "Registration_QC.py"))
 
 #-------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
-# Create master job submission scripts for all stages. These scripts will automatically submit all .sh scripts to the queue and will be chained together.
-
-# Job_Submission_First
-Job_Submission_First = open("Job_Submission_First.sh",'a')
-Job_Submission_First.write("#!/bin/bash\n#SBATCH --partition=single\n#SBATCH --nodes=" + n_nodes + "\n#SBATCH --mem=" + Job_Submission_Mem + "\n#SBATCH --time=" + Job_Submission_Time + "\n#SBATCH --job-name=Job_Submission_First.sh\n\necho \"The job started at $(date).\"\n\n")
-Job_Submission_First.write("cd " + Scripts_path + "\n\n")
-Job_Submission_First.write("sleep 10\n\n")
-Job_Submission_First.write("# Generate a sequence of numbers.\nNUMBERS=$(seq 1 " + str(Specimen_List_Length) + ")\n\n")
-Job_Submission_First.write("# For loop to automatically submit your jobs.\nfor NUM in $NUMBERS; do\nNAME=\"Label_Query_$NUM.sh\"\nLabel=\"sbatch $NAME\"\n$Label\necho $Label\n# Sleep script in 3 second intervals.\nsleep 3\ndone\n\n")
-Job_Submission_First.write("# Sleep script for 5 seconds before while loop.\nsleep 5\n\n")
-Job_Submission_First.write("# Create while loop to idle submission script.\nwhile [[ $(squeue -t R -u $USER --noheader | wc -l) -gt 1 || $(squeue -t PD -u $USER --noheader | wc -l) -ge 1 ]]; do\nsleep 5\ndone\n\n")
-Job_Submission_First.write("#----------------------------------------------------- Remove current submission script from the queue.\n\n")
-Job_Submission_First.write("echo \"The job ended at $(date).\"\n")
-Job_Submission_First.write("scancel -u $USER --jobname=Job_Submission_First.sh")
+# Create the master job submission script. It submits every .sh script once and is run on the login node (bash <PROJECT>_Labels_Submission.sh); there is no submission job polling the queue.
+# It also writes <PROJECT>_Labels_Manifest.json (upload it with the scripts), the expected outputs of every task: rerunning <PROJECT>_Labels_Submission.sh after a crash or a node failure (once the jobs left in the queue are cancelled) only submits the jobs, and the job array elements, whose tasks are missing or stale, and generating the scripts again in the same directory removes the scripts that are no longer part of the pipeline (the scripts of the other pipelines in the directory, which have their own submission scripts and manifests, are kept).
+Labels.write_submission()
+
+# Without a cluster (e.g., a pilot on a workstation), set the project paths above to local paths and run the same jobs with a local pool of processes, bounded by the cores and the declared memory:
+# python3 Local_Executor.py graph Labels_Graph.json --cores 64    (or: python3 Local_Executor.py slurm <PROJECT>_Labels_Submission.sh, which runs <PROJECT>_Labels_Submission.sh with stand-ins for sbatch and squeue)
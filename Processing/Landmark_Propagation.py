@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+"""
+This script propagates the landmarks of the atlas (.tag files) to the initialized space of every specimen, in place of one transformtags call per tag file
+and specimen, each of which reads the whole transformation again.
+
+The transformation of a specimen (e.g., <SpecID>_origtoANTS_nl_inverted.xfm, see Label_Propagation.py) is read once with XFM_Algebra.py, and the points of
+all tag files are stacked into one array and transformed in one pass: the linear parts as matrix products, and the displacement grid by trilinear sampling of
+the hyperslab of the grid around the landmarks, which is all of the grid that is read. The points are then split back into one tag file per anatomy term,
+with the weights, structure and patient IDs, and labels of the atlas points (as transformtags -vol1 does, only the first volume of a two-volume tag file is
+transformed). Several specimens are propagated in a pool of processes.
+
+The paths of the transformations and of the outputs are patterns in which {SpecID} stands for the specimen ID and {anatomy} for the anatomy term of a tag file:
+
+python3 Landmark_Propagation.py --tags <atlas tag> [<atlas tag> ...] --anatomy <term> [<term> ...] --xfm <nl/XFM/{SpecID}_origtoANTS_nl_inverted.xfm>
+                                --output <Source/Tag/{SpecID}_{anatomy}_Landmarks.tag> --specimens <SpecID> [<SpecID> ...] [--workers N]
+
+Dependencies required: numpy, and pyminc (pip install numpy pyminc) for transformations with displacement grids.
+"""
+
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from XFM_Algebra import read
+
+HEADER = "MNI Tag Point File"
+
+
+def read_tags(path):
+    # The header of a tag file (up to "Points ="), its first-volume points as an (N, 3) array, and the rest of every point line (the second volume, weight,
+    # structure ID, patient ID, and label), which is kept as it is.
+    with open(path) as handle:
+        text = handle.read()
+    if not text.startswith(HEADER) or "Points =" not in text:
+        raise ValueError(path + " is not an MNI tag point file.")
+    header, _, body = text.partition("Points =")
+    body = body.strip()
+    if body.endswith(";"):
+        body = body[:-1]
+    points, rests = [], []
+    for line in body.split("\n"):
+        fields = line.split(None, 3)
+        if not fields:
+            continue
+        points.append([float(value) for value in fields[:3]])
+        rests.append(fields[3].strip() if len(fields) > 3 else "")
+    return header + "Points =", np.array(points, dtype=np.float64).reshape(-1, 3), rests
+
+
+def write_tags(path, header, points, rests):
+    lines = [" " + " ".join("%.15g" % value for value in point) + (" " + rest if rest else "") for point, rest in zip(points, rests)]
+    with open(path + ".tmp", 'w') as handle:
+        handle.write(header + "\n" + "\n".join(lines) + ";\n")
+    os.replace(path + ".tmp", path)
+
+
+def specimen_path(pattern, SpecID, anatomy=""):
+    return pattern.replace("{SpecID}", SpecID).replace("{anatomy}", anatomy)
+
+
+def propagate(SpecID, tags, anatomy, xfm, output):
+    """Transform the points of every tag file (tags, with their anatomy terms) by the transformation of one specimen, and write one tag file per anatomy term."""
+    atlas = [read_tags(path) for path in tags]
+    points = np.concatenate([tag_points for _, tag_points, _ in atlas]) if atlas else np.zeros((0, 3))
+    transformed = read(specimen_path(xfm, SpecID)).apply(points)
+    start = 0
+    for (header, tag_points, rests), term in zip(atlas, anatomy):
+        write_tags(specimen_path(output, SpecID, term), header, transformed[start:start + len(tag_points)], rests)
+        start += len(tag_points)
+    return len(points)
+
+
+def workers():
+    # The CPUs SLURM gave the job, or every CPU outside of SLURM.
+    return int(os.environ.get("SLURM_CPUS_ON_NODE", 0)) or os.cpu_count() or 1
+
+
+def propagate_all(Specimen_IDs, tags, anatomy, xfm, output, processes=None):
+    # Propagate the landmarks to every specimen, in a pool of processes when there are several specimens.
+    processes = min(processes or workers(), len(Specimen_IDs))
+    if processes <= 1:
+        counts = [propagate(SpecID, tags, anatomy, xfm, output) for SpecID in Specimen_IDs]
+    else:
+        with ProcessPoolExecutor(processes) as pool:
+            counts = list(pool.map(propagate, Specimen_IDs, *[[value] * len(Specimen_IDs) for value in (tags, anatomy, xfm, output)]))
+    print("Propagated " + str(counts[0] if counts else 0) + " landmarks of " + str(len(tags)) + " tag files to " + str(len(Specimen_IDs)) + " specimens.")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Propagate the atlas landmarks of every tag file to every specimen in one pass per specimen.")
+    parser.add_argument('--tags', nargs='+', required=True, help='Atlas tag files')
+    parser.add_argument('--anatomy', nargs='+', required=True, help='Anatomy term of every tag file, in the same order')
+    parser.add_argument('--xfm', required=True, help='Transformation of a specimen, with {SpecID} for the specimen ID')
+    parser.add_argument('--output', required=True, help='Output tag file, with {SpecID} for the specimen ID and {anatomy} for the anatomy term')
+    parser.add_argument('--specimens', nargs='+', required=True, help='Specimen IDs')
+    parser.add_argument('--workers', type=int, default=None, help='Processes (the CPUs of the job by default)')
+    args = parser.parse_args()
+
+    if len(args.anatomy) != len(args.tags):
+        parser.error("every tag file needs one anatomy term")
+    propagate_all(args.specimens, args.tags, args.anatomy, args.xfm, args.output, args.workers)
@@ -1,7 +1,7 @@
 #-------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
 # This is a Python script for pairwise spatial normalization using SyN's non-linear algorithm. It will generate a series of Bash scripts that will pairwise register your images to an atlas. Any compute cluster can be used. To run these scripts, you must install the MINC Toolkit module onto the cluster beforehand, unless one already exists. You will notice here, for example, that we use a module called "minc/1.9.15", which is defined in the Bash header of every script via "module load minc/1.9.15". SLURM identifies the software on the cluster using this line. Other parameters you can play around with are time and memory. 
 
-# The resulting Bash scripts non-linearly register high-resolution mouse images (35 um) to an atlas. Other resolutions can be used, but the blurring and registratation step values need to be scaled accordingly. For instance, if you have 100 um image files, you would just scale the blurring values and the registration step values by a factor of 2. To execute these scripts, upload them to your remote /path/to/<PROJECT>/Scripts directory, and run "sbatch Job_Submission_First.sh". 
+# The resulting Bash scripts non-linearly register high-resolution mouse images (35 um) to an atlas. Other resolutions can be used, but the blurring and registratation step values need to be scaled accordingly. For instance, if you have 100 um image files, you would just scale the blurring values and the registration step values by a factor of 2. To execute these scripts, upload them to your remote /path/to/<PROJECT>/Scripts directory, and run "bash <PROJECT>_Pairwise_Submission.sh" on the login node. 
 
 # Citation: Percival, C.J., Devine, J., Darwin, B.C., Liu, W., van Eede, M., Henkelman, R.M. and Hallgrimsson, B., 2019. The effect of automated landmark identification on morphometric analyses. J Anat (2019). https://doi.org/10.1111/joa.12973
 # Citation: Devine, J., Aponte, J.D., Katz, D.C. et al. A Registration and Deep Learning Approach to Automated Landmark Detection for Geometric Morphometrics. Evol Biol (2020). https://doi.org/10.1007/s11692-020-09508-8
@@ -12,6 +12,10 @@
 # Import packages.
 import os
 import csv
+# To describe the pairwise registrations as a DAG of tasks and write one .sh script per task.
+from Pipeline_DAG import install
+from Intermediate_Lifecycle import report as lifecycle_report
+from Pairwise_Pipeline import build_pairwise_pipeline
 
 # 1) Your local and remote directories must be mapped correctly (i.e., the directories match the variables and "<PROJECT>" should be replaced with your project name);
 # 2) Let's assume your local specimen list is called spec_list.txt;
@@ -52,8 +56,13 @@ lsq12_Time = "07:00:00"
 lsq12_Mem = "25000M"
 nl_Time = "11:00:00"
 nl_Mem = "25000M"
-Job_Submission_Time = "05-00:00:00"
-Job_Submission_Mem = "2000M"
+# Submit every per-specimen stage as a single SLURM job array instead of one sbatch per script. At most Array_Concurrency elements of an array run at the same time (--array=1-N%K).
+Array_Jobs = True
+Array_Concurrency = "50"
+# Size the --mem and --time of every job from the headers of the volumes it reads (mincinfo dimensions and data type) and from the usage recorded by previous runs (the Stamps directory of the cluster, copied next to these scripts before regenerating them), times Resource_Margin; the Mem and Time above become ceilings. Local_MNC_path is a directory holding the specimens and the atlas (set it to Source_MNC_path when generating the scripts on the cluster); without it, the jobs are sized from the recorded usage. Set Auto_Resources = False to use the Mem and Time above for every job.
+Auto_Resources = True
+Local_MNC_path = None
+Resource_Margin = 1.5
 
 # Echo default parameters.
 print("\nThese are the default compute cluster parameters:")
@@ -65,8 +74,8 @@ print(f"lsq12 Time: {lsq12_Time}")
 print(f"lsq12 Memory: {lsq12_Mem}")
 print(f"nl Time: {nl_Time}")
 print(f"nl Memory: {nl_Mem}")
-print(f"Job Submission Time: {Job_Submission_Time}")
-print(f"Job Submission Memory: {Job_Submission_Mem}\n")
+print(f"Job arrays: {Array_Jobs}")
+print(f"Job array concurrency: {Array_Concurrency}\n")
 
 # Reminder to change parameters if needed.
 print(f"They need to be changed manually if you encounter any errors. Please put these scripts into the {PROJECT_PATH}Scripts directory and all of your image data into the {PROJECT_PATH}Source/MNC/ directory. \n")
@@ -87,54 +96,14 @@ nl_Init_path = PROJECT_PATH + "nl/INIT/"
 nl_Blurred_path = PROJECT_PATH + "nl/Blurred/"
 nl_XFM_path = PROJECT_PATH + "nl/XFM/"
 nl_MNC_path = PROJECT_PATH + "nl/MNC/"
+Quality_path = PROJECT_PATH + "Quality/"
+# With Telemetry_path, every command of the scripts appends its runtime, CPU time, peak memory, exit code, and disk I/O to Telemetry_path/<task>.jsonl; copy the directory back and run "python3 Telemetry.py report <Telemetry directory> --graph Pairwise_Graph.json" for the hot spots of every stage and the critical path. Recording is opt-in: set Telemetry_path (e.g., PROJECT_PATH + "Telemetry/") to record; the default None runs the commands as they are.
+Telemetry_path = None
 
 # Define paths to atlas files.
 Atlas_Avg = Source_MNC_path + Atlas
 Atlas_Avg_Mask = Source_MNC_path + Atlas_Mask
 
-# Define blur files without "_blur" suffix.
-Atlas_Avg_Mask_352 = Source_MNC_path + "Atlas_average_mask_352"
-Atlas_Avg_Mask_176 = Source_MNC_path + "Atlas_average_mask_176"
-Atlas_Avg_Mask_098 = Source_MNC_path + "Atlas_average_mask_098"
-Atlas_Avg_Mask_078 = Source_MNC_path + "Atlas_average_mask_078"
-Atlas_Avg_Mask_064 = Source_MNC_path + "Atlas_average_mask_064"
-Atlas_Avg_Mask_050 = Source_MNC_path + "Atlas_average_mask_050"
-Atlas_Avg_352 = lsq6_Blurred_path + "Atlas_average_352"
-Atlas_Avg_176 = lsq6_Blurred_path + "Atlas_average_176"
-Atlas_Avg_098 = lsq12_Blurred_path + "Atlas_average_098"
-Atlas_Avg_078 = lsq6_Blurred_path + "Atlas_average_078"
-Atlas_Avg_064 = lsq12_Blurred_path + "Atlas_average_064"
-Atlas_Avg_050 = lsq12_Blurred_path + "Atlas_average_050"
-
-# Define blur files with "_blur" suffix.
-Atlas_Avg_Mask_352_Blur = Source_MNC_path + "Atlas_average_mask_352_blur.mnc"
-Atlas_Avg_Mask_176_Blur = Source_MNC_path + "Atlas_average_mask_176_blur.mnc"
-Atlas_Avg_Mask_098_Blur = Source_MNC_path + "Atlas_average_mask_098_blur.mnc"
-Atlas_Avg_Mask_078_Blur = Source_MNC_path + "Atlas_average_mask_078_blur.mnc"
-Atlas_Avg_Mask_064_Blur = Source_MNC_path + "Atlas_average_mask_064_blur.mnc"
-Atlas_Avg_Mask_050_Blur = Source_MNC_path + "Atlas_average_mask_050_blur.mnc"
-Atlas_Avg_352_Blur = lsq6_Blurred_path + "Atlas_average_352_blur.mnc"
-Atlas_Avg_176_Blur = lsq6_Blurred_path + "Atlas_average_176_blur.mnc"
-Atlas_Avg_098_Blur = lsq12_Blurred_path + "Atlas_average_098_blur.mnc"
-Atlas_Avg_098_Dxyz = lsq12_Blurred_path + "Atlas_average_098_dxyz.mnc"
-Atlas_Avg_078_Blur = lsq6_Blurred_path + "Atlas_average_078_blur.mnc"
-Atlas_Avg_064_Blur = lsq12_Blurred_path + "Atlas_average_064_blur.mnc"
-Atlas_Avg_050_Blur = lsq12_Blurred_path + "Atlas_average_050_blur.mnc"
-
-# Define blur files with "dxyz" suffix.
-Atlas_Avg_Mask_352_Dxyz = Source_MNC_path + "Atlas_average_mask_352_dxyz.mnc"
-Atlas_Avg_Mask_176_Dxyz = Source_MNC_path + "Atlas_average_mask_176_dxyz.mnc"
-Atlas_Avg_Mask_098_Dxyz = Source_MNC_path + "Atlas_average_mask_098_dxyz.mnc"
-Atlas_Avg_Mask_078_Dxyz = Source_MNC_path + "Atlas_average_mask_078_dxyz.mnc"
-Atlas_Avg_Mask_064_Dxyz = Source_MNC_path + "Atlas_average_mask_064_dxyz.mnc"
-Atlas_Avg_Mask_050_Dxyz = Source_MNC_path + "Atlas_average_mask_050_dxyz.mnc"
-Atlas_Avg_352_Dxyz = lsq6_Blurred_path + "Atlas_average_352_dxyz.mnc"
-Atlas_Avg_176_Dxyz = lsq6_Blurred_path + "Atlas_average_176_dxyz.mnc"
-Atlas_Avg_098_Dxyz = lsq12_Blurred_path + "Atlas_average_098_dxyz.mnc"
-Atlas_Avg_078_Dxyz = lsq6_Blurred_path + "Atlas_average_078_dxyz.mnc"
-Atlas_Avg_064_Dxyz = lsq12_Blurred_path + "Atlas_average_064_dxyz.mnc"
-Atlas_Avg_050_Dxyz = lsq12_Blurred_path + "Atlas_average_050_dxyz.mnc"
-
 # Open and read ('r') the all specimen list.
 Specimen_List=open(All_Specimens,'r')
 # Read specimen list as a single string.
@@ -143,17 +112,19 @@ Specimens=Specimen_List.read()
 Specimen_IDs=Specimens.split('\n')
 # Remove the last blank entry caused by the final \n.
 del Specimen_IDs[-1]
-# Define the length of the specimen list.
-Specimen_List_Length=len(Specimen_IDs)
-# Divide the length of the list by the same number.
-Specimen_Group=int(Specimen_List_Length/Specimen_List_Length)
-# Calculate upper limit of specimen list to use in for loop sequences.
-Specimen_Upper=(Specimen_List_Length)-1
 # Close the specimen list.
 Specimen_List.close()
 
 # Code the strings for iterative blurring via mincblur. -clobber overwrites existing files; -no apodize turns off apodization, which is designed to reduce diffraction edge effects (e.g., detector noise); -gradient calculates the change in intensity of a single pixel in the source image to the target image; -fwhm stands for full-width at half-maximum. In other words, what we want to do is convolve a "smoothing kernel", or Gaussian function, over an input volume in order to average neighboring points. The full-width at half-maximum describes the width of the Gaussian function at half of its peak to the left and right;
 MNC_Blur = "mincblur -clobber -no_apodize -gradient -fwhm "
+# Blur_Engine = "Multi_Blur" replaces the chained mincblur calls with Multi_Blur.py, which reads every volume once and writes all of its blurring kernels (separable Gaussian filtering), and only writes gradient volumes (_dxyz.mnc) where ANTS reads them. It needs numpy, scipy, and pyminc on the cluster (pip install numpy scipy pyminc), so it is opt-in; the default Blur_Engine = "mincblur" uses MNC_Blur with the MINC Toolkit alone.
+Blur_Engine = "mincblur"
+# XFM_Engine = "XFM_Algebra" concatenates and inverts the transformation files with XFM_Algebra.py instead of xfmconcat and xfminvert: the linear parts are composed exactly, and the concatenated files (e.g., _origtonl_1.xfm) reference the displacement grids of the non-linear registrations instead of copying them, which saves one grid volume per specimen and transformation. The referenced grids must then stay next to their registration files. It needs numpy on the cluster and changes the format of the concatenated files, so it is opt-in; the default XFM_Engine = "xfmconcat" uses the MINC tools.
+XFM_Engine = "xfmconcat"
+# Quality gates. With Gate_Threshold (e.g., 3.5), a gate job follows the lsq6 and lsq12 stages (Gate_lsq6, Gate_lsq12): every resampled specimen is compared with the target of the stage within the mask (cross-correlation of volumes downsampled Gate_Downsample times; see Quality_Gate.py), and the specimens more than Gate_Threshold robust z-scores below the others, or below Gate_Min_Xcorr, are quarantined. The later jobs of a quarantined specimen end without running (leave it out of the specimen list of Label_Propagation.py), and Quality/<PROJECT>_<stage>_Gate.csv reports the measures and the status of every specimen. Once the source of a quarantined specimen is fixed (e.g., its landmarks), rerunning the jobs measures it again. Gate_Threshold = None (the default) keeps every specimen.
+Gate_Threshold = None
+Gate_Min_Xcorr = None
+Gate_Downsample = 2
 
 # Code the hierarchical registration strings which call upon the minctracc command. -clobber overwrites existing files; -xcorr stands for cross-correlation, which is the similarity metric to be optimized (maximized); -lsq6 indicates that we want perform a rigid body transformation with six degrees of freedom (translation (z,y,x) and rotation (z,y,x)); -lsq12 indicates that we want to perform a 12-parameter affine transformation with twelve degrees of freedom (translation (z,y,x), rotation (z,y,x), scale (z,y,x), and shear (z,y,x)); -w_translations/rotations/scales/shear optimization weights along z,y,x; -step is the z,y,x resolution; -simplex is the optimizer; -tol is the value at which the optimization stops.
 lsq6_Register_352_Blur = "minctracc -clobber -xcorr -lsq6 -w_translations 0.4 0.4 0.4 -w_rotations 0.0174533 0.0174533 0.0174533 -w_scales 0.02 0.02 0.02 -w_shear 0.02 0.02 0.02 -step 0.352 0.352 0.352 -simplex 0.78 -use_simplex -tol 0.0001 "
@@ -163,160 +134,50 @@ lsq12_Register_098_Blur = "minctracc -clobber -xcorr -lsq12 -w_translations 0.4
 lsq12_Register_064_Blur = "minctracc -clobber -xcorr -lsq12 -w_translations 0.4 0.4 0.4 -w_rotations 0.0174533 0.0174533 0.0174533 -w_scales 0.02 0.02 0.02 -w_shear 0.02 0.02 0.02 -step 0.064 0.064 0.064 -simplex 0.490 -use_simplex -tol 0.0001 "
 lsq12_Register_050_Blur = "minctracc -clobber -xcorr -lsq12 -w_translations 0.4 0.4 0.4 -w_rotations 0.0174533 0.0174533 0.0174533 -w_scales 0.02 0.02 0.02 -w_shear 0.02 0.02 0.02 -step 0.050 0.050 0.050 -simplex 0.333 -use_simplex -tol 0.0001 "
 
-#-------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
-# Begin writing .sh scripts that will be submitted to the cluster.
-#-------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
+# Code the ANTS registration string around the similarity metrics. -m is the similarity metric (CC is cross-correlation); -x is the mask; -t is the transformation model (SyN is SymmetricNormalization, and is a diffeomorphic transformation); -r is the regularization model (Gaussian); -i is the number of iterations and number of resolution levels; -o is the output transformation.
+nl_Register_Begin = "ANTS 3 --number-of-affine-iterations 0 "
+nl_Register_End = " -t SyN[0.4] -r Gauss[5,1] -i 100x100x100x0 -o "
 
-#-------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
-# Blur the atlas file.
-#-------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
-# Open a file to write to; 'a' for append; lsq6_First is the first 6-parameter .sh script to submit, because it blurs the intended target (i.e., the landmark initialized average) as well as a mask of equivalent resolution to constrain our computation.
-Atlas_Blur = open("Atlas_Blur.sh",'a')
-# Write standard .sh header. This header is needed for SLURM job submission.
-Atlas_Blur.write("#!/bin/bash\n#SBATCH --nodes=" + n_nodes + "\n#SBATCH --mem=" + lsq6_Mem + "\n#SBATCH --time=" + lsq6_Time + "\n\nmodule load " + Module + "\n\ncd " + Scripts_path + "\n\necho \"The job started at $(date).\"\n\n")
-# Write commands to blur the atlas file and Atlas_average_mask with isotropic blurring kernels. These blur values should be decided upon with respect to the original resolution of the image. Here, we're assuming 35 micron resolution.
-Atlas_Blur.write(MNC_Blur + "0.352 " + Atlas_Avg + " " + Atlas_Avg_352 + "\n")
-Atlas_Blur.write(MNC_Blur + "0.176 " + Atlas_Avg + " " + Atlas_Avg_176 + "\n")
-Atlas_Blur.write(MNC_Blur + "0.098 " + Atlas_Avg + " " + Atlas_Avg_098 + "\n")
-Atlas_Blur.write(MNC_Blur + "0.078 " + Atlas_Avg + " " + Atlas_Avg_078 + "\n")
-Atlas_Blur.write(MNC_Blur + "0.064 " + Atlas_Avg + " " + Atlas_Avg_064 + "\n")
-Atlas_Blur.write(MNC_Blur + "0.050 " + Atlas_Avg + " " + Atlas_Avg_050 + "\n")
-Atlas_Blur.write(MNC_Blur + "0.352 " + Atlas_Avg_Mask + " " + Atlas_Avg_Mask_352 + "\n")
-Atlas_Blur.write(MNC_Blur + "0.176 " + Atlas_Avg_Mask + " " + Atlas_Avg_Mask_176 + "\n")
-Atlas_Blur.write(MNC_Blur + "0.098 " + Atlas_Avg_Mask + " " + Atlas_Avg_Mask_098 + "\n")
-Atlas_Blur.write(MNC_Blur + "0.078 " + Atlas_Avg_Mask + " " + Atlas_Avg_Mask_078 + "\n")
-Atlas_Blur.write(MNC_Blur + "0.064 " + Atlas_Avg_Mask + " " + Atlas_Avg_Mask_064 + "\n")
-Atlas_Blur.write(MNC_Blur + "0.050 " + Atlas_Avg_Mask + " " + Atlas_Avg_Mask_050 + "\n")
-Atlas_Blur.write("echo \"The job ended at $(date).\"")
-# Close the file.
-Atlas_Blur.close()
+# Blurring kernels (fwhm) and the registration string of every level of the hierarchical registrations. The atlas and atlas mask are blurred with all of them.
+lsq6_Levels = [("0.352", lsq6_Register_352_Blur), ("0.176", lsq6_Register_176_Blur), ("0.078", lsq6_Register_078_Blur)]
+lsq12_Levels = [("0.098", lsq12_Register_098_Blur), ("0.064", lsq12_Register_064_Blur), ("0.050", lsq12_Register_050_Blur)]
+nl_Level = "0.098"
 
-#-------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
-# 6-parameter (translation (z,y,x), rotation (z,y,x)) optimal rigid body (affine...) registration stage.
-#-------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
-# Open a file to write to; 'a' for append; lsq6_Query is the only 6-parameter stage.
-# Begin a for loop to blur all landmark initialized source files, register them to , and resample each image into the new translation and rotation invariant space. Note that we ideally want to resample the LM initialized images, rather than the original .mnc images. Hence, the LM .xfm is not included in the concatenation.
-# Begin a counter.
-lsq6_Counter=0
-for SpecID in Specimen_IDs:
-# Add 1 to the counter for every new file in the loop.
-	lsq6_Counter += 1
-	# Open a file to write to; 'a' for append; lsq6_Second is the second stage of .sh scripts to submit.
-	lsq6_Query = open("lsq6_Query_" + str(lsq6_Counter) + ".sh",'a')
-	# Add header.
-	lsq6_Query.write("#!/bin/bash\n#SBATCH --nodes=" + n_nodes + "\n#SBATCH --mem=" + lsq6_Mem + "\n#SBATCH --time=" + lsq6_Time + "\n\nmodule load " + Module + "\n\ncd " + Scripts_path + "\n\necho \"The job started at $(date).\"\n\n")
-	lsq6_Query.write("echo \"Begin the optimized 6-parameter registration for " + SpecID + ".\"\n\n")
-	# Blur each image, as done with the average and average mask, with a 0.352, 0.176, and 0.078 isotropic Gaussian blurring kernel. These blur values should be decided upon with respect to the original resolution of the image.
-	lsq6_Query.write(MNC_Blur + "0.352 " + Source_MNC_path + SpecID + ".mnc " + lsq6_Blurred_path + SpecID + "_352\n")
-	lsq6_Query.write(MNC_Blur + "0.176 " + Source_MNC_path + SpecID + ".mnc " + lsq6_Blurred_path + SpecID + "_176\n")
-	lsq6_Query.write(MNC_Blur + "0.078 " + Source_MNC_path + SpecID + ".mnc " + lsq6_Blurred_path + SpecID + "_078\n")
-	# Call registration strings. We begin with the most blurred (e.g., 0.352) image. -model_mask specifies the mask we wish to use. Note that we use a mask with the same amount of blurring; -identity specifies an identity matrix that initializes the transformation matrix. Upon specifying a transformation matrix, we extract the relevant transformation parameters (here, rotation and translation) and optimize them to find the best transformation; -transformation specifies a file giving a previous source to target mapping, which is used as the new coordinate starting point for the optimization.
-	lsq6_Query.write(lsq6_Register_352_Blur + lsq6_Blurred_path + SpecID + "_352_blur.mnc " + Atlas_Avg_352_Blur + " " + lsq6_XFM_path + SpecID + "_lsq6_0.xfm -model_mask " + Atlas_Avg_Mask_352_Blur + " -identity\n")
-	lsq6_Query.write(lsq6_Register_176_Blur + lsq6_Blurred_path + SpecID + "_176_blur.mnc " + Atlas_Avg_176_Blur + " " + lsq6_XFM_path + SpecID + "_lsq6_1.xfm -model_mask " + Atlas_Avg_Mask_176_Blur + " -transformation " + lsq6_XFM_path + SpecID + "_lsq6_0.xfm\n")
-	lsq6_Query.write(lsq6_Register_078_Blur + lsq6_Blurred_path + SpecID + "_078_blur.mnc " + Atlas_Avg_078_Blur + " " + lsq6_XFM_path + SpecID + "_lsq6_2.xfm -model_mask " + Atlas_Avg_Mask_078_Blur + " -transformation " + lsq6_XFM_path + SpecID + "_lsq6_1.xfm\n")
-	# Resample the original image into the rotation and translation invariant space using the concatenated transformation. Be mindful of your "original" images and their naming convention.
-	lsq6_Query.write("mincresample -like " + Atlas_Avg + " -clobber -transformation " + lsq6_XFM_path + SpecID + "_lsq6_2.xfm " + Source_MNC_path + SpecID + ".mnc " + lsq6_MNC_path + SpecID + "_lsq6.mnc\n\n")
-	lsq6_Query.write("echo \"The job ended at $(date).\"")
-	# Close the 6-parameter blur/register file.
-	lsq6_Query.close()
+# Shared cache of blurred atlases (e.g., CLUSTER_PATH + "Blur_Cache/"), keyed by the checksum of the atlas and the blurring parameters. Projects registered against the same atlas link its blurred pyramid from the cache instead of running Atlas_Blur.sh, which is then skipped at submission. The first project fills the cache; to pre-populate it once per atlas, run "python3 Blur_Cache.py populate --cache <Blur_Cache_path> --command '<MNC_Blur>' <atlas> <fwhm> ..." (and the same for the atlas mask) on the cluster. Set Blur_Cache_path = None to blur the atlas in every project.
+Blur_Cache_path = None
+# Intermediate files. With Lifecycle_Mode = "delete", every .mnc and .xfm file a job writes (the blurs and gradients, the resampled volumes, ...) is deleted once the last job that reads it has succeeded (see Intermediate_Lifecycle.py); "archive" compresses it into Archive_path first. The files matching Lifecycle_Keep (fnmatch patterns on the paths or file names) are kept, among them the transformations Label_Propagation.py reads, and the non-linear transformations are always kept with their grids. The stamps keep the checksums of the released files, so the jobs around them stay up to date; a job that runs again restores its archived inputs, and <PROJECT>_Pairwise_Submission.sh runs the jobs of deleted inputs again. <PROJECT>_Pairwise_Submission.sh prints the projected peak disk use with and without the releases before submitting. Set Lifecycle_Mode = None to keep every file.
+Lifecycle_Mode = None
+Lifecycle_Keep = ["*_lsq6_2.xfm", "*_lsq12_2.xfm", "*_ANTS_nl.xfm", "*_ANTS_nl_inverse.xfm"]
+Archive_path = PROJECT_PATH + "Archive/"
 
 #-------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
-# 12-parameter (translation (z,y,x), rotation (z,y,x), scale (z,y,x), shear (z,y,x)) optimized affine registration stage.
+# Begin writing .sh scripts that will be submitted to the cluster.
 #-------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
-# Open a file to write to; 'a' for append; lsq12_Query is the only 12-parameter stage.
-# Begin a for loop to blur all landmark initialized source files, register them to LM_Average, and resample each image into the new translation and rotation invariant space.
-# Note that we ideally want to resample the LM initialized images, rather than the original .mnc images. Hence, the LM .xfm is not included in the concatenation.
-# Begin a counter.
-lsq12_Counter=0
-for SpecID in Specimen_IDs:
-# Add 1 to the counter for every new file in the loop.
-	lsq12_Counter += 1
-	# Open a file to write to; 'a' for append; lsq6_Second is the second stage of .sh scripts to submit.
-	lsq12_Query = open("lsq12_Query_" + str(lsq12_Counter) + ".sh",'a')
-	# Add header.
-	lsq12_Query.write("#!/bin/bash\n#SBATCH --nodes=" + n_nodes + "\n#SBATCH --mem=" + lsq12_Mem + "\n#SBATCH --time=" + lsq12_Time + "\n\nmodule load " + Module + "\n\ncd " + Scripts_path + "\n\necho \"The job started at $(date).\"\n\n")
-	lsq12_Query.write("echo \"Begin the optimized 12-parameter registration for " + SpecID + ".\"\n\n")
-	# Blur each image, as done with the average and average mask, with a 0.352, 0.176, and 0.078 isotropic Gaussian blurring kernel. These blur values should be decided upon with respect to the original resolution of the image.
-	lsq12_Query.write(MNC_Blur + "0.098 " + lsq6_MNC_path + SpecID + "_lsq6.mnc " + lsq12_Blurred_path + SpecID + "_098\n")
-	lsq12_Query.write(MNC_Blur + "0.064 " + lsq6_MNC_path + SpecID + "_lsq6.mnc " + lsq12_Blurred_path + SpecID + "_064\n")
-	lsq12_Query.write(MNC_Blur + "0.050 " + lsq6_MNC_path + SpecID + "_lsq6.mnc " + lsq12_Blurred_path + SpecID + "_050\n")
-	# Call registration strings. We begin with the most blurred (e.g., 0.352) image. -model_mask specifies the mask we wish to use. Note that we use a mask with the same amount of blurring; -identity specifies an identity matrix that initializes the transformation matrix. Upon specifying a transformation matrix, we extract the relevant transformation parameters (here, rotation and translation) and optimize them to find the best transformation; -transformation specifies a file giving a previous source to target mapping, which is used as the new coordinate starting point for the optimization.
-	lsq12_Query.write(lsq12_Register_098_Blur + lsq12_Blurred_path + SpecID + "_098_blur.mnc " + Atlas_Avg_098_Blur + " " + lsq12_XFM_path + SpecID + "_lsq12_0.xfm -model_mask " + Atlas_Avg_Mask_098_Blur + " -identity\n")
-	lsq12_Query.write(lsq12_Register_064_Blur + lsq12_Blurred_path + SpecID + "_064_blur.mnc " + Atlas_Avg_064_Blur + " " + lsq12_XFM_path + SpecID + "_lsq12_1.xfm -model_mask " + Atlas_Avg_Mask_064_Blur + " -transformation " + lsq12_XFM_path + SpecID + "_lsq12_0.xfm\n")
-	lsq12_Query.write(lsq12_Register_050_Blur + lsq12_Blurred_path + SpecID + "_050_blur.mnc " + Atlas_Avg_050_Blur + " " + lsq12_XFM_path + SpecID + "_lsq12_2.xfm -model_mask " + Atlas_Avg_Mask_050_Blur + " -transformation " + lsq12_XFM_path + SpecID + "_lsq12_1.xfm\n")
-	# Concatenate .xfm files.
-	lsq12_Query.write("xfmconcat -clobber " + lsq6_XFM_path + SpecID + "_lsq6_2.xfm " + lsq12_XFM_path + SpecID + "_lsq12_2.xfm " + lsq12_XFM_path + SpecID + "_origtolsq12.xfm\n")
-	# Resample the original image into the rotation and translation invariant space using the concatenated transformation. Be mindful of your "original" images and their naming convention.
-	lsq12_Query.write("mincresample -like " + Atlas_Avg + " -clobber -transformation " + lsq12_XFM_path + SpecID + "_origtolsq12.xfm " + Source_MNC_path + SpecID + ".mnc " + lsq12_MNC_path + SpecID + "_lsq12.mnc\n\n")
-	lsq12_Query.write("echo \"The job ended at $(date).\"")
-	# Close the 12-parameter blur/register file.
-	lsq12_Query.close()
+# Describe the atlas blurs and the lsq6, lsq12, and non-linear registrations as a DAG of tasks. Every task declares its inputs and outputs, and its script skips the work when the outputs are up to date with the task's commands and inputs (see Pipeline_DAG.py).
+Pairwise = build_pairwise_pipeline(dict(
+	PROJECT_NAME=PROJECT_NAME, Specimen_IDs=Specimen_IDs, Module=Module, n_nodes=n_nodes,
+	Scripts_path=Scripts_path, Source_MNC_path=Source_MNC_path, lsq6_Blurred_path=lsq6_Blurred_path, lsq6_XFM_path=lsq6_XFM_path, lsq6_MNC_path=lsq6_MNC_path,
+	lsq12_Blurred_path=lsq12_Blurred_path, lsq12_XFM_path=lsq12_XFM_path, lsq12_MNC_path=lsq12_MNC_path, nl_Blurred_path=nl_Blurred_path, nl_XFM_path=nl_XFM_path,
+	Atlas_Avg=Atlas_Avg, Atlas_Avg_Mask=Atlas_Avg_Mask, MNC_Blur=MNC_Blur, Blur_Engine=Blur_Engine, XFM_Engine=XFM_Engine, lsq6_Levels=lsq6_Levels, lsq12_Levels=lsq12_Levels,
+	nl_Level=nl_Level, nl_Register_Begin=nl_Register_Begin, nl_Register_End=nl_Register_End,
+	lsq6_Mem=lsq6_Mem, lsq6_Time=lsq6_Time, lsq12_Mem=lsq12_Mem, lsq12_Time=lsq12_Time, nl_Mem=nl_Mem, nl_Time=nl_Time, Array_Jobs=Array_Jobs, Array_Concurrency=Array_Concurrency,
+	Blur_Cache_path=Blur_Cache_path, Auto_Resources=Auto_Resources, Local_MNC_path=Local_MNC_path, Resource_Margin=Resource_Margin, Quality_path=Quality_path, Gate_Threshold=Gate_Threshold, Gate_Min_Xcorr=Gate_Min_Xcorr,
+	Gate_Downsample=Gate_Downsample, Graph_path="Pairwise_Graph.json", Telemetry_path=Telemetry_path,
+	Lifecycle_Mode=Lifecycle_Mode, Lifecycle_Keep=Lifecycle_Keep, Archive_path=Archive_path))
+# Write one .sh script per task (or per job array), a description of the DAG (Pairwise_Graph.json), and copies of Pipeline_DAG.py, Blur_Cache.py, Multi_Blur.py, Telemetry.py, XFM_Algebra.py, Registration_QC.py, Quality_Gate.py, and Intermediate_Lifecycle.py, which the scripts call to check and stamp their tasks, to link cached blurs, to blur the volumes, to record their commands, to concatenate the transformations, to quarantine the specimens that fail a stage, and to release the intermediate files, and the Lists directory of the tasks with more than LIST_LIMIT files (see Pipeline_DAG.py). Upload all of them to the Scripts directory.
+Pairwise.write_scripts()
+Pairwise.write_graph("Pairwise_Graph.json")
+install(".", ("Pipeline_DAG.py", "Blur_Cache.py", "Multi_Blur.py", "Telemetry.py", "XFM_Algebra.py", "Registration_QC.py", "Quality_Gate.py", "Intermediate_Lifecycle.py"))
 
 #-------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
-# NON-LINEAR STAGE
+# Create the master job submission script. It submits every .sh script once, and SLURM starts each job as soon as the jobs that produce its inputs have finished (--dependency=afterok, or aftercorr between the elements of two job arrays).
+# In other words, only <PROJECT>_Pairwise_Submission.sh needs to be run, on the login node (bash <PROJECT>_Pairwise_Submission.sh); there are no submission jobs polling the queue.
+# It also writes <PROJECT>_Pairwise_Manifest.json (upload it with the scripts), the expected outputs of every task: rerunning <PROJECT>_Pairwise_Submission.sh after a crash or a node failure (once the jobs left in the queue are cancelled) only submits the jobs, and the job array elements, whose tasks are missing or stale, and generating the scripts again in the same directory removes the scripts that are no longer part of the pipeline (the scripts of the other pipelines in the directory, which have their own submission scripts and manifests, are kept).
 #-------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
-# Create .sh files for non-linear registration.
-# Begin a counter.
-nl_Counter=0
-for SpecID in Specimen_IDs:
-# Add 1 to the counter for every new file in the loop.
-	nl_Counter += 1
-	# Open a file to write to; 'a' for append; lsq6_Second is the second stage of .sh scripts to submit.
-	nl_Query = open("nl_Query_" + str(nl_Counter) + ".sh",'a')
-	# Add header.
-	nl_Query.write("#!/bin/bash\n#SBATCH --nodes=" + n_nodes + "\n#SBATCH --mem=" + nl_Mem + "\n#SBATCH --time=" + nl_Time + "\n\nmodule load " + Module + "\n\ncd " + Scripts_path + "\n\necho \"The job started at $(date).\"\n\n")
-	nl_Query.write("echo \"Begin the optimized non-linear registration for " + SpecID + ".\"\n\n")
-	# Blur each lsq12 image with a 0.098 isotropic Gaussian blurring kernel. These blur values should be decided upon with respect to the original resolution of the image.
-	nl_Query.write(MNC_Blur + "0.098 " + lsq12_MNC_path + SpecID + "_lsq12.mnc " + nl_Blurred_path + SpecID + "_098\n")
-	# Call the ANTS registration string. -m is the similarity metric (CC is cross-correlation); -x is the mask; -t is the transformation model (SyN is SymmetricNormalization, and is a diffeomorphic transformation); -r is the regularization model (Gaussian); -i is the number of iterations and number of resolution levels; -o is the output transformation.
-	nl_Query.write("ANTS 3 --number-of-affine-iterations 0 -m CC[" + lsq12_MNC_path + SpecID + "_lsq12.mnc," + Atlas_Avg + ",1.0,4] -m CC[" + nl_Blurred_path + SpecID + "_098_dxyz.mnc," + Atlas_Avg_098_Dxyz + ",1.0,4] -x [" + Atlas_Avg_Mask_098_Blur + "] -t SyN[0.4] -r Gauss[5,1] -i 100x100x100x0 -o " + nl_XFM_path + SpecID + "_ANTS_nl.xfm\n")
-	nl_Query.write("echo \"The job ended at $(date).\"")
-	# Close the file.
-	nl_Query.close()
+Pairwise.write_submission()
+# With Lifecycle_Mode, it also writes Lifecycle.json (upload it with the scripts), the intermediates every job releases; the projected peak disk use of the run:
+if Pairwise.lifecycle:
+    print(lifecycle_report(Pairwise.lifecycle))
 
-#-------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
-# Create master job submission scripts for all stages. These scripts will automatically submit all .sh scripts to the queue and will be chained together. In other words, only the first script, Job_Submission_First.sh, needs to be submitted.
-#-------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
-# Job_Submission_First (i.e., 6-parameter registrations).
-Job_Submission_First = open("Job_Submission_First.sh",'a')
-Job_Submission_First.write("#!/bin/bash\n#SBATCH --nodes=" + n_nodes + "\n#SBATCH --mem=" + Job_Submission_Mem + "\n#SBATCH --time=" + Job_Submission_Time + "\n#SBATCH --job-name=Job_Submission_First.sh\n\necho \"The job started at $(date).\"\n\n")
-Job_Submission_First.write("cd " + Scripts_path + "\n\n")
-Job_Submission_First.write("sleep 10\n\n")
-Job_Submission_First.write("Atlas_Blur=$(sbatch -W Atlas_Blur.sh | awk '{print $4}')\n\n")
-Job_Submission_First.write("until [[ $(squeue -t CD -u $USER --noheader -j ${Atlas_Blur##* } | wc -l) -eq 1 ]]; do\nsleep 5\ndone\n\n")
-Job_Submission_First.write("# Generate a sequence of numbers.\nNUMBERS=$(seq 1 " + str(Specimen_List_Length) + ")\n\n")
-Job_Submission_First.write("# For loop to automatically submit your jobs.\nfor NUM in $NUMBERS; do\nNAME=\"lsq6_Query_$NUM.sh\"\nLSQ6=\"sbatch $NAME\"\n$LSQ6\necho $LSQ6\n# Sleep script in 3 second intervals.\nsleep 3\ndone\n\n")
-Job_Submission_First.write("# Sleep script for 5 seconds before while loop.\nsleep 5\n\n")
-Job_Submission_First.write("# Create while loop for PD jobs to idle submission script.\nwhile [[ $(squeue -t PD -u $USER --noheader | wc -l) -gt 0 ]]; do\nsleep 5\ndone\n\n")
-Job_Submission_First.write("# Create while loop for R jobs to idle submission script.\nwhile [[ $(squeue -t R -u $USER --noheader | wc -l) -gt 1 ]]; do\nsleep 5\ndone\n\n")
-Job_Submission_First.write("#----------------------------------------------------- Submit next job submission script and remove current submission script from the queue.\n\n")
-Job_Submission_First.write("sbatch Job_Submission_Second.sh\n\n")
-Job_Submission_First.write("echo \"The job ended at $(date).\"\n")
-Job_Submission_First.write("scancel -u $USER --jobname=Job_Submission_First.sh")
-# Job_Submission_Second (i.e., 12-parameter registrations).
-Job_Submission_Second = open("Job_Submission_Second.sh",'a')
-Job_Submission_Second.write("#!/bin/bash\n#SBATCH --nodes=" + n_nodes + "\n#SBATCH --mem=" + Job_Submission_Mem + "\n#SBATCH --time=" + Job_Submission_Time + "\n#SBATCH --job-name=Job_Submission_Second.sh\n\necho \"The job started at $(date).\"\n\n")
-Job_Submission_Second.write("cd " + Scripts_path + "\n\n")
-Job_Submission_Second.write("sleep 10\n\n")
-Job_Submission_Second.write("# Generate a sequence of numbers.\nNUMBERS=$(seq 1 " + str(Specimen_List_Length) + ")\n\n")
-Job_Submission_Second.write("# For loop to automatically submit your jobs.\nfor NUM in $NUMBERS; do\nNAME=\"lsq12_Query_$NUM.sh\"\nLSQ12=\"sbatch $NAME\"\n$LSQ12\necho $LSQ12\n# Sleep script in 3 second intervals.\nsleep 3\ndone\n\n")
-Job_Submission_Second.write("# Sleep script for 5 seconds before while loop.\nsleep 5\n\n")
-Job_Submission_Second.write("# Create while loop for PD jobs to idle submission script.\nwhile [[ $(squeue -t PD -u $USER --noheader | wc -l) -gt 0 ]]; do\nsleep 5\ndone\n\n")
-Job_Submission_Second.write("# Create while loop for R jobs to idle submission script.\nwhile [[ $(squeue -t R -u $USER --noheader | wc -l) -gt 1 ]]; do\nsleep 5\ndone\n\n")
-Job_Submission_Second.write("#----------------------------------------------------- Submit next job submission script and remove current submission script from the queue.\n\n")
-Job_Submission_Second.write("Job_Submission_Third=$(sbatch Job_Submission_Third.sh)\n\n")
-Job_Submission_Second.write("echo \"The job ended at $(date).\"\n")
-Job_Submission_Second.write("scancel -u $USER --jobname=Job_Submission_Second.sh")
-# Job_Submission_Third (i.e., nl_Fourth non-linear registrations).
-Job_Submission_Third = open("Job_Submission_Third.sh",'a')
-Job_Submission_Third.write("#!/bin/bash\n#SBATCH --nodes=" + n_nodes + "\n#SBATCH --mem=" + Job_Submission_Mem + "\n#SBATCH --time=" + Job_Submission_Time + "\n#SBATCH --job-name=Job_Submission_Third.sh\n\necho \"The job started at $(date).\"\n\n")
-Job_Submission_Third.write("cd " + Scripts_path + "\n\n")
-Job_Submission_Third.write("sleep 10\n\n")
-Job_Submission_Third.write("# Generate a sequence of numbers.\nNUMBERS=$(seq 1 " + str(Specimen_List_Length) + ")\n\n")
-Job_Submission_Third.write("# For loop to automatically submit your jobs.\nfor NUM in $NUMBERS; do\nNAME=\"nl_Query_$NUM.sh\"\nnl=\"sbatch $NAME\"\n$nl\necho $nl\n# Sleep script in 3 second intervals.\nsleep 3\ndone\n\n")
-Job_Submission_Third.write("# Sleep script for 5 seconds before while loop.\nsleep 5\n\n")
-Job_Submission_Third.write("# Create while loop for PD jobs to idle submission script.\nwhile [[ $(squeue -t PD -u $USER --noheader | wc -l) -gt 0 ]]; do\nsleep 5\ndone\n\n")
-Job_Submission_Third.write("# Create while loop for R jobs to idle submission script.\nwhile [[ $(squeue -t R -u $USER --noheader | wc -l) -gt 1 ]]; do\nsleep 5\ndone\n\n")
-Job_Submission_Third.write("#----------------------------------------------------- Remove current submission script from the queue.\n\n")
-Job_Submission_Third.write("echo \"The job ended at $(date).\"\n")
-Job_Submission_Third.write("scancel -u $USER --jobname=Job_Submission_Third.sh")
+# Without a cluster (e.g., a pilot on a workstation), set the project paths above to local paths and run the same jobs with a local pool of processes, bounded by the cores and the declared memory:
+# python3 Local_Executor.py graph Pairwise_Graph.json --cores 64    (or: python3 Local_Executor.py slurm <PROJECT>_Pairwise_Submission.sh, which runs <PROJECT>_Pairwise_Submission.sh with stand-ins for sbatch and squeue)
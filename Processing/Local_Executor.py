@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+
+"""
+This script runs a generated pipeline on a single machine (e.g., a 64-core workstation for a pilot or a benchmark) instead of a SLURM cluster. Jobs run as a pool of processes, bounded by the number of cores and by the memory the tasks declare (lsq6_Mem, nl_Mem, Label_Mem, ...); a job starts once every job it depends on has succeeded, and is cancelled if one of them failed, like --kill-on-invalid-dep=yes. The output of every job goes to Logs/<job>.log, and Logs/Local_Executor.json records the status, exit code, and runtime of every job.
+
+There are two ways to run a pipeline, sharing the same scheduler:
+
+python3 Local_Executor.py graph /path/to/Scripts/Atlas_Graph.json [--cores N] [--mem 64G]
+
+runs the tasks of the DAG written by the generator (Atlas_Graph.json, Pairwise_Graph.json, or Labels_Graph.json) with the same up-to-date checks and stamps as the .sh scripts.
+
+python3 Local_Executor.py slurm /path/to/Scripts/<pipeline>_Submission.sh [--cores N] [--mem 64G]
+
+runs the submission script with stand-ins for sbatch and squeue, which queue the jobs (including job arrays and their --dependency options), then runs the queued .sh scripts. This exercises the SLURM path, i.e., the scripts, the array tables, and the dependencies, with the same code. Set the project paths of the generator to local paths for either mode.
+"""
+
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+from Pipeline_DAG import Pipeline
+from Resource_Model import parse_mem
+
+
+class Job:
+    """A command to run once the jobs in after have succeeded; jobs of the same group run at most limit at a time (the %K of a job array)."""
+
+    def __init__(self, name, command, cwd, mem, after=(), env=None, group=None, limit=None):
+        self.name = name
+        self.command = command
+        self.cwd = cwd
+        self.mem = mem
+        self.after = list(after)
+        self.env = env or {}
+        self.group = group
+        self.limit = limit
+
+
+def total_memory():
+    # Physical memory of the machine in megabytes.
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 2.0 ** 20
+
+
+def run_jobs(jobs, cores, mem, log_dir):
+    """
+    Run jobs (an ordered dictionary of Job) with at most cores jobs and mem megabytes of declared memory at a time. A job that declares more memory than the
+    machine has runs alone. Returns the status ("done", "failed", or "cancelled"), exit code, and runtime of every job.
+    """
+    os.makedirs(log_dir, exist_ok=True)
+    results = OrderedDict()
+    waiting = OrderedDict(jobs)
+    running = {}
+    used = 0.0
+    while waiting or running:
+        # Cancel the jobs that depend on a failed or cancelled job.
+        for name, job in list(waiting.items()):
+            if any(results.get(dep, {}).get("status") in ("failed", "cancelled") for dep in job.after):
+                results[name] = {"status": "cancelled", "exit_code": None, "seconds": 0}
+                del waiting[name]
+        # Start the ready jobs, in submission order, while cores and memory remain.
+        for name, job in list(waiting.items()):
+            if len(running) >= cores:
+                break
+            if not all(results.get(dep, {}).get("status") == "done" for dep in job.after):
+                continue
+            if job.group and sum(1 for other in running.values() if other[0].group == job.group) >= (job.limit or cores):
+                continue
+            need = min(job.mem, mem)
+            if running and used + need > mem:
+                continue
+            log = open(os.path.join(log_dir, name + ".log"), 'w')
+            process = subprocess.Popen(job.command, cwd=job.cwd, stdout=log, stderr=subprocess.STDOUT, env=dict(os.environ, **job.env))
+            running[name] = (job, process, log, time.time(), need)
+            used += need
+            del waiting[name]
+        # Collect the finished jobs.
+        finished = False
+        for name, (job, process, log, start, need) in list(running.items()):
+            code = process.poll()
+            if code is None:
+                continue
+            log.close()
+            used -= need
+            del running[name]
+            results[name] = {"status": "done" if code == 0 else "failed", "exit_code": code, "seconds": round(time.time() - start, 1)}
+            print(name + ": " + results[name]["status"] + " (exit code " + str(code) + ", " + str(results[name]["seconds"]) + " s)")
+            finished = True
+        if running and not finished:
+            time.sleep(0.2)
+        elif not running and waiting and not finished:
+            # Nothing runs and nothing can start: the remaining jobs wait for jobs that do not exist.
+            for name in waiting:
+                results[name] = {"status": "cancelled", "exit_code": None, "seconds": 0}
+            break
+    with open(os.path.join(log_dir, "Local_Executor.json"), 'w') as summary:
+        json.dump(results, summary, indent=1)
+    return results
+
+
+def graph_jobs(graph_path):
+    # One job per task of the DAG, running the guard, commands, and stamp of its .sh script in the directory of the graph (where Pipeline_DAG.py was installed).
+    pipeline = Pipeline.load(graph_path)
+    cwd = os.path.dirname(os.path.abspath(graph_path))
+    pipeline.write_lists(cwd)
+    dependencies = pipeline.dependencies()
+    jobs = OrderedDict()
+    for name in pipeline.topological_order():
+        task = pipeline.tasks[name]
+        script = pipeline.guard(task, name, task.commands_hash()) + pipeline.body(task)
+        jobs[name] = Job(name, ["bash", "-c", script], cwd, parse_mem(task.mem or "0"), dependencies[name])
+    return jobs
+
+
+#-------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
+# sbatch and squeue stand-ins.
+#-------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
+def enqueue(queue_path, arguments):
+    # Record an sbatch call (options, script, and #SBATCH directives of the script) in the queue file and print its job ID, like sbatch --parsable.
+    options, script = arguments[:-1], arguments[-1]
+    with open(script) as handle:
+        directives = re.findall(r"^#SBATCH\s+(\S+)", handle.read(), re.M)
+    record = {"script": os.path.abspath(script), "cwd": os.getcwd(), "options": options, "directives": directives}
+    with open(queue_path, 'a') as queue:
+        queue.write(json.dumps(record) + "\n")
+    with open(queue_path) as queue:
+        print(1000 + sum(1 for _ in queue))
+
+
+def option(values, name):
+    # Value of a --name=value option among sbatch options or #SBATCH directives.
+    for value in values:
+        if value.startswith("--" + name + "="):
+            return value.split("=", 1)[1]
+    return None
+
+
+def slurm_jobs(submission_path):
+    # Run the submission script with the stand-ins, then turn the queued sbatch calls into jobs (one per array element), wired by their afterok/aftercorr dependencies.
+    shims = tempfile.mkdtemp(prefix="Local_Executor_")
+    queue_path = os.path.join(shims, "queue.jsonl")
+    open(queue_path, 'w').close()
+    with open(os.path.join(shims, "sbatch"), 'w') as sbatch:
+        sbatch.write("#!/bin/bash\nexec " + sys.executable + " " + os.path.abspath(__file__) + " enqueue " + queue_path + " \"$@\"\n")
+    with open(os.path.join(shims, "squeue"), 'w') as squeue:
+        squeue.write("#!/bin/bash\necho \"JOBID SCRIPT\"\nawk '{print NR + 1000, $0}' " + queue_path + "\n")
+    for shim in ("sbatch", "squeue"):
+        os.chmod(os.path.join(shims, shim), 0o755)
+    submission = subprocess.run(["bash", os.path.abspath(submission_path)], cwd=os.path.dirname(os.path.abspath(submission_path)),
+                                env=dict(os.environ, PATH=shims + os.pathsep + os.environ["PATH"]))
+    if submission.returncode != 0:
+        raise SystemExit(submission_path + " failed with exit code " + str(submission.returncode) + ".")
+    with open(queue_path) as queue:
+        records = [json.loads(line) for line in queue]
+    jobs, elements = OrderedDict(), {}
+    for number, record in enumerate(records, start=1001):
+        values = record["options"] + record["directives"]
+        name = os.path.basename(record["script"])[:-len(".sh")]
+        mem = parse_mem(option(values, "mem") or "0")
+        array = option(values, "array")
+        indices, limit = [None], None
+        if array:
+            # A resubmission may only run some elements (e.g., --array=1-3,7%K).
+            span, _, limit = array.partition("%")
+            indices = []
+            for part in span.split(","):
+                first, _, last = part.partition("-")
+                indices += list(range(int(first), int(last or first) + 1))
+            limit = int(limit) if limit else None
+        elements[str(number)] = OrderedDict()
+        for index in indices:
+            job_name = name if index is None else name + "_" + str(index)
+            env = {"SLURM_JOB_ID": str(number)}
+            if index is not None:
+                env.update(SLURM_ARRAY_JOB_ID=str(number), SLURM_ARRAY_TASK_ID=str(index))
+            after = []
+            for dependency in (option(values, "dependency") or "").split(","):
+                if not dependency:
+                    continue
+                kind, ids = dependency.split(":", 1)
+                for upstream in ids.split(":"):
+                    upstream_elements = elements.get(upstream, {})
+                    if kind == "aftercorr" and index in upstream_elements:
+                        after.append(upstream_elements[index])
+                    elif kind != "aftercorr":
+                        after += list(upstream_elements.values())
+            jobs[job_name] = Job(job_name, ["bash", record["script"]], record["cwd"], mem, after, env, name if index is not None else None, limit)
+            elements[str(number)][index] = job_name
+    return jobs
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) > 1 and sys.argv[1] == "enqueue":
+        # Called by the sbatch stand-in: enqueue <queue file> <sbatch arguments>.
+        enqueue(sys.argv[2], sys.argv[3:])
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser(description="Run a generated pipeline with a local pool of processes.")
+    parser.add_argument('mode', choices=['graph', 'slurm'], help='Run the tasks of a DAG (graph) or the jobs submitted by the submission script (slurm)')
+    parser.add_argument('path', help='Pipeline graph (.json) or job submission script (.sh)')
+    parser.add_argument('--cores', type=int, default=os.cpu_count(), help='Jobs running at the same time (default: all cores)')
+    parser.add_argument('--mem', default=None, help='Memory shared by the running jobs, e.g., 64G (default: all memory)')
+    parser.add_argument('--logs', default=None, help='Log directory (default: Logs next to the graph or script)')
+    args = parser.parse_args()
+
+    log_dir = args.logs or os.path.join(os.path.dirname(os.path.abspath(args.path)), "Logs")
+    jobs = graph_jobs(args.path) if args.mode == 'graph' else slurm_jobs(args.path)
+    results = run_jobs(jobs, args.cores, parse_mem(args.mem) if args.mem else total_memory(), log_dir)
+    failed = [name for name, result in results.items() if result["status"] != "done"]
+    print(str(len(results) - len(failed)) + " of " + str(len(results)) + " jobs succeeded." + (" Not done: " + " ".join(failed) if failed else ""))
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+"""
+This script blurs a MINC (.mnc) volume at several kernels in one pass, in place of the chained mincblur calls of the generated scripts. The volume is read from disk once, slab by slab, into a memory-mapped scratch copy next to the outputs, and every Gaussian kernel is applied separably from that copy (one 1D convolution along z over blocks of rows, then along y and x over slabs of slices), so a job only holds a few slabs in memory, whatever the size of the volume. Every kernel starts from the source rather than from the previous, smaller one: with the zero padding of mincblur, a cascade of kernels would lose the intensity that every pass spreads past the edges of the volume, and the blurs would differ from mincblur near the edges. Gradient magnitude volumes are only computed for the kernels that ask for them.
+
+The outputs are named like those of mincblur: <base>_blur.mnc and, for --gradient levels, <base>_dxyz.mnc.
+
+Dependencies required: numpy, scipy, and pyminc (pip install numpy scipy pyminc), which uses the libraries of the MINC Toolkit (https://bic-mni.github.io/).
+
+It can be ran via python3 Multi_Blur.py <source> --level <fwhm> <base> [--level <fwhm> <base> ...] [--gradient <fwhm> <base> ...]
+"""
+
+import argparse
+import math
+import os
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+try:
+    from scipy import ndimage
+except ImportError:
+    raise ImportError("Failed to import scipy. Try 'pip install scipy'")
+try:
+    from pyminc.volumes.factory import volumeFromFile, volumeLikeFile
+except ImportError:
+    raise ImportError("Failed to import pyminc. Try 'pip install pyminc'")
+
+# The full-width at half-maximum of a Gaussian is 2 sqrt(2 ln 2) times its standard deviation.
+FWHM_TO_SIGMA = 1.0 / (2.0 * math.sqrt(2.0 * math.log(2.0)))
+# Slices (along the first dimension) or rows (along the second) filtered at once; a slab of a 1000^2 slice grid takes 4 MB per slice as floats.
+SLAB = 16
+
+
+def read_volume(path, scratch):
+    # Read the volume once as floats, one slab at a time, into a memory-mapped array in the scratch directory. Returns the array and the step (separation) of
+    # every dimension in world units, in the dimension order of the data.
+    volume = volumeFromFile(path, dtype='float')
+    sizes = [int(size) for size in volume.sizes[:3]]
+    data = np.lib.format.open_memmap(os.path.join(scratch, "source.npy"), mode='w+', dtype=np.float32, shape=tuple(sizes))
+    for start in range(0, sizes[0], SLAB):
+        count = min(SLAB, sizes[0] - start)
+        data[start:start + count] = volume.getHyperslab((start, 0, 0), (count, sizes[1], sizes[2]), dtype='float')
+    steps = [abs(float(step)) for step in volume.separations]
+    volume.closeVolume()
+    return data, steps
+
+
+def write_volume(like, path, slabs):
+    # Write a float volume with the header (dimensions, steps, starts, and direction cosines) of the source from (start, slab) pairs, one slab at a time.
+    volume = volumeLikeFile(like, path, dtype='float', volumeType='float')
+    sizes = [int(size) for size in volume.sizes[:3]]
+    for start, slab in slabs:
+        volume.setHyperslab(np.ascontiguousarray(slab, dtype=np.float32), (start, 0, 0), (slab.shape[0], sizes[1], sizes[2]))
+    volume.writeFile()
+    volume.closeVolume()
+
+
+def gaussian(source, target, sigmas):
+    # Separable Gaussian filter (sigmas in voxels) of source into target, zero outside of the volume like the padding of mincblur: along z over blocks of
+    # SLAB rows (every block holds the whole z extent), then along y and x in place over slabs of SLAB slices.
+    for start in range(0, source.shape[1], SLAB):
+        block = np.array(source[:, start:start + SLAB], dtype=np.float32)
+        if sigmas[0] > 0:
+            block = ndimage.gaussian_filter1d(block, sigmas[0], axis=0, mode='constant', cval=0.0, output=np.float32)
+        target[:, start:start + SLAB] = block
+    for start in range(0, source.shape[0], SLAB):
+        slab = np.array(target[start:start + SLAB], dtype=np.float32)
+        for axis, sigma in ((1, sigmas[1]), (2, sigmas[2])):
+            if sigma > 0:
+                slab = ndimage.gaussian_filter1d(slab, sigma, axis=axis, mode='constant', cval=0.0, output=np.float32)
+        target[start:start + SLAB] = slab
+    target.flush()
+    return target
+
+
+def slabs(data):
+    for start in range(0, data.shape[0], SLAB):
+        yield start, data[start:start + SLAB]
+
+
+def gradient_magnitude(data, steps):
+    # Magnitude of the intensity gradient in world units (central differences), one slab at a time with a slice of halo on each side, so the slabs match the
+    # gradient of the whole volume. Yields (start, slab) pairs.
+    length = data.shape[0]
+    for start in range(0, length, SLAB):
+        end = min(start + SLAB, length)
+        low, high = max(start - 1, 0), min(end + 1, length)
+        slab = np.array(data[low:high], dtype=np.float32)
+        magnitude = np.zeros_like(slab)
+        for axis, step in enumerate(steps):
+            magnitude += np.gradient(slab, step, axis=axis) ** 2
+        yield start, np.sqrt(magnitude, out=magnitude)[start - low:start - low + end - start]
+
+
+def multi_blur(source, levels, gradients=()):
+    """
+    Blur source at every (fwhm, base) of levels, writing <base>_blur.mnc, and also <base>_dxyz.mnc for the (fwhm, base) pairs in gradients.
+    The source is read once; every kernel is applied to it, so the blurs match those of mincblur up to the edges.
+    """
+    bases = OrderedDict()
+    for fwhm, base in list(levels) + list(gradients):
+        bases.setdefault(float(fwhm), OrderedDict())[base] = (fwhm, base) in gradients
+    if not bases:
+        return
+    # The scratch copies are as large as the volume, so they go next to the outputs (the scratch space of the project) rather than to the /tmp of the node.
+    scratch = tempfile.mkdtemp(prefix="Multi_Blur_", dir=os.path.dirname(os.path.abspath((list(levels) + list(gradients))[0][1])))
+    try:
+        data, steps = read_volume(source, scratch)
+        blurred = np.lib.format.open_memmap(os.path.join(scratch, "blurred.npy"), mode='w+', dtype=np.float32, shape=data.shape)
+        for fwhm in sorted(bases):
+            gaussian(data, blurred, [fwhm * FWHM_TO_SIGMA / step for step in steps])
+            for base, gradient in bases[fwhm].items():
+                write_volume(source, base + "_blur.mnc", slabs(blurred))
+                if gradient:
+                    write_volume(source, base + "_dxyz.mnc", gradient_magnitude(blurred, steps))
+        del data, blurred
+    finally:
+        for name in ("source.npy", "blurred.npy"):
+            if os.path.exists(os.path.join(scratch, name)):
+                os.remove(os.path.join(scratch, name))
+        os.rmdir(scratch)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Blur a MINC volume at several kernels after reading it once.")
+    parser.add_argument('source', help='MINC volume to blur')
+    parser.add_argument('--level', nargs=2, action='append', default=[], metavar=('FWHM', 'BASE'), help='Kernel (fwhm, in world units) and output base name')
+    parser.add_argument('--gradient', nargs=2, action='append', default=[], metavar=('FWHM', 'BASE'), help='Same as --level, and also write the gradient magnitude')
+    args = parser.parse_args()
+
+    multi_blur(args.source, [tuple(level) for level in args.level], [tuple(level) for level in args.gradient])
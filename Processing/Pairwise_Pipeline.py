@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+"""
+This module describes the pairwise registration of every specimen to an existing atlas (Atlas_Blur -> lsq6_Query -> lsq12_Query -> nl_Query) as a DAG of tasks (see Pipeline_DAG.py). It is shared by LoRes_Pairwise.py and HiRes_Pairwise.py, which only differ in their blurring kernels, registration strings, and cluster resources.
+
+The task names match the Bash (.sh) scripts the pairwise generators have always written (Atlas_Blur.sh, lsq6_Query_1.sh, ..., nl_Query_N.sh). The per-specimen stages are added as arrays, so they can also be written as SLURM job arrays (lsq6_Query_Array.sh, ...).
+"""
+
+import shlex
+from types import SimpleNamespace
+
+from Intermediate_Lifecycle import plan as lifecycle_plan
+from Pipeline_DAG import Pipeline
+from Resource_Model import read_history, size_pipeline, volume_sizes
+from Atlas_Pipeline import blur_tag, blur_task, gate_stage, quality_gate, xfm_concat
+
+
+def build_pairwise_pipeline(Settings):
+    """
+    Build the pairwise DAG. Settings is a dictionary with the generator's paths, specimen IDs, blurring kernels, registration strings, and cluster resources:
+    lsq6_Levels and lsq12_Levels are lists of (fwhm, minctracc string); nl_Level is the fwhm of the ANTS gradient images, and nl_Register_Begin/nl_Register_End wrap the ANTS similarity metrics.
+    XFM_Engine selects xfmconcat or XFM_Algebra.py for the concatenations (see xfm_concat). With Gate_Threshold, a quality gate follows the lsq6 and lsq12 stages
+    (see quality_gate): the specimens that registered poorly to the atlas are quarantined, and their later registrations are dropped. With Blur_Cache_path, the atlas blurs are linked from a cache shared by every project (see Blur_Cache.py). With Auto_Resources, every job is sized like
+    the jobs of the atlas (see build_atlas_pipeline), with the atlas as the reference volume. With Lifecycle_Mode, the intermediates outside of Lifecycle_Keep
+    are released once the last task that reads them succeeded (see Intermediate_Lifecycle.py).
+    """
+    S = SimpleNamespace(**Settings)
+    P = Pipeline(S.PROJECT_NAME + "_Pairwise", S.Scripts_path, S.Module, S.n_nodes)
+    P.array_jobs = getattr(S, "Array_Jobs", False)
+    P.array_concurrency = getattr(S, "Array_Concurrency", None)
+    P.telemetry_path = getattr(S, "Telemetry_path", None)
+    lsq6_Tags = [blur_tag(fwhm) for fwhm, _ in S.lsq6_Levels]
+    lsq12_Tags = [blur_tag(fwhm) for fwhm, _ in S.lsq12_Levels]
+    nl_Tag = blur_tag(S.nl_Level)
+
+    # The atlas is blurred next to the specimens of the stage that uses the kernel; the atlas mask is blurred in Source/MNC.
+    Atlas_Blurred = {}
+    for fwhm, _ in S.lsq6_Levels:
+        Atlas_Blurred[fwhm] = S.lsq6_Blurred_path
+    for fwhm, _ in S.lsq12_Levels:
+        Atlas_Blurred.setdefault(fwhm, S.lsq12_Blurred_path)
+    Atlas_Blurred.setdefault(S.nl_Level, S.lsq12_Blurred_path)
+    Kernels = sorted(Atlas_Blurred, key=float, reverse=True)
+
+    def Atlas_Avg(fwhm, suffix="_blur.mnc"):
+        return Atlas_Blurred[fwhm] + "Atlas_average_" + blur_tag(fwhm) + suffix
+
+    def Atlas_Avg_Mask(fwhm):
+        return S.Source_MNC_path + "Atlas_average_mask_" + blur_tag(fwhm) + "_blur.mnc"
+
+    #---------------------------------------------------------------------------------------------------------------
+    # Blur the atlas file and the atlas mask with every kernel used by the registrations.
+    #---------------------------------------------------------------------------------------------------------------
+    Atlas_Blurs = ([(S.Atlas_Avg, Atlas_Blurred[fwhm] + "Atlas_average_" + blur_tag(fwhm), fwhm) for fwhm in Kernels] +
+                   [(S.Atlas_Avg_Mask, S.Source_MNC_path + "Atlas_average_mask_" + blur_tag(fwhm), fwhm) for fwhm in Kernels])
+    # ANTS only reads the gradient of the atlas at the non-linear kernel.
+    Task_Blur = P.add(blur_task(S, P, "Atlas_Blur", "Atlas_Blur", S.lsq6_Mem, S.lsq6_Time, Atlas_Blurs, gradients=[Atlas_Blurred[S.nl_Level] + "Atlas_average_" + nl_Tag]))
+    # With a shared cache, the atlas pyramid is linked from the cache (and only blurred into it on a miss). The submission script tries the links on the login node,
+    # so Atlas_Blur is not even submitted once the cache holds the atlas.
+    if getattr(S, "Blur_Cache_path", None):
+        def Cache(Action, Source, Base, fwhm):
+            return P.python + " Blur_Cache.py " + Action + " --cache " + S.Blur_Cache_path + " --command " + shlex.quote(S.MNC_Blur) + " " + fwhm + " " + Source + " " + Base
+        Task_Blur.commands = [Cache("blur", Source, Base, fwhm) for Source, Base, fwhm in Atlas_Blurs]
+        Task_Blur.shortcut = " && ".join(Cache("link", Source, Base, fwhm) for Source, Base, fwhm in Atlas_Blurs)
+
+    #---------------------------------------------------------------------------------------------------------------
+    # 6-parameter (translation (z,y,x), rotation (z,y,x)) optimal rigid body registration stage.
+    #---------------------------------------------------------------------------------------------------------------
+    # Blur every landmark initialized source file, register it hierarchically to the atlas, and resample it into the translation and rotation invariant space.
+    def lsq6_Query(Name, SpecID):
+        Task_lsq6 = blur_task(S, P, Name, "lsq6_Query", S.lsq6_Mem, S.lsq6_Time,
+                              [(S.Source_MNC_path + SpecID + ".mnc", S.lsq6_Blurred_path + SpecID + "_" + tag, fwhm) for (fwhm, _), tag in zip(S.lsq6_Levels, lsq6_Tags)],
+                              "Begin the optimized 6-parameter registration for " + SpecID + ".")
+        Previous = None
+        for Level, ((fwhm, Register), tag) in enumerate(zip(S.lsq6_Levels, lsq6_Tags)):
+            XFM = S.lsq6_XFM_path + SpecID + "_lsq6_" + str(Level) + ".xfm"
+            Init = " -identity" if Previous is None else " -transformation " + Previous
+            Task_lsq6.commands.append(Register + S.lsq6_Blurred_path + SpecID + "_" + tag + "_blur.mnc " + Atlas_Avg(fwhm) + " " + XFM + " -model_mask " + Atlas_Avg_Mask(fwhm) + Init)
+            Task_lsq6.inputs += [Atlas_Avg(fwhm), Atlas_Avg_Mask(fwhm)]
+            Task_lsq6.outputs.append(XFM)
+            Previous = XFM
+        # Resample the original image into the rotation and translation invariant space.
+        Task_lsq6.commands.append("mincresample -like " + S.Atlas_Avg + " -clobber -transformation " + Previous + " " + S.Source_MNC_path + SpecID + ".mnc " + S.lsq6_MNC_path + SpecID + "_lsq6.mnc")
+        Task_lsq6.inputs.append(S.Atlas_Avg)
+        Task_lsq6.outputs.append(S.lsq6_MNC_path + SpecID + "_lsq6.mnc")
+        return Task_lsq6
+    P.add_array("lsq6_Query", lsq6_Query, S.Specimen_IDs, start=1)
+    Gate = quality_gate(S, P, "lsq6", S.Atlas_Avg, S.Atlas_Avg_Mask, S.lsq6_MNC_path + "{SpecID}_lsq6.mnc", S.Specimen_IDs, None, S.lsq6_Mem, S.lsq6_Time)
+
+    #---------------------------------------------------------------------------------------------------------------
+    # 12-parameter (translation (z,y,x), rotation (z,y,x), scale (z,y,x), shear (z,y,x)) optimized affine registration stage.
+    #---------------------------------------------------------------------------------------------------------------
+    # Blur every lsq6 file, register it hierarchically to the atlas, concatenate the lsq6 and lsq12 transformations, and resample the source file into the 12-parameter space.
+    def lsq12_Query(Name, SpecID):
+        Task_lsq12 = blur_task(S, P, Name, "lsq12_Query", S.lsq12_Mem, S.lsq12_Time,
+                               [(S.lsq6_MNC_path + SpecID + "_lsq6.mnc", S.lsq12_Blurred_path + SpecID + "_" + tag, fwhm) for (fwhm, _), tag in zip(S.lsq12_Levels, lsq12_Tags)],
+                               "Begin the optimized 12-parameter registration for " + SpecID + ".")
+        Previous = None
+        for Level, ((fwhm, Register), tag) in enumerate(zip(S.lsq12_Levels, lsq12_Tags)):
+            XFM = S.lsq12_XFM_path + SpecID + "_lsq12_" + str(Level) + ".xfm"
+            Init = " -identity" if Previous is None else " -transformation " + Previous
+            Task_lsq12.commands.append(Register + S.lsq12_Blurred_path + SpecID + "_" + tag + "_blur.mnc " + Atlas_Avg(fwhm) + " " + XFM + " -model_mask " + Atlas_Avg_Mask(fwhm) + Init)
+            Task_lsq12.inputs += [Atlas_Avg(fwhm), Atlas_Avg_Mask(fwhm)]
+            Task_lsq12.outputs.append(XFM)
+            Previous = XFM
+        Orig_XFM = S.lsq12_XFM_path + SpecID + "_origtolsq12.xfm"
+        Task_lsq12.commands += [xfm_concat(S, P, [S.lsq6_XFM_path + SpecID + "_lsq6_2.xfm", Previous], Orig_XFM),
+                                "mincresample -like " + S.Atlas_Avg + " -clobber -transformation " + Orig_XFM + " " + S.Source_MNC_path + SpecID + ".mnc " + S.lsq12_MNC_path + SpecID + "_lsq12.mnc"]
+        Task_lsq12.inputs += [S.lsq6_XFM_path + SpecID + "_lsq6_2.xfm", S.Atlas_Avg, S.Source_MNC_path + SpecID + ".mnc"]
+        Task_lsq12.outputs += [Orig_XFM, S.lsq12_MNC_path + SpecID + "_lsq12.mnc"]
+        return Task_lsq12
+    P.add_array("lsq12_Query", lsq12_Query, S.Specimen_IDs, start=1)
+    gate_stage(P, "lsq12_Query", Gate)
+    Gate = quality_gate(S, P, "lsq12", S.Atlas_Avg, S.Atlas_Avg_Mask, S.lsq12_MNC_path + "{SpecID}_lsq12.mnc", S.Specimen_IDs, Gate, S.lsq12_Mem, S.lsq12_Time)
+
+    #---------------------------------------------------------------------------------------------------------------
+    # NON-LINEAR STAGE
+    #---------------------------------------------------------------------------------------------------------------
+    # Blur every lsq12 file and register it to the atlas with ANTS, using the intensities and the intensity gradients as similarity metrics.
+    def nl_Query(Name, SpecID):
+        Task_nl = blur_task(S, P, Name, "nl_Query", S.nl_Mem, S.nl_Time,
+                            [(S.lsq12_MNC_path + SpecID + "_lsq12.mnc", S.nl_Blurred_path + SpecID + "_" + nl_Tag, S.nl_Level)],
+                            "Begin the optimized non-linear registration for " + SpecID + ".", gradients=[S.nl_Blurred_path + SpecID + "_" + nl_Tag])
+        XFM = S.nl_XFM_path + SpecID + "_ANTS_nl.xfm"
+        Task_nl.commands.append(S.nl_Register_Begin + "-m CC[" + S.lsq12_MNC_path + SpecID + "_lsq12.mnc," + S.Atlas_Avg + ",1.0,4] -m CC[" + S.nl_Blurred_path + SpecID + "_" + nl_Tag + "_dxyz.mnc," +
+                                Atlas_Avg(S.nl_Level, "_dxyz.mnc") + ",1.0,4] -x [" + Atlas_Avg_Mask(S.nl_Level) + "]" + S.nl_Register_End + XFM)
+        Task_nl.inputs += [S.Atlas_Avg, Atlas_Avg(S.nl_Level, "_dxyz.mnc"), Atlas_Avg_Mask(S.nl_Level)]
+        # ANTS also writes the inverse warp (_ANTS_nl_inverse.xfm), which the label propagation uses instead of inverting the forward warp.
+        Task_nl.outputs += [XFM, XFM[:-len(".xfm")] + "_inverse.xfm"]
+        return Task_nl
+    P.add_array("nl_Query", nl_Query, S.Specimen_IDs, start=1)
+    gate_stage(P, "nl_Query", Gate)
+
+    # Size the header of every job from the headers of its input volumes and the usage recorded by previous runs (see Resource_Model.py).
+    Sizes = volume_sizes(S.Source_MNC_path, getattr(S, "Local_MNC_path", None), S.Atlas_Avg, getattr(S, "Volume_Voxels", None))
+    if getattr(S, "Auto_Resources", False):
+        size_pipeline(P, read_history(graph_path=getattr(S, "Graph_path", None)), Sizes, getattr(S, "Resource_Margin", 1.5))
+    # The plan of the intermediates every job releases once it is their last consumer (see Intermediate_Lifecycle.py).
+    if getattr(S, "Lifecycle_Mode", None):
+        P.lifecycle_path = "Lifecycle.json"
+        P.lifecycle = lifecycle_plan(P, S.Lifecycle_Mode, getattr(S, "Lifecycle_Keep", ()), getattr(S, "Archive_path", None), Sizes)
+
+    return P
@@ -0,0 +1,856 @@
+#!/usr/bin/env python3
+
+"""
+This module describes a processing pipeline as a directed acyclic graph (DAG) of tasks and writes the SLURM Bash (.sh) scripts that execute them. Each task declares the commands it runs, the files it reads (inputs) and the files it writes (outputs). Dependencies between tasks are inferred from these declarations: a task depends on every task that produces one of its inputs.
+
+Before the commands of a task run on the cluster, the generated script calls this module to hash the task's command lines and input files. If the outputs of the task already exist with the hashes recorded by a previous successful run, the task is skipped. A stamp is written after every successful run, so a parameter change or a replaced specimen only recomputes the tasks it actually affects.
+
+Stages whose tasks only differ by specimen (e.g., lsq6_Second_1 ... lsq6_Second_N) can be written as a single SLURM job array: one parametrized script whose SLURM_ARRAY_TASK_ID indexes into the specimen list of the stage, with a cap on the number of simultaneously running elements (--array=1-N%K).
+
+Short tasks of one stage (e.g., the pairwise lsq12 registrations) can be packed into jobs of a target wall time, so the queue holds fewer, fuller jobs; a packed job (or array element) runs its tasks one after the other, and its header is sized to the packed work.
+
+Jobs are chained with SLURM dependencies instead of polling the queue: the submission script (<pipeline>_Submission.sh, e.g., DO_Atlas_Submission.sh), which is run once on the login node, submits every job with --dependency=afterok on exactly the jobs that produce its inputs (or aftercorr, when every element of a job array only needs the corresponding element of another array). A task may also carry a cheap shortcut (e.g., linking cached files) that the submission script tries on the login node before submitting the job, or a skip command that the job tries when it starts, once its inputs exist (e.g., carrying over the results of a converged non-linear round). A task downstream of a quality gate (see Quality_Gate.py) is dropped by its job when all of its outputs belong to quarantined specimens, and the files of the quarantined specimens are left out of its inputs and outputs.
+
+Generating the scripts again in the same directory leaves the same files: write_submission() also writes a manifest (<pipeline>_Manifest.json) of the jobs, with the commands hash, inputs, and expected outputs of every task, and removes the scripts of the previous manifest of the same pipeline that are no longer written; the pipelines that share a Scripts directory (e.g., the pairwise registrations and the label propagation) keep their own submission scripts, manifests, and list files. Before submitting anything, the submission script checks the stamps of every task in the manifest on the login node (pending), so a rerun after a crash or a node failure only submits the jobs, and the elements of job arrays, whose tasks are missing or stale (or downstream of one that is).
+
+With a lifecycle plan (Lifecycle.json, see Intermediate_Lifecycle.py), every job releases the intermediate files it was the last consumer of once it is stamped,
+and the stamps keep the digests of the released files, so the tasks around them stay up to date.
+
+The files of a task with more than LIST_LIMIT inputs or outputs (e.g., the N^2 pairwise transformations that lsq12_XFM_Average reads) are written to a list file in the Lists/<pipeline> directory, which the guard, stamp, and release commands of its job take as @<list>, so their command lines do not grow with the files. The quality gates filter such a list into a list of the kept files.
+
+With a telemetry directory, every command of the scripts runs under Telemetry.py, which records its runtime, peak memory, and disk I/O for the hot-spot and critical-path reports of that script.
+
+The processing generators (e.g., LoRes_Atlas.py) import this module and copy it next to the scripts they write. On the cluster, the scripts call it from the Scripts directory via:
+
+python3 Pipeline_DAG.py uptodate <task> <commands hash> --inputs <files> --outputs <files>
+python3 Pipeline_DAG.py stamp <task> <commands hash> --seconds <runtime> --inputs <files> --outputs <files>
+python3 Pipeline_DAG.py pending <pipeline>_Manifest.json
+"""
+
+import argparse
+import hashlib
+import json
+import math
+import os
+import shlex
+import sys
+from collections import OrderedDict
+
+# Directory (relative to the Scripts directory) holding task stamps and cached file digests.
+STAMP_DIR = "Stamps"
+# A task with more input (or output) files than LIST_LIMIT gets them in a list file (Lists/<pipeline>/<task>_inputs.txt), which the guard passes as @<list> (expanded by
+# argparse), so no command line of its job grows with the files (e.g., the N^2 pairwise transformations of lsq12_XFM_Average would exceed ARG_MAX).
+LIST_LIMIT = 1000
+LIST_DIR = "Lists"
+
+
+class Task:
+    """A unit of work: a list of shell commands with declared input and output files."""
+
+    def __init__(self, name, commands, inputs=(), outputs=(), mem=None, time=None, stage=None, message=None, shortcut=None, size=None, skip=None, gate=None):
+        self.name = name
+        self.commands = list(commands)
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.mem = mem
+        self.time = time
+        # Tasks that belong to the same stage (e.g., lsq6_Second_1 ... lsq6_Second_N) share a stage name.
+        self.stage = stage or name
+        self.message = message
+        # A cheap command (e.g., linking cached files) that the submission script runs on the login node first; if it succeeds, the task is stamped and not submitted.
+        self.shortcut = shortcut
+        # A command that the job runs after its up-to-date check (e.g., carrying over the results of a converged round); if it succeeds, the task is stamped
+        # without running its commands. Unlike the shortcut, it runs when the job starts, after the tasks it depends on.
+        self.skip = skip
+        # The state of the quality gate the task is downstream of (see Quality_Gate.py): the job leaves the files of the quarantined specimens out of the inputs
+        # and outputs of the task, and drops the task when none of its outputs are left.
+        self.gate = gate
+        # Megavoxels of the input volumes (total, largest), set by the resource model so later runs can calibrate it against the recorded usage.
+        self.size = size
+
+    def commands_hash(self):
+        # Hash the command lines (and the skip command); any parameter change alters this hash and invalidates the stamp.
+        return hashlib.sha256("\n".join(self.commands + ([self.skip] if self.skip else [])).encode()).hexdigest()
+
+    def to_dict(self):
+        return OrderedDict([("name", self.name), ("stage", self.stage), ("mem", self.mem), ("time", self.time),
+                            ("message", self.message), ("shortcut", self.shortcut), ("skip", self.skip), ("gate", self.gate), ("size", self.size), ("commands", self.commands),
+                            ("inputs", self.inputs), ("outputs", self.outputs)])
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d["name"], d["commands"], d["inputs"], d["outputs"], d.get("mem"), d.get("time"), d.get("stage"), d.get("message"), d.get("shortcut"), d.get("size"), d.get("skip"), d.get("gate"))
+
+
+class Array:
+    """A stage of tasks built from one template: every task substitutes its own values (e.g., a specimen ID) for the template variables."""
+
+    def __init__(self, stage, variables, template, names, items, start):
+        self.stage = stage
+        self.variables = variables
+        self.template = template
+        self.names = names
+        self.items = items
+        self.start = start
+        self.values = dict(zip(names, items))
+
+    def substitute(self, text, values):
+        for variable, value in zip(self.variables, values):
+            text = text.replace("${" + variable + "}", value)
+        return text
+
+
+class Pipeline:
+    """An ordered collection of tasks forming a DAG through their inputs and outputs."""
+
+    def __init__(self, name, scripts_path, module, n_nodes="1", python="python3"):
+        self.name = name
+        self.scripts_path = scripts_path
+        self.module = module
+        self.n_nodes = n_nodes
+        self.python = python
+        self.tasks = OrderedDict()
+        self.arrays = OrderedDict()
+        # Job array settings used by write_scripts(): the maximum array index allowed by the cluster (MaxArraySize - 1) and the concurrency cap (%K).
+        self.array_jobs = False
+        self.array_concurrency = None
+        self.array_max_index = 1000
+        # Packed stages: stage -> (lists of task names run by one job, mem, time).
+        self.packs = OrderedDict()
+        # Directory (on the cluster) receiving the per-command records of Telemetry.py; None runs the commands as they are.
+        self.telemetry_path = None
+        # Plan of Intermediate_Lifecycle.py (e.g., Lifecycle.json), which releases the intermediate files once their last consumer succeeded, and the plan itself
+        # (written by write_submission); None keeps every file.
+        self.lifecycle_path = None
+        self.lifecycle = None
+
+    def add(self, task):
+        if task.name in self.tasks:
+            raise ValueError("Duplicate task name: " + task.name)
+        self.tasks[task.name] = task
+        return task
+
+    def add_array(self, stage, build, items, variables=("SpecID",), start=1):
+        # Add one task per item; build(name, *values) returns the task for an item. Items are specimen IDs or tuples of values (e.g., specimen pairs).
+        items = [tuple(item) if isinstance(item, (tuple, list)) else (item,) for item in items]
+        names = []
+        for index, values in enumerate(items, start=start):
+            names.append(self.add(build(stage + "_" + str(index), *values)).name)
+        # Building the task with Bash variables instead of values yields the template of the parametrized array script.
+        template = build("${TASK}", *["${" + variable + "}" for variable in variables])
+        array = Array(stage, list(variables), template, names, items, start)
+        # A variable may stand for several files (e.g., a list of transformations), so inputs and outputs are compared as the space separated lists of the scripts.
+        for name, values in zip(names, items):
+            task = self.tasks[name]
+            if ([array.substitute(command, values) for command in template.commands] != task.commands or
+                    array.substitute(" ".join(template.inputs), values) != " ".join(task.inputs) or
+                    array.substitute(" ".join(template.outputs), values) != " ".join(task.outputs)):
+                raise ValueError(name + " cannot be expressed by the template of stage " + stage)
+        self.arrays[stage] = array
+        return names
+
+    def pack(self, stage, cost, budget, margin=1.5, mem=None, group=None):
+        # Group the tasks of a stage into jobs of at most budget seconds, given the estimated seconds cost(task) of every task (first fit decreasing). A task longer
+        # than the budget gets a job of its own. The time of the packed jobs is their largest load times margin, and mem (if given) replaces the memory of the tasks.
+        # With group, only tasks of the same group(task) share a job (e.g., the pairs of a previous build, which are up to date, and the new ones).
+        names = [task.name for task in self.stages()[stage]]
+        members = set(names)
+        dependencies = self.dependencies()
+        for name in names:
+            if any(dep in members for dep in dependencies[name]):
+                raise ValueError("The tasks of stage " + stage + " depend on each other and cannot be packed.")
+        costs = OrderedDict((name, float(cost(self.tasks[name]))) for name in names)
+        position = dict((name, offset) for offset, name in enumerate(names))
+        partition = OrderedDict()
+        for name in names:
+            partition.setdefault(group(self.tasks[name]) if group else None, []).append(name)
+        bins = []
+        for group_names in partition.values():
+            ordered = sorted(group_names, key=lambda name: -costs[name])
+            smallest = costs[ordered[-1]]
+            # Bins are [load, names]; a bin is no longer scanned once even the smallest task does not fit, which keeps uniform costs linear in the number of tasks.
+            open_bins = []
+            for name in ordered:
+                for target in open_bins:
+                    if target[0] + costs[name] <= budget:
+                        break
+                else:
+                    target = [0.0, []]
+                    bins.append(target)
+                    open_bins.append(target)
+                target[0] += costs[name]
+                target[1].append(name)
+                if target[0] + smallest > budget:
+                    open_bins.remove(target)
+        # Jobs keep the order of the stage, and every job runs its tasks in the order of the stage.
+        bins.sort(key=lambda target: min(position[name] for name in target[1]))
+        groups = [sorted(target[1], key=position.get) for target in bins]
+        self.packs[stage] = (groups, mem or self.tasks[names[0]].mem, slurm_time(max(target[0] for target in bins) * margin))
+        return groups
+
+    def elements(self, stage):
+        # The tasks run by every job (or array element) of a stage: one task each, unless the stage is packed.
+        if stage in self.packs:
+            return self.packs[stage][0]
+        return [[task.name] for task in self.stages()[stage]]
+
+    def resources(self, stage, task):
+        # The header (mem, time) of the jobs of a stage: the packed resources, or the resources of the task.
+        if stage in self.packs:
+            return Task(task.name, [], mem=self.packs[stage][1], time=self.packs[stage][2])
+        return task
+
+    def pack_jobs(self, stage):
+        # Outside of job arrays, every job of a packed stage is its own script (e.g., lsq12_Third_Pack_1.sh).
+        return [(stage + "_Pack_" + str(number), names) for number, names in enumerate(self.elements(stage), start=1)]
+
+    def array_chunks(self, stage):
+        # Split an array stage into job arrays that respect the cluster's maximum array index. Returns (script name, first index, elements), where every element
+        # lists the tasks run by one array index.
+        elements = self.elements(stage)
+        start = 0 if stage in self.packs else self.arrays[stage].start
+        if start + len(elements) - 1 <= self.array_max_index:
+            return [(stage + "_Array", start, elements)]
+        size = self.array_max_index
+        return [(stage + "_Array_" + str(chunk), 0, elements[begin:begin + size])
+                for chunk, begin in enumerate(range(0, len(elements), size), start=1)]
+
+    def stages(self):
+        # Stage names in the order their first task was added.
+        stages = OrderedDict()
+        for task in self.tasks.values():
+            stages.setdefault(task.stage, []).append(task)
+        return stages
+
+    def producers(self):
+        # Map every declared output to the task that writes it.
+        producers = {}
+        for task in self.tasks.values():
+            for output in task.outputs:
+                if output in producers:
+                    raise ValueError(output + " is written by both " + producers[output] + " and " + task.name)
+                producers[output] = task.name
+        return producers
+
+    def dependencies(self):
+        # Map every task to the (ordered, unique) tasks that produce its inputs.
+        producers = self.producers()
+        dependencies = OrderedDict()
+        for task in self.tasks.values():
+            upstream = OrderedDict()
+            for path in task.inputs:
+                if path in producers and producers[path] != task.name:
+                    upstream[producers[path]] = True
+            dependencies[task.name] = list(upstream)
+        return dependencies
+
+    def topological_order(self):
+        # Kahn's algorithm, keeping the insertion order among independent tasks.
+        dependencies = self.dependencies()
+        remaining = OrderedDict((name, set(deps)) for name, deps in dependencies.items())
+        consumers = {name: [] for name in dependencies}
+        for name, deps in dependencies.items():
+            for dep in deps:
+                consumers[dep].append(name)
+        ready = [name for name, deps in remaining.items() if not deps]
+        order = []
+        while ready:
+            name = ready.pop(0)
+            order.append(name)
+            for consumer in consumers[name]:
+                remaining[consumer].discard(name)
+                if not remaining[consumer]:
+                    ready.append(consumer)
+        if len(order) != len(self.tasks):
+            raise ValueError("The pipeline contains a dependency cycle.")
+        return order
+
+    def header(self, task, array=None):
+        # Standard .sh header needed for SLURM job submission. Job arrays add the range of array indices and the concurrency cap.
+        directives = "#!/bin/bash\n#SBATCH --nodes=" + self.n_nodes + "\n#SBATCH --mem=" + task.mem + "\n#SBATCH --time=" + task.time + "\n"
+        if array:
+            directives += "#SBATCH --array=" + array + ("%" + str(self.array_concurrency) if self.array_concurrency else "") + "\n"
+        return directives + "\nmodule load " + self.module + "\n\ncd " + self.scripts_path + "\n\necho \"The job started at $(date).\"\n\n"
+
+    def guard(self, task, name=None, key=None):
+        # Skip the task when its stamp matches the current commands, inputs, and outputs; stop at the first failing command otherwise.
+        # Array scripts look up TASK and KEY in their tables, so name and key are only given for single-task scripts.
+        lines = ("TASK=\"" + name + "\"\nKEY=\"" + key + "\"\n") if name else ""
+        return (lines + "INPUTS=\"" + self.gated(task, task.inputs, "inputs") + "\nOUTPUTS=\"" + self.gated(task, task.outputs, "outputs") + "\n" +
+                self.gate_check(task) +
+                "if " + self.python + " Pipeline_DAG.py uptodate $TASK $KEY --inputs $INPUTS --outputs $OUTPUTS; then\n" +
+                "echo \"$TASK is up to date. Skipping it.\"\nexit 0\nfi\n" + self.restore() + self.skip_check(task) + "set -e\n\n")
+
+    def gate_check(self, task):
+        # End the job of a task downstream of a quality gate when all of its outputs belong to quarantined specimens (e.g., the registration of a quarantined
+        # specimen, or of a pair with one). The task is not stamped, as it has no outputs left.
+        if not task.gate or not task.outputs:
+            return ""
+        return "if [ -z \"$OUTPUTS\" ]; then\necho \"$TASK only works on quarantined specimens (see " + task.gate + "). Dropping it.\"\nexit 0\nfi\n"
+
+    def list_file(self, task, kind, files):
+        # The list file of the inputs or outputs (kind) of a task with more than LIST_LIMIT of them, or None. The files of an array template depend on its
+        # variables, so they stay on the command line.
+        if len(files) <= LIST_LIMIT or self.tasks.get(task.name) is not task:
+            return None
+        return LIST_DIR + "/" + self.name + "/" + task.name + "_" + kind + ".txt"
+
+    def lists(self):
+        # The list file and the files of every task with more than LIST_LIMIT inputs or outputs.
+        for task in self.tasks.values():
+            for kind, files in (("inputs", task.inputs), ("outputs", task.outputs)):
+                path = self.list_file(task, kind, files)
+                if path:
+                    yield path, files
+
+    def write_lists(self, directory="."):
+        # Write the list files into the directory the scripts run in.
+        for path, files in self.lists():
+            os.makedirs(os.path.join(directory, os.path.dirname(path)), exist_ok=True)
+            with open(os.path.join(directory, path), 'w') as list_file:
+                list_file.write("\n".join(files) + "\n")
+
+    def gated(self, task, files, kind):
+        # The quoted list of the files of a task (or @<list file>), less those of the quarantined specimens when the task is downstream of a quality gate
+        # (filtered when the job runs, into <list file>_kept.txt for a list file; the job fails if the state of the gate cannot be read).
+        path = self.list_file(task, kind, files)
+        if not task.gate:
+            return ("@" + path if path else " ".join(files)) + "\""
+        if path:
+            return "$(" + self.python + " Quality_Gate.py keep " + task.gate + " @" + path + " --list " + path[:-len(".txt")] + "_kept.txt)\" || exit 1"
+        return "$(" + self.python + " Quality_Gate.py keep " + task.gate + " " + " ".join(files) + ")\" || exit 1"
+
+    def skip_check(self, task):
+        # Stamp the task without running its commands when its skip command succeeds. The stamp keeps no runtime, so the resource model does not learn the
+        # cost of the skip command as the cost of the task.
+        if not task.skip:
+            return ""
+        return ("if " + task.skip + "; then\necho \"$TASK was satisfied by its skip command. Stamping it.\"\n" +
+                self.python + " Pipeline_DAG.py stamp $TASK $KEY --inputs $INPUTS --outputs $OUTPUTS\n" + self.release() + "exit 0\nfi\n")
+
+    def restore(self):
+        # With a lifecycle plan, a task that runs again first restores its archived inputs (the job fails on an input that was deleted; see pending).
+        if not self.lifecycle_path:
+            return ""
+        return self.python + " Intermediate_Lifecycle.py restore " + self.lifecycle_path + " --inputs $INPUTS || exit 1\n"
+
+    def release(self):
+        # With a lifecycle plan, a stamped task releases the intermediates it was the last consumer of. A failed release only keeps the files.
+        if not self.lifecycle_path:
+            return ""
+        return (self.python + " Intermediate_Lifecycle.py release " + self.lifecycle_path + " $TASK --inputs $INPUTS --outputs $OUTPUTS || " +
+                "echo \"The intermediates of $TASK were not released.\"\n")
+
+    def stamp(self):
+        # SECONDS is the runtime of the task in Bash, kept in the stamp so later runs can estimate the cost of the task.
+        return "\n" + self.python + " Pipeline_DAG.py stamp $TASK $KEY --seconds $SECONDS --inputs $INPUTS --outputs $OUTPUTS\n" + self.release() + "\n"
+
+    def specimen(self, task):
+        # The specimen (or specimen pair, as A:B) a task works on: the values of its SpecID variables, or their Bash variables in an array template.
+        for array in self.arrays.values():
+            variables = [position for position, variable in enumerate(array.variables) if variable.startswith("SpecID")]
+            if task is array.template:
+                return ":".join("${" + array.variables[position] + "}" for position in variables)
+            if task.name in array.values:
+                return ":".join(array.values[task.name][position] for position in variables)
+        return ""
+
+    def command(self, task, command):
+        # With telemetry_path, every command runs under Telemetry.py, which records its runtime, peak memory, and disk I/O; the hash of the task is unchanged.
+        if not self.telemetry_path:
+            return command
+        return (self.python + " Telemetry.py run " + self.telemetry_path + " $TASK " + task.stage + " \"" + self.specimen(task) + "\" -- " +
+                shlex.quote(command))
+
+    def body(self, task):
+        body = "echo \"" + task.message + "\"\n" if task.message else ""
+        return body + "\n".join(self.command(task, command) for command in task.commands) + "\n" + self.stamp() + "echo \"The job ended at $(date).\""
+
+    def script(self, task):
+        return self.header(task) + self.guard(task, task.name, task.commands_hash()) + self.body(task)
+
+    def packed(self, blocks, loop=None):
+        # Run every task of a packed job in its own subshell, so a skipped task (exit 0) or a failing one (set -e) does not stop the others. The job fails if one
+        # of its tasks failed, after the others have run and been stamped. With loop, the single block is the body of a Bash for loop over the tasks.
+        lines = "FAILED=0\n" + (loop + "\n" if loop else "")
+        for block in blocks:
+            lines += "(\nSECONDS=0\n" + block + "\n)\n[ $? -eq 0 ] || FAILED=1\n"
+        return lines + ("done\n" if loop else "") + "exit $FAILED\n"
+
+    def pack_script(self, stage, names):
+        return self.header(self.resources(stage, self.tasks[names[0]])) + self.packed(
+            [self.guard(self.tasks[name], name, self.tasks[name].commands_hash()) + self.body(self.tasks[name]) for name in names])
+
+    def array_script(self, array, first, elements):
+        # A parametrized script: SLURM_ARRAY_TASK_ID selects the task name, the task hash, and the values of the template variables from tables.
+        names = [name for element in elements for name in element]
+        offset = dict((name, position) for position, name in enumerate(names))
+        items = dict(zip(array.names, array.items))
+        table = "# Array tables: SLURM_ARRAY_TASK_ID " + str(first) + " selects the first entry of every table.\n"
+        table += "TASK_LIST=(" + " ".join(names) + ")\n"
+        table += "KEY_LIST=(" + " ".join(self.tasks[name].commands_hash() for name in names) + ")\n"
+        for position, variable in enumerate(array.variables):
+            table += variable + "_LIST=(" + " ".join(shlex.quote(items[name][position]) for name in names) + ")\n"
+        lookup = "TASK=${TASK_LIST[$INDEX]}\nKEY=${KEY_LIST[$INDEX]}\n"
+        for variable in array.variables:
+            lookup += variable + "=${" + variable + "_LIST[$INDEX]}\n"
+        # The commands of the template run in the Bash of Telemetry.py, which needs the values of the variables.
+        if self.telemetry_path:
+            lookup += "export " + " ".join(array.variables) + "\n"
+        header = self.header(self.resources(array.stage, array.template), str(first) + "-" + str(first + len(elements) - 1))
+        if array.stage not in self.packs:
+            return (header + table + "INDEX=$((SLURM_ARRAY_TASK_ID - " + str(first) + "))\n" + lookup + "\n" +
+                    self.guard(array.template) + self.body(array.template))
+        # Packed arrays: every element runs the tasks of its BIN_LIST entry (indices into the tables) one after the other.
+        table += "BIN_LIST=(" + " ".join("\"" + " ".join(str(offset[name]) for name in element) + "\"" for element in elements) + ")\n"
+        return header + table + "\n" + self.packed([lookup + "\n" + self.guard(array.template) + self.body(array.template)],
+                                                   "for INDEX in ${BIN_LIST[$((SLURM_ARRAY_TASK_ID - " + str(first) + "))]}; do")
+
+    def write_scripts(self):
+        # Write the .sh scripts into the current (local scripts) directory: one per task, or one per job array for array stages when array_jobs is set, and
+        # the list files of the tasks with more than LIST_LIMIT files (see list_file).
+        self.write_lists()
+        for stage, tasks in self.stages().items():
+            if self.array_jobs and stage in self.arrays:
+                for script_name, first, elements in self.array_chunks(stage):
+                    with open(script_name + ".sh", 'w') as script:
+                        script.write(self.array_script(self.arrays[stage], first, elements))
+                continue
+            if stage in self.packs:
+                for script_name, names in self.pack_jobs(stage):
+                    with open(script_name + ".sh", 'w') as script:
+                        script.write(self.pack_script(stage, names))
+                continue
+            for task in tasks:
+                with open(task.name + ".sh", 'w') as script:
+                    script.write(self.script(task))
+
+    def job_elements(self):
+        # Every SLURM job (named after its script) with its first array index (None outside of job arrays) and the tasks run by each of its elements.
+        for stage, tasks in self.stages().items():
+            if self.array_jobs and stage in self.arrays:
+                for chunk in self.array_chunks(stage):
+                    yield chunk
+            elif stage in self.packs:
+                for script_name, names in self.pack_jobs(stage):
+                    yield script_name, None, [names]
+            else:
+                for task in tasks:
+                    yield task.name, None, [[task.name]]
+
+    def jobs(self):
+        # Map every SLURM job (named after its script) to its tasks, and every task to its job and array index (None outside of job arrays).
+        jobs, index = OrderedDict(), {}
+        for job, first, elements in self.job_elements():
+            jobs[job] = [name for element in elements for name in element]
+            for offset, element in enumerate(elements):
+                for name in element:
+                    index[name] = (job, None if first is None else first + offset)
+        return jobs, index
+
+    def job_dependencies(self):
+        # Map every job to its upstream jobs and the dependency type: "aftercorr" when every array element only waits for the element with the same index of
+        # another array, "afterok" otherwise. Upstream jobs that are already waited for through another upstream job are dropped.
+        jobs, index = self.jobs()
+        dependencies = self.dependencies()
+        kinds = OrderedDict()
+        for job, names in jobs.items():
+            pairs = OrderedDict()
+            for name in names:
+                for dep in dependencies[name]:
+                    if index[dep][0] != job:
+                        pairs.setdefault(index[dep][0], []).append((index[name][1], index[dep][1]))
+            kinds[job] = OrderedDict()
+            for upstream, elements in pairs.items():
+                upstream_indices = set(index[name][1] for name in jobs[upstream])
+                corresponding = all(element is not None and element == upstream_element for element, upstream_element in elements)
+                covered = set(index[name][1] for name in names) <= upstream_indices
+                kinds[job][upstream] = "aftercorr" if corresponding and covered else "afterok"
+        consumers = OrderedDict((job, []) for job in kinds)
+        for job, upstream_kinds in kinds.items():
+            for upstream in upstream_kinds:
+                consumers[upstream].append(job)
+        reduced = OrderedDict()
+        for job, upstream_kinds in kinds.items():
+            reduced[job] = OrderedDict()
+            for upstream, kind in upstream_kinds.items():
+                implied = False
+                # Only the other upstream jobs that also consume upstream can imply it; scan whichever list is shorter.
+                others = consumers[upstream] if len(consumers[upstream]) < len(upstream_kinds) else list(upstream_kinds)
+                for other in others:
+                    if other == upstream or other not in upstream_kinds or upstream not in kinds[other]:
+                        continue
+                    other_kind = upstream_kinds[other]
+                    # All of upstream has finished before any element of other starts; or other relays the corresponding elements of upstream.
+                    if (kinds[other][upstream] == "afterok" or
+                            (other_kind == "aftercorr" and kind == "aftercorr") or
+                            (other_kind == "afterok" and set(index[name][1] for name in jobs[upstream]) <= set(index[name][1] for name in jobs[other]))):
+                        implied = True
+                        break
+                if not implied:
+                    reduced[job][upstream] = kind
+        return kinds, reduced
+
+    def job_order(self, kinds):
+        # Kahn's algorithm over jobs, so every job is submitted after the jobs it depends on.
+        remaining = OrderedDict((job, len(upstream)) for job, upstream in kinds.items())
+        consumers = OrderedDict((job, []) for job in kinds)
+        for job, upstream_kinds in kinds.items():
+            for upstream in upstream_kinds:
+                consumers[upstream].append(job)
+        ready = [job for job, count in remaining.items() if not count]
+        order = []
+        while ready:
+            job = ready.pop(0)
+            order.append(job)
+            for consumer in consumers[job]:
+                remaining[consumer] -= 1
+                if not remaining[consumer]:
+                    ready.append(consumer)
+        if len(order) != len(kinds):
+            raise ValueError("The pipeline contains a dependency cycle.")
+        return order
+
+    def shortcuts(self):
+        # Jobs of a single task with a shortcut; the submission script only submits them if the shortcut fails.
+        jobs, _ = self.jobs()
+        return OrderedDict((job, self.tasks[names[0]]) for job, names in jobs.items()
+                           if len(names) == 1 and job == names[0] and self.tasks[names[0]].shortcut)
+
+    def submission_path(self):
+        # The submission script and manifest are named after the pipeline, so the pipelines that share a Scripts directory do not overwrite each other's.
+        return self.name + "_Submission.sh"
+
+    def manifest_path(self):
+        return self.name + "_Manifest.json"
+
+    def submission(self, path=None, manifest=None):
+        # A Bash script for the login node that submits every job once, chained with SLURM dependencies, so no job has to poll the queue. It first checks the
+        # stamps of the tasks in the manifest, so a rerun (e.g., after a node failure) only submits the jobs, and the array elements, with missing or stale tasks.
+        path, manifest = path or self.submission_path(), manifest or self.manifest_path()
+        kinds, dependencies = self.job_dependencies()
+        shortcuts = self.shortcuts()
+        arrays = set(job for job, first, _ in self.job_elements() if first is not None)
+        # Jobs that are up to date, or satisfied on the login node, have an empty ID, so the dependencies of their consumers are joined at submission time without them.
+        lines = ["#!/bin/bash",
+                 "# Submit every job of " + self.name + " with its dependencies. Run this script on the login node (bash " + path + "); there is no need to sbatch it.",
+                 "# Dependent jobs are cancelled automatically when a job they depend on fails (--kill-on-invalid-dep=yes).",
+                 "# Rerunning it (e.g., after a node failure, once the jobs left in the queue are cancelled) only submits the jobs whose tasks are missing or stale.",
+                 "set -e", "", "cd " + self.scripts_path, "",
+                 "# Check the stamps of the tasks in " + manifest + ": DONE_<job> is set for the jobs whose tasks are all up to date, and ARRAY_<job> limits a job array",
+                 "# to its elements with stale tasks (CORR_<job> then turns the aftercorr dependencies on it into afterok).",
+                 "PENDING=$(" + self.python + " Pipeline_DAG.py pending " + manifest + ")",
+                 "eval \"$PENDING\"", ""]
+        if self.lifecycle_path:
+            lines += ["# The projected peak disk use, with the intermediates released once their last consumer succeeded (see Intermediate_Lifecycle.py).",
+                      self.python + " Intermediate_Lifecycle.py report " + self.lifecycle_path, ""]
+        lines += [
+                 "# Print the dependency options of a job from kind:ID:ID... arguments, leaving out the empty IDs of jobs that were not submitted.",
+                 "dependency() {",
+                 "    local option=\"\" kind ids id",
+                 "    for argument in \"$@\"; do",
+                 "        kind=${argument%%:*}; ids=\"\"",
+                 "        for id in ${argument#*:}; do ids=\"$ids:$id\"; done",
+                 "        [ -n \"$ids\" ] && option=\"$option,$kind$ids\"",
+                 "    done",
+                 "    [ -n \"$option\" ] && echo \"--kill-on-invalid-dep=yes --dependency=${option#,}\"",
+                 "    return 0",
+                 "}", ""]
+        for job in self.job_order(kinds):
+            dependency = ""
+            if dependencies[job]:
+                # An aftercorr dependency on a job array that only runs some of its elements becomes afterok, so it never waits on an element that was not submitted.
+                arguments = ["\"${CORR_" + upstream + ":-aftercorr}: $" + upstream + "\"" for upstream, kind in dependencies[job].items() if kind == "aftercorr"]
+                waited = ["$" + upstream for upstream, kind in dependencies[job].items() if kind == "afterok"]
+                dependency = " $(dependency " + " ".join((["\"afterok: " + " ".join(waited) + "\""] if waited else []) + arguments) + ")"
+            lines += ["if [ -n \"$DONE_" + job + "\" ]; then", job + "=\"\"", "echo \"" + job + " is up to date; it is not submitted.\""]
+            if job in shortcuts:
+                task = shortcuts[job]
+                stamp = (self.python + " Pipeline_DAG.py stamp " + task.name + " " + task.commands_hash() +
+                         " --inputs " + " ".join(task.inputs) + " --outputs " + " ".join(task.outputs))
+                lines += ["elif " + task.shortcut + " && " + stamp + "; then", job + "=\"\"", "echo \"" + job + " was satisfied on the login node; it is not submitted.\""]
+            lines += ["else", job + "=$(sbatch --parsable" + dependency + (" $ARRAY_" + job if job in arrays else "") + " " + job + ".sh | cut -d ';' -f 1)",
+                      "echo \"Submitted " + job + ".sh as job $" + job + ".\"", "fi"]
+        return "\n".join(lines) + "\n"
+
+    def manifest(self):
+        # The jobs of the scripts (with the tasks of every array element) and the commands hash, inputs, outputs, and gate of every task, which pending() checks.
+        jobs = OrderedDict()
+        for job, first, elements in self.job_elements():
+            jobs[job] = OrderedDict([("first", first), ("limit", self.array_concurrency if first is not None else None), ("elements", elements)])
+        tasks = OrderedDict((name, OrderedDict([("key", task.commands_hash()), ("inputs", task.inputs), ("outputs", task.outputs), ("gate", task.gate)]))
+                            for name, task in self.tasks.items())
+        return OrderedDict([("name", self.name), ("scripts", [job + ".sh" for job in jobs] + [path for path, _ in self.lists()]), ("jobs", jobs), ("tasks", tasks)])
+
+    def write_manifest(self, path=None):
+        # Regenerating the scripts in the same directory leaves the same files: the scripts (and list files) of the previous manifest of this pipeline that are
+        # no longer written (e.g., the task scripts of a stage that became a job array) are removed. The scripts of the other pipelines are in their manifests.
+        path = path or self.manifest_path()
+        manifest = self.manifest()
+        previous = _read_json(path)
+        for script_name in (previous or {}).get("scripts", []):
+            if script_name not in manifest["scripts"] and (script_name.endswith(".sh") or script_name.startswith(LIST_DIR + "/")) and os.path.isfile(script_name):
+                os.remove(script_name)
+        with open(path, 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=1)
+
+    def write_submission(self, path=None, manifest=None):
+        path, manifest = path or self.submission_path(), manifest or self.manifest_path()
+        with open(path, 'w') as script:
+            script.write(self.submission(path, manifest))
+        self.write_manifest(manifest)
+        if self.lifecycle_path and self.lifecycle:
+            with open(self.lifecycle_path, 'w') as plan:
+                json.dump(self.lifecycle, plan, indent=1)
+
+    def write_graph(self, path):
+        graph = OrderedDict([("name", self.name), ("scripts_path", self.scripts_path), ("module", self.module),
+                             ("n_nodes", self.n_nodes), ("python", self.python), ("telemetry_path", self.telemetry_path), ("lifecycle_path", self.lifecycle_path),
+                             ("tasks", [task.to_dict() for task in self.tasks.values()]),
+                             # The items of every array stage, so a later build can keep the task names of this one (e.g., Grow_Atlas in Atlas_Pipeline.py).
+                             ("arrays", OrderedDict((stage, OrderedDict([("variables", array.variables), ("start", array.start), ("items", array.items)]))
+                                                    for stage, array in self.arrays.items()))])
+        with open(path, 'w') as graph_file:
+            json.dump(graph, graph_file, indent=1)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as graph_file:
+            graph = json.load(graph_file)
+        pipeline = cls(graph["name"], graph["scripts_path"], graph["module"], graph["n_nodes"], graph.get("python", "python3"))
+        pipeline.telemetry_path = graph.get("telemetry_path")
+        pipeline.lifecycle_path = graph.get("lifecycle_path")
+        for task in graph["tasks"]:
+            pipeline.add(Task.from_dict(task))
+        return pipeline
+
+
+def slurm_time(seconds):
+    # Format a wall time for #SBATCH --time, rounded up to whole minutes: HH:MM:SS, or D-HH:MM:SS from one day on.
+    minutes = max(1, int(math.ceil(seconds / 60.0)))
+    days, minutes = divmod(minutes, 24 * 60)
+    clock = "%02d:%02d:00" % divmod(minutes, 60)
+    return (str(days) + "-" + clock) if days else clock
+
+
+def install(directory, modules=("Pipeline_DAG.py",)):
+    # Copy this module (and the other modules the jobs call, e.g., Blur_Cache.py) next to the generated scripts so the jobs can call them from the Scripts directory.
+    for module in modules:
+        source_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), module)
+        target = os.path.join(directory, module)
+        if os.path.abspath(target) != source_path:
+            with open(source_path) as source, open(target, 'w') as copy:
+                copy.write(source.read())
+
+
+#-------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
+# Content hashing and stamps (run on the cluster).
+#-------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
+def _write_json(path, data):
+    # Write atomically so concurrent jobs never read a partial file.
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp = path + "." + str(os.getpid()) + ".tmp"
+    with open(temp, 'w') as out:
+        json.dump(data, out)
+    os.replace(temp, path)
+
+
+def _read_json(path):
+    try:
+        with open(path) as handle:
+            return json.load(handle)
+    except (OSError, ValueError):
+        return None
+
+
+def release_record(path, stamp_dir=STAMP_DIR):
+    # Record of a file released (deleted or archived) by Intermediate_Lifecycle.py once its last consumer succeeded.
+    return os.path.join(stamp_dir, "Released", hashlib.sha1(os.path.abspath(path).encode()).hexdigest() + ".json")
+
+
+def file_digest(path, stamp_dir=STAMP_DIR):
+    # SHA-256 of a file's content, cached by size and modification time so large volumes are only hashed once. A released file keeps the digest it had, so
+    # the stamps of its producer and consumers still hold.
+    try:
+        info = os.stat(path)
+    except OSError:
+        released = _read_json(release_record(path, stamp_dir))
+        return released["sha256"] if released else None
+    cache_path = os.path.join(stamp_dir, "Digests", hashlib.sha1(os.path.abspath(path).encode()).hexdigest() + ".json")
+    cached = _read_json(cache_path)
+    if cached and cached["size"] == info.st_size and cached["mtime_ns"] == info.st_mtime_ns:
+        return cached["sha256"]
+    sha = hashlib.sha256()
+    with open(path, 'rb') as handle:
+        for block in iter(lambda: handle.read(1 << 23), b""):
+            sha.update(block)
+    digest = sha.hexdigest()
+    _write_json(cache_path, {"path": os.path.abspath(path), "size": info.st_size, "mtime_ns": info.st_mtime_ns, "sha256": digest})
+    return digest
+
+
+def task_key(commands_hash, inputs, stamp_dir=STAMP_DIR):
+    # Combine the command hash with the content hash of every input. Returns None if an input is missing.
+    key = hashlib.sha256(commands_hash.encode())
+    for path in inputs:
+        digest = file_digest(path, stamp_dir)
+        if digest is None:
+            return None
+        key.update((path + "=" + digest + "\n").encode())
+    return key.hexdigest()
+
+
+def uptodate(task, commands_hash, inputs, outputs, stamp_dir=STAMP_DIR):
+    stamp = _read_json(os.path.join(stamp_dir, task + ".json"))
+    if not stamp:
+        return False
+    key = task_key(commands_hash, inputs, stamp_dir)
+    if key is None or key != stamp["key"]:
+        return False
+    return all(output in stamp["outputs"] and file_digest(output, stamp_dir) == stamp["outputs"][output] for output in outputs)
+
+
+def peak_memory():
+    # Peak memory (megabytes) of the job so far, read from the cgroup SLURM confines it to (memory.peak in cgroup v2, memory.max_usage_in_bytes in v1).
+    # Returns None outside of a cgroup with memory accounting, e.g., on a workstation.
+    try:
+        with open("/proc/self/cgroup") as handle:
+            lines = handle.read().splitlines()
+    except OSError:
+        return None
+    for line in lines:
+        _, controllers, path = line.split(":", 2)
+        if controllers == "":
+            root, name = "/sys/fs/cgroup", "memory.peak"
+        elif "memory" in controllers.split(","):
+            root, name = "/sys/fs/cgroup/memory", "memory.max_usage_in_bytes"
+        else:
+            continue
+        # Walk up from the cgroup of this process (e.g., .../job_123/step_batch/user/task_0) to the first one that accounts memory.
+        while True:
+            try:
+                with open(os.path.join(root + path, name)) as handle:
+                    return round(int(handle.read()) / 2.0 ** 20)
+            except (OSError, ValueError):
+                if path in ("", "/"):
+                    break
+                path = os.path.dirname(path)
+    return None
+
+
+def stamp(task, commands_hash, inputs, outputs, stamp_dir=STAMP_DIR, seconds=None):
+    key = task_key(commands_hash, inputs, stamp_dir)
+    # The outputs have to be on disk; the digest of a released output does not stand in for it.
+    digests = OrderedDict((output, file_digest(output, stamp_dir) if os.path.exists(output) else None) for output in outputs)
+    missing = [output for output, digest in digests.items() if digest is None]
+    if key is None or missing:
+        raise SystemExit(task + " did not produce its declared outputs (or lost an input): " + " ".join(missing))
+    # The commands hash, the runtime, and the peak memory are kept for the resource model (Resource_Model.py), which sizes the task in later runs.
+    _write_json(os.path.join(stamp_dir, task + ".json"), {"key": key, "outputs": digests, "commands_hash": commands_hash, "seconds": seconds, "peak_mb": peak_memory()})
+
+
+def current(task, key, stamp_dir=STAMP_DIR):
+    # Whether a task of the manifest is up to date, as its job would find it: a task downstream of a quality gate checks the files its guard keeps, and is done
+    # when all of its outputs belong to quarantined specimens (see Quality_Gate.py).
+    inputs, outputs = task.inputs, task.outputs
+    if task.gate:
+        if not os.path.isfile(task.gate):
+            return False
+        from Quality_Gate import kept
+        inputs, outputs = kept(task.gate, inputs), kept(task.gate, outputs)
+        if task.outputs and not outputs:
+            return True
+    return uptodate(task.name, key, inputs, outputs, stamp_dir)
+
+
+def spans(indices):
+    # Compress sorted array indices into the ranges of sbatch --array (e.g., 1-3,7).
+    ranges = []
+    for index in indices:
+        if ranges and index == ranges[-1][1] + 1:
+            ranges[-1][1] = index
+        else:
+            ranges.append([index, index])
+    return ",".join(str(first) if first == last else str(first) + "-" + str(last) for first, last in ranges)
+
+
+def regenerate(graph, stale, stamp_dir=STAMP_DIR):
+    # The producers of the inputs of stale tasks that were deleted once their consumers succeeded (see Intermediate_Lifecycle.py): their release records are
+    # dropped so their jobs write the files again (an archived input is restored by the job that reads it instead). Returns the producers that were not stale.
+    producers = graph.producers()
+    regenerated = set()
+    for name in stale:
+        for path in graph.tasks[name].inputs:
+            producer = producers.get(path)
+            if producer is None or producer in stale or os.path.lexists(path):
+                continue
+            record = _read_json(release_record(path, stamp_dir))
+            if record is not None and not record.get("archive"):
+                os.remove(release_record(path, stamp_dir))
+                regenerated.add(producer)
+    return regenerated
+
+
+def pending(manifest_path, stamp_dir=STAMP_DIR):
+    """
+    Check every task of the manifest written by write_submission() against its stamp, in topological order, and print the Bash assignments the submission script
+    evaluates: DONE_<job>=1 for the jobs whose tasks are all up to date, and ARRAY_<job> (the --array option of the stale elements) and CORR_<job>=afterok for
+    the job arrays with some elements up to date. A task downstream of a stale task is stale as well, as its inputs are about to change, and the producer of
+    a deleted intermediate that a stale task reads is stale again (see regenerate).
+    """
+    manifest = _read_json(manifest_path)
+    if manifest is None:
+        raise SystemExit("Cannot read " + manifest_path + "; generate the scripts again.")
+    graph = Pipeline(manifest["name"], "", "")
+    for name, entry in manifest["tasks"].items():
+        graph.add(Task(name, [], entry["inputs"], entry["outputs"], gate=entry["gate"]))
+    dependencies = graph.dependencies()
+    order = graph.topological_order()
+    stale = set()
+    while True:
+        for name in order:
+            if name not in stale and (any(dep in stale for dep in dependencies[name]) or
+                                      not current(graph.tasks[name], manifest["tasks"][name]["key"], stamp_dir)):
+                stale.add(name)
+        producers = regenerate(graph, stale, stamp_dir)
+        if not producers:
+            break
+        stale.update(producers)
+    submitted = 0
+    for job, entry in manifest["jobs"].items():
+        first = entry["first"]
+        waiting = [offset + (first or 0) for offset, element in enumerate(entry["elements"]) if any(name in stale for name in element)]
+        if not waiting:
+            print("DONE_" + job + "=1")
+            continue
+        submitted += 1
+        if first is not None and len(waiting) < len(entry["elements"]):
+            print("ARRAY_" + job + "=--array=" + spans(waiting) + ("%" + str(entry["limit"]) if entry["limit"] else ""))
+            print("CORR_" + job + "=afterok")
+    # The summary goes to stderr, so the submission script only evaluates the assignments.
+    sys.stderr.write(str(len(graph.tasks) - len(stale)) + " of " + str(len(graph.tasks)) + " tasks are up to date; " + str(submitted) + " of " +
+                     str(len(manifest["jobs"])) + " jobs have tasks to run.\n")
+    return stale
+
+
+if __name__ == "__main__":
+
+    # @<list file> stands for the files of a list (see list_file).
+    parser = argparse.ArgumentParser(description="Content-hash stamps for pipeline tasks.", fromfile_prefix_chars='@')
+    parser.add_argument('action', choices=['uptodate', 'stamp', 'pending'])
+    parser.add_argument('task', help='Task name (pending: the manifest)')
+    parser.add_argument('commands_hash', nargs='?', help='Hash of the task command lines')
+    parser.add_argument('--inputs', nargs='*', default=[], help='Input files of the task')
+    parser.add_argument('--outputs', nargs='*', default=[], help='Output files of the task')
+    parser.add_argument('--stamps', default=STAMP_DIR, help='Stamp directory')
+    parser.add_argument('--seconds', type=int, help='Runtime of the task in seconds')
+    args = parser.parse_args()
+
+    if args.action == 'pending':
+        pending(args.task, args.stamps)
+        sys.exit(0)
+    if not args.commands_hash:
+        parser.error(args.action + " needs the commands hash")
+    if args.action == 'uptodate':
+        sys.exit(0 if uptodate(args.task, args.commands_hash, args.inputs, args.outputs, args.stamps) else 1)
+    stamp(args.task, args.commands_hash, args.inputs, args.outputs, args.stamps, args.seconds)
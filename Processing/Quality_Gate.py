@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+
+"""
+This script is the quality gate that follows a per-specimen stage of the atlas and pairwise pipelines. It quarantines the specimens whose resampled outputs
+failed to register, so they are dropped from the later stages and averages instead of pulling the average off or failing hours later.
+
+check measures every resampled specimen of the stage (e.g., lsq6/MNC/<SpecID>_lsq6.mnc) against the target of the stage (e.g., LM_average.mnc) within the
+mask, with the measures of Registration_QC.py (downsampled --downsample times), and quarantines the specimens whose cross-correlation has a robust z-score
+((value - median) / (1.4826 x median absolute deviation) across the specimens of the stage) below -threshold, or that fall below --min-xcorr. The robust
+z-scores are only used with at least MIN_SPECIMENS specimens. The state of the gate (.json) carries the specimens quarantined by the earlier gates
+(--previous-state), which are not measured again, and the report (.csv) lists the measures and the status of every specimen. A gate that would quarantine
+every specimen stops the pipeline instead.
+
+The tasks downstream of a gate (see Pipeline_DAG.py) call keep, which prints the files of its command line that do not belong to a quarantined specimen, on
+their inputs and outputs, and the job of a task without outputs left (e.g., the registration of a quarantined specimen) ends without running. The commands
+that list the files of every specimen (e.g., mincaverage) call keep on their lists as well. A file belongs to the specimen whose ID is the longest of the
+specimens of the gate (kept in its state) that its name starts with, followed by _, and a pairwise transformation (<SpecID>_to_<SpecID2>_...) to both of its
+specimens, so an ID that is a prefix of another (e.g., rg_fgfwt_105_4 and rg_fgfwt_105_4_17840) only matches its own files.
+
+python3 Quality_Gate.py check --stage <stage> --target <average> --mask <mask> --volume <lsq6/MNC/{SpecID}_lsq6.mnc> --specimens <SpecID> [<SpecID> ...]
+                              --state <state.json> --report <report.csv> [--previous-state <state.json>] [--threshold 3.5] [--min-xcorr X] [--downsample 2]
+                              [--workers N]
+python3 Quality_Gate.py keep <state.json> <file> [<file> ...] [--list <kept.txt>]    (@<list file> stands for the files of a list)
+
+Dependencies required: numpy and pyminc (pip install numpy pyminc) for check; keep only needs Python.
+"""
+
+import argparse
+import csv
+import json
+import os
+from collections import OrderedDict
+
+# Robust z-score of the cross-correlation below which (its negative) a specimen is quarantined.
+THRESHOLD = 3.5
+# Fewer specimens do not give a meaningful median absolute deviation; only --min-xcorr applies then.
+MIN_SPECIMENS = 5
+
+
+def read_state(path):
+    with open(path) as handle:
+        return json.load(handle, object_pairs_hook=OrderedDict)
+
+
+def write_state(path, state):
+    # Written to a temporary file and renamed, so the tasks downstream never read a partial state.
+    with open(path + ".tmp", 'w') as handle:
+        json.dump(state, handle, indent=1)
+    os.replace(path + ".tmp", path)
+
+
+def quarantine(path):
+    # The IDs of the specimens quarantined by the gate state at path (and by the gates before it).
+    return set(read_state(path)["quarantined"])
+
+
+def leading(name, IDs):
+    # The longest specimen ID (of the set IDs) that name starts with, followed by _, or None.
+    for end in sorted((index for index, character in enumerate(name) if character == "_"), reverse=True):
+        if name[:end] in IDs:
+            return name[:end]
+    return None
+
+
+def owners(path, IDs):
+    # The specimens a file belongs to: the specimen its name starts with, and the second specimen of a pairwise transformation (<SpecID>_to_<SpecID2>_...).
+    name = os.path.basename(path.rstrip("/"))
+    first = leading(name, IDs)
+    if first is None:
+        return []
+    rest = name[len(first):]
+    second = leading(rest[len("_to_"):], IDs) if rest.startswith("_to_") else None
+    return [first] + ([second] if second else [])
+
+
+def kept(path, files):
+    # The files that do not belong to a specimen quarantined by the gate state at path. States written before the specimens were kept in them match the
+    # quarantined IDs alone.
+    state = read_state(path)
+    quarantined = set(state["quarantined"])
+    IDs = set(state.get("specimens", ())) | quarantined
+    return [file for file in files if not any(SpecID in quarantined for SpecID in owners(file, IDs))]
+
+
+def check(stage, target, mask, volume, Specimen_IDs, state_path, report, previous_state=None, threshold=THRESHOLD, min_xcorr=None, factor=2, processes=None):
+    """
+    Measure the specimens of the stage that are not quarantined yet (volume is the path of a resampled specimen with {SpecID} for its ID) against the target,
+    quarantine the outliers, and write the state of the gate and its report.
+    """
+    import numpy as np
+    from Registration_QC import MEASURES, measure_all, robust_z
+    previous = read_state(previous_state) if previous_state else OrderedDict()
+    carried = previous.get("quarantined", OrderedDict())
+    IDs = [SpecID for SpecID in Specimen_IDs if SpecID not in carried]
+    results = measure_all(target, mask, [volume.replace("{SpecID}", SpecID) for SpecID in IDs], factor, processes=processes) if IDs else []
+    xcorr = [result[0] for result in results]
+    scores = robust_z(xcorr) if len(IDs) >= MIN_SPECIMENS else np.zeros(len(IDs))
+    quarantined = OrderedDict(carried)
+    for SpecID, value, score in zip(IDs, xcorr, scores):
+        reasons = (["xcorr z-score %.2f below -%g" % (score, threshold)] if score < -threshold else []) + (
+                   ["xcorr %.4f below %g" % (value, min_xcorr)] if min_xcorr is not None and value < min_xcorr else [])
+        if reasons:
+            quarantined[SpecID] = OrderedDict([("stage", stage), ("xcorr", value), ("z", float(score)), ("reason", "; ".join(reasons))])
+    if IDs and all(SpecID in quarantined for SpecID in IDs):
+        raise SystemExit("The " + stage + " gate would quarantine every specimen; check the target " + target + " and the mask " + mask + ".")
+    with open(report + ".tmp", 'w', newline='') as table:
+        writer = csv.writer(table)
+        writer.writerow(["ID", "stage"] + list(MEASURES) + ["xcorr_z", "status", "reason"])
+        measured = dict(zip(IDs, zip(results, scores)))
+        for SpecID in Specimen_IDs:
+            entry = quarantined.get(SpecID)
+            status = "kept" if entry is None else "quarantined" if entry["stage"] == stage else "quarantined at " + entry["stage"]
+            values = (["%.6f" % value for value in measured[SpecID][0]] + ["%.3f" % measured[SpecID][1]]) if SpecID in measured else [""] * (len(MEASURES) + 1)
+            writer.writerow([SpecID, stage] + values + [status, entry["reason"] if entry else ""])
+    os.replace(report + ".tmp", report)
+    # Every specimen of the gates so far, which keep matches the file names against.
+    specimens = list(OrderedDict.fromkeys(list(previous.get("specimens", ())) + list(Specimen_IDs)))
+    write_state(state_path, OrderedDict([("stage", stage), ("target", target), ("threshold", threshold), ("min_xcorr", min_xcorr), ("specimens", specimens),
+                                         ("quarantined", quarantined)]))
+    new = [SpecID for SpecID, entry in quarantined.items() if entry["stage"] == stage]
+    print("The " + stage + " gate measured " + str(len(IDs)) + " specimens against " + target + "; " +
+          (str(len(new)) + " quarantined: " + ", ".join(new) if new else "none quarantined") +
+          (" (" + str(len(carried)) + " quarantined earlier)" if carried else "") + ". See " + report + ".")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Quarantine the specimens that failed a stage, and drop them from the later stages.", fromfile_prefix_chars='@')
+    parser.add_argument('action', choices=['check', 'keep'])
+    parser.add_argument('paths', nargs='*', help='keep: state and files')
+    parser.add_argument('--stage', default=None, help='Stage of the gate (e.g., lsq6)')
+    parser.add_argument('--target', default=None, help='Target of the stage (e.g., LM_average.mnc)')
+    parser.add_argument('--mask', default=None, help='Mask of the target')
+    parser.add_argument('--volume', default=None, help='Resampled specimen, with {SpecID} for the specimen ID')
+    parser.add_argument('--specimens', nargs='+', default=[], help='Specimen IDs')
+    parser.add_argument('--state', default=None, help='State of the gate (.json)')
+    parser.add_argument('--report', default=None, help='Report of the gate (.csv)')
+    parser.add_argument('--previous-state', default=None, help='State of the previous gate')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD, help='Robust z-score of the cross-correlation below which a specimen is quarantined')
+    parser.add_argument('--min-xcorr', type=float, default=None, help='Cross-correlation below which a specimen is quarantined')
+    parser.add_argument('--downsample', type=int, default=2, help='Average blocks of f x f x f voxels before measuring')
+    parser.add_argument('--workers', type=int, default=None, help='Processes (the CPUs of the job by default)')
+    parser.add_argument('--list', default=None, help='keep: write the kept files to this list file and print @<list> (nothing when no file is kept)')
+    args = parser.parse_args()
+
+    if args.action == 'keep':
+        if not args.paths:
+            parser.error("keep needs the state")
+        files = kept(args.paths[0], args.paths[1:])
+        if args.list:
+            with open(args.list, 'w') as list_file:
+                list_file.write("".join(file + "\n" for file in files))
+            print("@" + args.list if files else "")
+        else:
+            print(" ".join(files))
+    elif not (args.stage and args.target and args.mask and args.volume and args.specimens and args.state and args.report):
+        parser.error("check needs --stage, --target, --mask, --volume, --specimens, --state, and --report")
+    else:
+        check(args.stage, args.target, args.mask, args.volume, args.specimens, args.state, args.report, args.previous_state, args.threshold, args.min_xcorr,
+              args.downsample, args.workers)
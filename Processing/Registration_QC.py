@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+
+"""
+This script measures how well every specimen was registered to the atlas and writes the measures of all specimens into one table, in place of one minccmp
+call per specimen appended to its own Quality/<SpecID>_Quality.txt.
+
+Every resampled specimen is compared with the atlas within the atlas mask by three measures: the cross-correlation of minccmp -xcorr (the sum of the products
+of the intensities over the square root of the product of their sums of squares), the root mean square error of the intensities, and the mutual information
+(in nats) of their joint histogram (--bins bins per axis over the intensity range of the atlas within the mask; intensities outside of the range fall into the
+edge bins). The volumes are streamed in slabs of SLAB slices, so only a few slabs are in memory at a time, and with --downsample f every block of f x f x f voxels is
+averaged first (the level of a pyramid), which divides the voxels read into the measures by f^3. The specimens are split between a pool of processes (--workers,
+by default the CPUs SLURM gave the job), and every process reads each slab of the atlas and the mask once for all of its specimens.
+
+The table (.csv) has one row per specimen: the ID, the measures, their robust z-scores ((value - median) / (1.4826 x median absolute deviation) across the
+specimens), and the outlier column, which names the measures beyond OUTLIER_Z in the direction of a poor registration (low cross-correlation and mutual
+information, high error). With --metadata, the columns of the metadata table (e.g., Metadata.csv, with the specimen IDs in --id-column) are joined to every row.
+
+python3 Registration_QC.py --atlas <atlas> --mask <mask> --volume <nl/MNC/{SpecID}_ANTS_nl.mnc> --specimens <SpecID> [<SpecID> ...] --output <table.csv>
+                           [--metadata <Metadata.csv> --id-column Biosample] [--downsample 1] [--bins 32] [--workers N]
+
+Dependencies required: numpy and pyminc (pip install numpy pyminc), which uses the libraries of the MINC Toolkit (https://bic-mni.github.io/).
+"""
+
+import argparse
+import csv
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+try:
+    from pyminc.volumes.factory import volumeFromFile
+except ImportError:
+    volumeFromFile = None
+
+# Slices of a slab (times the downsampling factor).
+SLAB = 16
+# Robust z-score beyond which a measure flags a specimen (Iglewicz and Hoaglin).
+OUTLIER_Z = 3.5
+# Direction of a poor registration for every measure.
+MEASURES = OrderedDict([("xcorr", -1), ("rmse", 1), ("mutual_information", -1)])
+
+
+def open_volume(path):
+    if volumeFromFile is None:
+        raise ImportError("Failed to import pyminc. Try 'pip install pyminc'")
+    return volumeFromFile(path, dtype='double')
+
+
+def downsample(slab, factor):
+    # The mean of every block of factor^3 voxels; the voxels beyond the last whole block of an axis are dropped.
+    if factor == 1:
+        return slab
+    z, y, x = (size // factor for size in slab.shape)
+    return slab[:z * factor, :y * factor, :x * factor].reshape(z, factor, y, factor, x, factor).mean(axis=(1, 3, 5))
+
+
+def slabs(volume, factor):
+    # The slabs of a volume (along its first dimension), downsampled.
+    sizes = list(volume.sizes[:3])
+    step = SLAB * factor
+    for start in range(0, sizes[0] - sizes[0] % factor if factor > 1 else sizes[0], step):
+        count = min(step, sizes[0] - start)
+        if factor > 1:
+            count -= count % factor
+        yield downsample(np.asarray(volume.getHyperslab([start, 0, 0], [count] + sizes[1:], dtype='double'), dtype=np.float64), factor)
+
+
+def atlas_range(atlas, mask, factor):
+    # The smallest and largest intensities of the atlas within the mask.
+    low, high = np.inf, -np.inf
+    atlas_volume, mask_volume = open_volume(atlas), open_volume(mask)
+    for atlas_slab, mask_slab in zip(slabs(atlas_volume, factor), slabs(mask_volume, factor)):
+        inside = atlas_slab[mask_slab > 0.5]
+        if inside.size:
+            low, high = min(low, inside.min()), max(high, inside.max())
+    atlas_volume.closeVolume()
+    mask_volume.closeVolume()
+    return low, high
+
+
+def measure_group(atlas, mask, paths, factor, bins, bounds):
+    """
+    The measures of a group of specimens (paths): the atlas and the mask are streamed once, and every specimen is read slab by slab alongside them. Returns a
+    list of (xcorr, rmse, mutual information).
+    """
+    atlas_volume, mask_volume = open_volume(atlas), open_volume(mask)
+    volumes = [open_volume(path) for path in paths]
+    for path, volume in zip(paths, volumes):
+        if list(volume.sizes[:3]) != list(atlas_volume.sizes[:3]):
+            raise ValueError(path + " is not on the grid of the atlas.")
+    products, atlas_squares, squares, errors, count = (np.zeros(len(paths)) for _ in range(5))
+    histograms = np.zeros((len(paths), bins, bins))
+    edges = np.linspace(bounds[0], bounds[1], bins + 1)[1:-1]
+    streams = [slabs(volume, factor) for volume in volumes]
+    for atlas_slab, mask_slab in zip(slabs(atlas_volume, factor), slabs(mask_volume, factor)):
+        inside = mask_slab > 0.5
+        reference = atlas_slab[inside]
+        reference_bins = np.searchsorted(edges, reference, side='right')
+        for index, stream in enumerate(streams):
+            values = next(stream)[inside]
+            products[index] += np.dot(reference, values)
+            atlas_squares[index] += np.dot(reference, reference)
+            squares[index] += np.dot(values, values)
+            errors[index] += np.sum((values - reference) ** 2)
+            count[index] += values.size
+            histograms[index] += np.bincount(reference_bins * bins + np.searchsorted(edges, values, side='right'), minlength=bins * bins).reshape(bins, bins)
+    for volume in [atlas_volume, mask_volume] + volumes:
+        volume.closeVolume()
+    results = []
+    for index in range(len(paths)):
+        joint = histograms[index] / max(count[index], 1)
+        marginal = np.outer(joint.sum(axis=1), joint.sum(axis=0))
+        present = joint > 0
+        information = float(np.sum(joint[present] * np.log(joint[present] / marginal[present])))
+        xcorr = products[index] / np.sqrt(atlas_squares[index] * squares[index]) if atlas_squares[index] * squares[index] > 0 else 0.0
+        results.append((float(xcorr), float(np.sqrt(errors[index] / max(count[index], 1))), information))
+    return results
+
+
+def robust_z(values):
+    # (value - median) / (1.4826 x median absolute deviation); zero for every value when the deviation is zero.
+    values = np.asarray(values, dtype=np.float64)
+    median = np.median(values)
+    deviation = 1.4826 * np.median(np.abs(values - median))
+    return (values - median) / deviation if deviation > 0 else np.zeros(len(values))
+
+
+def workers():
+    # The CPUs SLURM gave the job, or every CPU outside of SLURM.
+    return int(os.environ.get("SLURM_CPUS_ON_NODE", 0)) or os.cpu_count() or 1
+
+
+def read_metadata(path, id_column):
+    with open(path, newline='', encoding='utf-8-sig') as metadata:
+        reader = csv.DictReader(metadata)
+        return [column for column in reader.fieldnames if column != id_column], {row[id_column]: row for row in reader}
+
+
+def measure_all(atlas, mask, paths, factor=1, bins=32, processes=None):
+    # The measures of every path, with the paths split between a pool of processes (see measure_group), in the order of paths.
+    bounds = atlas_range(atlas, mask, factor)
+    processes = max(1, min(processes or workers(), len(paths)))
+    groups = [list(range(len(paths)))[index::processes] for index in range(processes)]
+    results = [None] * len(paths)
+    if processes == 1:
+        measured = [measure_group(atlas, mask, paths, factor, bins, bounds)]
+    else:
+        with ProcessPoolExecutor(processes) as pool:
+            measured = list(pool.map(measure_group, [atlas] * processes, [mask] * processes, [[paths[index] for index in group] for group in groups],
+                                     [factor] * processes, [bins] * processes, [bounds] * processes))
+    for group, group_results in zip(groups, measured):
+        for index, result in zip(group, group_results):
+            results[index] = result
+    return results
+
+
+def registration_qc(atlas, mask, volume, Specimen_IDs, output, metadata=None, id_column="Biosample", factor=1, bins=32, processes=None):
+    """Measure every specimen (volume is the path of a resampled specimen with {SpecID} for its ID) against the atlas and write the table to output."""
+    results = measure_all(atlas, mask, [volume.replace("{SpecID}", SpecID) for SpecID in Specimen_IDs], factor, bins, processes)
+    scores = OrderedDict((name, robust_z([result[position] for result in results])) for position, name in enumerate(MEASURES))
+    columns, rows = read_metadata(metadata, id_column) if metadata else ([], {})
+    with open(output + ".tmp", 'w', newline='') as table:
+        writer = csv.writer(table)
+        writer.writerow([id_column] + list(MEASURES) + [name + "_z" for name in MEASURES] + ["outlier"] + columns)
+        for index, SpecID in enumerate(Specimen_IDs):
+            flags = [name for name, sign in MEASURES.items() if sign * scores[name][index] > OUTLIER_Z]
+            writer.writerow([SpecID] + ["%.6f" % value for value in results[index]] + ["%.3f" % scores[name][index] for name in MEASURES] + [";".join(flags)] +
+                            [rows.get(SpecID, {}).get(column, "") for column in columns])
+    os.replace(output + ".tmp", output)
+    outliers = [SpecID for index, SpecID in enumerate(Specimen_IDs) if any(sign * scores[name][index] > OUTLIER_Z for name, sign in MEASURES.items())]
+    print("Measured " + str(len(Specimen_IDs)) + " specimens against the atlas" + (" (downsampled " + str(factor) + "x)" if factor > 1 else "") + "; " +
+          (str(len(outliers)) + " outliers: " + ", ".join(outliers) if outliers else "no outliers") + ".")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Measure the registration of every specimen to the atlas into one table.")
+    parser.add_argument('--atlas', required=True, help='Atlas average')
+    parser.add_argument('--mask', required=True, help='Atlas mask')
+    parser.add_argument('--volume', required=True, help='Resampled specimen, with {SpecID} for the specimen ID')
+    parser.add_argument('--specimens', nargs='+', required=True, help='Specimen IDs')
+    parser.add_argument('--output', required=True, help='Table of the measures (.csv)')
+    parser.add_argument('--metadata', default=None, help='Metadata table (.csv) joined to the measures')
+    parser.add_argument('--id-column', default="Biosample", help='Column of the specimen IDs in the metadata table')
+    parser.add_argument('--downsample', type=int, default=1, help='Average blocks of f x f x f voxels before measuring')
+    parser.add_argument('--bins', type=int, default=32, help='Bins per axis of the joint histogram of the mutual information')
+    parser.add_argument('--workers', type=int, default=None, help='Processes (the CPUs of the job by default)')
+    args = parser.parse_args()
+
+    registration_qc(args.atlas, args.mask, args.volume, args.specimens, args.output, args.metadata, args.id_column, args.downsample, args.bins, args.workers)
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+
+"""
+This module estimates what the tasks of a pipeline (see Pipeline_DAG.py) cost, so the generators can size the SLURM header (--mem and --time) of every job and
+pack short tasks into jobs of a target wall time (Pipeline.pack).
+
+The size of a task is read from the headers of its input volumes (mincinfo: the x, y, and z dimension lengths and the data type): the megavoxels it reads in
+total, which drives its runtime, and the megabytes of its largest volume held as floats, which drives its memory. A calibrated model turns the size into
+seconds and megabytes per stage family (lsq6, lsq12, nl, ...); a safety margin is added and the configured Mem/Time of the stage is the ceiling.
+
+The model is refined from recorded usage: the task stamps (Stamps/<task>.json) written on the cluster keep the runtime and the peak memory of every task, and
+the graph of the previous run (e.g., Atlas_Graph.json) keeps the size of every task. Copy the Stamps directory back next to the local scripts before
+regenerating them; a task is then estimated, in order of preference, from its own runtime and peak memory (matched on the hash of its command lines), from
+the usage of its stage per megavoxel, from the prior of its stage family, or from the median runtime and the peak memory of its stage. Without the sizes, the
+recorded usage alone sizes the jobs; the configured Mem and Time only stay in place for the tasks of a stage that has no record at all.
+"""
+
+import glob
+import json
+import math
+import os
+import statistics
+import subprocess
+from collections import OrderedDict
+
+from Pipeline_DAG import STAMP_DIR, slurm_time
+
+# Seconds of one task when neither runtimes nor the volume sizes are known.
+DEFAULT_SECONDS = 900.0
+# Seconds and megabytes of every task regardless of the volume size (loading the module, starting the tools, and stamping).
+BASE_SECONDS = 120.0
+BASE_MB = 512.0
+# Priors by stage family: (seconds per megavoxel read, memory as a multiple of the largest input held as floats). minctracc keeps the source and target, their
+# blurred copies, and gradients; the non-linear and ANTS registrations also keep the deformation grids. Registration_QC.py and the quality gates (Gate_lsq6, ...) stream their volumes in slabs.
+STAGE_MODEL = OrderedDict([("Atlas_Blur", (1.0, 4.0)), ("lsq6", (5.0, 8.0)), ("lsq12", (5.0, 8.0)), ("nl", (15.0, 12.0)), ("Label", (30.0, 16.0)), ("Registration_QC", (1.0, 0.5)), ("Gate", (1.0, 0.5))])
+DEFAULT_MODEL = (5.0, 8.0)
+# Recorded usage replaces the prior of a stage once it has this many tasks; the quantile keeps the slow and large tasks of the stage inside their headers.
+MIN_RECORDS = 3
+QUANTILE = 0.9
+# Bytes per voxel of the MINC data types reported by mincinfo -vartype.
+TYPE_BYTES = {"byte": 1, "short": 2, "int": 4, "long": 4, "float": 4, "double": 8}
+
+
+def task_stage(name):
+    # Task names are <stage>_<index> (e.g., lsq12_Third_12); other names are stages of their own.
+    stage, _, index = name.rpartition("_")
+    return stage if stage and index.isdigit() else name
+
+
+def stage_model(stage):
+    # The prior of the family of a stage (e.g., lsq12_Third -> lsq12).
+    for family, model in STAGE_MODEL.items():
+        if stage == family or stage.startswith(family + "_"):
+            return model
+    return DEFAULT_MODEL
+
+
+def mincinfo(path):
+    # Voxels and bytes per voxel of a MINC volume, read from its header. Returns None if the volume or mincinfo is missing.
+    try:
+        output = subprocess.check_output(["mincinfo", "-dimlength", "xspace", "-dimlength", "yspace", "-dimlength", "zspace", "-vartype", "image", path],
+                                         stderr=subprocess.DEVNULL, universal_newlines=True).split()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    if len(output) != 4:
+        return None
+    return int(output[0]) * int(output[1]) * int(output[2]), TYPE_BYTES.get(output[3], 4)
+
+
+def volume_sizes(Source_MNC_path, Local_MNC_path, Reference, Voxels=None, downsample=1):
+    """
+    Return a function giving the (voxels, bytes per voxel) of a volume of the pipeline. The specimens (files under Source_MNC_path) are read from their local
+    copies in Local_MNC_path; every other volume (blurred, resampled, averaged) is on the grid of Reference (e.g., LM_Avg), read from Local_MNC_path as well, or
+    else of Voxels floats. Volumes that cannot be read have the size of the reference, and no size at all if the reference cannot be read either.
+    With downsample (e.g., 2 for a preview atlas), every volume outside of Source_MNC_path has downsample^3 times fewer voxels than the reference.
+    """
+    headers = {}
+
+    def header(path):
+        if path not in headers:
+            headers[path] = mincinfo(os.path.join(Local_MNC_path, os.path.basename(path))) if Local_MNC_path else None
+        return headers[path]
+
+    def volume_size(path):
+        reference = header(Reference) or ((int(Voxels), 4) if Voxels else None)
+        if path.startswith(Source_MNC_path):
+            return header(path) or reference
+        if reference and downsample != 1:
+            return max(1, reference[0] // downsample ** 3), reference[1]
+        return reference
+    return volume_size
+
+
+def task_size(task, volume_size):
+    # (megavoxels of all .mnc inputs, megabytes of the largest .mnc input as floats); None without input volumes or without their sizes.
+    sizes = [volume_size(path) for path in task.inputs if path.endswith(".mnc")]
+    sizes = [size for size in sizes if size]
+    if not sizes:
+        return None
+    return [round(sum(voxels for voxels, _ in sizes) / 1e6, 3), round(max(voxels * max(4, width) for voxels, width in sizes) / 2.0 ** 20, 1)]
+
+
+def quantile(values, q=QUANTILE):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(math.ceil(q * len(values))) - 1)]
+
+
+class History:
+    """
+    The usage recorded by a previous run: runtimes and peak memory by commands hash and by stage, and per-stage rates (seconds per megavoxel, peak memory per
+    megabyte of volume).
+    """
+
+    def __init__(self):
+        self.seconds = {}
+        self.peak_mb = {}
+        self.stage_seconds = OrderedDict()
+        self.stage_peak_mb = OrderedDict()
+        self.rates = OrderedDict()
+        self.memory = OrderedDict()
+
+    def model(self, stage):
+        # The calibrated (seconds per megavoxel, memory multiple) of a stage; the prior stands in where fewer than MIN_RECORDS tasks were recorded.
+        prior = stage_model(stage)
+        rates, memory = self.rates.get(stage, []), self.memory.get(stage, [])
+        return (quantile(rates) if len(rates) >= MIN_RECORDS else prior[0], quantile(memory) if len(memory) >= MIN_RECORDS else prior[1])
+
+
+def read_history(stamp_dir=STAMP_DIR, graph_path=None):
+    """
+    Read the runtimes and peak memory recorded in the stamps of a previous run. With the graph of that run (graph_path), whose tasks carry their sizes, the usage
+    is also turned into per-stage rates. Returns an empty History without stamps.
+    """
+    sizes = {}
+    if graph_path and os.path.isfile(graph_path):
+        with open(graph_path) as graph:
+            sizes = dict((task["name"], task.get("size")) for task in json.load(graph)["tasks"])
+    history = History()
+    for path in sorted(glob.glob(os.path.join(stamp_dir, "*.json"))):
+        try:
+            with open(path) as handle:
+                stamp = json.load(handle)
+        except (OSError, ValueError):
+            continue
+        if not isinstance(stamp, dict) or stamp.get("seconds") is None:
+            continue
+        name = os.path.basename(path)[:-len(".json")]
+        stage, seconds = task_stage(name), float(stamp["seconds"])
+        if stamp.get("commands_hash"):
+            history.seconds[stamp["commands_hash"]] = seconds
+            if stamp.get("peak_mb"):
+                history.peak_mb[stamp["commands_hash"]] = float(stamp["peak_mb"])
+        history.stage_seconds.setdefault(stage, []).append(seconds)
+        if stamp.get("peak_mb"):
+            history.stage_peak_mb.setdefault(stage, []).append(float(stamp["peak_mb"]))
+        size = sizes.get(name)
+        if size and size[0] > 0:
+            history.rates.setdefault(stage, []).append(max(seconds - BASE_SECONDS, 0.0) / size[0])
+            if stamp.get("peak_mb"):
+                history.memory.setdefault(stage, []).append(max(float(stamp["peak_mb"]) - BASE_MB, 0.0) / size[1])
+    return history
+
+
+def estimated(task, history, size=None):
+    # Whether the runtime of a task is estimated from its size or from recorded runtimes, rather than DEFAULT_SECONDS.
+    return bool(size or task.size or task.commands_hash() in history.seconds or history.stage_seconds.get(task.stage))
+
+
+def task_cost(task, history, size=None):
+    # Estimated seconds of a task: its own past runtime, the calibrated model of its stage, the median past runtime of its stage, or DEFAULT_SECONDS.
+    seconds = history.seconds.get(task.commands_hash())
+    if seconds is not None:
+        return seconds
+    size = size or task.size
+    if size:
+        return BASE_SECONDS + history.model(task.stage)[0] * size[0]
+    if history.stage_seconds.get(task.stage):
+        return statistics.median(history.stage_seconds[task.stage])
+    return DEFAULT_SECONDS
+
+
+def task_memory(task, history, size=None):
+    # Estimated megabytes of a task: its own recorded peak, the calibrated model of its stage, the QUANTILE of the recorded peaks of its stage, or None.
+    peak = history.peak_mb.get(task.commands_hash())
+    if peak is not None:
+        return peak
+    size = size or task.size
+    if size:
+        return BASE_MB + history.model(task.stage)[1] * size[1]
+    if history.stage_peak_mb.get(task.stage):
+        return quantile(history.stage_peak_mb[task.stage])
+    return None
+
+
+def parse_mem(mem):
+    # Megabytes of a SLURM memory request (e.g., "20000M", "20G", or a bare number of megabytes).
+    units = {"K": 1.0 / 1024, "M": 1, "G": 1024, "T": 1024 * 1024}
+    mem = str(mem).strip().upper()
+    if mem[-1] in units:
+        return float(mem[:-1]) * units[mem[-1]]
+    return float(mem)
+
+
+def parse_time(time):
+    # Seconds of a SLURM wall time (e.g., "07:00:00", "1-12:00:00", or "30:00").
+    days, _, clock = str(time).rpartition("-")
+    fields = [int(field) for field in clock.split(":")]
+    while len(fields) < 3:
+        fields.insert(0, 0)
+    return (int(days) if days else 0) * 86400 + fields[0] * 3600 + fields[1] * 60 + fields[2]
+
+
+def size_pipeline(P, history, volume_size, margin=1.5):
+    """
+    Size the header of every task of P from its input volumes and the recorded usage: the estimated memory and runtime times margin, never more than the Mem
+    and Time the generator configured for the stage (which stay in place for tasks with neither a size nor records). The template of every array stage gets
+    the largest header of its tasks.
+    """
+    for task in P.tasks.values():
+        task.size = task_size(task, volume_size)
+        if task.time and estimated(task, history):
+            task.time = slurm_time(min(task_cost(task, history) * margin, parse_time(task.time)))
+        mem = task_memory(task, history)
+        if task.mem and mem is not None:
+            task.mem = str(int(math.ceil(min(mem * margin, parse_mem(task.mem))))) + "M"
+    for array in P.arrays.values():
+        tasks = [P.tasks[name] for name in array.names]
+        array.template.mem = max((task.mem for task in tasks), key=parse_mem)
+        array.template.time = max((task.time for task in tasks), key=parse_time)
@@ -0,0 +1,216 @@
+# This is a Python script designed to generate an unbiased popoulation average. The script generates a series of bash (.sh) files that should be executed in parallel on a compute cluster. Any compute cluster can be used. To run these scripts, you must install the MINC Toolkit module onto the cluster beforehand, unless one already exists. You will notice here, for example, that we use a module called "minc/1.9.15", which is defined in the Bash header of every script via "module load minc/1.9.15". SLURM identifies the software on the cluster using this line. Other parameters you can play around with are time and memory. 
+
+# The resulting Bash scripts non-linearly register mouse images of any voxel size together. Instead of hand-scaled copies of the blurring kernels and registration parameters (LoRes_Atlas.py for 35 um, HiRes_Atlas.py for 12 um), every blurring kernel, step, simplex size, and lattice diameter is derived from the declared voxel size of the images, scaling those of LoRes_Atlas.py (35 um) (see scaled_levels in Atlas_Pipeline.py). With a preview factor of 2 or 4, the scripts first downsample the images and build the whole atlas at 2x or 4x the voxel size, a draft atlas for a fraction of the core-hours of the full-resolution build; the preview lives in <PROJECT>/Preview_<factor>x, next to the full-resolution project. To execute these scripts, upload them to your remote /path/to/<PROJECT>/Scripts (or /path/to/<PROJECT>/Preview_<factor>x/Scripts) directory, and run "bash <PROJECT>_Atlas_Submission.sh" on the login node. 
+
+# To use OS dependent functionality.
+import os
+# To describe the atlas construction as a DAG of tasks and write one .sh script per task.
+from Pipeline_DAG import install
+from Intermediate_Lifecycle import report as lifecycle_report
+from Atlas_Pipeline import build_atlas_pipeline, scaled_levels
+
+#-------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
+# PLEASE READ! THE ONLY VARIABLES THAT NEED TO BE EDITED WITHIN THIS SCRIPT ARE BETWEEN THESE DASHED LINES.
+
+# 1) "<PROJECT>" should be replaced with your project name;
+# 2) Let's assume your local specimen list is called spec_list.txt;
+# 3) Name your initialized source images $spec.mnc, where $spec is the exact name of the specimen annotated in spec_list.txt; 
+# 4) Let's assume your initial average and average mask are called LM_average.mnc and LM_average_mask.mnc, respectively; if they aren't, modify the LM_Avg and LM_Avg_Mask variables.
+# 5) The initialized source images, average, and average mask must be sftp'd into your remote $PROJECT_PATH/Source/MNC directory on the cluster before any analyses can begin.
+# 6) The Bash (.sh) scripts you generate from running this Python script should be sftp'd into your remote $PROJECT_PATH/Scripts directory.
+
+# Define project name on cluster.
+PROJECT_NAME = input("Enter project name (e.g., DO): ")
+
+# Define project path on cluster.
+CLUSTER_PATH = input("Enter project path on cluster (e.g., /work/hallgrimsson_lab/): ")
+
+# Define the voxel size of the images (in um) and the preview factor.
+Resolution = float(input("Enter the voxel size of the images in um (e.g., 35): "))
+Preview_Factor = input("Enter 2 or 4 to build a preview atlas at 2x or 4x the voxel size, or leave blank to build the full-resolution atlas: ").strip()
+Preview_Factor = int(Preview_Factor) if Preview_Factor else None
+if Preview_Factor not in (None, 2, 4):
+    raise SystemExit("The preview factor must be 2, 4, or blank.")
+
+# Define full project path on cluster. The preview atlas is built in its own project directory, from the images of the full-resolution project.
+FULL_PROJECT_PATH = CLUSTER_PATH + PROJECT_NAME + "/"
+PROJECT_PATH = FULL_PROJECT_PATH + "Preview_" + str(Preview_Factor) + "x/" if Preview_Factor else FULL_PROJECT_PATH
+
+# Echo reminder to create remote directory structure.
+print("\nCreate directory structure on cluster that roughly matches your local structure. E.g.:\n")
+print(f"mkdir -p {PROJECT_PATH}{{Scripts,Telemetry,Quality,Source/{{Blurred,MNC,Orig,Resample,Tag,XFM}},lsq6/{{Blurred,MNC,XFM}},lsq12/{{Blurred,MNC,XFM}},nl/{{Ana_Test,Blurred,INIT,MNC,XFM}}}}\n")
+
+# Change the local working directory to print out scripts.
+LOCAL_SCRIPT_PATH = input("Enter path to local scripts directory (e.g., /mnt/Storage1/Hallgrimsson/Users/Jay/Workshop/Scripts/): ")
+# The preview scripts are written into their own subdirectory (e.g., Scripts/Preview_2x), as they share the names of the full-resolution scripts.
+if Preview_Factor:
+    LOCAL_SCRIPT_PATH = os.path.join(LOCAL_SCRIPT_PATH, "Preview_" + str(Preview_Factor) + "x")
+    os.makedirs(LOCAL_SCRIPT_PATH, exist_ok=True)
+os.chdir(LOCAL_SCRIPT_PATH)
+
+# Define path to list specimens Here, spec_list.txt is usually a list of 25 specimens. 
+All_Specimens = input("Enter path to listen of specimens (e.g., /mnt/Storage1/Hallgrimsson/Users/Jay/Workshop/Source/spec_list.txt): ")
+
+# Cluster parameters:
+Module = "minc/1.9.15"
+n_nodes = "1"
+lsq6_Time = "07:00:00"
+lsq6_Mem = "20000M"
+lsq12_Time = "07:00:00"
+lsq12_Mem = "20000M"
+nl_Time = "11:00:00"
+nl_Mem = "20000M"
+# Submit every per-specimen (and per-pair) stage as a single SLURM job array instead of one sbatch per script. At most Array_Concurrency elements of an array run at the same time (--array=1-N%K).
+Array_Jobs = True
+Array_Concurrency = "50"
+# Size the --mem and --time of every job from the headers of the volumes it reads (mincinfo dimensions and data type) and from the usage recorded by previous runs (the Stamps directory of the cluster, copied next to these scripts before regenerating them), times Resource_Margin; the Mem and Time above become ceilings. Local_MNC_path is a directory holding the specimens and the landmark initialized average (LM_average.mnc) (set it to Source_MNC_path when generating the scripts on the cluster); without it, the jobs are sized from Volume_Voxels (below) or from the recorded usage. Set Auto_Resources = False to use the Mem and Time above for every job.
+Auto_Resources = True
+Local_MNC_path = None
+Resource_Margin = 1.5
+
+# Echo default parameters.
+print("\nThese are the default compute cluster parameters:")
+print(f"Module: {Module}")
+print(f"Number of nodes: {n_nodes}")
+print(f"lsq6 Time: {lsq6_Time}")
+print(f"lsq6 Memory: {lsq6_Mem}")
+print(f"lsq12 Time: {lsq12_Time}")
+print(f"lsq12 Memory: {lsq12_Mem}")
+print(f"nl Time: {nl_Time}")
+print(f"nl Memory: {nl_Mem}")
+print(f"Job arrays: {Array_Jobs}")
+print(f"Job array concurrency: {Array_Concurrency}\n")
+
+# Reminder to change parameters if needed.
+print(f"They need to be changed manually if you encounter any errors. Please put these scripts into the {PROJECT_PATH}Scripts directory and all of your image data into the {PROJECT_PATH}Source/MNC/ directory. \n")
+
+#-------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
+# Define supercomputer paths.
+Scripts_path = PROJECT_PATH + "Scripts/"
+Source_XFM_path = PROJECT_PATH + "Source/XFM/"
+Source_MNC_path = PROJECT_PATH + "Source/MNC/"
+lsq6_path = PROJECT_PATH + "lsq6/"
+lsq6_Blurred_path = PROJECT_PATH + "lsq6/Blurred/"
+lsq6_XFM_path = PROJECT_PATH + "lsq6/XFM/"
+lsq6_MNC_path = PROJECT_PATH + "lsq6/MNC/"
+lsq12_path = PROJECT_PATH + "lsq12/"
+lsq12_Blurred_path = PROJECT_PATH + "lsq12/Blurred/"
+lsq12_XFM_path = PROJECT_PATH + "lsq12/XFM/"
+lsq12_MNC_path = PROJECT_PATH + "lsq12/MNC/"
+nl_Init_path = PROJECT_PATH + "nl/INIT/"
+nl_Blurred_path = PROJECT_PATH + "nl/Blurred/"
+nl_XFM_path = PROJECT_PATH + "nl/XFM/"
+nl_MNC_path = PROJECT_PATH + "nl/MNC/"
+Quality_path = PROJECT_PATH + "Quality/"
+# With Telemetry_path, every command of the scripts appends its runtime, CPU time, peak memory, exit code, and disk I/O to Telemetry_path/<task>.jsonl; copy the directory back and run "python3 Telemetry.py report <Telemetry directory> --graph Atlas_Graph.json" for the hot spots of every stage and the critical path. Recording is opt-in: set Telemetry_path (e.g., PROJECT_PATH + "Telemetry/") to record; the default None runs the commands as they are.
+Telemetry_path = None
+
+# Define average files.
+LM_Avg = Source_MNC_path + "LM_average.mnc"
+LM_Avg_Mask = Source_MNC_path + "LM_average_mask.mnc"
+lsq6_Avg = lsq6_path + PROJECT_NAME + "_lsq6_average.mnc"
+lsq12_Avg = lsq12_path + PROJECT_NAME + "_lsq12_average.mnc"
+nl_1_Avg = nl_MNC_path + "NL_1_average.mnc"
+nl_2_Avg = nl_MNC_path + "NL_2_average.mnc"
+nl_3_Avg = nl_MNC_path + "NL_3_average.mnc"
+nl_4_Avg = nl_MNC_path + PROJECT_NAME + "_Atlas.mnc"
+
+# Open and read ('r') the specimen list.
+Specimen_List=open(All_Specimens,'r')
+# Read specimen list as a single string.
+Specimens=Specimen_List.read()
+# Split the specimens by line to obtain a vector of specimen IDs.
+Specimen_IDs=Specimens.split('\n')
+# Remove the last blank entry caused by the final \n.
+del Specimen_IDs[-1]
+# Close the specimen list.
+Specimen_List.close()
+
+# Code the strings for iterative blurring via mincblur. -clobber overwrites existing files; -no apodize turns off apodization, which is designed to reduce diffraction edge effects (e.g., detector noise); -gradient calculates the change in intensity of a single pixel in the source image to the target image; -fwhm stands for full-width at half-maximum. In other words, what we want to do is convolve a "smoothing kernel", or Gaussian function, over an input volume in order to average neighboring points. The full-width at half-maximum describes the width of the Gaussian function at half of its peak to the left and right;
+MNC_Blur = "mincblur -clobber -no_apodize -gradient -fwhm "
+# Blur_Engine = "Multi_Blur" replaces the chained mincblur calls with Multi_Blur.py, which reads every volume once and writes all of its blurring kernels (separable Gaussian filtering), and only writes gradient volumes (_dxyz.mnc) where ANTS reads them. It needs numpy, scipy, and pyminc on the cluster (pip install numpy scipy pyminc), so it is opt-in; the default Blur_Engine = "mincblur" uses MNC_Blur with the MINC Toolkit alone.
+Blur_Engine = "mincblur"
+# Average_Engine = "Streaming_Average" replaces the mincaverage call at the end of every stage with Streaming_Average.py: every per-specimen job folds its resampled file into a running sum (memory-mapped, in <average>.stream next to the average) as soon as it is written, the job of the last specimen writes the average (as floats), and the average job only checks it against its inputs. The files are read from Atlas_Graph.json instead of one command line, which overflows for large cohorts. It needs numpy and pyminc on the cluster, so it is opt-in; the default Average_Engine = "mincaverage" uses MNC_Avg. With Stream_Variance = True, a variance map (<average>_variance.mnc) is written next to every average.
+# For very large cohorts (e.g., over 1,000 specimens), Average_Engine = "Tree" spreads every average over jobs instead: partial sums of Tree_Fan_In files each (<average>_tree/), combined Tree_Fan_In at a time until one job divides the total, so no job reads more than Tree_Fan_In volumes. The partial sums are compensated, so the average does not depend on Tree_Fan_In (python3 Streaming_Average.py selftest checks this).
+Average_Engine = "mincaverage"
+Stream_Variance = False
+Tree_Fan_In = 32
+# XFM_Engine = "XFM_Algebra" concatenates and inverts the transformation files with XFM_Algebra.py instead of xfmconcat and xfminvert: the linear parts are composed exactly, and the concatenated files (e.g., _origtonl_1.xfm) reference the displacement grids of the non-linear registrations instead of copying them, which saves one grid volume per specimen and transformation. The referenced grids must then stay next to their registration files. It needs numpy on the cluster and changes the format of the concatenated files, so it is opt-in; the default XFM_Engine = "xfmconcat" uses the MINC tools.
+XFM_Engine = "xfmconcat"
+# lsq12_Average_Engine = "XFM_Average" replaces the xfmavg call of every lsq12_Fourth job with one job (lsq12_XFM_Average) that reads all pairwise lsq12 transformations into one array and writes the log-Euclidean mean (the mean of the matrix logarithms, as xfmavg takes it) of every specimen with XFM_Average.py, in seconds. It needs numpy on the cluster, so it is opt-in; the default lsq12_Average_Engine = "xfmavg" uses xfmavg.
+lsq12_Average_Engine = "xfmavg"
+
+# The hierarchical registration strings call upon the minctracc command. -clobber overwrites existing files; -xcorr stands for cross-correlation, which is the similarity metric to be optimized (maximized); -lsq6 indicates that we want perform a rigid body transformation with six degrees of freedom (translation (z,y,x) and rotation (z,y,x)); -lsq12 indicates that we want to perform a 12-parameter affine transformation with twelve degrees of freedom (translation (z,y,x), rotation (z,y,x), scale (z,y,x), and shear (z,y,x)); -w_translations/rotations/scales/shear optimization weights along z,y,x; -step is the z,y,x resolution; -simplex is the optimizer; -tol is the value at which the optimization stops.
+# Beginning of mincaverage command to which .mnc files will be added.
+MNC_Avg = "mincaverage -clobber -2 -filetype -nonormalize "
+
+# Blurring kernels (full-width at half-maximum, in mm) and their registration strings, from the most to the least blurred image, derived from the voxel size of the images (of the downsampled images for a preview). Blurred files are named after the kernel size in microns (e.g., LM_average_704_blur.mnc at 70 um).
+Level_Resolution = Resolution * (Preview_Factor or 1)
+lsq6_Levels, lsq12_Levels, nl_Levels = scaled_levels(Level_Resolution)
+print("Blurring kernels (mm) for " + ("%g" % Level_Resolution) + " um voxels: lsq6 " + ", ".join(Level[0] for Level in lsq6_Levels) + "; lsq12 " +
+      ", ".join(Level[0] for Level in lsq12_Levels) + "; nl " + ", ".join(Level[0] for Level in nl_Levels) + "\n")
+
+# Pairwise lsq12 design. With lsq12_Partners = None, every specimen is registered to every specimen (N x N registrations). For large cohorts, set lsq12_Partners to k to register each specimen to only k partners and average over those, either "random" partners or "stratified" partners, which are drawn in proportion to the strata (Strata_Columns) of the metadata table (matched on its Biosample column).
+lsq12_Partners = None
+lsq12_Partner_Mode = "random"
+Metadata_CSV = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Postprocessing", "Data", "Metadata", "MusMorph_Metadata_Mar2024.csv")
+Strata_Columns = ["Experimental_Group", "Genotype"]
+# With lsq12_Symmetric = True, only one direction of every pair (A to B) is registered, and B to A is the inverse (xfminvert) of the 12-parameter transformation, which halves the pairwise registrations.
+lsq12_Symmetric = False
+# Pack the pairwise lsq12 registrations into jobs of about lsq12_Pack_Budget seconds of estimated work, instead of one job (or array element) per pair; the headers of these jobs are sized to the packed work. A pair is estimated like every job (see Auto_Resources above): from its runtime in a previous run, or from the size of its volumes. Volume_Voxels, the number of voxels of the average (the product of mincinfo -dimlength xspace, yspace, and zspace), stands in for the volume headers when Local_MNC_path is not set. Without the sizes or the runtimes of a previous run, the cost of a pair is unknown, and every pair keeps its own job. Set lsq12_Pack_Budget = None for one job per pair.
+lsq12_Pack_Budget = 4 * 3600
+Volume_Voxels = None
+# Seed of the random partner choices, so regenerating the scripts gives the same design.
+lsq12_Seed = 1
+# With k partners, the full N x N lsq12 average is also computed for lsq12_Drift_Subset random specimens, and Quality/<PROJECT>_lsq12_Drift.txt reports how far the k-partner results drift from it.
+lsq12_Drift_Subset = 10
+
+# Non-linear convergence. With nl_Convergence_Threshold (e.g., 0.002), every non-linear average is compared with the previous one and every resampled specimen with the new average, within the mask (minccmp cross-correlation), and Quality/<PROJECT>_nl_<round>_Convergence.json keeps the result. Once nl_Min_Rounds rounds are done and the average changes by less than the threshold (1 - cross-correlation), and the specimens gain less than the threshold in cross-correlation, the later rounds carry the last transformations, specimens, and average over instead of registering again. Below nl_Shorten_Threshold (3 x the threshold when None), the next round runs with half of its minctracc iterations. Set nl_Convergence_Threshold = None to always run every round in full.
+nl_Convergence_Threshold = None
+nl_Shorten_Threshold = None
+nl_Min_Rounds = 2
+# Quality gates. With Gate_Threshold (e.g., 3.5), a gate job follows the lsq6 and lsq12 stages and every non-linear round (Gate_lsq6, Gate_lsq12, Gate_nl_1, ...): every resampled specimen is compared with the target of the stage within the mask (cross-correlation of volumes downsampled Gate_Downsample times; see Quality_Gate.py), and the specimens more than Gate_Threshold robust z-scores below the others, or below Gate_Min_Xcorr, are quarantined. The later jobs of a quarantined specimen end without running, it is left out of every later average, and Quality/<PROJECT>_<stage>_Gate.csv reports the measures and the status of every specimen. Once the source of a quarantined specimen is fixed (e.g., its landmarks), rerunning the jobs measures it again. Gate_Threshold = None (the default) keeps every specimen.
+Gate_Threshold = None
+Gate_Min_Xcorr = None
+Gate_Downsample = 2
+# Incremental growth. When new specimens arrive (e.g., a new litter), add them to the specimen list and set Grow_Atlas = True: the specimens and lsq12 pairs of the previous build, read from the Atlas_Graph.json it left in this directory, keep their task names, so their stamps still hold and only the new rows and columns of the pairwise lsq12 matrix are registered (about 2 x N x m pairs for m new specimens instead of (N + m)^2) before the averages are recomputed. Keep LM_average.mnc and the files of the previous build, and use the full pairwise design (lsq12_Partners = None). With Previous_Atlas (e.g., CLUSTER_PATH + PROJECT_NAME + "/Previous_atlas.mnc", a copy of the final non-linear average of the previous build), the first non-linear round registers to the previous atlas instead of the lsq12 average, and with nl_Convergence_Threshold the later rounds are carried over once the average stops changing.
+Grow_Atlas = False
+Previous_Atlas = None
+# Intermediate files. With Lifecycle_Mode = "delete", every .mnc and .xfm file a job writes (the blurs and gradients, the lsq12 pairs, the resampled volumes of every round, ...) is deleted once the last job that reads it has succeeded (see Intermediate_Lifecycle.py), so a HiRes run fits the scratch quota; "archive" compresses it into Archive_path first. The files matching Lifecycle_Keep (fnmatch patterns on the paths or file names) are kept, and the non-linear transformations are always kept with their grids. The stamps keep the checksums of the released files, so the jobs around them stay up to date; a job that runs again restores its archived inputs, and <PROJECT>_Atlas_Submission.sh runs the jobs of deleted inputs again (with Grow_Atlas, use "archive", or the lsq12 pairs of the previous build run again). <PROJECT>_Atlas_Submission.sh prints the projected peak disk use with and without the releases before submitting. Set Lifecycle_Mode = None to keep every file.
+Lifecycle_Mode = None
+Lifecycle_Keep = ["*_average.mnc", "*_Atlas.mnc", "*_lsq6_2.xfm", "*_lsq12_AVG.xfm", "*_origtolsq12.xfm", "*_nl_4.mnc", "*_origtonl_4.xfm"]
+Archive_path = PROJECT_PATH + "Archive/"
+
+#-------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
+# Begin writing .sh scripts that will be submitted to the cluster.
+#-------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
+# Describe the lsq6, lsq12, and four non-linear stages (after the downsampling of a preview) as a DAG of tasks. Every task declares its inputs and outputs, and its script skips the work when the outputs are up to date with the task's commands and inputs (see Pipeline_DAG.py).
+Atlas = build_atlas_pipeline(dict(
+	PROJECT_NAME=PROJECT_NAME, Specimen_IDs=Specimen_IDs, Module=Module, n_nodes=n_nodes,
+	Scripts_path=Scripts_path, Source_MNC_path=Source_MNC_path, lsq6_Blurred_path=lsq6_Blurred_path, lsq6_XFM_path=lsq6_XFM_path, lsq6_MNC_path=lsq6_MNC_path,
+	lsq12_Blurred_path=lsq12_Blurred_path, lsq12_XFM_path=lsq12_XFM_path, lsq12_MNC_path=lsq12_MNC_path, nl_Init_path=nl_Init_path, nl_Blurred_path=nl_Blurred_path, nl_XFM_path=nl_XFM_path, nl_MNC_path=nl_MNC_path,
+	LM_Avg=LM_Avg, LM_Avg_Mask=LM_Avg_Mask, lsq6_Avg=lsq6_Avg, lsq12_Avg=lsq12_Avg, nl_Avgs=[nl_1_Avg, nl_2_Avg, nl_3_Avg, nl_4_Avg],
+	MNC_Blur=MNC_Blur, Blur_Engine=Blur_Engine, XFM_Engine=XFM_Engine, lsq12_Average_Engine=lsq12_Average_Engine, MNC_Avg=MNC_Avg, Average_Engine=Average_Engine, Stream_Variance=Stream_Variance, Tree_Fan_In=Tree_Fan_In, lsq6_Levels=lsq6_Levels, lsq12_Levels=lsq12_Levels, nl_Levels=nl_Levels,
+	lsq6_Mem=lsq6_Mem, lsq6_Time=lsq6_Time, lsq12_Mem=lsq12_Mem, lsq12_Time=lsq12_Time, nl_Mem=nl_Mem, nl_Time=nl_Time, Array_Jobs=Array_Jobs, Array_Concurrency=Array_Concurrency,
+	Quality_path=Quality_path, lsq12_Partners=lsq12_Partners, lsq12_Partner_Mode=lsq12_Partner_Mode, Metadata_CSV=Metadata_CSV, Strata_Columns=Strata_Columns, lsq12_Seed=lsq12_Seed, lsq12_Drift_Subset=lsq12_Drift_Subset, lsq12_Symmetric=lsq12_Symmetric,
+	nl_Convergence_Threshold=nl_Convergence_Threshold, nl_Shorten_Threshold=nl_Shorten_Threshold, nl_Min_Rounds=nl_Min_Rounds, Gate_Threshold=Gate_Threshold, Gate_Min_Xcorr=Gate_Min_Xcorr, Gate_Downsample=Gate_Downsample, Grow_Atlas=Grow_Atlas, Previous_Atlas=Previous_Atlas,
+	lsq12_Pack_Budget=lsq12_Pack_Budget, Volume_Voxels=Volume_Voxels, Auto_Resources=Auto_Resources, Local_MNC_path=Local_MNC_path, Resource_Margin=Resource_Margin, Graph_path="Atlas_Graph.json", Telemetry_path=Telemetry_path,
+	Lifecycle_Mode=Lifecycle_Mode, Lifecycle_Keep=Lifecycle_Keep, Archive_path=Archive_path,
+	Resolution=Resolution, Preview_Factor=Preview_Factor, Preview_Source_path=FULL_PROJECT_PATH + "Source/MNC/"))
+# Write one .sh script per task (or per job array), a description of the DAG (Atlas_Graph.json), and copies of Pipeline_DAG.py, Multi_Blur.py, Streaming_Average.py, Telemetry.py, Atlas_Convergence.py, XFM_Algebra.py, XFM_Average.py, Registration_QC.py, Quality_Gate.py, and Intermediate_Lifecycle.py, which the scripts call to check and stamp their tasks, to blur and average the volumes, to record their commands, to measure the convergence of the non-linear rounds, to concatenate and average the transformations, to quarantine the specimens that fail a stage, and to release the intermediate files, and the Lists directory of the tasks with more than LIST_LIMIT files (see Pipeline_DAG.py). Upload all of them to the Scripts directory.
+Atlas.write_scripts()
+Atlas.write_graph("Atlas_Graph.json")
+install(".", ("Pipeline_DAG.py", "Multi_Blur.py", "Streaming_Average.py", "Telemetry.py", "Atlas_Convergence.py", "XFM_Algebra.py", "XFM_Average.py", "Registration_QC.py", "Quality_Gate.py", "Intermediate_Lifecycle.py"))
+
+#-------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
+# Create the master job submission script. It submits every .sh script once, and SLURM starts each job as soon as the jobs that produce its inputs have finished (--dependency=afterok, or aftercorr between the elements of two job arrays).
+# In other words, only <PROJECT>_Atlas_Submission.sh needs to be run, on the login node (bash <PROJECT>_Atlas_Submission.sh); there are no submission jobs polling the queue.
+# It also writes <PROJECT>_Atlas_Manifest.json (upload it with the scripts), the expected outputs of every task: rerunning <PROJECT>_Atlas_Submission.sh after a crash or a node failure (once the jobs left in the queue are cancelled) only submits the jobs, and the job array elements, whose tasks are missing or stale, and generating the scripts again in the same directory removes the scripts that are no longer part of the pipeline (the scripts of the other pipelines in the directory, which have their own submission scripts and manifests, are kept).
+#-------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
+Atlas.write_submission()
+# With Lifecycle_Mode, it also writes Lifecycle.json (upload it with the scripts), the intermediates every job releases; the projected peak disk use of the run:
+if Atlas.lifecycle:
+    print(lifecycle_report(Atlas.lifecycle))
+
+# Without a cluster (e.g., a pilot on a workstation), set the project paths above to local paths and run the same jobs with a local pool of processes, bounded by the cores and the declared memory:
+# python3 Local_Executor.py graph Atlas_Graph.json --cores 64    (or: python3 Local_Executor.py slurm <PROJECT>_Atlas_Submission.sh, which runs <PROJECT>_Atlas_Submission.sh with stand-ins for sbatch and squeue)
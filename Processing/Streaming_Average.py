@@ -0,0 +1,487 @@
+#!/usr/bin/env python3
+
+"""
+This script averages the resampled specimens of an atlas stage as they arrive, in place of one mincaverage call over all of them at the end of the stage.
+
+Every per-specimen task folds its resampled volume into a running sum as soon as it is written (add), slab by slab, into memory-mapped arrays kept next to the
+average (<average>.stream/): the sum, optionally the sum of squares for a variance map, and the list of the volumes already added with their content hashes
+(the hashes of the stamps, see Pipeline_DAG.py). The task that adds the last volume of the stage writes the average right away. The average task of the stage
+then only checks the accumulator against its inputs (finalize): it rewrites the average if it is missing, and streams every volume again if one was rerun
+after it was added or was never added (e.g., its task was up to date), so the average always matches its inputs. The volumes are read from the graph of the
+pipeline instead of the command line, which long specimen lists would overflow. With the state of a quality gate (--gate, see Quality_Gate.py), the volumes
+of the quarantined specimens are left out of the average, and finalize subtracts the ones already added from the sums.
+
+For very large cohorts, the average can also be reduced as a tree across jobs (Average_Engine = "Tree"): every leaf job sums a group of volumes into a partial
+sum (partial), every inner job combines a group of partial sums (combine), and the root divides the total by the count. Partial sums are directories of
+memory-mapped float64 arrays with a compensation term (the rounding error of every addition, as in Kahan summation), so the total does not depend on the shape
+of the tree to float64 precision, and the float average written is the same for every fan-in; selftest checks this against the single-shot average, running
+partial and combine end to end on volumes stored as arrays.
+
+python3 Streaming_Average.py add <average> <volume> [--variance] [--graph Atlas_Graph.json --task <average task> --stage <specimen stage>] [--gate <state>]
+python3 Streaming_Average.py finalize <average> --graph Atlas_Graph.json --task <average task> --stage <specimen stage> [--variance] [--gate <state>]
+python3 Streaming_Average.py partial <partial sum> <volume> [<volume> ...] [--variance]
+python3 Streaming_Average.py combine <partial sum or average .mnc> <partial sum> [<partial sum> ...]
+python3 Streaming_Average.py selftest
+
+Dependencies required: numpy and pyminc (pip install numpy pyminc), which uses the libraries of the MINC Toolkit (https://bic-mni.github.io/). Concurrent adds
+are serialized with a lock file (fcntl); on a file system without locks, the volumes are only averaged by finalize.
+"""
+
+import argparse
+import fcntl
+import json
+import os
+import tempfile
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+try:
+    from pyminc.volumes.factory import volumeFromFile, volumeLikeFile
+except ImportError:
+    # selftest runs without pyminc; every command that reads or writes volumes needs it.
+    volumeFromFile = volumeLikeFile = None
+
+from Pipeline_DAG import file_digest
+
+# Slices (along the first dimension) read from a volume at once; with float64 sums, a slab of a 1000^2 slice grid takes 8 MB per slice.
+SLAB = 16
+
+
+def accumulator_path(average):
+    return average + ".stream"
+
+
+def variance_path(average):
+    # The variance map written next to the average (e.g., NL_1_average_variance.mnc).
+    return average[:-len(".mnc")] + "_variance.mnc"
+
+
+@contextmanager
+def locked(accumulator):
+    # Hold the lock of the accumulator, so the array elements of a stage add their volumes one at a time. Yields False on a file system without locks.
+    os.makedirs(accumulator, exist_ok=True)
+    with open(os.path.join(accumulator, "lock"), 'w') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        except OSError as error:
+            print("The accumulator " + accumulator + " cannot be locked (" + str(error) + ").")
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def read_state(accumulator):
+    path = os.path.join(accumulator, "state.json")
+    if not os.path.isfile(path):
+        return None
+    with open(path) as handle:
+        return json.load(handle, object_pairs_hook=OrderedDict)
+
+
+def write_state(accumulator, state):
+    # Written to a temporary file and renamed, so a job killed mid-write leaves the previous state.
+    path = os.path.join(accumulator, "state.json")
+    with open(path + ".tmp", 'w') as handle:
+        json.dump(state, handle, indent=1)
+    os.replace(path + ".tmp", path)
+
+
+def new_state(accumulator, sizes, variance):
+    # An empty accumulator for volumes of the given dimension sizes. The sums are recreated in place; the lock file stays, as other jobs may be waiting on it.
+    for name in ["sum"] + (["sumsq"] if variance else []):
+        np.lib.format.open_memmap(os.path.join(accumulator, name + ".npy"), mode='w+', dtype=np.float64, shape=tuple(sizes)).flush()
+    if not variance and os.path.isfile(os.path.join(accumulator, "sumsq.npy")):
+        os.remove(os.path.join(accumulator, "sumsq.npy"))
+    return OrderedDict([("sizes", list(sizes)), ("variance", variance), ("stale", False), ("added", OrderedDict()), ("finalized", None)])
+
+
+def fold(accumulator, volume_path, variance, sign=1.0):
+    # Add (or, with a sign of -1, subtract) a volume to the sums, one slab of slices at a time, so only a slab of the volume is in memory.
+    volume = open_volume(volume_path)
+    sizes = [int(size) for size in volume.sizes[:3]]
+    total = np.load(os.path.join(accumulator, "sum.npy"), mmap_mode='r+')
+    squares = np.load(os.path.join(accumulator, "sumsq.npy"), mmap_mode='r+') if variance else None
+    if list(total.shape) != sizes:
+        volume.closeVolume()
+        raise SystemExit(volume_path + " does not have the dimensions of the accumulator " + str(list(total.shape)) + ".")
+    for start in range(0, sizes[0], SLAB):
+        count = min(SLAB, sizes[0] - start)
+        slab = np.asarray(volume.getHyperslab((start, 0, 0), (count, sizes[1], sizes[2])), dtype=np.float64)
+        total[start:start + count] += sign * slab
+        if squares is not None:
+            squares[start:start + count] += sign * slab * slab
+    volume.closeVolume()
+    total.flush()
+    if squares is not None:
+        squares.flush()
+
+
+def open_volume(volume_path):
+    if volumeFromFile is None:
+        raise ImportError("Failed to import pyminc. Try 'pip install pyminc'")
+    return volumeFromFile(volume_path, dtype='double')
+
+
+def volume_sizes(volume_path):
+    volume = open_volume(volume_path)
+    sizes = [int(size) for size in volume.sizes[:3]]
+    volume.closeVolume()
+    return sizes
+
+
+def stage_volumes(graph_path, task, stage):
+    # The volumes the average task reads that the tasks of the specimen stage write, in the order of the task's inputs.
+    with open(graph_path) as graph:
+        tasks = json.load(graph)["tasks"]
+    written = set(output for entry in tasks if entry["stage"] == stage for output in entry["outputs"])
+    inputs = next(entry["inputs"] for entry in tasks if entry["name"] == task)
+    return [path for path in inputs if path in written and path.endswith(".mnc")]
+
+
+def gated_volumes(gate, volumes):
+    # The volumes of the specimens that the quality gate state gate did not quarantine (see Quality_Gate.py).
+    if not gate:
+        return volumes
+    from Quality_Gate import kept
+    return kept(gate, volumes)
+
+
+def drop(accumulator, state, volumes):
+    # Subtract the added volumes that are no longer volumes of the stage (e.g., quarantined by its quality gate) from the sums, as long as they still have the
+    # content that was added; otherwise the accumulator is marked stale.
+    for path in [path for path in state["added"] if path not in volumes]:
+        if state["stale"] or file_digest(path) != state["added"][path]:
+            state["stale"] = True
+            return
+        fold(accumulator, path, state["variance"], -1.0)
+        del state["added"][path]
+
+
+def write_average(accumulator, state, average, like):
+    # Write the mean (and, with the sums of squares, the variance) of the added volumes with the header of one of them. The float64 sums are divided one slab
+    # at a time, so only the float output is held in memory.
+    total = np.load(os.path.join(accumulator, "sum.npy"), mmap_mode='r')
+    squares = np.load(os.path.join(accumulator, "sumsq.npy"), mmap_mode='r') if state["variance"] else None
+    write_statistics(average, like, len(state["added"]), lambda start, end: total[start:end], lambda start, end: squares[start:end] if squares is not None else None,
+                     total.shape[0])
+    state["finalized"] = OrderedDict(state["added"])
+    write_state(accumulator, state)
+
+
+def write_statistics(average, like, count, total, squares, length):
+    # Write the mean (and the variance, when squares gives slabs) of count volumes from the slabs of their sums (total(start, end)), one slab at a time.
+    if volumeLikeFile is None:
+        raise ImportError("Failed to import pyminc. Try 'pip install pyminc'")
+    mean = volumeLikeFile(like, average, dtype='float', volumeType='float')
+    variance = volumeLikeFile(like, variance_path(average), dtype='float', volumeType='float') if squares(0, 1) is not None else None
+    for start in range(0, length, SLAB):
+        end = min(start + SLAB, length)
+        slab = total(start, end) / count
+        mean.data[start:end] = slab
+        if variance is not None:
+            variance.data[start:end] = np.maximum(squares(start, end) / count - slab * slab, 0.0)
+    for volume in [mean] + ([variance] if variance is not None else []):
+        volume.writeFile()
+        volume.closeVolume()
+
+
+def complete(state, volumes):
+    # Whether the accumulator holds exactly the current content of the volumes of the stage.
+    return (not state["stale"] and set(state["added"]) == set(volumes) and all(state["added"][path] == file_digest(path) for path in volumes))
+
+
+def add(average, volume_path, variance=False, graph_path=None, task=None, stage=None, gate=None):
+    """
+    Fold volume_path into the running sums of average. A volume added again with the same content is ignored; with a new content (a rerun), the sums can no
+    longer be corrected, so the accumulator is marked stale and finalize streams every volume again. With the graph, the task, and the stage, the add that
+    completes the stage (less the specimens quarantined by the gate state gate) also writes the average.
+    """
+    accumulator = accumulator_path(average)
+    digest = file_digest(volume_path)
+    with locked(accumulator) as held:
+        # Without a lock, the volume is left to finalize, which runs alone.
+        if not held:
+            return
+        state = read_state(accumulator)
+        if state is None or state["variance"] != variance:
+            state = new_state(accumulator, volume_sizes(volume_path), variance)
+        if volume_path in state["added"]:
+            if state["added"][volume_path] == digest:
+                return
+            state["stale"] = True
+        else:
+            fold(accumulator, volume_path, variance)
+        state["added"][volume_path] = digest
+        state["added"] = OrderedDict(sorted(state["added"].items()))
+        write_state(accumulator, state)
+        if graph_path and task and stage:
+            volumes = gated_volumes(gate, stage_volumes(graph_path, task, stage))
+            if complete(state, volumes):
+                print("The last volume of " + stage + " arrived; writing " + average + ".")
+                write_average(accumulator, state, average, volumes[0])
+
+
+def finalize(average, graph_path, task, stage, variance=False, gate=None):
+    """
+    Make average (and, with variance, <average>_variance.mnc) the mean (and variance) of the volumes of the stage, less those of the specimens quarantined by
+    the gate state gate, whose volumes are subtracted from the sums. An average written by the last add is kept; otherwise the accumulator is rebuilt by
+    streaming every volume when it does not hold exactly the current volumes.
+    """
+    accumulator = accumulator_path(average)
+    volumes = gated_volumes(gate, stage_volumes(graph_path, task, stage))
+    with locked(accumulator):
+        state = read_state(accumulator)
+        if state is not None and state["variance"] == variance:
+            drop(accumulator, state, volumes)
+        if state is None or state["variance"] != variance or not complete(state, volumes):
+            print("Streaming the " + str(len(volumes)) + " volumes of " + stage + " into " + accumulator + ".")
+            state = new_state(accumulator, volume_sizes(volumes[0]), variance)
+            for path in volumes:
+                fold(accumulator, path, state["variance"])
+                state["added"][path] = file_digest(path)
+            state["added"] = OrderedDict(sorted(state["added"].items()))
+            write_state(accumulator, state)
+        outputs = [average] + ([variance_path(average)] if variance else [])
+        if state["finalized"] != state["added"] or not all(os.path.isfile(output) for output in outputs):
+            write_average(accumulator, state, average, volumes[0])
+
+
+#-------------------------------------------------------------------------------------------------------------------------------------------------------------
+# Tree reduction.
+#-------------------------------------------------------------------------------------------------------------------------------------------------------------
+def two_sum(a, b):
+    # The sum of two arrays and its exact rounding error (Knuth's TwoSum): a + b == s + e exactly.
+    s = a + b
+    bb = s - a
+    return s, (a - (s - bb)) + (b - bb)
+
+
+def partial_arrays(partial, sizes=None, variance=False):
+    # The memory-mapped (sum, compensation) pairs of a partial sum directory, for the values and, with variance, their squares; new (zeros) with sizes.
+    names = [("sum", "sum_error")] + ([("sumsq", "sumsq_error")] if variance else [])
+    if sizes is not None:
+        os.makedirs(partial, exist_ok=True)
+        return [tuple(np.lib.format.open_memmap(os.path.join(partial, name + ".npy"), mode='w+', dtype=np.float64, shape=tuple(sizes)) for name in pair)
+                for pair in names]
+    return [tuple(np.load(os.path.join(partial, name + ".npy"), mmap_mode='r') for name in pair) for pair in names]
+
+
+def read_meta(partial):
+    with open(os.path.join(partial, "meta.json")) as handle:
+        return json.load(handle, object_pairs_hook=OrderedDict)
+
+
+def write_meta(partial, meta):
+    # Written last, as the declared output of the job: a partial sum is complete once its meta.json exists.
+    with open(os.path.join(partial, "meta.json.tmp"), 'w') as handle:
+        json.dump(meta, handle, indent=1)
+    os.replace(os.path.join(partial, "meta.json.tmp"), os.path.join(partial, "meta.json"))
+
+
+def reduce_slabs(sources, pairs, length):
+    """
+    Add the slabs of every source into the (sum, compensation) pairs. A source is a function (start, end) -> a list of slabs, one per pair; the slabs of a
+    partial sum are (sum, compensation) tuples, those of a volume are plain values. Every addition keeps its rounding error in the compensation.
+    """
+    for start in range(0, length, SLAB):
+        end = min(start + SLAB, length)
+        totals = [(np.zeros_like(total[start:end]), np.zeros_like(total[start:end])) for total, _ in pairs]
+        for source in sources:
+            for index, slab in enumerate(source(start, end)):
+                value, error = slab if isinstance(slab, tuple) else (slab, 0.0)
+                total, compensation = totals[index]
+                total[...], rounding = two_sum(total, value)
+                compensation += rounding + error
+        for (total, compensation), (slab_total, slab_compensation) in zip(pairs, totals):
+            total[start:end] = slab_total
+            compensation[start:end] = slab_compensation
+    for total, compensation in pairs:
+        total.flush()
+        compensation.flush()
+
+
+def volume_source(volume_path, variance):
+    # The slabs (values, and squares with variance) of a volume, read one slab at a time.
+    volume = open_volume(volume_path)
+    sizes = [int(size) for size in volume.sizes[:3]]
+
+    def slabs(start, end):
+        slab = np.asarray(volume.getHyperslab((start, 0, 0), (end - start, sizes[1], sizes[2])), dtype=np.float64)
+        return [slab] + ([slab * slab] if variance else [])
+    return slabs, volume
+
+
+def partial_source(partial, variance):
+    pairs = partial_arrays(partial, variance=variance)
+    return lambda start, end: [(total[start:end], compensation[start:end]) for total, compensation in pairs]
+
+
+def partial(output, volumes, variance=False):
+    # Sum a group of volumes into the partial sum directory output (a leaf of the tree). A group left empty by a quality gate gives an empty partial sum.
+    if not volumes:
+        os.makedirs(output, exist_ok=True)
+        write_meta(output, OrderedDict([("sizes", None), ("variance", variance), ("count", 0), ("volumes", OrderedDict())]))
+        return
+    sizes = volume_sizes(volumes[0])
+    pairs = partial_arrays(output, sizes, variance)
+    sources = [volume_source(path, variance) for path in volumes]
+    reduce_slabs([slabs for slabs, _ in sources], pairs, sizes[0])
+    for _, volume in sources:
+        volume.closeVolume()
+    write_meta(output, OrderedDict([("sizes", sizes), ("variance", variance), ("count", len(volumes)),
+                                    ("volumes", OrderedDict((path, file_digest(path)) for path in volumes))]))
+
+
+def combine(output, partials):
+    """
+    Combine partial sums: into the partial sum directory output (an inner node of the tree), or, for an output ending in .mnc, into the average (and the
+    variance map, when the partial sums have squares) with the header of the first volume (the root of the tree).
+    """
+    # Empty partial sums (groups left empty by a quality gate) are skipped; an inner node whose partial sums are all empty is empty as well.
+    metas = OrderedDict((path, read_meta(path)) for path in partials)
+    variance = all(meta["variance"] for meta in metas.values())
+    partials = [path for path, meta in metas.items() if meta["count"]]
+    if not partials and output.endswith(".mnc"):
+        raise SystemExit("The partial sums of " + output + " are all empty.")
+    if not partials:
+        os.makedirs(output, exist_ok=True)
+        write_meta(output, OrderedDict([("sizes", None), ("variance", variance), ("count", 0), ("volumes", OrderedDict())]))
+        return
+    metas = [metas[path] for path in partials]
+    sizes = metas[0]["sizes"]
+    if any(meta["sizes"] != sizes for meta in metas):
+        raise SystemExit("The partial sums " + " ".join(partials) + " do not have the same dimensions.")
+    volumes = OrderedDict((path, digest) for meta in metas for path, digest in meta["volumes"].items())
+    sources = [partial_source(path, variance) for path in partials]
+    if not output.endswith(".mnc"):
+        reduce_slabs(sources, partial_arrays(output, sizes, variance), sizes[0])
+        write_meta(output, OrderedDict([("sizes", sizes), ("variance", variance), ("count", len(volumes)), ("volumes", volumes)]))
+        return
+    # The root reduces into a temporary directory next to the average, and the compensation is added back once, in float64, before the division.
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(output))) as root:
+        pairs = partial_arrays(root, sizes, variance)
+        reduce_slabs(sources, pairs, sizes[0])
+        write_statistics(output, next(iter(volumes)), len(volumes), lambda start, end: pairs[0][0][start:end] + pairs[0][1][start:end],
+                         lambda start, end: pairs[1][0][start:end] + pairs[1][1][start:end] if variance else None, sizes[0])
+
+
+def tree_groups(items, fan_in):
+    # Split items into consecutive groups of at most fan_in items, as even as possible (e.g., 10 items with a fan-in of 4: 4, 3, 3).
+    count = -(-len(items) // fan_in)
+    size, extra = divmod(len(items), count)
+    groups, start = [], 0
+    for index in range(count):
+        end = start + size + (index < extra)
+        groups.append(items[start:end])
+        start = end
+    return groups
+
+
+class ArrayVolume:
+    """
+    A stand-in for the pyminc volumes of selftest: a volume is a .npy array saved under its .mnc name, read by hyperslabs and written from its data array.
+    """
+
+    def __init__(self, path, like=None):
+        self.path = path
+        self.data = np.zeros(np.load(like).shape, dtype=np.float32) if like else np.load(path, mmap_mode='r')
+        self.sizes = list(self.data.shape)
+
+    def getHyperslab(self, start, count):
+        return np.array(self.data[tuple(slice(first, first + length) for first, length in zip(start, count))])
+
+    def writeFile(self):
+        with open(self.path, 'wb') as handle:
+            np.save(handle, self.data)
+
+    def closeVolume(self):
+        pass
+
+
+@contextmanager
+def array_volumes(directory):
+    # Read and write the volumes as ArrayVolume, in directory (where the digests of the volumes are cached), for as long as the context lasts.
+    global open_volume, volumeLikeFile
+    saved, cwd = (open_volume, volumeLikeFile), os.getcwd()
+    open_volume = ArrayVolume
+    volumeLikeFile = lambda like, path, dtype=None, volumeType=None: ArrayVolume(path, like)
+    os.chdir(directory)
+    try:
+        yield
+    finally:
+        open_volume, volumeLikeFile = saved
+        os.chdir(cwd)
+
+
+def selftest(count=23, sizes=(37, 6, 5), seed=1):
+    """
+    Check the tree reduction against the single-shot average (the float64 mean and variance of all volumes at once): random volumes with a wide dynamic range
+    are written to disk and reduced end to end with partial and combine (stand-ins replacing pyminc, see ArrayVolume), with every fan-in from 2 to count and
+    an empty group among the leaves (a group left empty by a quality gate). Every tree must write the same float average and variance, within float tolerance
+    of the single-shot ones.
+    """
+    rng = np.random.default_rng(seed)
+    arrays = [rng.lognormal(6.0, 2.0, sizes) * rng.choice([-1.0, 1.0], sizes) for _ in range(count)]
+    single, spread = np.mean(np.stack(arrays), axis=0), np.var(np.stack(arrays), axis=0)
+    results = OrderedDict()
+    with tempfile.TemporaryDirectory() as directory, array_volumes(directory):
+        volumes = []
+        for index, array in enumerate(arrays):
+            volumes.append(os.path.join(directory, "volume_%d.mnc" % index))
+            with open(volumes[-1], 'wb') as handle:
+                np.save(handle, array)
+        for fan_in in range(2, count + 1):
+            level = []
+            for index, group in enumerate(tree_groups(volumes, fan_in) + [[]]):
+                level.append(os.path.join(directory, "%d_leaf_%d" % (fan_in, index)))
+                partial(level[-1], group, variance=True)
+            depth = 0
+            while len(level) > fan_in:
+                depth += 1
+                groups, level = tree_groups(level, fan_in), []
+                for index, group in enumerate(groups):
+                    level.append(os.path.join(directory, "%d_node_%d_%d" % (fan_in, depth, index)))
+                    combine(level[-1], group)
+            average = os.path.join(directory, "%d_average.mnc" % fan_in)
+            combine(average, level)
+            results[fan_in] = (np.load(average), np.load(variance_path(average)))
+    reference = results[count]
+    failures = [fan_in for fan_in, result in results.items() if not (np.array_equal(result[0], reference[0]) and np.array_equal(result[1], reference[1]))]
+    error = float(np.max(np.abs(reference[0].astype(np.float64) - single) / np.maximum(np.abs(single), 1e-300)))
+    variance_error = float(np.max(np.abs(reference[1].astype(np.float64) - spread) / np.maximum(spread, 1e-300)))
+    print("Reduced " + str(count) + " volumes of " + "x".join(str(size) for size in sizes) + " voxels with partial and combine, fan-ins 2 to " + str(count) + ": " +
+          ("identical float averages and variances" if not failures else "float averages differ for fan-ins " + ", ".join(str(fan_in) for fan_in in failures)) +
+          "; largest relative difference to the single-shot average " + "%.2e" % error + ", and to its variance " + "%.2e" % variance_error + ".")
+    return not failures and error < 1e-6 and variance_error < 1e-6
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Average the resampled specimens of a stage as they arrive, or as a tree of partial sums.")
+    parser.add_argument('action', choices=['add', 'finalize', 'partial', 'combine', 'selftest'])
+    parser.add_argument('paths', nargs='*', help='add: average and volume; finalize: average; partial: partial sum and volumes; combine: output and partial sums')
+    parser.add_argument('--variance', action='store_true', help='Also sum the squares and write the variance map (<average>_variance.mnc)')
+    parser.add_argument('--graph', default=None, help='Graph of the pipeline (e.g., Atlas_Graph.json)')
+    parser.add_argument('--task', default=None, help='Average task of the stage in the graph (e.g., nl_Third)')
+    parser.add_argument('--stage', default=None, help='Stage whose outputs are averaged (e.g., nl_Second)')
+    parser.add_argument('--gate', default=None, help='State of the quality gate whose quarantined specimens are left out (see Quality_Gate.py)')
+    args = parser.parse_args()
+
+    if args.action == 'selftest':
+        raise SystemExit(0 if selftest() else 1)
+    if len(args.paths) < (1 if args.action in ('finalize', 'partial') else 2):
+        parser.error(args.action + " needs more paths")
+    if args.action == 'add':
+        add(args.paths[0], args.paths[1], args.variance, args.graph, args.task, args.stage, args.gate)
+    elif args.action == 'finalize':
+        if not (args.graph and args.task and args.stage):
+            parser.error("finalize needs --graph, --task, and --stage")
+        finalize(args.paths[0], args.graph, args.task, args.stage, args.variance, args.gate)
+    elif args.action == 'partial':
+        partial(args.paths[0], args.paths[1:], args.variance)
+    else:
+        combine(args.paths[0], args.paths[1:])
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+
+"""
+This script records what every command of the generated job scripts costs, and reports where the time of a pipeline goes.
+
+When the generator sets Telemetry_path, every command of a task runs under this script (see Pipeline.command in Pipeline_DAG.py), which appends one JSON line
+per command to <Telemetry_path>/<task>.jsonl: the task, stage, and specimen, the command name (e.g., minctracc), the start, wall, and CPU time in seconds,
+the peak resident memory in megabytes, the exit code, and the bytes read from and written to disk. The command's own exit code is returned, so the scripts
+stop at a failing command as before.
+
+python3 Telemetry.py run <Telemetry_path> <task> <stage> <specimen> -- <command>
+
+Copy the Telemetry directory back from the cluster to report the hot spots of every stage (commands ranked by their total wall time), the timeline of the
+stages, and, with the graph written by the generator, the critical path of the run (the chain of dependent tasks that took the longest):
+
+python3 Telemetry.py report /path/to/Telemetry [--graph /path/to/Scripts/Atlas_Graph.json] [--top 10]
+"""
+
+import argparse
+import glob
+import json
+import os
+import resource
+import shlex
+import socket
+import subprocess
+import sys
+import time
+from collections import OrderedDict
+
+# Width, in characters, of the timeline bars of the report.
+BAR_WIDTH = 50
+
+
+def command_name(command):
+    # The program a command line runs (e.g., minctracc), with the script name for Python scripts (e.g., python3 Multi_Blur.py).
+    try:
+        words = shlex.split(command)
+    except ValueError:
+        words = command.split()
+    if not words:
+        return ""
+    name = os.path.basename(words[0])
+    if name.startswith("python") and len(words) > 1:
+        return name + " " + os.path.basename(words[1])
+    return name
+
+
+def job_id():
+    # The SLURM job (and array element) running the command, or the process of the script outside of SLURM (e.g., under Local_Executor.py).
+    if "SLURM_JOB_ID" in os.environ:
+        return os.environ["SLURM_JOB_ID"] + ("_" + os.environ["SLURM_ARRAY_TASK_ID"] if "SLURM_ARRAY_TASK_ID" in os.environ else "")
+    return socket.gethostname() + "_" + str(os.getppid())
+
+
+def run(directory, task, stage, specimen, command):
+    """
+    Run a command line with Bash and append its record to <directory>/<task>.jsonl. Returns the exit code of the command (128 + N for a signal N, like Bash).
+    The peak memory is the largest resident set of the processes of the command, and the disk I/O counts the 512-byte blocks of the kernel's accounting.
+    """
+    before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.time()
+    code = subprocess.call(["bash", "-c", command])
+    wall = time.time() - start
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    code = 128 - code if code < 0 else code
+    record = OrderedDict([("task", task), ("stage", stage), ("specimen", specimen or None), ("command", command_name(command)),
+                          ("start", round(start, 3)), ("wall", round(wall, 3)),
+                          ("cpu", round(after.ru_utime - before.ru_utime + after.ru_stime - before.ru_stime, 3)),
+                          ("peak_rss_mb", round(after.ru_maxrss / 1024.0, 1)), ("exit_code", code),
+                          ("read_bytes", (after.ru_inblock - before.ru_inblock) * 512), ("write_bytes", (after.ru_oublock - before.ru_oublock) * 512),
+                          ("job", job_id())])
+    # A full disk or a missing directory must not fail the task, only its record.
+    try:
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, task + ".jsonl"), 'a') as records:
+            records.write(json.dumps(record) + "\n")
+    except OSError as error:
+        print("Telemetry record of " + task + " not written: " + str(error), file=sys.stderr)
+    return code
+
+
+def read_records(directory):
+    # Every record of the telemetry directory, in the order the commands started.
+    records = []
+    for path in sorted(glob.glob(os.path.join(directory, "*.jsonl"))):
+        with open(path) as handle:
+            for line in handle:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+    return sorted(records, key=lambda record: record["start"])
+
+
+def latest_runs(records):
+    # Keep the records of the last job that ran every task, so tasks that were rerun (e.g., after a failure or a parameter change) count once.
+    last = {}
+    for record in records:
+        last[record["task"]] = record["job"]
+    return [record for record in records if last[record["task"]] == record["job"]]
+
+
+def task_spans(records):
+    # (start, end) of every task from the first start to the last end of its commands.
+    spans = OrderedDict()
+    for record in records:
+        start, end = spans.get(record["task"], (record["start"], record["start"] + record["wall"]))
+        spans[record["task"]] = (min(start, record["start"]), max(end, record["start"] + record["wall"]))
+    return spans
+
+
+def hot_spots(records):
+    # Per stage, the commands ranked by their total wall time: [(stage, total wall, [(command, runs, total, mean, max, CPU, peak RSS, read, written, failures)])].
+    stages = OrderedDict()
+    for record in records:
+        stats = stages.setdefault(record["stage"], OrderedDict()).setdefault(record["command"], [0, 0.0, 0.0, 0.0, 0.0, 0, 0, 0])
+        stats[0] += 1
+        stats[1] += record["wall"]
+        stats[2] = max(stats[2], record["wall"])
+        stats[3] += record["cpu"]
+        stats[4] = max(stats[4], record["peak_rss_mb"])
+        stats[5] += record["read_bytes"]
+        stats[6] += record["write_bytes"]
+        stats[7] += record["exit_code"] != 0
+    table = []
+    for stage, commands in stages.items():
+        rows = [(command, runs, total, total / runs, longest, cpu, rss, read, written, failures)
+                for command, (runs, total, longest, cpu, rss, read, written, failures) in commands.items()]
+        rows.sort(key=lambda row: -row[2])
+        table.append((stage, sum(row[2] for row in rows), rows))
+    table.sort(key=lambda entry: -entry[1])
+    return table
+
+
+def critical_path(spans, dependencies):
+    """
+    The chain of dependent tasks with the largest total runtime, given the (start, end) span of every task that ran and the dependencies of the DAG
+    (Pipeline.dependencies). Tasks without records (e.g., skipped as up to date) take no time. Returns the task names from the first to the last.
+    """
+    length, previous = OrderedDict(), {}
+    for name, upstream in dependencies.items():
+        duration = spans[name][1] - spans[name][0] if name in spans else 0.0
+        best = max(upstream, key=lambda dep: length[dep], default=None)
+        length[name] = duration + (length[best] if best else 0.0)
+        previous[name] = best
+    name = max(length, key=length.get, default=None)
+    path = []
+    while name:
+        path.append(name)
+        name = previous[name]
+    return path[::-1]
+
+
+def bar(start, end, origin, span):
+    # An ASCII bar placing [start, end] within [origin, origin + span].
+    first = int((start - origin) / span * BAR_WIDTH) if span else 0
+    last = max(first + 1, int(round((end - origin) / span * BAR_WIDTH))) if span else 1
+    return " " * first + "#" * (last - first) + " " * (BAR_WIDTH - last)
+
+
+def gigabytes(count):
+    return "%.1f" % (count / 2.0 ** 30)
+
+
+def report(directory, graph_path=None, top=10):
+    records = latest_runs(read_records(directory))
+    if not records:
+        raise SystemExit("No telemetry records in " + directory + ".")
+    spans = task_spans(records)
+    origin = min(start for start, _ in spans.values())
+    span = max(end for _, end in spans.values()) - origin
+    lines = [str(len(records)) + " commands of " + str(len(spans)) + " tasks over " + "%.0f" % span + " s (" + "%.2f" % (span / 3600.0) + " h).", ""]
+    lines.append("Hot spots by stage (total wall time of every command):")
+    for stage, total, rows in hot_spots(records):
+        lines.append("")
+        lines.append(stage + ": " + "%.0f" % total + " s of commands")
+        lines.append("  %-24s %6s %10s %8s %8s %6s %9s %8s %8s %6s" % ("command", "runs", "wall (s)", "mean", "max", "share", "CPU (s)", "RSS (MB)", "R/W (GB)", "failed"))
+        for command, runs, wall, mean, longest, cpu, rss, read, written, failures in rows[:top]:
+            lines.append("  %-24s %6d %10.0f %8.1f %8.1f %5.1f%% %9.0f %8.0f %8s %6d" % (command[:24], runs, wall, mean, longest, 100.0 * wall / total if total else 0.0,
+                                                                                         cpu, rss, gigabytes(read) + "/" + gigabytes(written), failures))
+    lines += ["", "Timeline of the stages (first start to last end):"]
+    stages = OrderedDict()
+    for record in records:
+        start, end = stages.get(record["stage"], (record["start"], record["start"] + record["wall"]))
+        stages[record["stage"]] = (min(start, record["start"]), max(end, record["start"] + record["wall"]))
+    for stage, (start, end) in stages.items():
+        lines.append("  %-20s |%s| %8.0f s" % (stage[:20], bar(start, end, origin, span), end - start))
+    if graph_path:
+        # Imported here so the run mode does not need the graph.
+        from Pipeline_DAG import Pipeline
+        pipeline = Pipeline.load(graph_path)
+        dependencies = pipeline.dependencies()
+        ordered = OrderedDict((name, dependencies[name]) for name in pipeline.topological_order())
+        path = critical_path(spans, ordered)
+        busy = sum(spans[name][1] - spans[name][0] for name in path if name in spans)
+        lines += ["", "Critical path (" + "%.0f" % busy + " s of work; the rest of the " + "%.0f" % span + " s is queueing and gaps):"]
+        for name in path:
+            if name in spans:
+                start, end = spans[name]
+                lines.append("  %-20s |%s| %8.0f s" % (name[:20], bar(start, end, origin, span), end - start))
+            else:
+                lines.append("  %-20s |%s| %8s" % (name[:20], " " * BAR_WIDTH, "skipped"))
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) > 1 and sys.argv[1] == "run":
+        # run <directory> <task> <stage> <specimen> -- <command>; parsed by hand, so the command line reaches Bash untouched.
+        if len(sys.argv) != 8 or sys.argv[6] != "--":
+            raise SystemExit("Usage: Telemetry.py run <directory> <task> <stage> <specimen> -- <command>")
+        sys.exit(run(*sys.argv[2:6], sys.argv[7]))
+
+    parser = argparse.ArgumentParser(description="Report the per-command telemetry of a pipeline run.")
+    parser.add_argument('action', choices=['report'])
+    parser.add_argument('directory', help='Telemetry directory (Telemetry_path of the generator)')
+    parser.add_argument('--graph', default=None, help='Graph of the pipeline (e.g., Atlas_Graph.json), to report the critical path')
+    parser.add_argument('--top', type=int, default=10, help='Commands listed per stage')
+    args = parser.parse_args()
+
+    print(report(args.directory, args.graph, args.top))
@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+
+"""
+This script reads MNI transformation files (.xfm) into objects that can be concatenated, inverted, and applied to points in memory, in place of the xfmconcat
+and xfminvert calls that chain the lsq6, lsq12, and non-linear transformations of every specimen.
+
+A transformation is a list of parts applied in order: linear parts (the 3 x 4 matrix of Linear_Transform) and grid parts (the displacement volume of a
+Grid_Transform, possibly inverted). Linear parts are read as exact fractions of their decimal digits, so concatenating and inverting them is exact (adjacent
+linear parts are multiplied into one, and an identity between two grids is dropped); they are only rounded to the nearest double when written. Grid parts are
+only references: concatenating or inverting a transformation never reads or copies its displacement volumes (xfmconcat and xfminvert copy every grid next to
+their output), and a grid is only loaded when points are transformed by it. A written grid part points to the displacement volume of its source file,
+relative to the directory of the output as the MINC Toolkit resolves it, so the source transformation must be kept as long as the output is used. Where the
+inverse of a non-linear transformation was written by its registration (e.g., the inverse warp of ANTS), concat can use it for the inverse of a
+concatenation instead of an inverted grid, which every reader of the inverse would otherwise invert point by point.
+
+Points are transformed through a grid part by trilinear interpolation of its displacement (zero outside of the grid), reading only the hyperslab of the grid
+around the points, and through an inverted grid part by fixed-point iteration (x = y - d(x)), as the MINC Toolkit does. The grid is assumed to be aligned with the world axes (no direction cosines), which holds for the
+grids minctracc and mincANTS write.
+
+python3 XFM_Algebra.py concat <xfm> [<xfm> ...] <output> [--inverse <inverse output> [--known-inverse <xfm> <inverse of xfm> ...]]
+python3 XFM_Algebra.py invert <xfm> <output>
+python3 XFM_Algebra.py show <xfm>
+python3 XFM_Algebra.py apply <xfm> [--invert] < points (x y z per line, in world coordinates)
+python3 XFM_Algebra.py selftest
+
+Dependencies required: none for concat, invert, and show; apply needs numpy, and pyminc (pip install numpy pyminc) for transformations with grid parts.
+"""
+
+import argparse
+import os
+import sys
+from fractions import Fraction
+from itertools import product
+
+try:
+    import numpy as np
+except ImportError:
+    # concat, invert, and show only handle the matrices and the references to the grids.
+    np = None
+try:
+    from pyminc.volumes.factory import volumeFromFile
+except ImportError:
+    volumeFromFile = None
+
+HEADER = "MNI Transform File"
+# Iterations and tolerance (mm) of the fixed-point inversion of a displacement grid.
+INVERSE_ITERATIONS = 20
+INVERSE_TOLERANCE = 1e-4
+
+
+def number(value):
+    # The shortest decimal that reads back as the nearest double of an exact value.
+    text = repr(float(value))
+    if text.endswith(".0"):
+        text = text[:-2]
+    return "0" if text == "-0" else text
+
+
+class Linear:
+    """A linear part: the 3 x 4 matrix [A | t] of exact fractions, mapping x to A x + t."""
+
+    def __init__(self, matrix):
+        self.matrix = [[Fraction(value) for value in row] for row in matrix]
+
+    @classmethod
+    def identity(cls):
+        return cls([[1 if row == column else 0 for column in range(4)] for row in range(3)])
+
+    def is_identity(self):
+        return self.matrix == Linear.identity().matrix
+
+    def then(self, other):
+        # The part applying self, then other: [B | u] [A | t] = [BA | Bt + u].
+        A, B = self.matrix, other.matrix
+        return Linear([[sum(B[row][k] * A[k][column] for k in range(3)) + (B[row][3] if column == 3 else 0) for column in range(4)] for row in range(3)])
+
+    def inverse(self):
+        # Gauss-Jordan elimination over the fractions: [A | t]^-1 = [A^-1 | -A^-1 t].
+        rows = [self.matrix[row][:3] + [1 if row == column else 0 for column in range(3)] for row in range(3)]
+        for column in range(3):
+            pivot = next((row for row in range(column, 3) if rows[row][column] != 0), None)
+            if pivot is None:
+                raise ValueError("The linear transformation is singular.")
+            rows[column], rows[pivot] = rows[pivot], rows[column]
+            rows[column] = [value / rows[column][column] for value in rows[column]]
+            for row in range(3):
+                if row != column and rows[row][column] != 0:
+                    factor = rows[row][column]
+                    rows[row] = [value - factor * pivot_value for value, pivot_value in zip(rows[row], rows[column])]
+        inverse = [row[3:] for row in rows]
+        return Linear([inverse[row] + [-sum(inverse[row][k] * self.matrix[k][3] for k in range(3))] for row in range(3)])
+
+    def apply(self, points):
+        matrix = np.array([[float(value) for value in row] for row in self.matrix])
+        return points @ matrix[:, :3].T + matrix[:, 3]
+
+    def lines(self, directory=None):
+        return ["Transform_Type = Linear;", "Linear_Transform ="] + [" " + " ".join(number(value) for value in row) + (";" if row is self.matrix[-1] else "")
+                                                                     for row in self.matrix]
+
+
+class Grid:
+    """A grid part: a reference to a displacement volume (x -> x + d(x)), inverted or not. The volume is only read to transform points."""
+
+    def __init__(self, path, inverted=False):
+        self.path = os.path.abspath(path)
+        self.inverted = inverted
+        self.field = None
+
+    def inverse(self):
+        return Grid(self.path, not self.inverted)
+
+    def load(self, lower=None, upper=None):
+        """
+        The displacements as an (x, y, z, 3) array of floats, with the world coordinates of its first voxel and the voxel steps along x, y, and z: of the whole
+        grid (kept for later calls), or, with the corners of a world box, of the voxels around the box only, read as a hyperslab.
+        """
+        if self.field is not None:
+            return self.field
+        if volumeFromFile is None:
+            raise ImportError("Transforming points through a displacement grid needs pyminc (pip install pyminc).")
+        volume = volumeFromFile(self.path, dtype='double')
+        names = list(volume.dimnames)
+        order = [names.index(name) for name in ("xspace", "yspace", "zspace", "vector_dimension")]
+        starts = np.array([volume.starts[index] for index in order[:3]])
+        steps = np.array([volume.separations[index] for index in order[:3]])
+        sizes = np.array([volume.sizes[index] for index in order[:3]])
+        first, counts = np.zeros(3, dtype=int), sizes
+        if lower is not None:
+            # One voxel beyond the box on every side, so every point of the box has its eight neighbours.
+            corners = (np.array([lower, upper], dtype=np.float64) - starts) / steps
+            first = np.clip(np.floor(corners.min(axis=0)).astype(int) - 1, 0, sizes - 1)
+            counts = np.clip(np.ceil(corners.max(axis=0)).astype(int) + 1, 0, sizes - 1) - first + 1
+        start, count = [0] * 4, list(volume.sizes)
+        for axis, index in enumerate(order[:3]):
+            start[index], count[index] = int(first[axis]), int(counts[axis])
+        data = np.transpose(np.array(volume.getHyperslab(start, count, dtype='double'), dtype=np.float64), order)
+        volume.closeVolume()
+        field = (data, starts + first * steps, steps)
+        if lower is None:
+            self.field = field
+        return field
+
+    def displacement(self, points, field=None):
+        # Trilinear interpolation of the displacement at every point (from field, or from the whole grid); points outside of the grid are not displaced.
+        data, starts, steps = field or self.load()
+        voxels = (points - starts) / steps
+        shape = np.array(data.shape[:3])
+        inside = np.all((voxels >= 0) & (voxels <= shape - 1), axis=1)
+        base = np.clip(np.floor(voxels).astype(int), 0, np.maximum(shape - 2, 0))
+        weights = voxels - base
+        result = np.zeros(points.shape)
+        for corner in product((0, 1), repeat=3):
+            index = np.minimum(base + corner, shape - 1)
+            weight = np.prod(np.where(corner, weights, 1.0 - weights), axis=1)
+            result += weight[:, None] * data[index[:, 0], index[:, 1], index[:, 2]]
+        result[~inside] = 0.0
+        return result
+
+    def apply(self, points):
+        # A forward grid only reads the voxels around the points (e.g., the landmarks of a specimen); the fixed-point iteration of an inverted grid moves the
+        # points, so it reads the whole grid.
+        if not len(points):
+            return points
+        if not self.inverted:
+            return points + self.displacement(points, self.load(points.min(axis=0), points.max(axis=0)))
+        result = points - self.displacement(points)
+        for _ in range(INVERSE_ITERATIONS):
+            update = points - self.displacement(result)
+            change = np.max(np.abs(update - result)) if len(points) else 0.0
+            result = update
+            if change < INVERSE_TOLERANCE:
+                break
+        return result
+
+    def lines(self, directory=None):
+        path = os.path.relpath(self.path, directory) if directory is not None else self.path
+        return ["Transform_Type = Grid_Transform;", "Displacement_Volume = " + path + ";"] + (["Invert_Flag = True;"] if self.inverted else [])
+
+
+class Transform:
+    """A list of linear and grid parts, applied in order. Adjacent linear parts are multiplied into one as they are added."""
+
+    def __init__(self, parts=()):
+        self.parts = []
+        for part in parts:
+            self.append(part)
+
+    def append(self, part):
+        if isinstance(part, Linear) and self.parts and isinstance(self.parts[-1], Linear):
+            part = self.parts.pop().then(part)
+        if isinstance(part, Linear) and part.is_identity() and self.parts:
+            return
+        if not isinstance(part, Linear) and len(self.parts) == 1 and isinstance(self.parts[0], Linear) and self.parts[0].is_identity():
+            self.parts.pop()
+        self.parts.append(part)
+
+    def then(self, other):
+        return Transform(self.parts + other.parts)
+
+    def inverse(self):
+        return Transform([part.inverse() for part in reversed(self.parts)])
+
+    def linear(self):
+        # The single linear part of a transformation without grids (the identity if it has no parts), or None.
+        if any(not isinstance(part, Linear) for part in self.parts):
+            return None
+        return self.parts[0] if self.parts else Linear.identity()
+
+    def apply(self, points):
+        # Transform an (N, 3) array of world coordinates.
+        if np is None:
+            raise ImportError("Transforming points needs numpy (pip install numpy).")
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        for part in self.parts:
+            points = part.apply(points)
+        return points
+
+    def text(self, path=None, comment=None):
+        directory = os.path.dirname(os.path.abspath(path)) if path else None
+        lines = [HEADER] + (["%" + line for line in comment.split("\n")] if comment else []) + [""]
+        for part in self.parts or [Linear.identity()]:
+            lines += part.lines(directory)
+        return "\n".join(lines) + "\n"
+
+    def write(self, path, comment=None):
+        # Written through a temporary file, so a concurrent reader never sees half of a transformation.
+        with open(path + ".tmp", 'w') as handle:
+            handle.write(self.text(path, comment))
+        os.replace(path + ".tmp", path)
+
+
+def parse(text, directory="."):
+    """Parse the text of a .xfm file. Relative displacement volumes are resolved from directory (that of the file), as the MINC Toolkit does."""
+    lines = text.split("\n")
+    if not lines or lines[0].strip() != HEADER:
+        raise ValueError("Not an MNI transformation file (the first line is not \"" + HEADER + "\").")
+    body = " ".join(line for line in lines[1:] if not line.lstrip().startswith("%"))
+    parts, kind, fields = [], None, {}
+
+    def close():
+        if kind is None:
+            return
+        inverted = fields.get("Invert_Flag", "False").strip() == "True"
+        if kind == "Linear":
+            values = fields.get("Linear_Transform", "").split()
+            if len(values) != 12:
+                raise ValueError("A linear transformation needs 12 values, not " + str(len(values)) + ".")
+            part = Linear([values[row * 4:row * 4 + 4] for row in range(3)])
+            parts.append(part.inverse() if inverted else part)
+        elif kind == "Grid_Transform":
+            volume = fields.get("Displacement_Volume", "").strip()
+            if not volume:
+                raise ValueError("A grid transformation needs a Displacement_Volume.")
+            parts.append(Grid(os.path.join(directory, volume), inverted))
+        else:
+            raise ValueError("Transformations of type " + kind + " are not supported.")
+
+    for statement in body.split(";"):
+        if "=" not in statement:
+            continue
+        key, _, value = statement.partition("=")
+        key = key.strip()
+        if key == "Transform_Type":
+            close()
+            kind, fields = value.strip(), {}
+        else:
+            fields[key] = value
+    close()
+    return Transform(parts)
+
+
+def read(path):
+    with open(path) as handle:
+        return parse(handle.read(), os.path.dirname(os.path.abspath(path)))
+
+
+def concat(paths, output, inverse_output=None, known_inverses=None):
+    """
+    Concatenate the transformations of paths (applied in order) into output, and optionally its inverse into inverse_output. known_inverses maps a path to a
+    file holding its inverse (e.g., the inverse warp ANTS writes next to its forward warp), which then replaces the inverted grids of that path in the inverse.
+    """
+    transform, inverse = Transform(), Transform()
+    known_inverses = known_inverses or {}
+    for path in paths:
+        part = read(path)
+        transform = transform.then(part)
+        inverse = (read(known_inverses[path]) if path in known_inverses else part.inverse()).then(inverse)
+    transform.write(output, "Concatenated from " + " ".join(paths) + " by XFM_Algebra.py")
+    if inverse_output:
+        inverse.write(inverse_output, "Inverse of " + output + " by XFM_Algebra.py" +
+                      "".join(", with " + known_inverses[path] + " as the inverse of " + path for path in paths if path in known_inverses))
+    return transform
+
+
+def selftest():
+    """
+    Check the linear algebra: a chain of rotations, scales, shears, and translations with decimal entries composed with its inverse must give the identity
+    exactly, and a concatenation written and read again must match the product of its parts to double precision, with its grid references kept.
+    """
+    import math
+    import tempfile
+    parts = []
+    for index in range(1, 7):
+        angle = 0.3 * index
+        cos, sin = Fraction(repr(math.cos(angle))), Fraction(repr(math.sin(angle)))
+        scale, shear = Fraction(1) + Fraction(index, 40), Fraction(index, 97)
+        parts.append(Linear([[cos * scale, -sin, shear, Fraction(index * 3, 7)], [sin, cos * scale, 0, Fraction(-index, 3)], [0, shear, scale, Fraction("0.125")]]))
+    chain = Transform(parts)
+    exact = chain.then(chain.inverse()).linear().is_identity()
+    with tempfile.TemporaryDirectory() as directory:
+        paths = []
+        for index, part in enumerate(parts[:3] + [Grid(os.path.join(directory, "nl_grid_0.mnc"))] + parts[3:]):
+            paths.append(os.path.join(directory, "part_%d.xfm" % index))
+            Transform([part]).write(paths[-1])
+        output = os.path.join(directory, "output", "concat.xfm")
+        os.makedirs(os.path.dirname(output))
+        concat(paths, output, output[:-len(".xfm")] + "_inverted.xfm")
+        written, inverted = read(output), read(output[:-len(".xfm")] + "_inverted.xfm")
+        expected = [Transform(parts[:3]).linear(), Transform(parts[3:]).linear()]
+        error = max(abs(float(value) - float(reference)) for part, linear in zip(written.parts[::2], expected)
+                    for row, reference_row in zip(part.matrix, linear.matrix) for value, reference in zip(row, reference_row))
+        grids = (len(written.parts) == 3 and written.parts[1].path == os.path.join(directory, "nl_grid_0.mnc") and not written.parts[1].inverted and
+                 len(inverted.parts) == 3 and inverted.parts[1].inverted and "../nl_grid_0.mnc" in open(output).read())
+    print("Composed " + str(len(parts)) + " linear transformations with their inverse: " + ("exactly the identity" if exact else "not the identity") +
+          "; concatenation written and read again: largest difference " + "%.1e" % error + ", grid references " + ("kept" if grids else "lost") + ".")
+    return exact and grids and error < 1e-12
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Concatenate, invert, and apply MNI transformations (.xfm) without copying their displacement grids.")
+    parser.add_argument('action', choices=['concat', 'invert', 'show', 'apply', 'selftest'])
+    parser.add_argument('paths', nargs='*', help='concat: transformations and output; invert: transformation and output; show and apply: transformation')
+    parser.add_argument('--inverse', default=None, help='concat: also write the inverse of the concatenation')
+    parser.add_argument('--known-inverse', nargs=2, action='append', default=[], metavar=('XFM', 'INVERSE'),
+                        help='concat: a file holding the inverse of one of the transformations, used for the inverse instead of inverting it')
+    parser.add_argument('--invert', action='store_true', help='apply: transform the points by the inverse')
+    args = parser.parse_args()
+
+    if args.action == 'selftest':
+        raise SystemExit(0 if selftest() else 1)
+    if len(args.paths) < {'concat': 2, 'invert': 2, 'show': 1, 'apply': 1}[args.action]:
+        parser.error(args.action + " needs more paths")
+    if args.action == 'concat':
+        concat(args.paths[:-1], args.paths[-1], args.inverse, dict(args.known_inverse))
+    elif args.action == 'invert':
+        read(args.paths[0]).inverse().write(args.paths[1], "Inverse of " + args.paths[0] + " by XFM_Algebra.py")
+    elif args.action == 'show':
+        sys.stdout.write(read(args.paths[0]).text())
+    else:
+        transform = read(args.paths[0])
+        if args.invert:
+            transform = transform.inverse()
+        points = [[float(value) for value in line.split()[:3]] for line in sys.stdin if line.strip()]
+        for point in transform.apply(points):
+            print(" ".join("%.6f" % value for value in point))
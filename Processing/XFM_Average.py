@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+
+"""
+This script averages the pairwise 12-parameter transformations of the atlas construction for every specimen at once, in place of one xfmavg call per specimen
+(lsq12_Fourth), each of which reads its N transformations from the command line.
+
+The task of the graph (see Pipeline_DAG.py) lists every pairwise transformation (<SpecID>_to_<SpecID2>_lsq12_2.xfm) as an input and every average
+(<SpecID>_lsq12_AVG.xfm) as an output. The transformations are read into one (N, N, 4, 4) array of homogeneous matrices (missing pairs of a sparse design are
+masked out), and the average of every row is the log-Euclidean mean exp(mean(log M)) of its matrices, the mean of the matrix logarithms that xfmavg also
+takes for linear transformations. The logarithms and exponentials are computed for all matrices together: the logarithm by inverse scaling and squaring
+(Denman-Beavers square roots until the matrices are close to the identity, then the series of 2 atanh), the exponential by scaling and squaring of its Taylor
+series. The averages are written with XFM_Algebra.py.
+
+python3 XFM_Average.py lsq12 --graph Atlas_Graph.json --task <average task> [--gate <state>]
+python3 XFM_Average.py selftest
+
+Dependencies required: numpy (pip install numpy).
+"""
+
+import argparse
+import json
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+from XFM_Algebra import Linear, Transform, read
+
+PAIR_SUFFIX = "_lsq12_2.xfm"
+AVERAGE_SUFFIX = "_lsq12_AVG.xfm"
+# Matrices whose logarithms are computed together; bounds the memory of the temporaries (a few hundred megabytes).
+CHUNK = 65536
+# The logarithm series is used once every matrix is within this distance (largest absolute entry) of the identity; 8 terms of 2 atanh are then exact to double precision.
+LOG_RADIUS = 0.25
+LOG_TERMS = 8
+SQRT_ITERATIONS = 50
+MAX_SQUARE_ROOTS = 40
+EXP_TERMS = 18
+
+
+def homogeneous(path):
+    # The 4 x 4 matrix of a linear transformation file.
+    linear = read(path).linear()
+    if linear is None:
+        raise ValueError(path + " is not a linear transformation.")
+    return np.array([[float(value) for value in row] for row in linear.matrix] + [[0.0, 0.0, 0.0, 1.0]])
+
+
+def sqrtm(matrices):
+    # Principal square roots of a stack of matrices by the Denman-Beavers iteration.
+    Y, Z = matrices.copy(), np.broadcast_to(np.eye(matrices.shape[-1]), matrices.shape).copy()
+    for _ in range(SQRT_ITERATIONS):
+        Y_Next, Z = 0.5 * (Y + np.linalg.inv(Z)), 0.5 * (Z + np.linalg.inv(Y))
+        change = np.max(np.abs(Y_Next - Y)) if len(Y) else 0.0
+        Y = Y_Next
+        if change < 1e-15 * max(1.0, np.max(np.abs(Y))):
+            break
+    return Y
+
+
+def logm(matrices):
+    # Principal logarithms of a stack of matrices (without eigenvalues on the closed negative real axis): log M = 2^k log M^(1/2^k).
+    identity = np.eye(matrices.shape[-1])
+    roots, k = matrices, 0
+    while len(roots) and np.max(np.abs(roots - identity)) > LOG_RADIUS and k < MAX_SQUARE_ROOTS:
+        roots, k = sqrtm(roots), k + 1
+    # log X = 2 atanh(Z) = 2 (Z + Z^3 / 3 + Z^5 / 5 + ...), with Z = (X - I)(X + I)^-1.
+    Z = (roots - identity) @ np.linalg.inv(roots + identity)
+    Z2, term, total = Z @ Z, Z, Z.copy()
+    for n in range(1, LOG_TERMS):
+        term = term @ Z2
+        total += term / (2 * n + 1)
+    return 2.0 ** (k + 1) * total
+
+
+def expm(matrices):
+    # Exponentials of a stack of matrices: exp(A) = exp(A / 2^s)^(2^s), with the Taylor series of the scaled matrices.
+    norm = np.max(np.abs(matrices)) * matrices.shape[-1] if len(matrices) else 0.0
+    s = max(0, int(np.ceil(np.log2(norm))) + 1) if norm > 0.5 else 0
+    scaled = matrices / 2.0 ** s
+    term, total = np.broadcast_to(np.eye(matrices.shape[-1]), matrices.shape).copy(), np.broadcast_to(np.eye(matrices.shape[-1]), matrices.shape).copy()
+    for n in range(1, EXP_TERMS):
+        term = term @ scaled / n
+        total += term
+    for _ in range(s):
+        total = total @ total
+    return total
+
+
+def log_euclidean_means(matrices, mask):
+    """
+    The log-Euclidean mean of every row of an (N, M, 4, 4) array of matrices, over the entries where the (N, M) mask is True. The logarithms are computed
+    CHUNK matrices at a time.
+    """
+    N, M = matrices.shape[:2]
+    flat, flat_mask = matrices.reshape(-1, 4, 4), mask.reshape(-1)
+    sums = np.zeros((N, 4, 4))
+    for start in range(0, len(flat), CHUNK):
+        present = np.nonzero(flat_mask[start:start + CHUNK])[0] + start
+        if len(present):
+            np.add.at(sums, present // M, logm(flat[present]))
+    counts = mask.sum(axis=1)
+    if np.any(counts == 0):
+        raise ValueError("Every specimen needs at least one transformation to average.")
+    return expm(sums / counts[:, None, None])
+
+
+def pair_plan(graph_path, task):
+    # The (SpecID, output) averages of the task and the (SpecID, SpecID2, path) pairwise transformations it reads, from the graph of the pipeline.
+    with open(graph_path) as graph:
+        entry = next(entry for entry in json.load(graph)["tasks"] if entry["name"] == task)
+    outputs = OrderedDict((os.path.basename(path)[:-len(AVERAGE_SUFFIX)], path) for path in entry["outputs"] if path.endswith(AVERAGE_SUFFIX))
+    pairs = []
+    for path in entry["inputs"]:
+        name = os.path.basename(path)
+        if not name.endswith(PAIR_SUFFIX):
+            continue
+        # Specimen IDs may contain "_to_" themselves, so the pair is split where both sides are specimens of the task.
+        parts = name[:-len(PAIR_SUFFIX)].split("_to_")
+        split = [("_to_".join(parts[:index]), "_to_".join(parts[index:])) for index in range(1, len(parts))]
+        split = [(SpecID, SpecID2) for SpecID, SpecID2 in split if SpecID in outputs and SpecID2 in outputs]
+        if len(split) != 1:
+            raise ValueError("Cannot tell the specimens of " + path + ".")
+        pairs.append(split[0] + (path,))
+    return outputs, pairs
+
+
+def average_lsq12(graph_path, task, gate=None):
+    """
+    Average the pairwise transformations of every specimen of the task and write the averages. With the state of a quality gate (see Quality_Gate.py), the
+    quarantined specimens and their pairs are left out.
+    """
+    outputs, pairs = pair_plan(graph_path, task)
+    if gate:
+        from Quality_Gate import quarantine
+        IDs = quarantine(gate)
+        outputs = OrderedDict((SpecID, path) for SpecID, path in outputs.items() if SpecID not in IDs)
+        pairs = [pair for pair in pairs if pair[0] not in IDs and pair[1] not in IDs]
+    index = {SpecID: position for position, SpecID in enumerate(outputs)}
+    N = len(outputs)
+    matrices = np.broadcast_to(np.eye(4), (N, N, 4, 4)).copy()
+    mask = np.zeros((N, N), dtype=bool)
+    for SpecID, SpecID2, path in pairs:
+        matrices[index[SpecID], index[SpecID2]] = homogeneous(path)
+        mask[index[SpecID], index[SpecID2]] = True
+    means = log_euclidean_means(matrices, mask)
+    for (SpecID, path), mean in zip(outputs.items(), means):
+        Transform([Linear(mean[:3].tolist())]).write(path, "Log-Euclidean mean of " + str(int(mask[index[SpecID]].sum())) + " transformations by XFM_Average.py")
+    print("Averaged " + str(len(pairs)) + " pairwise transformations into " + str(N) + " averages.")
+
+
+def selftest(count=40, seed=1):
+    """
+    Check the batched logarithm and exponential: exp(log M) must give M back for random 12-parameter transformations (rotations, scales, shears, and
+    translations of several millimetres), and the mean of a row of commuting matrices (scalings along one axis) must be their geometric mean.
+    """
+    rng = np.random.default_rng(seed)
+    matrices = []
+    for _ in range(count):
+        angles = rng.normal(0.0, 0.3, 3)
+        rotation = np.eye(3)
+        for axis, angle in enumerate(angles):
+            plane = [other for other in range(3) if other != axis]
+            turn = np.eye(3)
+            turn[np.ix_(plane, plane)] = [[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]]
+            rotation = turn @ rotation
+        affine = np.eye(4)
+        affine[:3, :3] = rotation @ (np.diag(rng.uniform(0.7, 1.3, 3)) + np.triu(rng.normal(0.0, 0.05, (3, 3)), 1))
+        affine[:3, 3] = rng.normal(0.0, 5.0, 3)
+        matrices.append(affine)
+    matrices = np.array(matrices)
+    error = float(np.max(np.abs(expm(logm(matrices)) - matrices)))
+    scales = rng.uniform(0.8, 1.25, count)
+    diagonal = np.array([np.diag([scale, 1.0, 1.0, 1.0]) for scale in scales])
+    mean = log_euclidean_means(diagonal[None], np.ones((1, count), dtype=bool))[0]
+    geometric = float(np.exp(np.mean(np.log(scales))))
+    mean_error = abs(mean[0, 0] - geometric) + float(np.max(np.abs(mean[1:, 1:] - np.eye(3))))
+    print("exp(log M) of " + str(count) + " random 12-parameter transformations: largest difference " + "%.1e" % error +
+          "; log-Euclidean mean of commuting scalings: difference to the geometric mean " + "%.1e" % mean_error + ".")
+    return error < 1e-9 and mean_error < 1e-12
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Average the pairwise lsq12 transformations of every specimen in one pass.")
+    parser.add_argument('action', choices=['lsq12', 'selftest'])
+    parser.add_argument('--graph', default=None, help='Graph of the pipeline (e.g., Atlas_Graph.json)')
+    parser.add_argument('--task', default=None, help='Task of the graph whose inputs are the pairwise transformations and whose outputs are the averages')
+    parser.add_argument('--gate', default=None, help='State of the quality gate whose quarantined specimens are left out')
+    args = parser.parse_args()
+
+    if args.action == 'selftest':
+        raise SystemExit(0 if selftest() else 1)
+    if not (args.graph and args.task):
+        parser.error("lsq12 needs --graph and --task")
+    average_lsq12(args.graph, args.task, args.gate)